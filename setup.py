@@ -13,6 +13,7 @@ setuptools.setup(
             "structural-info = zernikegrams.structural_info.get_structural_info:main",
             "neighborhoods = zernikegrams.neighborhoods.get_neighborhoods:main",
             "zernikegrams = zernikegrams.holograms.get_holograms:main",
+            "zernikegrams-from-structural-info = zernikegrams.holograms.get_holograms_from_structural_info:main",
             "noise-neighborhoods = zernikegrams.add_noise.get_noised_nh:main"
         ]
     },
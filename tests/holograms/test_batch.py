@@ -0,0 +1,105 @@
+import numpy as np
+
+from zernikegrams.structural_info import get_structural_info_fn
+from zernikegrams.neighborhoods import get_neighborhoods_fn
+from zernikegrams.holograms import get_holograms_fn, get_zernikegrams_from_structural_info_fn
+
+
+get_structural_info_kwargs = {'padded_length': None,
+                              'parser': 'biopython',
+                              'SASA': True,
+                              'charge': True,
+                              'DSSP': False,
+                              'angles': False,
+                              'fix': False,
+                              'hydrogens': False,
+                              'extra_molecules': True,
+                              'multi_struct': 'warn'}
+
+get_neighborhoods_kwargs = {'r_max': 10.0,
+                            'remove_central_residue': False,
+                            'remove_central_sidechain': True,
+                            'backbone_only': False}
+
+get_zernikegrams_kwargs = {'r_max': 10.0,
+                           'radial_func_mode': 'ks',
+                           'radial_func_max': 10,
+                           'Lmax': 5,
+                           'channels': ['C', 'N', 'O', 'S', 'H', 'SASA', 'charge'],
+                           'request_frame': False,
+                           'rst_normalization': 'square'}
+
+
+def test_fused_matches_two_stage():
+    proteins = get_structural_info_fn('tests/data/pdbs/2fe3.pdb', **get_structural_info_kwargs)
+
+    neighborhoods = get_neighborhoods_fn(proteins, **get_neighborhoods_kwargs)
+    two_stage = get_holograms_fn(neighborhoods, **get_zernikegrams_kwargs)
+
+    fused = get_zernikegrams_from_structural_info_fn(
+        proteins,
+        remove_central_sidechain=True,
+        **get_zernikegrams_kwargs,
+    )
+
+    assert np.all(two_stage['res_id'] == fused['res_id'])
+    assert np.all(two_stage['label'] == fused['label'])
+    assert np.allclose(two_stage['zernikegram'], fused['zernikegram'], rtol=1e-4, atol=1e-5)
+
+
+def test_batch_callbacks_match_single():
+    from zernikegrams.neighborhoods.get_neighborhoods import get_padded_neighborhoods_batch
+    from zernikegrams.holograms.get_holograms import (
+        get_num_components,
+        get_zernikegram_dtype,
+        get_zernikegrams_from_neighborhoods,
+    )
+
+    proteins = get_structural_info_fn('tests/data/pdbs/2fe3.pdb', **get_structural_info_kwargs)
+    neighborhoods = get_neighborhoods_fn(proteins, **get_neighborhoods_kwargs)
+
+    pdbs, counts, batch_neighborhoods = get_padded_neighborhoods_batch(
+        np.concatenate([proteins, proteins]),
+        padded_length=1000,
+        unique_chains=False,
+        central_residue_only=False,
+        keep_central_CA=False,
+        **get_neighborhoods_kwargs,
+    )
+    assert counts.tolist() == [len(neighborhoods)] * 2
+    assert np.array_equal(batch_neighborhoods[: len(neighborhoods)], neighborhoods)
+    assert np.array_equal(batch_neighborhoods[len(neighborhoods) :], neighborhoods)
+
+    single = get_holograms_fn(neighborhoods, **get_zernikegrams_kwargs)
+
+    ks = np.arange(get_zernikegrams_kwargs['radial_func_max'] + 1)
+    num_components = get_num_components(
+        get_zernikegrams_kwargs['Lmax'], ks, False, 'ks', get_zernikegrams_kwargs['channels']
+    )
+    zernikegrams, res_ids, proportions = get_zernikegrams_from_neighborhoods(
+        neighborhoods,
+        get_zernikegrams_kwargs['Lmax'],
+        ks,
+        get_zernikegrams_kwargs['r_max'],
+        get_zernikegram_dtype(5, num_components),
+        mode='ks',
+        channels=get_zernikegrams_kwargs['channels'],
+        rst_normalization='square',
+    )
+
+    assert np.array_equal(res_ids, neighborhoods['res_id'])
+    assert np.all(proportions == -1.0)
+    assert np.all(single['res_id'] == zernikegrams['res_id'])
+    assert np.allclose(single['zernikegram'], zernikegrams['zernikegram'], rtol=1e-4, atol=1e-5)
+
+
+def test_fused_without_proteins():
+    proteins = get_structural_info_fn('tests/data/pdbs/2fe3.pdb', **get_structural_info_kwargs)
+
+    fused = get_zernikegrams_from_structural_info_fn(
+        proteins[:0],
+        remove_central_sidechain=True,
+        **get_zernikegrams_kwargs,
+    )
+
+    assert fused['zernikegram'].shape[0] == fused['res_id'].shape[0] == 0
@@ -0,0 +1,53 @@
+import numpy as np
+
+from zernikegrams.structural_info import get_structural_info_fn
+from zernikegrams.neighborhoods import get_neighborhoods_fn
+from zernikegrams.neighborhoods.neighborhoods_core import get_backbone_frames
+
+
+get_structural_info_kwargs = {'padded_length': None,
+                              'parser': 'biopython',
+                              'SASA': True,
+                              'charge': True,
+                              'DSSP': False,
+                              'angles': False,
+                              'fix': False,
+                              'hydrogens': False,
+                              'extra_molecules': True,
+                              'multi_struct': 'warn'}
+
+
+def test_backbone_frames_are_orthonormal():
+    rng = np.random.default_rng(0)
+    N_coords, CA_coords, C_coords = rng.normal(size=(3, 50, 3))
+
+    frames = get_backbone_frames(N_coords, CA_coords, C_coords)
+
+    assert frames.shape == (50, 3, 3)
+    assert np.allclose(np.einsum('rij,rkj->rik', frames, frames), np.eye(3))
+    x = (N_coords - CA_coords) / np.linalg.norm(N_coords - CA_coords, axis=-1, keepdims=True)
+    assert np.allclose(frames[:, 0], x)
+    # CA-C lies in the xy plane
+    assert np.allclose(np.einsum('ri,ri->r', frames[:, 2], C_coords - CA_coords), 0.0)
+
+
+def test_aligned_neighborhoods_are_in_the_stored_frame():
+    proteins = get_structural_info_fn('tests/data/pdbs/2fe3.pdb', **get_structural_info_kwargs)
+
+    kwargs = {'r_max': 10.0, 'coordinate_system': 'cartesian', 'store_frames': True}
+    nbs = get_neighborhoods_fn(proteins, **kwargs)
+    aligned = get_neighborhoods_fn(proteins, align_to_backbone_frame=True, **kwargs)
+
+    assert np.array_equal(nbs['res_id'], aligned['res_id'])
+    assert np.allclose(nbs['frame'], aligned['frame'])
+
+    # rotating the unaligned neighborhoods into the stored frames aligns them
+    rotated = np.einsum('naj,nij->nai', nbs['coords'], nbs['frame'])
+    assert np.allclose(rotated, aligned['coords'], atol=1e-4)
+
+    # in the aligned neighborhoods, the central N is on the x axis
+    for nb in aligned[:20]:
+        central = np.logical_and.reduce(nb['res_ids'] == nb['res_id'], axis=-1)
+        N_coords = nb['coords'][central & (nb['atom_names'] == b'N   ')]
+        assert np.allclose(N_coords[0, 1:], 0.0, atol=1e-5)
+        assert N_coords[0, 0] > 0
@@ -0,0 +1,73 @@
+import h5py
+import numpy as np
+
+from zernikegrams.structural_info import get_structural_info_fn
+from zernikegrams.neighborhoods.buckets import (
+    BucketedNeighborhoodsWriter,
+    assign_buckets,
+    bucket_neighborhoods,
+    iter_buckets,
+    read_neighborhood,
+)
+from zernikegrams.neighborhoods.neighborhoods_core import (
+    get_neighborhoods_from_protein,
+    pad_neighborhoods,
+)
+from zernikegrams.utils.hdf5_writer import BufferedHDF5Writer
+
+
+get_structural_info_kwargs = {'padded_length': None,
+                              'parser': 'biopython',
+                              'SASA': True,
+                              'charge': True,
+                              'DSSP': False,
+                              'angles': False,
+                              'fix': False,
+                              'hydrogens': False,
+                              'extra_molecules': True,
+                              'multi_struct': 'warn'}
+
+
+def test_assign_buckets():
+    lengths = np.array([1, 64, 65, 128, 129, 180, 181])
+    assert assign_buckets(lengths, [64, 128], 180).tolist() == [0, 0, 1, 1, 2, 2, -1]
+
+
+def test_bucketed_neighborhoods_round_trip(tmp_path):
+    proteins = get_structural_info_fn('tests/data/pdbs/2fe3.pdb', **get_structural_info_kwargs)
+    neighborhoods = get_neighborhoods_from_protein(proteins[0], remove_central_residue=False)
+    lengths = np.array([nh[1].shape[0] for nh in neighborhoods])
+    bucket_sizes = [int(np.percentile(lengths, 25)), int(np.percentile(lengths, 50))]
+    max_atoms = int(np.percentile(lengths, 90))
+
+    padded = pad_neighborhoods(neighborhoods, padded_length=np.max(lengths))
+
+    with h5py.File(tmp_path / 'nbs.hdf5', 'w') as f, BufferedHDF5Writer(f) as buffered_writer:
+        writer = BucketedNeighborhoodsWriter(buffered_writer, 'data', padded['res_id'].dtype, bucket_sizes, max_atoms)
+        # two proteins' worth of writes
+        half = len(neighborhoods) // 2
+        stored = [
+            writer.write(*bucket_neighborhoods(neighborhoods[:half], bucket_sizes, max_atoms)),
+            writer.write(*bucket_neighborhoods(neighborhoods[half:], bucket_sizes, max_atoms)),
+        ]
+        writer.close()
+    stored = np.concatenate(stored)
+
+    kept = lengths <= max_atoms
+    assert np.array_equal(stored, padded['res_id'][kept])
+
+    with h5py.File(tmp_path / 'nbs.hdf5', 'r') as f:
+        group = f['data']
+        assert group.attrs['num_dropped'] == np.sum(~kept)
+        assert group.attrs['num_overflow'] == np.sum(kept & (lengths > bucket_sizes[-1]))
+        assert np.array_equal(group['dropped'][:], padded['res_id'][~kept])
+
+        for row, nh in enumerate(padded[kept]):
+            bucketed = read_neighborhood(group, row)
+            width = bucketed['atom_names'].shape[0]
+            assert np.array_equal(bucketed['res_id'], nh['res_id'])
+            assert np.array_equal(bucketed['atom_names'], nh['atom_names'][:width])
+            assert np.array_equal(bucketed['coords'], nh['coords'][:width])
+
+    widths = {name: nhs['atom_names'].shape[1] for name, nhs in iter_buckets(tmp_path / 'nbs.hdf5', 'data')}
+    assert widths == {str(bucket_sizes[0]): bucket_sizes[0], str(bucket_sizes[1]): bucket_sizes[1], 'overflow': max_atoms}
@@ -0,0 +1,35 @@
+import numpy as np
+
+from zernikegrams.neighborhoods.neighborhoods_core import (
+    get_chain_sequences,
+    get_unique_chains,
+)
+
+
+def make_res_ids(chain, seq, atoms_per_residue):
+    res_ids = []
+    for resnum, (aa, num_atoms) in enumerate(zip(seq, atoms_per_residue)):
+        res_ids += [[aa, "1abc", chain, str(resnum), " ", "null"]] * num_atoms
+    return np.array(res_ids, dtype="S5")
+
+
+def test_chain_sequences_are_per_residue():
+    res_ids = np.vstack([
+        make_res_ids("A", "GAV", [4, 5, 7]),
+        make_res_ids("B", "GAV", [4, 5, 6]), # missing one atom, same sequence
+        make_res_ids("C", "GAW", [4, 5, 7]),
+    ])
+
+    assert get_chain_sequences(res_ids) == {b"A": b"GAV", b"B": b"GAV", b"C": b"GAW"}
+    assert get_unique_chains(res_ids) == [b"A", b"C"]
+
+
+def test_non_canonical_residues_are_ignored():
+    res_ids = np.vstack([
+        make_res_ids("B", "GAV", [4, 5, 7]),
+        make_res_ids("A", "GXAV", [4, 1, 5, 7]),
+        make_res_ids("C", "X", [1]),
+    ])
+
+    assert get_chain_sequences(res_ids) == {b"A": b"GAV", b"B": b"GAV"}
+    assert get_unique_chains(res_ids) == [b"A"]
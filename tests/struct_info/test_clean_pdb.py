@@ -1,8 +1,21 @@
 from Bio.PDB import PDBParser
-from zernikegrams.structural_info.RaSP import clean_pdb
-from zernikegrams.structural_info.structural_info_core import REDUCER
+from zernikegrams.structural_info.RaSP import (
+    clean_pdb,
+    clean_structure,
+    warm_up,
+)
+from zernikegrams.structural_info.structural_info_core import (
+    REDUCER,
+    WHITEOUT,
+    get_pdbfixer_dir,
+    relocate_pdbfixer,
+)
+import os
+import shutil
 import tempfile
 
+import pdbfixer
+
 def count_element_atoms(pdb_file, element="H"):
     parser = PDBParser(QUIET=True)
     structure = parser.get_structure('structure', pdb_file)
@@ -68,3 +81,70 @@ def test_yes_extra_molecules_keeps_FE():
 
         assert count_element_atoms(tmp.name, "FE") == 1 
             
+
+
+def test_clean_structure_in_memory_matches_file():
+    with open("tests/data/pdbs/1MBO.pdb", "rb") as f:
+        pdb_data = f.read()
+    model = clean_structure(
+        "archive.tar/1MBO.pdb",
+        REDUCER,
+        hydrogens=False,
+        extra_molecules=True,
+        pdb_data=pdb_data,
+    ).model
+
+    with tempfile.NamedTemporaryFile() as tmp:
+        clean_pdb(
+            "tests/data/pdbs/1MBO.pdb",
+            tmp.name,
+            REDUCER,
+            hydrogens=False,
+            extra_molecules=True
+        )
+        expected = PDBParser(QUIET=True).get_structure("structure", tmp.name)[0]
+
+        assert [atom.get_full_id()[2:] for atom in model.get_atoms()] == [
+            atom.get_full_id()[2:] for atom in expected.get_atoms()
+        ]
+
+def test_relocate_pdbfixer_removes_whiteout(tmp_path):
+    root = os.path.dirname(pdbfixer.pdbfixer.__file__)
+    shutil.copytree(root, tmp_path / "pdbfixer")
+    (tmp_path / "pdbfixer" / "templates" / WHITEOUT).touch()
+
+    get_pdbfixer_dir.cache_clear()
+    pdbfixer.pdbfixer.__file__ = str(tmp_path / "pdbfixer" / "pdbfixer.py")
+    try:
+        pdbfixer_dir = relocate_pdbfixer()
+        assert relocate_pdbfixer() == pdbfixer_dir
+        assert not pdbfixer_dir.startswith(str(tmp_path))
+        assert WHITEOUT not in os.listdir(os.path.join(pdbfixer_dir, "templates"))
+        assert len(list(warm_up(hydrogens=True).get_atoms())) == 35
+    finally:
+        get_pdbfixer_dir.cache_clear()
+        pdbfixer.pdbfixer.__file__ = os.path.join(root, "pdbfixer.py")
+
+def test_complete_structures_bypass_pdbfixer():
+    def clean(pdb_file, bypass_complete):
+        model, bypassed = clean_structure(
+            pdb_file,
+            REDUCER,
+            hydrogens=False,
+            extra_molecules=False,
+            bypass_complete=bypass_complete,
+        )
+        return bypassed, [
+            (atom.get_full_id()[2:], atom.element, atom.occupancy, atom.bfactor, tuple(atom.coord))
+            for atom in model.get_atoms()
+        ]
+
+    # every heavy atom and a terminal oxygen
+    bypassed, atoms = clean("tests/data/pdbs/1hmd.pdb", True)
+    fixed, fixed_atoms = clean("tests/data/pdbs/1hmd.pdb", False)
+    assert bypassed and not fixed
+    assert atoms == fixed_atoms
+
+    # missing side chains
+    bypassed, _ = clean("tests/data/pdbs/1bkx.pdb", True)
+    assert not bypassed
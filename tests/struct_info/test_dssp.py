@@ -0,0 +1,96 @@
+import os
+import shutil
+import subprocess
+
+import h5py
+import numpy as np
+import pytest
+
+from Bio.PDB.DSSP import make_dssp_dict
+
+from zernikegrams.structural_info.dssp import get_dssp_dict
+from zernikegrams.structural_info.native_parser import read_atom_columns
+from zernikegrams.structural_info.structural_info_core import DSSP, get_mkdssp_dict
+
+DIR = os.path.join(os.path.dirname(__file__), "..", "data")
+PDBS = ["2fe3", "3lq0", "4PER", "5vyr"]
+CODES = set("HBEGITSP-")
+# DSSP codes of the three states of pyrosetta
+THREE_STATES = {"H": "H", "G": "H", "I": "H", "E": "E", "B": "E"}
+MIN_AGREEMENT = 0.85
+# per-residue agreement of the DSSP codes with mkdssp
+MIN_MKDSSP_AGREEMENT = 0.98
+# stored outputs of mkdssp for PDBS, written by running this file
+MKDSSP_DIR = os.path.join(DIR, "dssp")
+
+
+def get_mkdssp_file(pdb):
+    return os.path.join(MKDSSP_DIR, f"{pdb}.dssp")
+
+
+def get_dict(pdb):
+    columns = read_atom_columns(os.path.join(DIR, "pdbs", f"{pdb}.pdb"))
+    return get_dssp_dict(
+        columns.chains,
+        columns.resnums,
+        columns.icodes,
+        columns.resnames,
+        columns.atom_names,
+        columns.coords,
+    )
+
+
+def test_codes_match_pyrosetta():
+    with h5py.File(os.path.join(DIR, "baseline_struct_info._hdf5"), "r") as f:
+        proteins = {
+            protein["pdb"].decode(): protein["res_ids"] for protein in f["data"][:]
+        }
+    for pdb in PDBS:
+        dssp_dict = get_dict(pdb)
+        assert set(ss for _, ss in dssp_dict.values()) <= CODES
+
+        expected = {
+            (chain.decode(), int(resnum)): ss.decode()
+            for _, name, chain, resnum, _, ss in proteins[pdb]
+            if name
+        }
+        matches = [
+            THREE_STATES.get(ss, "L") == expected[(chain, resnum)]
+            for (chain, (_, resnum, _)), (_, ss) in dssp_dict.items()
+            if (chain, resnum) in expected
+        ]
+        assert len(matches) > 200
+        assert np.mean(matches) > MIN_AGREEMENT, pdb
+
+
+@pytest.mark.parametrize("pdb", PDBS)
+def test_codes_match_mkdssp(pdb):
+    if os.path.exists(get_mkdssp_file(pdb)):
+        expected = make_dssp_dict(get_mkdssp_file(pdb))[0]
+    elif shutil.which(DSSP) is not None:
+        expected = get_mkdssp_dict(os.path.join(DIR, "pdbs", f"{pdb}.pdb"))
+    else:
+        pytest.skip(
+            f"no stored mkdssp output for {pdb} and mkdssp is not installed, "
+            "run this file with mkdssp to store them"
+        )
+    dssp_dict = get_dict(pdb)
+    keys = set(expected) & set(dssp_dict)
+    assert len(keys) > 0.95 * len(expected)
+    matches = [dssp_dict[key][1] == expected[key][1] for key in keys]
+    assert np.mean(matches) > MIN_MKDSSP_AGREEMENT, pdb
+
+
+if __name__ == "__main__":
+    # stores the outputs of mkdssp that test_codes_match_mkdssp compares to
+    os.makedirs(MKDSSP_DIR, exist_ok=True)
+    for pdb in PDBS:
+        subprocess.run(
+            [
+                DSSP,
+                "--output-format=dssp",
+                os.path.join(DIR, "pdbs", f"{pdb}.pdb"),
+                get_mkdssp_file(pdb),
+            ],
+            check=True,
+        )
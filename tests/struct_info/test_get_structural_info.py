@@ -5,6 +5,12 @@ import hdf5plugin
 import numpy as np
 import pytest
 import os
+import shutil
+
+from zernikegrams.structural_info.get_structural_info import (
+    get_parser,
+    get_structural_info_from_dataset,
+)
 
 
 MISMATCH_TOL = 0.20  # Tolerance for discrepancies between reference pyrosetta structural infos and new biopython ones
@@ -73,5 +79,38 @@ def test_number_of_atoms_matches_pyrosetta():
     os.remove(test_path)
 
 
+def test_abbreviated_flags():
+    # --S is --SASA, as used above, and must not be an ambiguous prefix
+    args = get_parser().parse_args(
+        "--pdb_dir tests/data/pdbs -o out.hdf5 --S -c --sasa_points 50".split()
+    )
+    assert args.SASA and args.charge and args.sasa_points == 50
+
+
+def test_resume_skips_names_with_underscores(tmp_path):
+    # "_" is replaced with "-" in the names of the rows
+    pdb_dir = tmp_path / "pdbs"
+    pdb_dir.mkdir()
+    shutil.copy("tests/data/pdbs/2fe3.pdb", pdb_dir / "x_y.pdb")
+    shutil.copy("tests/data/pdbs/2fe3.pdb", pdb_dir / "2fe3.pdb")
+    hdf5_out = str(tmp_path / "out.hdf5")
+
+    for _ in range(3):
+        get_structural_info_from_dataset(
+            str(pdb_dir),
+            ["x_y", "2fe3"],
+            20000,
+            hdf5_out,
+            "data",
+            1,
+            SASA=False,
+            charge=False,
+            DSSP=False,
+            resume=True,
+        )
+        with h5py.File(hdf5_out, "r") as f:
+            assert sorted(f["data"]["pdb"]) == [b"2fe3", b"x-y"]
+
+
 if __name__ == '__main__':
     test_number_of_atoms_matches_pyrosetta()
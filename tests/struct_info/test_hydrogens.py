@@ -0,0 +1,97 @@
+import os
+
+import numpy as np
+from Bio.PDB import PDBParser
+
+from zernikegrams.structural_info.hydrogens import (
+    ECLOUD,
+    HYDROGENS,
+    NUCLEAR,
+    ROTOR,
+    add_hydrogens,
+    compare_hydrogens,
+)
+from zernikegrams.structural_info.RaSP import clean_structure
+from zernikegrams.structural_info.structural_info_core import REDUCER
+
+DIR = os.path.join(os.path.dirname(__file__), "..", "data")
+# NMR structure of the villin headpiece, with the hydrogens of all its residues
+NMR_PDB = os.path.join(DIR, "1vii.pdb")
+
+
+def get_model(pdb_file):
+    return PDBParser(QUIET=True).get_structure("structure", pdb_file)[0]
+
+
+def remove_hydrogens(model):
+    for residue in model.get_residues():
+        for atom in [atom for atom in residue if atom.element == "H"]:
+            residue.detach_child(atom.get_id())
+    return model
+
+
+def test_hydrogens_match_nmr():
+    reference = get_model(NMR_PDB)
+    model = remove_hydrogens(get_model(NMR_PDB))
+    assert add_hydrogens(model, NUCLEAR) == 301
+
+    comparison = compare_hydrogens(model, reference)
+    assert comparison.num_hydrogens == comparison.num_reference
+    assert comparison.num_matched == comparison.num_reference
+    assert comparison.rmsd < 0.35
+
+    # same names as the reference, for the hydrogens that do not rotate,
+    # after the N-terminus, whose H is named H1 in the reference
+    fixed = {
+        (resname, hydrogen.name)
+        for resname, hydrogens in HYDROGENS.items()
+        for hydrogen in hydrogens
+        if hydrogen.kind != ROTOR
+    }
+    errors = [
+        atom - reference[chain.id][residue.id][atom.get_id()]
+        for chain in model
+        for residue in chain.get_list()[1:]
+        for atom in residue
+        if atom.get_id() == "H" or (residue.get_resname(), atom.get_id()) in fixed
+    ]
+    assert len(errors) > 150
+    assert np.max(errors) < 0.2
+
+
+def test_hydrogen_distances():
+    model = remove_hydrogens(get_model(NMR_PDB))
+    add_hydrogens(model)
+    for residue in model.get_residues():
+        heavy = np.array([atom.get_coord() for atom in residue if atom.element != "H"])
+        for atom in residue:
+            if atom.element == "H":
+                distance = np.linalg.norm(heavy - atom.get_coord(), axis=1).min()
+                assert np.isclose(list(ECLOUD.values()), distance, atol=1e-3).any()
+
+
+def test_compare_hydrogens_to_itself():
+    model = get_model(NMR_PDB)
+    comparison = compare_hydrogens(model, model)
+    assert comparison.num_matched == comparison.num_hydrogens == 301
+    assert comparison.rmsd == 0.0
+
+
+def test_builtin_engine_adds_hydrogens_without_reduce():
+    model = clean_structure(
+        "tests/data/pdbs/1bkx.pdb",
+        "not-reduce",
+        hydrogens=True,
+        extra_molecules=False,
+        hydrogen_engine="builtin",
+    ).model
+    heavy_model = clean_structure(
+        "tests/data/pdbs/1bkx.pdb", REDUCER, hydrogens=False, extra_molecules=False
+    ).model
+
+    heavy_atoms = [atom.get_full_id()[2:] for atom in model.get_atoms() if atom.element != "H"]
+    assert heavy_atoms == [atom.get_full_id()[2:] for atom in heavy_model.get_atoms()]
+    for residue in model.get_residues():
+        assert residue.get_resname() not in HYDROGENS or any(
+            atom.element == "H" for atom in residue
+        )
@@ -0,0 +1,103 @@
+import os
+
+import numpy as np
+import pytest
+from Bio.PDB import MMCIFIO, PDBParser
+
+from zernikegrams.structural_info.native_parser import (
+    UnsupportedStructureError,
+    get_structure_columns,
+    read_atom_columns,
+)
+
+DIR = os.path.join(os.path.dirname(__file__), "..", "data", "pdbs")
+# 3lq0 has many atoms with alternate locations
+PDBS = ["1bkx.pdb", "3lq0.pdb"]
+
+
+def read_biopython(path):
+    structure = PDBParser(QUIET=True).get_structure("x", path)
+    atoms = list(next(structure.get_models()).get_atoms())
+    return (
+        [atom.get_name() for atom in atoms],
+        [atom.element for atom in atoms],
+        [atom.get_full_id()[2:4] for atom in atoms],
+        np.array([atom.get_coord() for atom in atoms]),
+    )
+
+
+def assert_same_atoms(columns, path):
+    names, elements, ids, coords = read_biopython(path)
+    assert list(columns.atom_names) == names
+    assert list(columns.elements) == elements
+    assert [
+        (chain, (" ", int(resnum), icode))
+        for chain, resnum, icode in zip(columns.chains, columns.resnums, columns.icodes)
+    ] == [(chain, (" ", resnum, icode)) for chain, (_, resnum, icode) in ids]
+    assert np.array_equal(columns.coords, coords)
+
+
+@pytest.mark.parametrize("pdb", PDBS)
+def test_pdb_matches_biopython(pdb):
+    path = os.path.join(DIR, pdb)
+    columns = read_atom_columns(path)
+    assert columns.num_models == 1
+    assert_same_atoms(columns, path)
+
+
+@pytest.mark.parametrize("pdb", PDBS)
+def test_structure_columns_match_biopython(pdb):
+    path = os.path.join(DIR, pdb)
+    structure = PDBParser(QUIET=True).get_structure("x", path)
+    columns = get_structure_columns(structure)
+    assert_same_atoms(columns, path)
+    for column, expected in zip(columns, read_atom_columns(path)):
+        assert np.array_equal(column, expected)
+
+
+@pytest.mark.parametrize("pdb", PDBS)
+def test_mmcif_matches_biopython(pdb, tmp_path):
+    path = os.path.join(DIR, pdb)
+    io = MMCIFIO()
+    io.set_structure(PDBParser(QUIET=True).get_structure("x", path))
+    cif = str(tmp_path / "x.cif")
+    io.save(cif)
+    assert_same_atoms(read_atom_columns(cif), path)
+
+
+def test_first_model_only(tmp_path):
+    with open(os.path.join(DIR, "1bkx.pdb")) as f:
+        atoms = [line for line in f if line.startswith(("ATOM", "HETATM"))]
+    path = str(tmp_path / "models.pdb")
+    with open(path, "w") as f:
+        f.write("MODEL        1\n" + "".join(atoms) + "ENDMDL\n")
+        f.write("MODEL        2\n" + "".join(atoms[:10]) + "ENDMDL\nEND\n")
+    columns = read_atom_columns(path)
+    assert columns.num_models == 2
+    assert_same_atoms(columns, path)
+
+
+def test_highest_occupancy_altloc(tmp_path):
+    path = str(tmp_path / "altloc.pdb")
+    with open(path, "w") as f:
+        f.write(
+            "ATOM      1  N   ALA A   1      11.000  12.000  13.000  1.00 10.00           N\n"
+            "ATOM      2  CA AALA A   1      1.000   1.000   1.000  0.40 10.00           C\n"
+            "ATOM      3  CA BALA A   1      2.000   2.000   2.000  0.60 10.00           C\n"
+            "ATOM      4  C   ALA A   1      3.000   3.000   3.000  1.00 10.00           C\n"
+        )
+    columns = read_atom_columns(path)
+    assert list(columns.atom_names) == ["N", "CA", "C"]
+    assert np.array_equal(columns.coords[1], [2.0, 2.0, 2.0])
+    assert_same_atoms(columns, path)
+
+
+def test_point_mutation_is_unsupported(tmp_path):
+    path = str(tmp_path / "mutation.pdb")
+    with open(path, "w") as f:
+        f.write(
+            "ATOM      1  CA AALA A   1      1.000   1.000   1.000  0.40 10.00           C\n"
+            "ATOM      2  CA BGLY A   1      2.000   2.000   2.000  0.60 10.00           C\n"
+        )
+    with pytest.raises(UnsupportedStructureError):
+        read_atom_columns(path)
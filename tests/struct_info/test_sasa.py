@@ -0,0 +1,44 @@
+import os
+
+import numpy as np
+from Bio.PDB import PDBParser
+from Bio.PDB.SASA import ShrakeRupley
+
+from zernikegrams.structural_info.sasa import shrake_rupley
+
+PDB = os.path.join(os.path.dirname(__file__), "..", "data", "pdbs", "1bkx.pdb")
+
+
+def get_atoms():
+    structure = PDBParser(QUIET=True).get_structure("1bkx", PDB)
+    atoms = list(structure.get_atoms())
+    coords = np.array([atom.get_coord() for atom in atoms], dtype=np.float64)
+    elements = np.array([atom.element for atom in atoms])
+    return structure, atoms, coords, elements
+
+
+def test_matches_biopython():
+    structure, atoms, coords, elements = get_atoms()
+    ShrakeRupley().compute(structure, level="A")
+    expected = np.array([atom.sasa for atom in atoms])
+    assert np.allclose(shrake_rupley(coords, elements), expected, atol=1e-6)
+
+
+def test_blocks_and_threads_agree():
+    _, _, coords, elements = get_atoms()
+    sasas = shrake_rupley(coords, elements)
+    assert np.array_equal(shrake_rupley(coords, elements, block_atoms=37, threads=3), sasas)
+
+
+def test_residues_and_fewer_points():
+    _, atoms, coords, elements = get_atoms()
+    residue_ids = [str(atom.get_parent().get_full_id()) for atom in atoms]
+    _, residues = np.unique(residue_ids, return_inverse=True)
+    sasas = shrake_rupley(coords, elements)
+    assert np.allclose(
+        shrake_rupley(coords, elements, residues=residues),
+        np.bincount(residues, weights=sasas),
+    )
+    # coarser, but close in total
+    coarse = shrake_rupley(coords, elements, n_points=30)
+    assert abs(coarse.sum() - sasas.sum()) / sasas.sum() < 0.05
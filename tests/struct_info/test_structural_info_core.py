@@ -97,6 +97,42 @@ def test_get_chi_angles_and_norm_vecs_throws():
     assert np.all(np.isnan(angles)) and np.all(np.isnan(vecs))
 
 
+def test_chi_angles_and_norm_vecs_of_residues_match():
+    np.random.seed(0)
+    residues = []
+    for resname in ["ASP", "LYS", "ALA", "PHE", "ASP"]:
+        names = {name for triple in VEC_AA_ATOM_DICT.get(resname, []) for name in triple}
+        residues.append((resname, {name: np.random.random(3) for name in sorted(names | {"N", "CA"})}))
+    # the ASP of the last residue misses an atom
+    del residues[-1][1]["OD1"]
+
+    atom_residues = np.concatenate([[i] * len(atoms) for i, (_, atoms) in enumerate(residues)])
+    atom_names = np.concatenate([list(atoms) for _, atoms in residues])
+    coords = np.concatenate([list(atoms.values()) for _, atoms in residues])
+    angles, vecs = get_chi_angles_and_norm_vecs_of_residues(
+        np.array([resname for resname, _ in residues]), atom_residues, atom_names, coords, "X"
+    )
+
+    for i, (resname, atoms) in enumerate(residues):
+        expected_angles, expected_vecs = get_chi_angles_and_norm_vecs(resname, atoms, "X")
+        assert np.allclose(angles[i], expected_angles, equal_nan=True)
+        assert np.allclose(vecs[i], expected_vecs, equal_nan=True)
+    assert np.all(np.isnan(angles[-1]))
+
+
+def test_get_charges_matches_table():
+    resnames = np.array(["ALA", "ALA", "LYS", "HOH", "ARG", "UNK"])
+    atom_names = np.array(["CA", "ha", "NZ", "O", "XX", "CA"])
+    expected = []
+    for resname, atom_name in zip(resnames, atom_names):
+        res_charges = CHARGES_AMBER99SB.get(resname, 0)
+        if isinstance(res_charges, dict):
+            expected.append(res_charges.get(atom_name.upper(), 0))
+        else:
+            expected.append(res_charges)
+    assert np.array_equal(get_charges(resnames, atom_names), expected)
+
+
 def test_get_info_from_protein_basic():
     pdb, (
         atom_names,
@@ -109,6 +145,7 @@ def test_get_info_from_protein_basic():
         angles,
         norm_vecs,
         is_multi_model,
+        is_bypassed,
     ) = get_structural_info_from_protein(
         pdb_file="tests/data/pdbs/1hmd.pdb",
         calculate_SASA=False,
@@ -137,6 +174,7 @@ def test_get_info_from_protein_shapes_align():
         angles,
         norm_vecs,
         is_multi_model,
+        is_bypassed,
     ) = get_structural_info_from_protein(
         pdb_file="tests/data/pdbs/1hmd.pdb",
         calculate_SASA=True,
@@ -153,3 +191,17 @@ def test_get_info_from_protein_shapes_align():
         != 0
     )
     assert angles.shape[0] == norm_vecs.shape[0] != 0
+
+
+def test_get_info_from_protein_bypassed():
+    for pdb_file, expected in [("tests/data/pdbs/1hmd.pdb", 1), ("tests/data/pdbs/1bkx.pdb", 0)]:
+        pdb, structural_info = get_structural_info_from_protein(
+            pdb_file=pdb_file,
+            calculate_SASA=False,
+            calculate_angles=False,
+            calculate_charge=False,
+            calculate_DSSP=False,
+            fix=True,
+            extra_molecules=False,
+        )
+        assert structural_info[-1].tolist() == [expected]
@@ -0,0 +1,82 @@
+import gzip
+import io
+import os
+import tarfile
+import zipfile
+
+from zernikegrams.preprocessors.archives import (
+    ArchiveMember,
+    get_member_groups,
+    get_structure_sources,
+    read_structures,
+)
+from zernikegrams.preprocessors.hdf5_ranges import READ_BYTES
+
+DIR = os.path.join(os.path.dirname(__file__), '..', 'data', 'pdbs')
+
+
+def read(pdb):
+    with open(os.path.join(DIR, pdb + '.pdb'), 'rb') as f:
+        return f.read()
+
+
+def make_dir(tmp_path):
+    pdb_dir = tmp_path / 'pdbs'
+    pdb_dir.mkdir()
+    (pdb_dir / '1bkx.pdb').write_bytes(read('1bkx'))
+    (pdb_dir / '1hmd.pdb.gz').write_bytes(gzip.compress(read('1hmd')))
+    with tarfile.open(pdb_dir / 'shard.tar', 'w') as tar:
+        for name, data in [('a/2fe3.pdb.gz', gzip.compress(read('2fe3'))), ('3lq0.pdb', read('3lq0'))]:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    with zipfile.ZipFile(pdb_dir / 'shard.zip', 'w') as zf:
+        zf.writestr('4PER.pdb', read('4PER'), compress_type=zipfile.ZIP_DEFLATED)
+        zf.writestr('5vyr.pdb', read('5vyr'), compress_type=zipfile.ZIP_STORED)
+        zf.writestr('README', b'not a structure')
+    return str(pdb_dir)
+
+
+def test_sources_read_in_memory(tmp_path):
+    pdb_dir = make_dir(tmp_path)
+    sources = get_structure_sources(pdb_dir)
+    assert sorted(sources) == ['1bkx', '1hmd', '2fe3', '3lq0', '4PER', '5vyr']
+    # the index of every shard is built once, and saved next to it
+    assert os.path.exists(os.path.join(pdb_dir, 'shard.tar.index.npy'))
+    assert os.path.exists(os.path.join(pdb_dir, 'shard.zip.index.npy'))
+
+    pdbs = sorted(sources)
+    structures = read_structures([sources[pdb] for pdb in pdbs])
+    for pdb, (pdb_file, data) in zip(pdbs, structures):
+        assert os.path.basename(pdb_file) == pdb + '.pdb'
+        if pdb == '1bkx':
+            # plain files are read by their parser
+            assert data is None and pdb_file == os.path.join(pdb_dir, '1bkx.pdb')
+        else:
+            assert data == read(pdb)
+
+
+def test_member_groups_contiguous(tmp_path):
+    sources = get_structure_sources(make_dir(tmp_path))
+    members = [(pdb, source) for pdb, source in sources.items() if isinstance(source, ArchiveMember)]
+    groups = get_member_groups(members, target_cost=float('inf'))
+    assert [[pdb for pdb, _ in group] for group in groups] == [['2fe3', '3lq0'], ['4PER', '5vyr']]
+    assert len(get_member_groups(members, target_cost=1.0)) == 4
+
+
+def test_member_groups_skip_unselected_members(tmp_path):
+    pdb_dir = tmp_path / 'pdbs'
+    pdb_dir.mkdir()
+    with tarfile.open(pdb_dir / 'shard.tar', 'w') as tar:
+        for name, data in [('2fe3.pdb', read('2fe3')), ('big.pdb', b' ' * (READ_BYTES + 1)), ('3lq0.pdb', read('3lq0'))]:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    sources = get_structure_sources(str(pdb_dir))
+    members = [(pdb, sources[pdb]) for pdb in ['2fe3', '3lq0']]
+
+    # the unselected member between them is not read with them
+    groups = get_member_groups(members, target_cost=float('inf'))
+    assert [[pdb for pdb, _ in group] for group in groups] == [['2fe3'], ['3lq0']]
+    structures = read_structures([source for _, source in members])
+    assert [data for _, data in structures] == [read('2fe3'), read('3lq0')]
@@ -0,0 +1,36 @@
+import json
+
+import numpy as np
+import pytest
+
+from zernikegrams.utils.checkpoints import StageCheckpoint, get_manifest_path
+
+
+def test_resume_from_checkpoint(tmp_path):
+    hdf5_out = str(tmp_path / 'out.hdf5')
+    checkpoint = StageCheckpoint(hdf5_out, {'r_max': 10.0}, resume=True)
+    assert not checkpoint.resuming
+    with checkpoint.open() as f, checkpoint.writer(f) as writer:
+        writer.create_dataset('data', 'f4')
+        writer.append('data', np.arange(3, dtype='f4'))
+        checkpoint.update(writer, done=[b'1abc', '2abc'], failed=[(b'3abc', 'timed out')])
+        checkpoint.save(writer)
+        # not recorded, dropped on resume
+        writer.append('data', np.arange(3, dtype='f4'))
+
+    with open(get_manifest_path(hdf5_out)) as f:
+        assert json.load(f)['rows'] == {'data': 3}
+
+    checkpoint = StageCheckpoint(hdf5_out, {'r_max': 10.0}, resume=True)
+    assert checkpoint.resuming
+    assert checkpoint.is_skipped(b'1abc') and checkpoint.is_skipped('3abc')
+    assert not checkpoint.is_skipped('4abc')
+    with checkpoint.open() as f, checkpoint.writer(f) as writer:
+        writer.create_dataset('data', 'f4')
+        assert writer.size('data') == 3
+
+    with pytest.raises(ValueError):
+        StageCheckpoint(hdf5_out, {'r_max': 12.0}, resume=True)
+
+    StageCheckpoint(hdf5_out, {'r_max': 12.0}, resume=False)
+    assert not (tmp_path / 'out.hdf5.progress.json').exists()
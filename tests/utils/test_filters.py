@@ -0,0 +1,34 @@
+import numpy as np
+
+from zernikegrams.utils.filters import ResidueFilter, RESIDUES_WITH_NO_SIDECHAIN
+from zernikegrams.utils.residue_selection import ResidueSelection
+
+
+res_ids = np.array([
+    [b"G", b"1abc", b"A", b"1", b" ", b"null"],
+    [b"K", b"1abc", b"A", b"2", b" ", b"null"],
+    [b"V", b"1abc", b"B", b"10", b" ", b"null"],
+    [b"W", b"2def", b"A", b"12", b" ", b"null"],
+    [b"A", b"2def", b"A", b"13", b" ", b"null"],
+], dtype="S4")
+
+
+def test_empty_filter_selects_everything():
+    residue_filter = ResidueFilter()
+
+    assert not residue_filter
+    assert residue_filter.pdbs is None
+    assert np.all(residue_filter.select(res_ids))
+
+
+def test_filters_are_combined():
+    selection = ResidueSelection()
+    selection.add("1abc")
+    residue_filter = ResidueFilter(
+        pdb_chain_pairs={"1abc_A", "2def_A"},
+        excluded_residue_types=RESIDUES_WITH_NO_SIDECHAIN,
+        residue_selection=selection,
+    )
+
+    assert residue_filter.pdbs == {b"1abc"}
+    assert np.all(residue_filter.select(res_ids) == [False, True, False, False, False])
@@ -0,0 +1,28 @@
+import numpy as np
+
+from zernikegrams.preprocessors.pdbs import (
+    process_data_foldcomp,
+    process_range_foldcomp,
+)
+
+
+def callback(pdb_file, pdb_data=None):
+    return pdb_file, pdb_data
+
+
+def test_ranges_decoded_in_memory():
+    process_data_foldcomp.callback = callback
+    process_data_foldcomp.params = {}
+    # a database as opened by the worker, indexed like foldcomp's
+    process_range_foldcomp.db = [('A0', 'ATOM 0\n'), ('A1', 'ATOM 1\n'), ('A2', 'ATOM 2\n')]
+    process_range_foldcomp.foldcomp_file = '/data/afdb'
+    process_range_foldcomp.batched = False
+
+    results = process_range_foldcomp((1, 3, np.array([1, 2])))
+    assert results == [('/data/afdb/A1.pdb', b'ATOM 1\n'), ('/data/afdb/A2.pdb', b'ATOM 2\n')]
+
+    process_data_foldcomp.callback = lambda pdb_files, pdb_data: list(zip(pdb_files, pdb_data))
+    process_range_foldcomp.batched = True
+    assert process_range_foldcomp((0, 2, np.array([0, 1]))) == [
+        [('/data/afdb/A0.pdb', b'ATOM 0\n'), ('/data/afdb/A1.pdb', b'ATOM 1\n')]
+    ]
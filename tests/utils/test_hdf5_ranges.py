@@ -0,0 +1,28 @@
+import h5py
+import numpy as np
+
+from zernikegrams.preprocessors.batching import get_size_batches
+from zernikegrams.preprocessors.hdf5_ranges import get_index_ranges, get_rows_per_range
+
+
+def test_rows_per_range_are_chunk_aligned(tmp_path):
+    with h5py.File(tmp_path / 'data.hdf5', 'w') as f:
+        dataset = f.create_dataset('data', shape=(1000,), dtype='f4', chunks=(16,))
+        # load balance bound: 1000 / (4 * 2) rows, rounded up to whole chunks
+        assert get_rows_per_range(dataset, 1000, 2) == 128
+        assert get_rows_per_range(dataset, 3, 8) == 16
+
+
+def test_index_ranges_cover_indices():
+    inds = np.array([0, 3, 15, 16, 40, 41, 47, 90])
+    ranges = get_index_ranges(inds, 16)
+    assert [(start, stop) for start, stop, _ in ranges] == [(0, 16), (16, 17), (40, 48), (90, 91)]
+    assert np.array_equal(np.concatenate([group for _, _, group in ranges]), inds)
+    assert get_index_ranges(np.array([], dtype=int), 16) == []
+
+
+def test_size_batches():
+    sizes = [10, 10, 25, 5, 40, 1, 1, 1]
+    batches = list(get_size_batches(range(len(sizes)), sizes.__getitem__, 30))
+    assert batches == [[0, 1], [2, 3], [4], [5, 6, 7]]
+    assert list(get_size_batches(range(len(sizes)), sizes.__getitem__, 100, max_items=3)) == [[0, 1, 2], [3, 4, 5], [6, 7]]
@@ -0,0 +1,54 @@
+import h5py
+import numpy as np
+
+from zernikegrams.utils.hdf5_writer import BufferedHDF5Writer
+
+
+def test_buffered_writes_match_rows(tmp_path):
+    dt = np.dtype([('res_id', 'S5', (6,)), ('zernikegram', 'f4', (100,)), ('label', '<i4')])
+    rows = np.zeros(1000, dtype=dt)
+    rows['res_id'] = np.arange(6000).astype('S5').reshape(-1, 6)
+    rows['zernikegram'] = np.random.default_rng(0).normal(size=(1000, 100))
+    rows['label'] = np.arange(1000)
+
+    with h5py.File(tmp_path / 'out.hdf5', 'w') as f, BufferedHDF5Writer(f) as writer:
+        writer.create_dataset('data', dt, chunk_rows=16)
+        writer.create_dataset('nh_list', ('S5', (6,)))
+        writer.create_dataset('proportion_sidechains_removed', 'f4')
+        writer.create_dataset('empty', 'f4')
+
+        # single rows, tuples and batches of any size
+        writer.append('data', rows[0])
+        writer.append('data', tuple(rows[1]))
+        start = 2
+        for size in (3, 100, 1, 500, 394):
+            writer.append('data', rows[start : start + size])
+            start += size
+        for row in rows:
+            writer.append('nh_list', row['res_id'])
+            writer.append('proportion_sidechains_removed', -1.0)
+        assert writer.size('data') == 1000
+
+    with h5py.File(tmp_path / 'out.hdf5', 'r') as f:
+        assert f['data'].chunks == (16,)
+        assert np.array_equal(f['data'][:], rows)
+        assert np.array_equal(f['nh_list'][:], rows['res_id'])
+        assert np.all(f['proportion_sidechains_removed'][:] == -1.0)
+        assert f['empty'].shape == (0,)
+
+
+def test_resume_truncates_and_appends(tmp_path):
+    rows = np.arange(100, dtype='f4')
+    with h5py.File(tmp_path / 'out.hdf5', 'w') as f, BufferedHDF5Writer(f) as writer:
+        writer.create_dataset('data', 'f4', chunk_rows=16)
+        writer.append('data', rows[:40])
+        writer.flush()
+        # rows written after the last checkpoint
+        writer.append('data', np.full(10, -1, dtype='f4'))
+
+    with h5py.File(tmp_path / 'out.hdf5', 'r+') as f:
+        with BufferedHDF5Writer(f, resume_rows={'data': 40}) as writer:
+            writer.create_dataset('data', 'f4')
+            assert writer.size('data') == 40
+            writer.append('data', rows[40:])
+        assert np.array_equal(f['data'][:], rows)
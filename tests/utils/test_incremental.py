@@ -0,0 +1,88 @@
+import h5py
+import numpy as np
+import pytest
+
+from zernikegrams.utils.incremental import (
+    IncrementalUpdate,
+    get_live_hashes,
+    get_live_rows,
+)
+
+
+def run(hdf5_out, inputs, params={'r_max': 10.0}, compact=False):
+    """A stage writing one row per residue of the inputs it processes"""
+    update = IncrementalUpdate(hdf5_out, params, 'data', update=True)
+    update.get_name_length(4)
+    update.plan({pdb: str(len(residues)) for pdb, residues in inputs.items()})
+    processed = []
+    with update.open() as f, update.writer(f) as writer:
+        writer.create_dataset('data', [('pdb', 'S4'), ('residue', '<i4')])
+        for pdb, residues in inputs.items():
+            if update.is_skipped(pdb):
+                continue
+            processed.append(pdb)
+            rows = np.array([(pdb, r) for r in residues], dtype=[('pdb', 'S4'), ('residue', '<i4')])
+            writer.append('data', rows)
+            update.append(rows['pdb'])
+        writer.flush()
+        update.write(f)
+    if compact:
+        update.compact(['data'])
+    return processed
+
+
+def read_live(hdf5_out):
+    with h5py.File(hdf5_out, 'r') as f:
+        data = f['data'][:][get_live_rows(f)]
+        hashes = get_live_hashes(f)
+    return sorted((pdb.decode(), int(r)) for pdb, r in data), hashes
+
+
+def test_update_processes_changes_and_tombstones(tmp_path):
+    hdf5_out = str(tmp_path / 'out.hdf5')
+    assert run(hdf5_out, {'1abc': [1, 2], '2abc': [1], '3abc': []}) == ['1abc', '2abc', '3abc']
+
+    # 1abc changed, 2abc removed, 3abc unchanged, 4abc added
+    processed = run(hdf5_out, {'1abc': [1, 2, 3], '3abc': [], '4abc': [7]})
+    assert processed == ['1abc', '4abc']
+
+    live, hashes = read_live(hdf5_out)
+    assert live == [('1abc', 1), ('1abc', 2), ('1abc', 3), ('4abc', 7)]
+    assert hashes == {'1abc': '3', '3abc': '0', '4abc': '1'}
+    with h5py.File(hdf5_out, 'r') as f:
+        # the rows of tombstones are kept
+        assert f['data'].shape == (7,)
+        assert f['manifest/index']['tombstone'].sum() == 2
+
+    assert run(hdf5_out, {'1abc': [1, 2, 3], '3abc': [], '4abc': [7]}) == []
+    assert read_live(hdf5_out)[0] == live
+
+    with pytest.raises(ValueError):
+        run(hdf5_out, {'1abc': [1]}, params={'r_max': 12.0})
+
+
+
+def test_compact_removes_tombstones(tmp_path):
+    hdf5_out = str(tmp_path / 'out.hdf5')
+    run(hdf5_out, {'1abc': [1, 2], '2abc': [1], '3abc': [], '5abc': [4, 5]}, compact=True)
+
+    # 1abc changed, 2abc removed, 3abc and 5abc unchanged, 4abc added
+    inputs = {'1abc': [1, 2, 3], '3abc': [], '4abc': [7], '5abc': [4, 5]}
+    assert run(hdf5_out, inputs, compact=True) == ['1abc', '4abc']
+
+    live, hashes = read_live(hdf5_out)
+    assert live == [('1abc', 1), ('1abc', 2), ('1abc', 3), ('4abc', 7), ('5abc', 4), ('5abc', 5)]
+    assert hashes == {'1abc': '3', '3abc': '0', '4abc': '1', '5abc': '2'}
+    with h5py.File(hdf5_out, 'r') as f:
+        # all the rows are live, in the order they were written
+        assert [(pdb.decode(), int(r)) for pdb, r in f['data'][:]] == [
+            ('5abc', 4), ('5abc', 5), ('1abc', 1), ('1abc', 2), ('1abc', 3), ('4abc', 7)
+        ]
+        assert not f['manifest/index']['tombstone'].any()
+        assert np.array_equal(get_live_rows(f), np.arange(6))
+
+    # updates of a compacted output append to its rows
+    assert run(hdf5_out, {**inputs, '5abc': [6]}, compact=True) == ['5abc']
+    assert read_live(hdf5_out)[0] == sorted(live[:4] + [('5abc', 6)])
+    with h5py.File(hdf5_out, 'r') as f:
+        assert f['data'].shape == (5,)
@@ -0,0 +1,47 @@
+import numpy as np
+
+from zernikegrams.utils.residue_selection import (
+    ResidueSelection,
+    parse_resnums,
+    select_res_ids,
+)
+
+
+res_ids = np.array([
+    [b"G", b"1abc", b"A", b"-1", b" ", b"null"],
+    [b"A", b"1abc", b"A", b"10", b" ", b"null"],
+    [b"V", b"1abc", b"B", b"10", b" ", b"null"],
+    [b"W", b"2def", b"A", b"12", b" ", b"null"],
+    [b"Y", b"3ghi", b"C", b"40", b" ", b"null"],
+], dtype="S4")
+
+
+def test_select_res_ids_matches_broadcast():
+    selection = np.array([
+        [b"V", b"1abc", b"B", b"10", b" ", b"null"],
+        [b"Y", b"3ghi", b"C", b"40", b" ", b"null"],
+        [b"Y", b"3ghi", b"C", b"41", b" ", b"null"],
+    ], dtype="S8")
+
+    expected = np.any(
+        np.all(selection.reshape(-1, 6, 1) == res_ids.transpose().reshape(1, 6, -1), axis=1),
+        axis=0,
+    )
+    assert np.all(select_res_ids(res_ids, selection) == expected)
+    assert np.all(select_res_ids(res_ids, selection) == [False, False, True, False, True])
+
+
+def test_parse_resnums():
+    assert parse_resnums("10-20,35") == [(10, 20), (35, 35)]
+    assert parse_resnums("-5--1,3") == [(-5, -1), (3, 3)]
+
+
+def test_residue_selection_file(tmp_path):
+    path = tmp_path / "selection.txt"
+    path.write_text("# comment\n1abc A -1-5\n1abc B\n3ghi\n")
+
+    selection = ResidueSelection.from_file(str(path))
+
+    assert selection.pdbs == {b"1abc", b"3ghi"}
+    assert "1abc" in selection and b"2def" not in selection
+    assert np.all(selection.select(res_ids) == [True, False, True, False, True])
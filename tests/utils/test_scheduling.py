@@ -0,0 +1,30 @@
+import h5py
+import numpy as np
+
+from zernikegrams.preprocessors.hdf5_ranges import get_index_ranges
+from zernikegrams.preprocessors.scheduling import (
+    get_cost_groups,
+    get_row_costs,
+    schedule_index_ranges,
+)
+
+
+def test_cost_groups_largest_first():
+    items = ['a', 'b', 'c', 'd', 'e', 'f']
+    costs = np.array([1.0, 50.0, 2.0, 20.0, 3.0, 1.0])
+    assert get_cost_groups(items, costs, 10.0) == [['b'], ['d'], ['e', 'c', 'a', 'f']]
+
+
+def test_index_ranges_split_and_ordered():
+    costs = np.array([1.0, 1.0, 30.0, 1.0, 1.0, 1.0, 1.0, 1.0])
+    ranges = schedule_index_ranges(get_index_ranges(np.arange(8), 4), costs, 5.0)
+    assert [(start, stop) for start, stop, _ in ranges] == [(2, 3), (4, 8), (0, 2), (3, 4)]
+
+
+def test_row_costs_follow_compressed_sizes(tmp_path):
+    data = np.zeros((4, 10000), dtype=np.float32)
+    data[2] = np.random.default_rng(0).normal(size=10000)
+    with h5py.File(tmp_path / 'data.hdf5', 'w') as f:
+        dataset = f.create_dataset('data', data=data, chunks=(1, 10000), compression='gzip')
+        costs = get_row_costs(dataset)
+    assert np.argmax(costs) == 2
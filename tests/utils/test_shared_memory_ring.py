@@ -0,0 +1,74 @@
+import time
+from multiprocessing import Pool
+
+import numpy as np
+
+from zernikegrams.preprocessors.shared_memory_ring import (
+    SharedMemoryRing,
+    SharedMemoryResult,
+    attach,
+    pack_result,
+    pack_results,
+)
+
+
+def make_result(i):
+    dt = np.dtype([('res_id', 'S5', (6,)), ('coords', 'f4', (10, 3))])
+    rows = np.zeros(i + 1, dtype=dt)
+    rows['coords'] = i
+    return (b'pdb%d' % i, (rows, [np.arange(i), np.array(b'x')]), None)
+
+
+def test_pack_unpack_round_trip():
+    ring = SharedMemoryRing(2, 1 << 16)
+    try:
+        packed = ring.pack(make_result(3))
+        assert isinstance(packed, SharedMemoryResult)
+        (unpacked,) = ring.results([packed])
+        expected = make_result(3)
+        assert unpacked[0] == expected[0] and unpacked[2] is None
+        assert np.array_equal(unpacked[1][0], expected[1][0])
+        assert np.array_equal(unpacked[1][1][0], expected[1][1][0])
+        assert unpacked[1][1][1] == b'x'
+
+        # too large for a slot
+        large = (np.zeros((1 << 16) + 1, dtype=np.uint8),)
+        assert ring.pack(large) is large
+    finally:
+        ring.close()
+
+
+def test_pool_results_through_ring():
+    ring = SharedMemoryRing.for_pool(2, 1 << 16)
+    try:
+        with Pool(2, initializer=attach, initargs=(ring,)) as pool:
+            results = ring.results(pool.imap(_pack_make_result, range(50)))
+            for i, res in enumerate(results):
+                assert res[0] == b'pdb%d' % i
+                assert np.all(res[1][0]['coords'] == i)
+                assert np.array_equal(res[1][1][0], np.arange(i))
+    finally:
+        ring.close()
+
+
+def _pack_make_result(i):
+    return pack_result(make_result, i)
+
+
+def test_task_results_do_not_wait_for_slots():
+    ring = SharedMemoryRing(2, 1 << 16)
+    attach(ring)
+    # the free slots reach the queue through its feeder thread
+    time.sleep(0.2)
+    try:
+        start = time.time()
+        packed = pack_results(make_result(i) for i in range(10))
+        # the slots are released after the task, its other results are pickled
+        assert time.time() - start < 0.5
+        assert [isinstance(res, SharedMemoryResult) for res in packed] == [True] * 2 + [False] * 8
+        for i, res in enumerate(ring.results(packed)):
+            assert res[0] == b'pdb%d' % i
+            assert np.all(res[1][0]['coords'] == i)
+    finally:
+        attach(None)
+        ring.close()
@@ -0,0 +1,65 @@
+import os
+import time
+
+import numpy as np
+
+from zernikegrams.preprocessors.supervised_pool import SupervisedPool, WorkerLimits
+
+
+def work(task):
+    if task == 'hang':
+        time.sleep(60)
+    if task == 'crash':
+        os._exit(3)
+    if task == 'raise':
+        raise ValueError('bad item')
+    if task == 'grow':
+        work.leak = np.ones(1 << 26, dtype=np.uint8)
+        time.sleep(60)
+    return task, os.getpid()
+
+
+def work_group(group):
+    return [work(task) for task in group]
+
+
+def test_results_in_order():
+    with SupervisedPool(3) as pool:
+        results = list(pool.imap(work, range(20)))
+    assert [task for task, _ in results] == list(range(20))
+
+
+def test_failures_are_recorded_and_workers_replaced():
+    tasks = [0, 'hang', 1, 'crash', 2, 'raise', 3]
+    with SupervisedPool(2, limits=WorkerLimits(timeout=1.0)) as pool:
+        results = list(pool.imap(work, tasks))
+        assert [task for task, _ in results] == [0, 1, 2, 3]
+        reasons = {failure.task: failure.reason for failure in pool.failures}
+    assert reasons['hang'] == 'timed out'
+    assert reasons['crash'] == 'worker died with exit code 3'
+    assert reasons['raise'] == 'ValueError: bad item'
+
+
+def test_rss_cap():
+    limits = WorkerLimits(max_rss=1 << 25)
+    with SupervisedPool(1, limits=limits) as pool:
+        assert list(pool.imap(work, ['grow', 0]))[0][0] == 0
+        assert pool.failures[0].task == 'grow'
+        assert pool.failures[0].reason.startswith('exceeded the RSS cap')
+
+
+def test_workers_recycled_after_max_tasks():
+    with SupervisedPool(1, limits=WorkerLimits(max_tasks=2)) as pool:
+        pids = [pid for _, pid in pool.imap(work, range(6))]
+    assert len(set(pids)) == 3
+
+
+def test_failed_groups_retried_item_by_item():
+    groups = [[0, 1], [2, 'crash', 3], [4]]
+    with SupervisedPool(2) as pool:
+        results = pool.imap_with_retries(
+            work_group, groups, lambda group: [[task] for task in group], ordered=True
+        )
+        tasks = [task for result in results for task, _ in result]
+        assert tasks == [0, 1, 4, 2, 3]
+        assert [failure.task for failure in pool.failures] == [['crash']]
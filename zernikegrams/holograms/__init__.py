@@ -1 +1,2 @@
-from .get_holograms import get_holograms_fn
\ No newline at end of file
+from .get_holograms import get_holograms_fn
+from .get_holograms_from_structural_info import get_zernikegrams_from_structural_info_fn
\ No newline at end of file
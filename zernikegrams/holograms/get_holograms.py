@@ -13,13 +13,25 @@ import numpy as np
 from sqlitedict import SqliteDict
 
 from zernikegrams.utils import log_config as logging
+from zernikegrams.utils.checkpoints import StageCheckpoint
+from zernikegrams.utils.incremental import IncrementalUpdate
 
 logger = logging.getLogger(__name__)
 
 from zernikegrams.preprocessors.neighborhoods_hdf5 import HDF5Preprocessor
+from zernikegrams.preprocessors.supervised_pool import (
+    WorkerLimits,
+    add_worker_arguments,
+    get_worker_limits,
+)
 from zernikegrams.utils.spherical_bases import change_basis_complex_to_real
-from zernikegrams.holograms.holograms_core import get_hologram
+from zernikegrams.holograms.holograms_core import (
+    get_hologram,
+    get_holograms_batch,
+    get_frame,
+)
 from zernikegrams.utils.protein_naming import ol_to_ind_size
+from zernikegrams.utils.filters import ResidueFilter, RESIDUES_WITH_NO_SIDECHAIN
 
 # from protein_holography_pytorch.utils.posterity import get_metadata,record_metadata
 from zernikegrams.utils.argparse import *
@@ -257,6 +269,242 @@ def stringify(res_id):
     return "_".join(list(map(lambda x: x.decode("utf-8"), list(res_id))))
 
 
+def get_zernikegram_dtype(L: int, num_components: int) -> np.dtype:
+    """
+    Dtype of the zernikegram rows written in torch format
+    """
+    return np.dtype(
+        [
+            ("res_id", f"S{L}", (6,)),
+            ("zernikegram", "f4", (num_components,)),
+            ("frame", "f4", (3, 3)),
+            ("label", "<i4"),
+            ("backbone_coords", "f4", (4, 3)),
+        ]
+    )
+
+
+def parse_channels(channels: List[str]) -> List:
+    """
+    Expands the channel presets "dlpacker" and "AAs" into their list of channels
+    """
+    AAs = [
+        b"A",
+        b"R",
+        b"N",
+        b"D",
+        b"C",
+        b"Q",
+        b"E",
+        b"H",
+        b"I",
+        b"L",
+        b"K",
+        b"M",
+        b"F",
+        b"P",
+        b"S",
+        b"T",
+        b"W",
+        b"Y",
+        b"V",
+        b"G",
+    ]
+
+    if channels[0] == "dlpacker":
+        logger.info("using dlpacker")
+        # NOTE my code is different than williams, I switched amino acid 'O' with amino acid
+        # 'G' because glycine is canonical, whereas pyrrolysine is not.
+        # My example follows DLPackers code, which lists their amino acids in utils.py "THE20"
+        # TODO: check if dl packer puts hydrogen in the all other elements channel, if not remove it
+        return [
+            "C",
+            "N",
+            "O",
+            "S",
+            "all_other_elements",
+            "charge",
+            *AAs,
+            "all_other_AAs",
+        ]
+
+    elif channels[0] == "AAs":
+        return [*AAs, "all_other_AAs"]
+
+    return channels
+
+
+def flatten_padded_neighborhoods(
+    np_nhs: np.ndarray,
+) -> Tuple[Dict[str, np.ndarray], np.ndarray]:
+    """
+    Concatenates the real (non-padding) atoms of padded neighborhoods.
+
+    Returns
+    -------
+    Tuple of (dict mapping field name to the concatenated atoms, number of atoms
+    per neighborhood)
+    """
+    real_locs = np_nhs["atom_names"] != EMPTY_ATOM_NAME
+    lengths = np.sum(real_locs, axis=-1)
+    nhs = {
+        name: np_nhs[name][real_locs]
+        for name in ("atom_names", "elements", "res_ids", "coords", "SASAs", "charges")
+    }
+    return nhs, lengths
+
+
+def get_zernikegrams_batch(
+    res_id: np.ndarray,
+    nhs: Dict[str, np.ndarray],
+    lengths: np.ndarray,
+    L_max: int,
+    ks: np.ndarray,
+    r_max: float,
+    torch_dt: np.dtype,
+    real_sph_harm: bool = True,
+    mode: str = "ns",
+    channels: List[str] = ["C", "N", "O", "S", "H", "SASA", "charge"],
+    request_frame: bool = False,
+    sph_harm_normalization: str = "component",
+    rst_normalization: Optional[str] = None,
+    frames: Optional[np.ndarray] = None,
+    return_kept: bool = False,
+    **kwargs,
+) -> np.ndarray:
+    """
+    Batched counterpart of `get_single_zernikegram` in torch format.
+
+    Parameters
+    ----------
+    res_id : np.ndarray
+        Residue ids of the central residues, shape [num_neighborhoods, 6]
+    nhs : Dict[str, np.ndarray]
+        Atoms of all neighborhoods concatenated, in spherical coordinates
+        (see `flatten_padded_neighborhoods`)
+    lengths : np.ndarray
+        Number of atoms in each neighborhood
+    frames : np.ndarray, optional
+        Backbone frames of the central residues, shape [num_neighborhoods, 3, 3],
+        as stored by the neighborhoods stage. Used when request_frame is True,
+        instead of recomputing the frames from the atoms.
+    return_kept : bool
+        Whether to also return the indices of the neighborhoods the rows
+        come from
+
+    Returns
+    -------
+    np.ndarray of dtype torch_dt, with one row per neighborhood that could be
+    projected. Neighborhoods of non-canonical residues, or whose zernikegram
+    contains NaNs or Infs, are skipped.
+    """
+    lengths = np.asarray(lengths)
+    valid = np.array([aa not in {b"Z", b"X"} for aa in res_id[:, 0]], dtype=bool)
+    for skipped in res_id[~valid]:
+        logger.error(
+            f"Skipping neighborhood with residue: {skipped[0].decode('utf-8')}"
+        )
+
+    valid_inds = np.nonzero(valid)[0]
+    atom_valid = np.repeat(valid, lengths)
+    res_id = res_id[valid]
+    lengths = lengths[valid]
+    if frames is not None:
+        frames = frames[valid]
+    nhs = {key: val[atom_valid] for key, val in nhs.items()}
+    num_nhs = res_id.shape[0]
+
+    hgms = get_holograms_batch(
+        nhs,
+        lengths,
+        L_max,
+        ks,
+        r_max,
+        mode=mode,
+        channels=channels,
+        rst_normalization=rst_normalization,
+    )
+
+    finite = np.ones(num_nhs, dtype=bool)
+    for l in range(0, L_max + 1):
+        finite &= np.all(np.isfinite(hgms[str(l)]), axis=(1, 2))
+    for bad in res_id[~finite]:
+        logger.error(f"NaNs or Infs in hologram for {stringify(bad)}")
+
+    if real_sph_harm:
+        for l in range(0, L_max + 1):
+            hgms[str(l)] = np.einsum(
+                "nm,bcm->bcn", change_basis_complex_to_real(l), np.conj(hgms[str(l)])
+            )
+            if sph_harm_normalization == "component":
+                if rst_normalization is None:
+                    hgms[str(l)] *= np.sqrt(4 * np.pi).astype(np.float32)
+                elif rst_normalization == "square":
+                    hgms[str(l)] *= (1.0 / np.sqrt(4 * np.pi)).astype(np.float32)
+
+    zgrams = np.concatenate(
+        [
+            np.einsum("mn,bNn->bNm", cob_mats[l], hgms[str(l)])
+            .reshape(num_nhs, -1)
+            .real
+            for l in range(L_max + 1)
+        ],
+        axis=-1,
+    )
+
+    # get backbone atom coords, in standardard [C, O, N, CA] order
+    from zernikegrams.utils.conversions import spherical_to_cartesian__numpy
+
+    segments = np.repeat(np.arange(num_nhs), lengths)
+    central_res_mask = np.logical_and.reduce(
+        nhs["res_ids"] == res_id[segments], axis=-1
+    )
+    has_central = np.bincount(segments[central_res_mask], minlength=num_nhs) > 0
+    backbone_coords = np.zeros((num_nhs, 4, 3))
+    for i, atom_name in enumerate((C, O, N)):
+        atom_mask = np.logical_and(central_res_mask, nhs["atom_names"] == atom_name)
+        counts = np.bincount(segments[atom_mask], minlength=num_nhs)
+        bad_counts = np.logical_and(has_central, counts != 1)
+        for bad in res_id[bad_counts]:
+            logger.error(
+                f"{counts[bad_counts][0]} {atom_name.decode('utf-8').strip()} atoms "
+                f"in central residue of {stringify(bad)} instead of 1"
+            )
+        finite &= ~bad_counts
+        atom_mask &= np.repeat(counts == 1, lengths)
+        backbone_coords[segments[atom_mask], i] = spherical_to_cartesian__numpy(
+            nhs["coords"][atom_mask]
+        )
+
+    arr = np.zeros(shape=(np.sum(finite),), dtype=torch_dt)
+    arr["res_id"] = res_id[finite]
+    arr["zernikegram"] = zgrams[finite]
+    arr["frame"] = np.nan
+    arr["label"] = [ol_to_ind_size[aa.decode("utf-8")] for aa in arr["res_id"][:, 0]]
+    arr["backbone_coords"] = backbone_coords[finite]
+
+    if request_frame and frames is not None:
+        arr["frame"] = frames[finite]
+    elif request_frame:
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        for n, i in enumerate(np.nonzero(finite)[0]):
+            atoms = slice(offsets[i], offsets[i + 1])
+            frame = get_frame(
+                {
+                    "res_id": res_id[i],
+                    "res_ids": nhs["res_ids"][atoms],
+                    "coords": nhs["coords"][atoms],
+                    "atom_names": nhs["atom_names"][atoms],
+                }
+            )
+            if frame is not None:
+                arr["frame"][n] = frame
+
+    if return_kept:
+        return arr, valid_inds[finite]
+    return arr
+
+
 def get_single_zernikegram(
     np_nh,
     L_max,
@@ -394,6 +642,70 @@ def get_single_zernikegram(
     return hgm, np_nh["res_id"]
 
 
+def get_zernikegrams_from_neighborhoods(
+    np_nhs: np.ndarray,
+    L_max: int,
+    ks: np.ndarray,
+    r_max: float,
+    torch_dt: np.dtype,
+    proportion_sidechain_removed: Optional[np.ndarray] = None,
+    real_sph_harm: bool = True,
+    mode: str = "ns",
+    channels: List[str] = ["C", "N", "O", "S", "H", "SASA", "charge"],
+    request_frame: bool = False,
+    sph_harm_normalization: str = "component",
+    rst_normalization: Optional[str] = None,
+    **kwargs,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Batch counterpart of `get_single_zernikegram` in torch format, without
+    zeros, called by the preprocessor on batches of padded neighborhoods.
+
+    Parameters
+    ----------
+    np_nhs : np.ndarray
+        Padded neighborhoods, in spherical coordinates. Their "frame" field,
+        if any, is used when request_frame is True.
+    proportion_sidechain_removed : np.ndarray, optional
+        Proportion of sidechains removed from each neighborhood
+
+    Returns
+    -------
+    Tuple of (zernikegrams of dtype torch_dt, residue ids of all the
+    neighborhoods of the batch, proportion of sidechains removed of each
+    zernikegram, or -1)
+    """
+    nhs, lengths = flatten_padded_neighborhoods(np_nhs)
+    if "frame" in np_nhs.dtype.names:
+        frames = np_nhs["frame"]
+    else:
+        frames = None
+
+    zernikegrams, kept = get_zernikegrams_batch(
+        np_nhs["res_id"],
+        nhs,
+        lengths,
+        L_max,
+        ks,
+        r_max,
+        torch_dt,
+        real_sph_harm=real_sph_harm,
+        mode=mode,
+        channels=channels,
+        request_frame=request_frame,
+        sph_harm_normalization=sph_harm_normalization,
+        rst_normalization=rst_normalization,
+        frames=frames,
+        return_kept=True,
+    )
+    if proportion_sidechain_removed is None:
+        proportions = np.full(kept.shape[0], -1.0, dtype=np.float32)
+    else:
+        proportions = proportion_sidechain_removed[kept]
+
+    return zernikegrams, np_nhs["res_id"], proportions
+
+
 def get_zernikegrams_from_dataset(
     hdf5_in,
     input_dataset_name,
@@ -414,6 +726,9 @@ def get_zernikegrams_from_dataset(
     exclude_residues_with_no_sidechain: bool = False,
     angles_db: Optional[str] = None,
     vectors_db: Optional[str] = None,
+    worker_limits: WorkerLimits = WorkerLimits(),
+    resume: bool = False,
+    update: bool = False,
 ):
 
     # get metadata
@@ -421,7 +736,52 @@ def get_zernikegrams_from_dataset(
 
     start_time = time()
 
+    if resume and not torch_format:
+        raise ValueError("Only runs with torch_format can be resumed")
+    if update and not torch_format:
+        raise ValueError("Only runs with torch_format can be updated")
+    if resume and update:
+        raise ValueError("Cannot resume and update at the same time")
+
     ds = HDF5Preprocessor(hdf5_in, input_dataset_name)
+    if update and ds.hashes is None:
+        raise ValueError(f"Cannot update from {hdf5_in}, it has no manifest")
+    if exclude_residues_with_no_sidechain:
+        ds.filter_neighborhoods(
+            ResidueFilter(excluded_residue_types=RESIDUES_WITH_NO_SIDECHAIN)
+        )
+
+    params = {
+        "hdf5_in": hdf5_in,
+        "input_dataset_name": input_dataset_name,
+        "output_dataset_name": output_dataset_name,
+        "r_max": r_max,
+        "Lmax": Lmax,
+        "ks": list(ks),
+        "real_sph_harm": real_sph_harm,
+        "keep_zeros": keep_zeros,
+        "mode": mode,
+        "channels": channels,
+        "request_frame": request_frame,
+        "sph_harm_normalization": sph_harm_normalization,
+        "rst_normalization": rst_normalization,
+        "exclude_residues_with_no_sidechain": exclude_residues_with_no_sidechain,
+        "angles_db": angles_db,
+        "vectors_db": vectors_db,
+    }
+    # the proteins of the neighborhoods, see `zernikegrams.utils.incremental`
+    incremental = IncrementalUpdate(hdf5_out, params, "nh_list", update=update)
+    if update:
+        incremental.plan(ds.hashes)
+        ds.skip_neighborhoods(lambda res_id: incremental.is_skipped(res_id[1]))
+
+    # the neighborhoods done are read from the output, see `zernikegrams.utils.checkpoints`
+    checkpoint = StageCheckpoint(hdf5_out, params, resume=resume, persist_done=False)
+    if checkpoint.resuming:
+        with h5py.File(hdf5_out, "r") as f:
+            done = f["nh_list"][: checkpoint.rows.get("nh_list", 0)]
+        checkpoint.done.update(map(stringify, done))
+        ds.skip_neighborhoods(lambda res_id: checkpoint.is_skipped(stringify(res_id)))
     bad_neighborhoods = []
     n = 0
     ks = np.array(ks)
@@ -437,7 +797,7 @@ def get_zernikegrams_from_dataset(
             for l in range(Lmax + 1)
         ]
 
-    L = np.max([5, ds.pdb_name_length])
+    L = incremental.get_name_length(np.max([5, ds.pdb_name_length]))
 
     if torch_format:
         logger.info(f"Using torch format")
@@ -458,15 +818,7 @@ def get_zernikegrams_from_dataset(
             angles_db = SqliteDict(angles_db, flag="r")
             vectors_db = SqliteDict(vectors_db, flag="r")
         else:
-            dt = np.dtype(
-                [
-                    ("res_id", f"S{L}", (6,)),
-                    ("zernikegram", "f4", (num_components,)),
-                    ("frame", "f4", (3, 3)),
-                    ("label", "<i4"),
-                    ("backbone_coords", "f4", (4, 3)),
-                ]
-            )
+            dt = get_zernikegram_dtype(L, num_components)
             angles_db = None
             vectors_db = None
 
@@ -487,25 +839,26 @@ def get_zernikegrams_from_dataset(
             ]
         )
 
-    logger.info(f"Transforming {ds.size} in zernikegrams")
+    logger.info(f"Transforming {ds.count()} in zernikegrams")
     logger.info("Writing hdf5 file")
 
-    nhs = np.empty(shape=ds.size, dtype=(f"S{L}", (6)))
-    with h5py.File(hdf5_out, "w") as f:
-        f.create_dataset(
-            output_dataset_name, shape=(ds.size,), dtype=dt, compression=LZ4()
-        )
-        f.create_dataset(
-            "nh_list", dtype=(f"S{L}", (6)), shape=(ds.size,), compression=LZ4()
-        )
-        f.create_dataset(
-            "proportion_sidechains_removed",
-            dtype="f4",
-            shape=(ds.size,),
-            compression=LZ4(),
-        )
-        # record_metadata(metadata, f[neighborhood_list])
-        # record_metadata(metadata, f["nh_list"])
+    nhs = np.empty(shape=ds.count(), dtype=(f"S{L}", (6)))
+    if not torch_format:
+        with h5py.File(hdf5_out, "w") as f:
+            f.create_dataset(
+                output_dataset_name, shape=(ds.count(),), dtype=dt, compression=LZ4()
+            )
+            f.create_dataset(
+                "nh_list", dtype=(f"S{L}", (6)), shape=(ds.count(),), compression=LZ4()
+            )
+            f.create_dataset(
+                "proportion_sidechains_removed",
+                dtype="f4",
+                shape=(ds.count(),),
+                compression=LZ4(),
+            )
+            # record_metadata(metadata, f[neighborhood_list])
+            # record_metadata(metadata, f["nh_list"])
 
     if not torch_format:
         with Progress as bar:
@@ -529,6 +882,7 @@ def get_zernikegrams_from_dataset(
                             "rst_normalization": rst_normalization,
                         },
                         parallelism=parallelism,
+                        worker_limits=worker_limits,
                     )
                 ):
                     if hgm is None or hgm[0] is None:
@@ -558,85 +912,146 @@ def get_zernikegrams_from_dataset(
     else:
         with Progress() as bar:
             task = bar.add_task("Zernikegrams", total=ds.count())
-            with h5py.File(hdf5_out, "r+") as f:
-                n = 0
+            output = incremental if update else checkpoint
+            with output.open() as f, output.writer(f) as writer:
+                writer.create_dataset(output_dataset_name, dt)
+                writer.create_dataset("nh_list", (f"S{L}", (6)))
+                writer.create_dataset("proportion_sidechains_removed", "f4")
+                n = writer.size("nh_list")
                 init_time = time()
                 logger.info("Time to start: %.5fs" % (init_time - start_time))
-                for i, hgm in enumerate(
-                    ds.execute(
-                        get_single_zernikegram,
+                if not keep_zeros:
+                    # zernikegrams of batches of neighborhoods at once, with
+                    # the batched kernel, which does not keep zeros
+                    for zernikegrams, res_ids, proportions in ds.execute(
+                        get_zernikegrams_from_neighborhoods,
                         limit=None,
                         params={
                             "L_max": Lmax,
                             "ks": ks,
-                            "num_combi_channels": num_combi_channels,
                             "r_max": r_max,
+                            "torch_dt": dt,
                             "real_sph_harm": real_sph_harm,
-                            "keep_zeros": keep_zeros,
                             "mode": mode,
                             "channels": channels,
-                            "torch_format": torch_format,
-                            "torch_dt": dt,
                             "request_frame": request_frame,
                             "sph_harm_normalization": sph_harm_normalization,
                             "rst_normalization": rst_normalization,
                         },
                         parallelism=parallelism,
-                    )
-                ):
-
-                    new_time = time()
-                    # print('%d - %.5fs' % (i, new_time - init_time), end='\r', file=sys.stderr)
-                    try:
-                        if hgm is None or hgm[0] is None:
-                            logger.warn("error")
-                            continue
-
-                        hgm_data, nh_info, proportion_sidechain_removed = hgm
-
-                        res_id, zgram, frame, label, backbone_coords = hgm_data
+                        batched=True,
+                        worker_limits=worker_limits,
+                    ):
+                        try:
+                            if angles_db is not None:
+                                for j, res_id in enumerate(zernikegrams["res_id"]):
+                                    stringified_res_id = stringify(res_id)
+                                    zernikegrams["chi_angles"][j] = angles_db[
+                                        stringified_res_id
+                                    ]
+                                    zernikegrams["norm_vecs"][j] = vectors_db[
+                                        stringified_res_id
+                                    ]
+
+                            writer.append(output_dataset_name, zernikegrams)
+                            writer.append("nh_list", zernikegrams["res_id"])
+                            writer.append("proportion_sidechains_removed", proportions)
+                            incremental.append(zernikegrams["res_id"][:, 1])
+                            n += zernikegrams.shape[0]
+                            checkpoint.update(writer)
+                        finally:
+                            bar.update(
+                                task,
+                                advance=res_ids.shape[0],
+                                description=f"zernikegrams: {n}/{ds.count()}",
+                            )
+                else:
+                    for i, hgm in enumerate(
+                        ds.execute(
+                            get_single_zernikegram,
+                            limit=None,
+                            params={
+                                "L_max": Lmax,
+                                "ks": ks,
+                                "num_combi_channels": num_combi_channels,
+                                "r_max": r_max,
+                                "real_sph_harm": real_sph_harm,
+                                "keep_zeros": keep_zeros,
+                                "mode": mode,
+                                "channels": channels,
+                                "torch_format": torch_format,
+                                "torch_dt": dt,
+                                "request_frame": request_frame,
+                                "sph_harm_normalization": sph_harm_normalization,
+                                "rst_normalization": rst_normalization,
+                            },
+                            parallelism=parallelism,
+                            worker_limits=worker_limits,
+                        )
+                    ):
 
-                        if exclude_residues_with_no_sidechain:
-                            if label in {GLYCINE, ALANINE}:
+                        new_time = time()
+                        # print('%d - %.5fs' % (i, new_time - init_time), end='\r', file=sys.stderr)
+                        try:
+                            if hgm is None or hgm[0] is None:
+                                logger.warn("error")
                                 continue
 
-                        if angles_db is not None:
-                            stringified_res_id = stringify(res_id)
-                            chi_angles = angles_db[stringified_res_id]
-                            norm_vecs = vectors_db[stringified_res_id]
-                            arr = (
-                                res_id,
-                                zgram,
-                                frame,
-                                label,
-                                backbone_coords,
-                                chi_angles,
-                                norm_vecs,
+                            hgm_data, nh_info, proportion_sidechain_removed = hgm
+
+                            res_id, zgram, frame, label, backbone_coords = hgm_data
+
+                            if angles_db is not None:
+                                stringified_res_id = stringify(res_id)
+                                chi_angles = angles_db[stringified_res_id]
+                                norm_vecs = vectors_db[stringified_res_id]
+                                arr = (
+                                    res_id,
+                                    zgram,
+                                    frame,
+                                    label,
+                                    backbone_coords,
+                                    chi_angles,
+                                    norm_vecs,
+                                )
+                            else:
+                                arr = (res_id, zgram, frame, label, backbone_coords)
+
+                            writer.append(output_dataset_name, (*arr,))
+                            writer.append("nh_list", nh_info)
+                            incremental.append([nh_info[1]])
+                            if proportion_sidechain_removed is not None:
+                                writer.append(
+                                    "proportion_sidechains_removed",
+                                    proportion_sidechain_removed,
+                                )
+                            else:
+                                writer.append("proportion_sidechains_removed", -1.0)
+                            n += 1
+                            checkpoint.update(writer)
+
+                        finally:
+                            bar.update(
+                                task,
+                                advance=1,
+                                description=f"zernikegrams: {n}/{ds.count()}",
                             )
-                        else:
-                            arr = (res_id, zgram, frame, label, backbone_coords)
-
-                        f[output_dataset_name][n] = (*arr,)
-                        f["nh_list"][n] = nh_info
-                        if proportion_sidechain_removed is not None:
-                            f["proportion_sidechains_removed"][
-                                n
-                            ] = proportion_sidechain_removed
-                        else:
-                            f["proportion_sidechains_removed"][n] = -1.0
-
-                    finally:
-                        bar.update(
-                            task,
-                            advance=1,
-                            description=f"zernikegrams: {n}/{ds.count()}",
-                        )
-                        n += 1
 
-                logger.info(f"Resizing to {n}")
-                f[output_dataset_name].resize((n,))
-                f["nh_list"].resize((n,))
-                f["proportion_sidechains_removed"].resize((n,))
+                for res_id, reason in ds.failures:
+                    logger.warning(f"Failed to process {stringify(res_id)}: {reason}")
+                checkpoint.update(
+                    writer,
+                    failed=[(stringify(res_id), reason) for res_id, reason in ds.failures],
+                )
+                checkpoint.save(writer)
+                incremental.write(f)
+
+                logger.info(f"Number of zernikegrams: {n}")
+
+            # the last stage, so its readers do not need the manifest
+            incremental.compact(
+                [output_dataset_name, "nh_list", "proportion_sidechains_removed"]
+            )
 
 
 def main():
@@ -757,71 +1172,25 @@ def main():
     )
     parser.add_argument("--angle_db", dest="angles_db", type=str, default=None)
     parser.add_argument("--vec_db", dest="vectors_db", type=str, default=None)
+    add_worker_arguments(parser)
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        default=False,
+        help="Record progress next to --hdf5_out, and resume an interrupted run with the same arguments from it, only processing the neighborhoods that are not done yet. Requires --torch_format.",
+    )
+    parser.add_argument(
+        "--update",
+        action="store_true",
+        default=False,
+        help="Keep a manifest of the proteins in --hdf5_out, and if it exists, update it with the same arguments: only process the neighborhoods of the proteins that were added or changed in --hdf5_in since, and remove the rows of the proteins that were removed or changed. --hdf5_in must have been written with --update. Requires --torch_format, and cannot be combined with --resume.",
+    )
 
     args = parser.parse_args()
 
     logger.info(f"{args.channels=}")
 
-    if args.channels[0] == "dlpacker":
-        logger.info("using dlpacker")
-        # NOTE my code is different than williams, I switched amino acid 'O' with amino acid
-        # 'G' because glycine is canonical, whereas pyrrolysine is not.
-        # My example follows DLPackers code, which lists their amino acids in utils.py "THE20"
-        # TODO: check if dl packer puts hydrogen in the all other elements channel, if not remove it
-        args.channels = [
-            "C",
-            "N",
-            "O",
-            "S",
-            "all_other_elements",
-            "charge",
-            b"A",
-            b"R",
-            b"N",
-            b"D",
-            b"C",
-            b"Q",
-            b"E",
-            b"H",
-            b"I",
-            b"L",
-            b"K",
-            b"M",
-            b"F",
-            b"P",
-            b"S",
-            b"T",
-            b"W",
-            b"Y",
-            b"V",
-            b"G",
-            "all_other_AAs",
-        ]
-
-    elif args.channels[0] == "AAs":
-        args.channels = [
-            b"A",
-            b"R",
-            b"N",
-            b"D",
-            b"C",
-            b"Q",
-            b"E",
-            b"H",
-            b"I",
-            b"L",
-            b"K",
-            b"M",
-            b"F",
-            b"P",
-            b"S",
-            b"T",
-            b"W",
-            b"Y",
-            b"V",
-            b"G",
-            "all_other_AAs",
-        ]
+    args.channels = parse_channels(args.channels)
 
     logger.info(f"{args.channels=}")
 
@@ -847,9 +1216,13 @@ def main():
         sph_harm_normalization=args.sph_harm_normalization,
         rst_normalization=args.rst_normalization,
         torch_format=args.torch_format,
+        request_frame=args.request_frame,
         exclude_residues_with_no_sidechain=args.exclude_residues_with_no_sidechain,
         angles_db=args.angles_db,
         vectors_db=args.vectors_db,
+        worker_limits=get_worker_limits(args),
+        resume=args.resume,
+        update=args.update,
     )
 
     logger.info(f"Time of computation: {time() - s:1f} secs")
@@ -0,0 +1,723 @@
+"""
+Module for computing zernikegrams directly from structural info, without
+writing the intermediate neighborhoods to disk.
+
+Each worker loads one protein, builds all of its neighborhoods in memory and
+projects them with the batched zernike kernel, returning only zernikegram rows.
+"""
+
+import sys
+
+from argparse import ArgumentParser
+from rich.progress import Progress
+from time import time
+from typing import *
+
+import h5py
+from hdf5plugin import LZ4
+import numpy as np
+
+from zernikegrams.utils import log_config as logging
+from zernikegrams.utils.checkpoints import StageCheckpoint, replace_dataset
+from zernikegrams.utils.incremental import IncrementalUpdate
+
+logger = logging.getLogger(__name__)
+
+from zernikegrams.preprocessors.proteins_hdf5 import HDF5Preprocessor
+from zernikegrams.preprocessors.supervised_pool import (
+    WorkerLimits,
+    add_worker_arguments,
+    get_worker_limits,
+)
+from zernikegrams.neighborhoods.neighborhoods_core import (
+    get_neighborhoods_from_protein,
+)
+from zernikegrams.neighborhoods.get_neighborhoods import (
+    get_chain_dedup_index,
+    get_residue_filter,
+)
+from zernikegrams.holograms.get_holograms import (
+    get_num_components,
+    get_zernikegram_dtype,
+    get_zernikegrams_batch,
+    parse_channels,
+)
+from zernikegrams.utils.filters import ResidueFilter
+from zernikegrams.utils.argparse import *
+
+NEIGHBORHOOD_FIELDS = ("atom_names", "elements", "res_ids", "coords", "SASAs", "charges")
+
+
+def get_zernikegrams_from_protein(
+    np_protein: np.ndarray,
+    r_max: float,
+    L_max: int,
+    ks: np.ndarray,
+    torch_dt: np.dtype,
+    real_sph_harm: bool = True,
+    mode: str = "ns",
+    channels: List[str] = ["C", "N", "O", "S", "H", "SASA", "charge"],
+    request_frame: bool = False,
+    sph_harm_normalization: str = "component",
+    rst_normalization: Optional[str] = None,
+    unique_chains: bool = False,
+    remove_central_residue: bool = False,
+    remove_central_sidechain: bool = False,
+    central_residue_only: bool = False,
+    keep_central_CA: bool = False,
+    backbone_only: bool = False,
+    get_residues=None,
+    residue_filter: Optional[ResidueFilter] = None,
+    duplicate_chains: Optional[Dict] = None,
+    **kwargs,
+) -> Tuple[bytes, Optional[np.ndarray]]:
+    """
+    Gets the zernikegrams of all the neighborhoods of one structural info unit
+
+    Parameters
+    ----------
+    np_protein : np.ndarray
+        Array representation of a protein
+    torch_dt : np.dtype
+        Dtype of the zernikegram rows, see `get_zernikegram_dtype`
+    residue_filter : ResidueFilter, optional
+        Only residues that pass the filter contribute zernikegrams
+    duplicate_chains : dict, optional
+        Maps pdbs to the chains that do not contribute neighborhoods, see
+        `get_chain_dedup_index`
+
+    Returns
+    -------
+    Tuple of (pdb, zernikegram rows), where the rows are None if the protein
+    could not be processed
+    """
+    pdb = np_protein[0]
+
+    try:
+        if get_residues is None:
+            res_ids = None
+        else:
+            res_ids = get_residues(np_protein)
+
+        if duplicate_chains is None:
+            excluded_chains = None
+        else:
+            excluded_chains = duplicate_chains.get(pdb)
+
+        neighborhoods = get_neighborhoods_from_protein(
+            np_protein,
+            r_max=r_max,
+            res_ids_selection=res_ids,
+            uc=unique_chains,
+            excluded_chains=excluded_chains,
+            residue_filter=residue_filter,
+            remove_central_residue=remove_central_residue,
+            remove_central_sidechain=remove_central_sidechain,
+            central_residue_only=central_residue_only,
+            keep_central_CA=keep_central_CA,
+            backbone_only=backbone_only,
+            coordinate_system="spherical",
+            store_frames=request_frame,
+        )
+
+        if len(neighborhoods) == 0:
+            return pdb, np.zeros(shape=(0,), dtype=torch_dt)
+
+        # concatenate the ragged neighborhoods, with the same field dtypes as
+        # the padded neighborhoods would have on disk
+        res_id = np.stack([nh[0] for nh in neighborhoods])
+        lengths = np.array([nh[1].shape[0] for nh in neighborhoods])
+        nhs = {
+            name: np.concatenate([nh[i + 1] for nh in neighborhoods])
+            for i, name in enumerate(NEIGHBORHOOD_FIELDS)
+        }
+        for name in ("coords", "SASAs", "charges"):
+            nhs[name] = nhs[name].astype(np.float32)
+        if request_frame:
+            frames = np.stack([nh[-1] for nh in neighborhoods])
+        else:
+            frames = None
+
+        zernikegrams = get_zernikegrams_batch(
+            res_id,
+            nhs,
+            lengths,
+            L_max,
+            ks,
+            r_max,
+            torch_dt,
+            real_sph_harm=real_sph_harm,
+            mode=mode,
+            channels=channels,
+            request_frame=request_frame,
+            sph_harm_normalization=sph_harm_normalization,
+            rst_normalization=rst_normalization,
+            frames=frames,
+        )
+    except Exception as e:
+        logger.error(f"Error with {pdb}")
+        logger.exception(e)
+        return pdb, None
+
+    return pdb, zernikegrams
+
+
+def get_zernikegrams_from_structural_info_fn(
+    proteins: np.ndarray,
+    r_max: float,
+    radial_func_max: int,
+    Lmax: int,
+    channels: List[str],
+    request_frame: bool = False,
+    real_sph_harm: bool = True,
+    sph_harm_normalization: str = "component",
+    rst_normalization: Optional[str] = None,
+    radial_func_mode="ns",
+    unique_chains: bool = False,
+    remove_central_residue: bool = False,
+    remove_central_sidechain: bool = False,
+    central_residue_only: bool = False,
+    keep_central_CA: bool = False,
+    backbone_only: bool = False,
+    get_residues=None,
+    residue_filter: Optional[ResidueFilter] = None,
+) -> Dict:
+    """
+    In-memory counterpart of `get_neighborhoods_fn` followed by
+    `get_holograms_fn`, that does not materialize padded neighborhoods.
+    """
+    ks = np.arange(radial_func_max + 1)
+    num_components = get_num_components(Lmax, ks, False, radial_func_mode, channels)
+    L = np.max(list(map(len, proteins["pdb"])) + [5])
+    dt = get_zernikegram_dtype(L, num_components)
+
+    zernikegrams = []
+    for np_protein in proteins:
+        pdb, arr = get_zernikegrams_from_protein(
+            np_protein,
+            r_max,
+            Lmax,
+            ks,
+            dt,
+            real_sph_harm=real_sph_harm,
+            mode=radial_func_mode,
+            channels=channels,
+            request_frame=request_frame,
+            sph_harm_normalization=sph_harm_normalization,
+            rst_normalization=rst_normalization,
+            unique_chains=unique_chains,
+            remove_central_residue=remove_central_residue,
+            remove_central_sidechain=remove_central_sidechain,
+            central_residue_only=central_residue_only,
+            keep_central_CA=keep_central_CA,
+            backbone_only=backbone_only,
+            get_residues=get_residues,
+            residue_filter=residue_filter,
+        )
+        if arr is None:
+            print(f"Error with PDB {pdb}. Skipping.")
+            continue
+        zernikegrams.append(arr)
+
+    # empty, with the output dtype, if every protein failed
+    zernikegrams = np.concatenate(zernikegrams) if zernikegrams else np.zeros(0, dtype=dt)
+
+    return {
+        "zernikegram": zernikegrams["zernikegram"],
+        "res_id": zernikegrams["res_id"],
+        "frame": zernikegrams["frame"] if request_frame else None,
+        "label": zernikegrams["label"],
+        "backbone_coords": zernikegrams["backbone_coords"],
+    }
+
+
+def get_zernikegrams_from_structural_info(
+    hdf5_in: str,
+    input_dataset_name: str,
+    hdf5_out: str,
+    output_dataset_name: str,
+    r_max: float,
+    Lmax: int,
+    ks: np.ndarray,
+    parallelism: int = 4,
+    real_sph_harm: bool = True,
+    mode: str = "ns",
+    channels: List[str] = ["C", "N", "O", "S", "H", "SASA", "charge"],
+    request_frame: bool = False,
+    sph_harm_normalization: str = "component",
+    rst_normalization: Optional[str] = None,
+    exclude_residues_with_no_sidechain: bool = False,
+    unique_chains: bool = False,
+    remove_central_residue: bool = False,
+    remove_central_sidechain: bool = False,
+    central_residue_only: bool = False,
+    keep_central_CA: bool = False,
+    backbone_only: bool = False,
+    get_residues_file: Optional[str] = None,
+    filter_out_chains_not_in_proteinnet: bool = False,
+    pdb_chain_pairs_to_consider_filepath: Optional[str] = None,
+    dedup_chains_across_pdbs: bool = False,
+    residue_selection_file: Optional[str] = None,
+    shared_memory_mb: Optional[int] = None,
+    worker_limits: WorkerLimits = WorkerLimits(),
+    resume: bool = False,
+    update: bool = False,
+):
+    """
+    Parallel computation of zernikegrams from a structural info file, writing
+    to hdf5_out the same datasets as `neighborhoods` followed by `zernikegrams`
+    with the torch format, without writing the neighborhoods.
+
+    Parameters
+    ----------
+    hdf5_in : str
+        Path to hdf5 file containing structural info
+    input_dataset_name : str
+        Name of the dataset within the hdf5 file to process
+    hdf5_out : str
+        Path to write the output file
+    parallelism : int
+        Number of workers to use
+    dedup_chains_across_pdbs : bool
+        Whether chains identical to a chain of another entry should not contribute
+        zernikegrams. The duplicates are recorded in the "chain_aliases" dataset.
+    residue_selection_file : str, optional
+        Path to a residue selection file, see `zernikegrams.utils.residue_selection`.
+        Proteins with no selected residue are not loaded.
+    shared_memory_mb : int, optional
+        Size in MB of the shared memory buffers the workers send their
+        zernikegrams through, see `zernikegrams.preprocessors.shared_memory_ring`.
+    worker_limits : WorkerLimits
+        Limits of the workers, see `zernikegrams.preprocessors.supervised_pool`.
+        Proteins whose worker fails them are added to pdbs_fail.
+    resume : bool
+        Whether to record progress, and to resume an interrupted run with the
+        same parameters, see `zernikegrams.utils.checkpoints`.
+    update : bool
+        Whether to keep a manifest of the proteins, and to only process the
+        proteins that were added or changed in hdf5_in since the last run,
+        see `zernikegrams.utils.incremental`. hdf5_in must have been written
+        with update too.
+    """
+    if resume and update:
+        raise ValueError("Cannot resume and update at the same time")
+    if dedup_chains_across_pdbs and update:
+        # the duplicates depend on all the proteins, not only the updated ones
+        raise ValueError("Cannot update with dedup_chains_across_pdbs")
+
+    ds = HDF5Preprocessor(hdf5_in, input_dataset_name)
+    if update and ds.hashes is None:
+        raise ValueError(f"Cannot update from {hdf5_in}, it has no manifest")
+
+    ks = np.array(ks)
+
+    # import user method
+    if not get_residues_file is None:
+        import importlib.util
+
+        spec = importlib.util.spec_from_file_location(
+            "get_residues_module", get_residues_file
+        )
+        module = importlib.util.module_from_spec(spec)
+        sys.modules["get_residues_module"] = module
+        spec.loader.exec_module(module)
+
+        from get_residues_module import get_residues
+    else:
+        get_residues = None
+
+    residue_filter = get_residue_filter(
+        hdf5_in,
+        filter_out_chains_not_in_proteinnet=filter_out_chains_not_in_proteinnet,
+        pdb_chain_pairs_to_consider_filepath=pdb_chain_pairs_to_consider_filepath,
+        residue_selection_file=residue_selection_file,
+        exclude_residues_with_no_sidechain=exclude_residues_with_no_sidechain,
+    )
+    if residue_filter.pdbs is not None:
+        ds.filter_pdbs(residue_filter.pdbs)
+
+    if dedup_chains_across_pdbs:
+        duplicate_chains, chain_aliases = get_chain_dedup_index(ds, parallelism)
+    else:
+        duplicate_chains, chain_aliases = None, None
+
+    params = {
+        "hdf5_in": hdf5_in,
+        "input_dataset_name": input_dataset_name,
+        "output_dataset_name": output_dataset_name,
+        "r_max": r_max,
+        "Lmax": Lmax,
+        "ks": list(ks),
+        "real_sph_harm": real_sph_harm,
+        "mode": mode,
+        "channels": channels,
+        "request_frame": request_frame,
+        "sph_harm_normalization": sph_harm_normalization,
+        "rst_normalization": rst_normalization,
+        "exclude_residues_with_no_sidechain": exclude_residues_with_no_sidechain,
+        "unique_chains": unique_chains,
+        "remove_central_residue": remove_central_residue,
+        "remove_central_sidechain": remove_central_sidechain,
+        "central_residue_only": central_residue_only,
+        "keep_central_CA": keep_central_CA,
+        "backbone_only": backbone_only,
+        "get_residues_file": get_residues_file,
+        "filter_out_chains_not_in_proteinnet": filter_out_chains_not_in_proteinnet,
+        "pdb_chain_pairs_to_consider_filepath": pdb_chain_pairs_to_consider_filepath,
+        "dedup_chains_across_pdbs": dedup_chains_across_pdbs,
+        "residue_selection_file": residue_selection_file,
+    }
+    incremental = IncrementalUpdate(hdf5_out, params, "nh_list", update=update)
+    L = incremental.get_name_length(np.max([ds.pdb_name_length, 5]))
+    num_components = get_num_components(Lmax, ks, False, mode, channels)
+    dt = get_zernikegram_dtype(L, num_components)
+
+    checkpoint = StageCheckpoint(hdf5_out, params, resume=resume)
+    if checkpoint.resuming:
+        ds.skip_pdbs(checkpoint.is_skipped)
+    if update:
+        incremental.plan(ds.hashes)
+        ds.skip_pdbs(incremental.is_skipped)
+
+    # the proteins done by an earlier run
+    pdbs_pass = [
+        pdb.encode("utf-8") for pdb in sorted(checkpoint.done)
+        if pdb not in checkpoint.failed
+    ]
+    pdbs_fail = [pdb.encode("utf-8") for pdb in checkpoint.failed]
+    pdbs_pass.extend(incremental.read_kept("pdbs_pass"))
+    pdbs_fail.extend(incremental.read_kept("pdbs_fail"))
+
+    logger.info("Writing hdf5 file")
+    with Progress() as bar:
+        task = bar.add_task("Zernikegrams", total=ds.count())
+        output = incremental if update else checkpoint
+        with output.open() as f, output.writer(f) as writer:
+            writer.create_dataset(output_dataset_name, dt)
+            writer.create_dataset("nh_list", (f"S{L}", (6)))
+            writer.create_dataset("proportion_sidechains_removed", "f4")
+            n = writer.size("nh_list")
+            for i, (pdb, zernikegrams) in enumerate(
+                ds.execute(
+                    get_zernikegrams_from_protein,
+                    limit=None,
+                    params={
+                        "r_max": r_max,
+                        "L_max": Lmax,
+                        "ks": ks,
+                        "torch_dt": dt,
+                        "real_sph_harm": real_sph_harm,
+                        "mode": mode,
+                        "channels": channels,
+                        "request_frame": request_frame,
+                        "sph_harm_normalization": sph_harm_normalization,
+                        "rst_normalization": rst_normalization,
+                        "unique_chains": unique_chains,
+                        "remove_central_residue": remove_central_residue,
+                        "remove_central_sidechain": remove_central_sidechain,
+                        "central_residue_only": central_residue_only,
+                        "keep_central_CA": keep_central_CA,
+                        "backbone_only": backbone_only,
+                        "get_residues": get_residues,
+                        "residue_filter": residue_filter,
+                        "duplicate_chains": duplicate_chains,
+                    },
+                    parallelism=parallelism,
+                    shared_memory_bytes=(
+                        None if shared_memory_mb is None else shared_memory_mb << 20
+                    ),
+                    worker_limits=worker_limits,
+                )
+            ):
+                try:
+                    if zernikegrams is None:
+                        pdbs_fail.append(pdb)
+                        checkpoint.update(
+                            writer, done=[pdb], failed=[(pdb, "failed to get the zernikegrams")]
+                        )
+                        continue
+
+                    num_zernikegrams = zernikegrams.shape[0]
+
+                    if num_zernikegrams == 0:
+                        logger.warning(f"No zernikegrams for {pdb}. Skipping.")
+                        pdbs_fail.append(pdb)
+                        checkpoint.update(
+                            writer, done=[pdb], failed=[(pdb, "no zernikegrams")]
+                        )
+                        continue
+
+                    writer.append(output_dataset_name, zernikegrams)
+                    writer.append("nh_list", zernikegrams["res_id"])
+                    writer.append(
+                        "proportion_sidechains_removed",
+                        np.full(num_zernikegrams, -1.0, dtype=np.float32),
+                    )
+                    incremental.append(zernikegrams["res_id"][:, 1])
+
+                    n += num_zernikegrams
+                    pdbs_pass.append(pdb)
+                    checkpoint.update(writer, done=[pdb])
+                except Exception as e:
+                    logger.warning(
+                        "Failed to process zernikegrams with the following error:"
+                    )
+                    logger.exception(e)
+                finally:
+                    bar.update(
+                        task,
+                        advance=1,
+                        description=f"Zernikegrams: {i + 1}/{ds.count()}",
+                    )
+
+            for pdb, reason in ds.failures:
+                logger.warning(f"Failed to process {pdb}: {reason}")
+                pdbs_fail.append(pdb)
+            checkpoint.update(writer, failed=ds.failures)
+            checkpoint.save(writer)
+
+            logger.info(f"Number of processed zernikegrams: {n}")
+
+            incremental.write(f)
+            replace_dataset(f, "pdbs_pass", data=pdbs_pass)
+            replace_dataset(f, "pdbs_fail", data=pdbs_fail)
+
+            if chain_aliases is not None:
+                replace_dataset(f, "chain_aliases", data=chain_aliases)
+
+    # the last stage, so its readers do not need the manifest
+    incremental.compact(
+        [output_dataset_name, "nh_list", "proportion_sidechains_removed"]
+    )
+
+
+def main():
+    parser = ArgumentParser()
+
+    parser.add_argument(
+        "--hdf5_in",
+        type=str,
+        help="input hdf5 filename, containing structural info",
+        required=True,
+    )
+    parser.add_argument(
+        "--hdf5_out",
+        type=str,
+        help="ouptut hdf5 filename, which will contain zernikegrams.",
+        required=True,
+    )
+    parser.add_argument(
+        "--input_dataset_name",
+        type=str,
+        help='Name of the dataset within hdf5_in where the structural information is stored. We recommend keeping this set to simply "data".',
+        default="data",
+    )
+    parser.add_argument(
+        "--output_dataset_name",
+        type=str,
+        help='Name of the dataset within hdf5_out where the zernikegrams will be stored. We recommend keeping this set to simply "data".',
+        default="data",
+    )
+    parser.add_argument(
+        "--parallelism", type=int, help="Parallelism for multiprocessing.", default=4
+    )
+
+    # neighborhoods
+    parser.add_argument(
+        "--r_max",
+        type=float,
+        help="Radius of neighborhood, with zero at central residue's CA",
+        default=10.0,
+    )
+    parser.add_argument(
+        "--remove_central_residue",
+        help="Whether to remove the central residue from the neighborhood. Cannot be done in conjunction with --central_residue_only nor --remove_central_sidechain.",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--remove_central_sidechain",
+        help="Whether to remove the central residue's sidechain from the neighborhood, while keeping the backbone atoms. Cannot be done in conjunction with --central_residue_only nor --remove_central_residue.",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--central_residue_only",
+        help="Whether to only keep the central residue in the neighborhood. Cannot be done in conjunction with --remove_central_residue nor --remove_central_sidechain.",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--keep_central_CA",
+        help="Whether to keep the central residue's CA in the neighborhood.",
+        action="store_true",
+        default=False
+    )
+    parser.add_argument(
+        "--backbone_only",
+        help="Whether to only include backbone atoms in the neighborhood, as opposed to all atoms.",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--unique_chains",
+        help="Only take one neighborhood per residue per unique chain",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--get_residues_file",
+        type=str,
+        default=None
+    )
+    parser.add_argument(
+        "--filter_out_chains_not_in_proteinnet",
+        help="Whether to filter out chains not in proteinnet. Only relevant when training and testing on proteinnet casp12 PDBs.",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--pdb_chain_pairs_to_consider_filepath",
+        type=str,
+        help="Path to file containing pdb_chain pairs to consider.",
+        default=None
+    )
+    parser.add_argument(
+        "--residue_selection_file",
+        type=str,
+        help="Path to a file selecting the residues to use as neighborhood centers, with one 'pdb [chain [resnums]]' entry per line, e.g. '1abc A 10-20,35'. Proteins not in the file are skipped without being loaded.",
+        default=None,
+    )
+    parser.add_argument(
+        "--dedup_chains_across_pdbs",
+        help="Only take neighborhoods from one chain per unique sequence across the whole dataset. Duplicate chains are recorded in the chain_aliases dataset.",
+        action="store_true",
+        default=False,
+    )
+
+    # zernikegrams
+    parser.add_argument(
+        "--l_max",
+        type=int,
+        help="Maximum spherical frequency to use in projections",
+        default=6,
+    )
+    parser.add_argument(
+        "--radial_func_mode",
+        type=str,
+        help="Operation mode for radial functions: \
+              ns (treating k input as literal n values to use), \
+              ks (treating k values as wavelengths)",
+        default="ns",
+    )
+    parser.add_argument(
+        "--radial_func_max",
+        type=int,
+        help="Maximum radial frequency to use in projections",
+        default=20,
+    )
+    parser.add_argument(
+        "--channels",
+        type=comma_sep_str_list,
+        help="Channels to use in zernikegrams.",
+        default=["C", "N", "O", "S"],
+    )
+    parser.add_argument(
+        "--sph_harm_normalization",
+        type=str,
+        help="Normalization to use for spherical harmonics."
+        'Use "integral" for pre-trained tensorflow HCNN_AA, "component" for pre-trained pytorch H-(V)AE.',
+        choices=["integral", "component"],
+        default="component",
+    )
+    parser.add_argument(
+        "--rst_normalization",
+        type=optional_str,
+        help="Normalization to use for the zernikegrams of individual Dirac-delta functions. We find that 'square' tends to work the best.",
+        choices=[None, "None", "square"],
+        default=None,
+    )
+    parser.add_argument(
+        "--use_complex_sph_harm",
+        help="Use complex spherical harmonics, as opposed to real oness.",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--request_frame",
+        help="Request frame from dataset.",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--exclude_residues_with_no_sidechain",
+        action="store_true",
+        default=False,
+        help="Effectively excludes neighborhoods whose central residue is a Glycine or an Alanine.",
+    )
+    parser.add_argument(
+        "--shared_memory_mb",
+        type=int,
+        help="Send the zernikegrams of each protein from the workers through shared memory buffers of this size in MB instead of pickling them through a pipe. Results that do not fit go through the pipe as usual.",
+        default=None,
+    )
+    add_worker_arguments(parser)
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        default=False,
+        help="Record progress next to --hdf5_out, and resume an interrupted run with the same arguments from it, only processing the proteins that are not done yet.",
+    )
+    parser.add_argument(
+        "--update",
+        action="store_true",
+        default=False,
+        help="Keep a manifest of the proteins in --hdf5_out, and if it exists, update it with the same arguments: only process the proteins that were added or changed in --hdf5_in since, and remove the rows of the proteins that were removed or changed. --hdf5_in must have been written with --update. Cannot be combined with --resume.",
+    )
+
+    args = parser.parse_args()
+
+    args.channels = parse_channels(args.channels)
+
+    logger.info(f"{args.channels=}")
+
+    s = time()
+
+    get_zernikegrams_from_structural_info(
+        args.hdf5_in,
+        args.input_dataset_name,
+        args.hdf5_out,
+        args.output_dataset_name,
+        args.r_max,
+        args.l_max,
+        np.arange(args.radial_func_max + 1),
+        parallelism=args.parallelism,
+        real_sph_harm=not args.use_complex_sph_harm,
+        mode=args.radial_func_mode,
+        channels=args.channels,
+        request_frame=args.request_frame,
+        sph_harm_normalization=args.sph_harm_normalization,
+        rst_normalization=args.rst_normalization,
+        exclude_residues_with_no_sidechain=args.exclude_residues_with_no_sidechain,
+        unique_chains=args.unique_chains,
+        remove_central_residue=args.remove_central_residue,
+        remove_central_sidechain=args.remove_central_sidechain,
+        central_residue_only=args.central_residue_only,
+        keep_central_CA=args.keep_central_CA,
+        backbone_only=args.backbone_only,
+        get_residues_file=args.get_residues_file,
+        filter_out_chains_not_in_proteinnet=args.filter_out_chains_not_in_proteinnet,
+        pdb_chain_pairs_to_consider_filepath=args.pdb_chain_pairs_to_consider_filepath,
+        dedup_chains_across_pdbs=args.dedup_chains_across_pdbs,
+        residue_selection_file=args.residue_selection_file,
+        shared_memory_mb=args.shared_memory_mb,
+        worker_limits=get_worker_limits(args),
+        resume=args.resume,
+        update=args.update,
+    )
+
+    logger.info(f"Time of computation: {time() - s:1f} secs")
+
+
+if __name__ == "__main__":
+    main()
@@ -520,13 +520,221 @@ def get_hologram(
                 "nm,cm->cn", change_basis_complex_to_real(l), np.conj(arr[0][l])
             ).real
         return arr_real[0], np.array(list(zip(ns, ls, ms)))
-    if request_frame:
+    if request_frame and "frame" in nh.dtype.names:
+        # stored by the neighborhoods stage
+        frame = nh["frame"]
+    elif request_frame:
         frame = get_frame(nh)
     else:
         frame = None
     return arr[0], frame  # , np.array(list(zip(ns, ls, ms)))
 
 
+def zernike_coeff_lm_batch(
+    r: np.ndarray,
+    t: np.ndarray,
+    p: np.ndarray,
+    n: np.ndarray,
+    r_max: np.float32,
+    l: np.ndarray,
+    m: np.ndarray,
+    weights: np.ndarray,
+    segments: np.ndarray,
+    num_segments: int,
+    rst_normalization: Optional[str] = None,
+) -> np.ndarray:
+    """
+    Compute Zernike coefficients for many point clouds at once.
+
+    Same math as `zernike_coeff_lm_new`, but the points of all the point clouds
+    are concatenated and `segments` assigns each point to its point cloud. The
+    radial and angular terms are evaluated once per unique (n, l) and (l, m)
+    combination over all points.
+
+    Parameters
+    ----------
+    r, t, p : np.ndarray
+        Radii, theta and phi values of all points, shape [T].
+    n, l, m : np.ndarray
+        Combined Zernike indices, shape [nlm].
+    r_max : np.float64
+
+    weights : np.ndarray
+        Channel weights of all points, shape [C, T].
+    segments : np.ndarray
+        Index of the point cloud each point belongs to, shape [T]. Points of
+        the same point cloud must be contiguous.
+    num_segments : int
+        Number of point clouds.
+
+    Returns
+    -------
+    coeffs : np.ndarray
+        Zernike coefficients of shape [num_segments, C, nlm].
+    """
+    D = 3.0
+
+    A = np.power(-1.0 + 0j, (n - l) / 2.0)
+    B = np.sqrt(2.0 * n + D)
+    C = sp.special.binom((n + l + D) // 2 - 1, (n - l) // 2)
+
+    nl_unique_combs, nl_inv_map = np.unique(
+        np.vstack([n, l]).T, axis=0, return_inverse=True
+    )
+    nl_inv_map = nl_inv_map.reshape(-1)
+    E_unique = sp.special.hyp2f1(
+        -(nl_unique_combs[:, 0, None] - nl_unique_combs[:, 1, None]) / 2.0,
+        (nl_unique_combs[:, 0, None] + nl_unique_combs[:, 1, None] + D) / 2.0,
+        nl_unique_combs[:, 1, None] + D / 2.0,
+        r[None, :] ** 2 / r_max**2,
+    )
+
+    # the radial part only depends on (n, l)
+    R_unique = E_unique * np.power(r[None, :] / r_max, nl_unique_combs[:, 1, None])
+
+    lm_unique_combs, lm_inv_map = np.unique(
+        np.vstack([l, m]).T, axis=0, return_inverse=True
+    )
+    lm_inv_map = lm_inv_map.reshape(-1)
+    y_unique = np.conj(
+        sp.special.sph_harm(
+            lm_unique_combs[:, 1, None],
+            lm_unique_combs[:, 0, None],
+            p[None, :],
+            t[None, :],
+        )
+    )
+
+    # n indexes the combinations of n, l, m and N indexes the points
+    all_points_coeffs = (
+        (A * B * C)[:, None]
+        * R_unique[nl_inv_map]
+        * y_unique[lm_inv_map]
+    )
+
+    if rst_normalization == "square":
+        square_norm = 1.0 / np.einsum(
+            "nN->N", all_points_coeffs * np.conj(all_points_coeffs)
+        )
+        weights = weights * square_norm[None, :]
+
+    # points of a point cloud are contiguous, so the per-cloud sums are small
+    # matmuls over slices of points
+    offsets = np.concatenate(
+        [[0], np.cumsum(np.bincount(segments, minlength=num_segments))]
+    )
+    coeffs = np.zeros(
+        (num_segments, weights.shape[0], all_points_coeffs.shape[0]),
+        dtype=all_points_coeffs.dtype,
+    )
+    for i in range(num_segments):
+        points = slice(offsets[i], offsets[i + 1])
+        coeffs[i] = weights[:, points] @ all_points_coeffs[:, points].T
+
+    return coeffs
+
+
+def get_holograms_batch(
+    nhs: Dict[str, np.ndarray],
+    lengths: np.ndarray,
+    L_max: int,
+    radial_nums: Union[List, np.ndarray],
+    r_max: np.float32,
+    mode: str = "ks",
+    channels: List[str] = ["C", "N", "O", "S", "H", "SASA", "charge"],
+    rst_normalization: Optional[str] = None,
+    max_atoms_per_batch: int = 8192,
+) -> Dict[str, np.ndarray]:
+    """
+    Batched counterpart of `get_hologram`, without zeros.
+
+    Parameters
+    ----------
+    nhs : Dict[str, np.ndarray]
+        The atoms of all neighborhoods, concatenated. Must contain "coords"
+        (spherical), "elements", "atom_names" and "res_ids", plus "SASAs" and
+        "charges" if those channels are requested.
+    lengths : np.ndarray
+        Number of atoms of each neighborhood, in order.
+    max_atoms_per_batch : int
+        Neighborhoods are projected in groups of about this many atoms, to bound
+        the memory of the intermediate [nlm, atoms] arrays.
+
+    Returns
+    -------
+    Dict[str, np.ndarray]
+        Maps str(l) to complex holograms of shape
+        [num_neighborhoods, num_radial(l) * num_channels, 2l + 1], with the
+        same layout as the fields returned by `get_hologram`.
+    """
+    lengths = np.asarray(lengths)
+    num_nhs = lengths.shape[0]
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+
+    real_locs = np.logical_and(
+        nhs["atom_names"] != EMPTY_ATOM_NAME, nhs["coords"][:, 0] <= r_max
+    )
+    segments = np.repeat(np.arange(num_nhs), lengths)
+
+    ns, ls, ms = get_3D_zernike_function_indices(
+        L_max, radial_nums, mode=mode, keep_zeros=False
+    )
+    nmax_per_l = np.array([len(np.unique(ns[ls == l])) for l in range(L_max + 1)])
+
+    out_z = np.zeros((num_nhs, len(channels), ns.shape[0]), dtype=np.complex64)
+
+    # group consecutive neighborhoods so that each group has a bounded number of atoms
+    group_starts = [0]
+    for i in range(1, num_nhs):
+        if offsets[i] - offsets[group_starts[-1]] >= max_atoms_per_batch:
+            group_starts.append(i)
+    group_ends = group_starts[1:] + [num_nhs]
+
+    for start, end in zip(group_starts, group_ends):
+        # indices of the real atoms of the group
+        locs = offsets[start] + np.flatnonzero(real_locs[offsets[start] : offsets[end]])
+        if locs.shape[0] == 0:
+            continue
+
+        group_nh = {
+            key: nhs[key][locs]
+            for key in ("res_ids", "SASAs", "charges")
+            if key in nhs
+        }
+        atom_names = nhs["atom_names"][locs]
+        backbone_mask = np.logical_or.reduce([atom_names == b for b in BACKBONE_ATOMS])
+        elements = nhs["elements"][locs]
+        group_real_locs = np.ones(elements.shape[0], dtype=bool)
+
+        arr_weights = np.empty(shape=(len(channels), elements.shape[0]))
+        for i, ch in enumerate(channels):
+            arr_weights[i] = get_channel_weights(
+                ch, group_nh, elements, group_real_locs, backbone_mask
+            )
+
+        r, t, p = np.einsum("ij->ji", nhs["coords"][locs])
+        out_z[start:end] = zernike_coeff_lm_batch(
+            r,
+            t,
+            p,
+            ns,
+            r_max,
+            ls,
+            ms,
+            arr_weights,
+            segments[locs] - start,
+            end - start,
+            rst_normalization,
+        )
+
+    hgms = {}
+    for l in range(L_max + 1):
+        hgms[str(l)] = out_z[:, :, ls == l].reshape(
+            num_nhs, nmax_per_l[l] * len(channels), 2 * l + 1
+        )
+    return hgms
+
+
 def get_frame(nh):
     try:
         cartesian_coords = nh["coords"]
@@ -0,0 +1,240 @@
+"""
+Neighborhoods grouped by number of atoms, so that every neighborhood is only
+padded to the size of its bucket rather than to one global max_atoms.
+
+A bucketed neighborhoods output is an HDF5 group with:
+
+    <size>      neighborhoods with at most <size> atoms (and more atoms than
+                the previous bucket), padded to <size> atoms
+    overflow    neighborhoods with more atoms than the largest bucket, padded
+                to max_atoms
+    index       (bucket, offset) of every neighborhood, in the order of the
+                "nh_list" dataset
+
+The names of the buckets, in the order of the index, are in the "buckets"
+attribute of the group. Neighborhoods with more than max_atoms atoms cannot be
+stored; they are counted in the "num_dropped" attribute and their residue ids
+are in the "dropped" dataset.
+"""
+
+from typing import *
+
+import h5py
+import numpy as np
+
+from zernikegrams.neighborhoods.neighborhoods_core import (
+    get_neighborhood_dtype,
+    pad_neighborhoods,
+)
+from zernikegrams.utils import log_config as logging
+from zernikegrams.utils.hdf5_writer import BufferedHDF5Writer
+
+logger = logging.getLogger(__name__)
+
+OVERFLOW = "overflow"
+INDEX_DT = np.dtype([("bucket", "u1"), ("offset", "<i8")])
+
+
+def get_bucket_names(bucket_sizes: Sequence[int]) -> List[str]:
+    return [str(size) for size in bucket_sizes] + [OVERFLOW]
+
+
+def check_bucket_sizes(bucket_sizes: Sequence[int], max_atoms: int) -> List[int]:
+    """
+    Validates the bucket sizes against the padding of the overflow bucket.
+
+    Returns
+    -------
+    The sorted bucket sizes
+    """
+    bucket_sizes = sorted(set(bucket_sizes))
+    if len(bucket_sizes) == 0 or bucket_sizes[0] <= 0:
+        raise ValueError(f"Invalid bucket sizes {bucket_sizes}")
+    if bucket_sizes[-1] >= max_atoms:
+        raise ValueError(
+            f"The largest bucket size, {bucket_sizes[-1]}, must be smaller than "
+            f"max_atoms, {max_atoms}, which is the padding of the overflow bucket."
+        )
+    return bucket_sizes
+
+
+def assign_buckets(
+    lengths: np.ndarray, bucket_sizes: Sequence[int], max_atoms: int
+) -> np.ndarray:
+    """
+    Bucket of neighborhoods with the given number of atoms.
+
+    Returns
+    -------
+    np.ndarray of int, with len(bucket_sizes) for the overflow bucket and -1
+    for the neighborhoods with more than max_atoms atoms
+    """
+    buckets = np.searchsorted(bucket_sizes, lengths, side="left")
+    buckets[lengths > max_atoms] = -1
+    return buckets
+
+
+def bucket_neighborhoods(
+    neighborhoods: List, bucket_sizes: Sequence[int], max_atoms: int
+) -> Tuple[np.ndarray, np.ndarray, List[Optional[np.ndarray]]]:
+    """
+    Pad the neighborhoods of a protein to the size of their bucket.
+
+    Parameters
+    ----------
+    neighborhoods : list
+        Neighborhoods as returned by `get_neighborhoods_from_protein`
+    bucket_sizes : sequence of int
+        Sorted bucket sizes, see `check_bucket_sizes`
+    max_atoms : int
+        Padding of the overflow bucket
+
+    Returns
+    -------
+    Tuple of (res_id of every neighborhood, bucket of every neighborhood as in
+    `assign_buckets`, padded neighborhoods of every bucket - None if empty -
+    in the order of the neighborhoods)
+    """
+    res_id = np.stack([neighborhood[0] for neighborhood in neighborhoods])
+    lengths = np.array([neighborhood[1].shape[0] for neighborhood in neighborhoods])
+    buckets = assign_buckets(lengths, bucket_sizes, max_atoms)
+
+    padded = []
+    for bucket, size in enumerate(list(bucket_sizes) + [max_atoms]):
+        inds = np.nonzero(buckets == bucket)[0]
+        if inds.shape[0] == 0:
+            padded.append(None)
+        else:
+            padded.append(
+                pad_neighborhoods([neighborhoods[i] for i in inds], padded_length=size)
+            )
+    return res_id, buckets, padded
+
+
+class BucketedNeighborhoodsWriter:
+    """
+    Appends bucketed neighborhoods to an HDF5 group, see the module docstring
+    for the layout.
+
+    Parameters
+    ----------
+    writer : BufferedHDF5Writer
+        Writer of the output file
+    name : str
+        Name of the group
+    """
+
+    def __init__(
+        self,
+        writer: BufferedHDF5Writer,
+        name: str,
+        res_id_dt: np.dtype,
+        bucket_sizes: Sequence[int],
+        max_atoms: int,
+        frame: bool = False,
+    ):
+        self.writer = writer
+        self.name = name
+        # the group exists when resuming, see `zernikegrams.utils.checkpoints`
+        self.group = writer.f.require_group(name)
+        self.names = get_bucket_names(bucket_sizes)
+        self.sizes = list(bucket_sizes) + [max_atoms]
+
+        for bucket_name, size in zip(self.names, self.sizes):
+            writer.create_dataset(
+                f"{name}/{bucket_name}",
+                get_neighborhood_dtype(res_id_dt, size, frame=frame),
+            )
+        writer.create_dataset(f"{name}/index", INDEX_DT)
+        writer.create_dataset(f"{name}/dropped", res_id_dt, shape=(6,))
+        self.group.attrs["buckets"] = self.names
+        self.num_dropped = writer.size(f"{name}/dropped")
+
+    def write(
+        self,
+        res_id: np.ndarray,
+        buckets: np.ndarray,
+        padded: List[Optional[np.ndarray]],
+    ) -> np.ndarray:
+        """
+        Appends the output of `bucket_neighborhoods`.
+
+        Returns
+        -------
+        The residue ids of the stored neighborhoods, in index order
+        """
+        index = np.zeros(res_id.shape[0], dtype=INDEX_DT)
+        for bucket, nhs in enumerate(padded):
+            if nhs is None:
+                continue
+            path = f"{self.name}/{self.names[bucket]}"
+            start = self.writer.size(path)
+            self.writer.append(path, nhs)
+
+            # keep the order of the neighborhoods in the index
+            rows = buckets == bucket
+            index["bucket"][rows] = bucket
+            index["offset"][rows] = np.arange(start, start + nhs.shape[0])
+
+        dropped = buckets < 0
+        if np.any(dropped):
+            logger.warning(
+                f"Dropping {np.sum(dropped)} neighborhoods with more than "
+                f"{self.sizes[-1]} atoms"
+            )
+            self.writer.append(f"{self.name}/dropped", res_id[dropped])
+            self.num_dropped += np.sum(dropped)
+
+        self.writer.append(f"{self.name}/index", index[~dropped])
+        return res_id[~dropped]
+
+    def close(self):
+        """
+        Writes the counts. The datasets are complete once the writer is closed.
+        """
+        counts = [
+            self.writer.size(f"{self.name}/{bucket_name}")
+            for bucket_name in self.names
+        ]
+        self.group.attrs["num_dropped"] = self.num_dropped
+        self.group.attrs["num_overflow"] = counts[-1]
+
+        logger.info(
+            "Neighborhoods per bucket: "
+            + ", ".join(f"{name}: {count}" for name, count in zip(self.names, counts))
+            + f", dropped: {self.num_dropped}"
+        )
+
+
+def is_bucketed(f: h5py.File, name: str) -> bool:
+    return isinstance(f[name], h5py.Group)
+
+
+def read_neighborhood(obj: Union[h5py.Dataset, h5py.Group], row: int) -> np.ndarray:
+    """
+    Reads the neighborhood at row of the nh_list, from a bucketed group or a
+    plain neighborhoods dataset.
+    """
+    if isinstance(obj, h5py.Dataset):
+        return obj[row]
+    bucket, offset = obj["index"][row]
+    return obj[obj.attrs["buckets"][bucket]][offset]
+
+
+def iter_buckets(
+    hdf5_file: str, name: str, batch_size: int = 1024
+) -> Iterator[Tuple[str, np.ndarray]]:
+    """
+    Iterates over a bucketed neighborhoods output, bucket by bucket, in batches
+    of fixed-size neighborhoods.
+
+    Yields
+    ------
+    Tuple of (bucket name, neighborhoods), with at most batch_size neighborhoods
+    """
+    with h5py.File(hdf5_file, "r") as f:
+        group = f[name]
+        for bucket_name in group.attrs["buckets"]:
+            dataset = group[bucket_name]
+            for start in range(0, dataset.shape[0], batch_size):
+                yield bucket_name, dataset[start : start + batch_size]
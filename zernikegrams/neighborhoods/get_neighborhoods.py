@@ -7,19 +7,36 @@
 from argparse import ArgumentParser
 import sys
 from time import time
+from typing import List, Optional
 
 import h5py
 from hdf5plugin import LZ4
 import numpy as np
 from rich.progress import Progress
 
+from zernikegrams.neighborhoods.buckets import (
+    BucketedNeighborhoodsWriter,
+    bucket_neighborhoods,
+    check_bucket_sizes,
+)
 from zernikegrams.neighborhoods.neighborhoods_core import (
+    get_chain_hashes,
+    get_neighborhood_dtype,
     get_neighborhoods_from_protein,
     pad_neighborhoods,
 )
 
 from zernikegrams.preprocessors.proteins_hdf5 import HDF5Preprocessor
+from zernikegrams.preprocessors.supervised_pool import (
+    WorkerLimits,
+    add_worker_arguments,
+    get_worker_limits,
+)
+from zernikegrams.utils.filters import ResidueFilter, RESIDUES_WITH_NO_SIDECHAIN
+from zernikegrams.utils.residue_selection import ResidueSelection
 from zernikegrams.utils import log_config as logging
+from zernikegrams.utils.checkpoints import StageCheckpoint, replace_dataset
+from zernikegrams.utils.incremental import IncrementalUpdate
 
 logger = logging.getLogger(__name__)
 
@@ -37,20 +54,22 @@ def get_neighborhoods_fn(
     padded_length: int = 1000,
     unique_chains: bool = False,
     get_residues=None,
+    store_frames: bool = False,
 ):
 
     L = len(proteins[0]["pdb"].decode("utf-8"))
-    dt = np.dtype(
-        [
-            ("res_id", f"S{L}", (6)),
-            ("atom_names", "S4", (padded_length)),
-            ("elements", "S1", (padded_length)),
-            ("res_ids", f"S{L}", (padded_length, 6)),
-            ("coords", "f4", (padded_length, 3)),
-            ("SASAs", "f4", (padded_length)),
-            ("charges", "f4", (padded_length)),
-        ]
-    )
+    dt = [
+        ("res_id", f"S{L}", (6)),
+        ("atom_names", "S4", (padded_length)),
+        ("elements", "S1", (padded_length)),
+        ("res_ids", f"S{L}", (padded_length, 6)),
+        ("coords", "f4", (padded_length, 3)),
+        ("SASAs", "f4", (padded_length)),
+        ("charges", "f4", (padded_length)),
+    ]
+    if store_frames:
+        dt.append(("frame", "f4", (3, 3)))
+    dt = np.dtype(dt)
 
     neighborhoods = []
     num_nbs = 0
@@ -68,6 +87,7 @@ def get_neighborhoods_fn(
             align_to_backbone_frame=align_to_backbone_frame,
             backbone_only=backbone_only,
             get_residues=get_residues,
+            store_frames=store_frames,
         )
         if nbs is None:
             print(f"Error with PDB {pdb}. Skipping.")
@@ -76,14 +96,10 @@ def get_neighborhoods_fn(
         neighborhoods.append(nbs)
         num_nbs += len(nbs)
 
-    np_neighborhoods = np.zeros(shape=(num_nbs,), dtype=dt)
-    n = 0
-    for nbs in neighborhoods:
-        for nb in nbs:
-            np_neighborhoods[n] = (*nb,)
-            n += 1
+    if num_nbs == 0:
+        return np.zeros(shape=(0,), dtype=dt)
 
-    return np_neighborhoods
+    return np.concatenate([nbs.astype(dt) for nbs in neighborhoods])
 
 
 def get_proteinnet__pdb_chain_pairs(testing=False):
@@ -119,6 +135,105 @@ def get_proteinnet__pdb_chain_pairs(testing=False):
     return set(map(lambda x: "_".join(x), zip(pdbs, chains)))
 
 
+def get_residue_filter(
+    hdf5_in: str,
+    filter_out_chains_not_in_proteinnet: bool = False,
+    pdb_chain_pairs_to_consider_filepath: Optional[str] = None,
+    residue_selection_file: Optional[str] = None,
+    exclude_residues_with_no_sidechain: bool = False,
+) -> ResidueFilter:
+    """
+    Gathers the chain and residue filters requested from the command line into
+    a single ResidueFilter, to be evaluated in the workers.
+    """
+    if filter_out_chains_not_in_proteinnet and pdb_chain_pairs_to_consider_filepath is not None:
+        raise ValueError("Cannot use both filter_out_chains_not_in_proteinnet and pdb_chain_pairs_to_consider_filepath, as they conflict with each other.")
+
+    pdb_chain_pairs_to_consider = None
+    if filter_out_chains_not_in_proteinnet:
+        print("Filtering out chains not in ProteinNet.")
+        try:
+            pdb_chain_pairs_to_consider = get_proteinnet__pdb_chain_pairs(
+                testing=True if "testing" in hdf5_in else False
+            )  # not an ideal if-confition... but it saves extra parameters
+        except FileNotFoundError:
+            print("Could not find ProteinNet file. Ignoring.")
+    elif pdb_chain_pairs_to_consider_filepath is not None:
+        print(f"Filtering out chains not in {pdb_chain_pairs_to_consider_filepath}.")
+        with open(pdb_chain_pairs_to_consider_filepath, "r") as f:
+            pdb_chain_pairs_to_consider = set(f.read().splitlines())
+
+    if residue_selection_file is not None:
+        residue_selection = ResidueSelection.from_file(residue_selection_file)
+    else:
+        residue_selection = None
+
+    return ResidueFilter(
+        pdb_chain_pairs=pdb_chain_pairs_to_consider,
+        excluded_residue_types=(
+            RESIDUES_WITH_NO_SIDECHAIN if exclude_residues_with_no_sidechain else None
+        ),
+        residue_selection=residue_selection,
+    )
+
+
+def get_chain_dedup_index(ds: HDF5Preprocessor, parallelism: int = 4):
+    """
+    Index of the chains of a structural info dataset that have the same
+    sequence as a chain of another entry, so that identical chains are
+    featurized only once. For every group of chains with the same sequence,
+    the canonical chain is the first one in (pdb, chain) order.
+
+    Parameters
+    ----------
+    ds : HDF5Preprocessor
+        The structural info dataset
+    parallelism : int
+        Number of workers to use
+
+    Returns
+    -------
+    duplicate_chains : dict of bytes to set of bytes
+        Maps each pdb to its chains that are not canonical
+    aliases : np.ndarray
+        One row per non-canonical chain, with its canonical chain and the hash
+        of the sequence they share
+    """
+    chains_per_hash = {}
+    for pdb, chain_hashes in ds.execute(
+        get_chain_hashes, limit=None, params={}, parallelism=parallelism
+    ):
+        for chain, seq_hash in chain_hashes.items():
+            chains_per_hash.setdefault(seq_hash, []).append((pdb, chain))
+
+    L = np.max([ds.pdb_name_length, 5])
+    dt = np.dtype(
+        [
+            ("pdb", f"S{L}"),
+            ("chain", f"S{L}"),
+            ("canonical_pdb", f"S{L}"),
+            ("canonical_chain", f"S{L}"),
+            ("seq_hash", "S40"),
+        ]
+    )
+
+    duplicate_chains = {}
+    aliases = []
+    for seq_hash, pdb_chains in chains_per_hash.items():
+        canonical_pdb, canonical_chain = min(pdb_chains)
+        for pdb, chain in pdb_chains:
+            if (pdb, chain) == (canonical_pdb, canonical_chain):
+                continue
+            duplicate_chains.setdefault(pdb, set()).add(chain)
+            aliases.append((pdb, chain, canonical_pdb, canonical_chain, seq_hash))
+
+    logger.info(
+        f"{len(aliases)} chains are duplicates of {len(chains_per_hash)} unique chains"
+    )
+
+    return duplicate_chains, np.array(sorted(aliases), dtype=dt)
+
+
 def get_padded_neighborhoods(
     np_protein,
     r_max,
@@ -132,6 +247,10 @@ def get_padded_neighborhoods(
     align_to_backbone_frame: bool = False,
     backbone_only: bool = False,
     get_residues=None,
+    residue_filter: Optional[ResidueFilter] = None,
+    duplicate_chains=None,
+    store_frames: bool = False,
+    bucket_sizes: Optional[List[int]] = None,
 ):
     """
     Gets padded neighborhoods associated with one structural info unit
@@ -146,6 +265,18 @@ def get_padded_neighborhoods(
     unique_chains : bool
         Flag indicating whether chains with identical sequences should
         contribute unique neoighborhoods
+    residue_filter : ResidueFilter, optional
+        Only residues that pass the filter contribute neighborhoods
+    duplicate_chains : dict, optional
+        Maps pdbs to the chains that are duplicates of chains in other entries,
+        see `get_chain_dedup_index`. Those chains do not contribute neighborhoods.
+    store_frames : bool
+        Whether to store the backbone frame of the central residue of every
+        neighborhood, in the "frame" field
+    bucket_sizes : list of int, optional
+        Pad every neighborhood to the size of its bucket, and neighborhoods
+        larger than all buckets to padded_length. The padded neighborhoods are
+        then returned as the output of `bucket_neighborhoods`.
     """
 
     pdb = np_protein[0]
@@ -154,26 +285,28 @@ def get_padded_neighborhoods(
     logger.debug(f"Coordinate system is {coordinate_system}")
 
     try:
-        if get_residues is None:
-            res_ids = None
-        else:
-            res_ids = get_residues(np_protein)
-
-        neighborhoods = get_neighborhoods_from_protein(
+        neighborhoods = get_protein_neighborhoods(
             np_protein,
-            r_max=r_max,
-            res_ids_selection=res_ids,
-            uc=unique_chains,
-            remove_central_residue=remove_central_residue,
-            remove_central_sidechain=remove_central_sidechain,
-            central_residue_only=central_residue_only,
-            keep_central_CA=keep_central_CA,
-            backbone_only=backbone_only,
-            align_to_backbone_frame=align_to_backbone_frame,
+            r_max,
+            unique_chains,
+            remove_central_residue,
+            remove_central_sidechain,
+            central_residue_only,
+            keep_central_CA,
             coordinate_system=coordinate_system,
+            align_to_backbone_frame=align_to_backbone_frame,
+            backbone_only=backbone_only,
+            get_residues=get_residues,
+            residue_filter=residue_filter,
+            duplicate_chains=duplicate_chains,
+            store_frames=store_frames,
         )
-        padded_neighborhoods = pad_neighborhoods(
-            neighborhoods, padded_length=padded_length
+        padded_neighborhoods = pad_protein_neighborhoods(
+            neighborhoods,
+            np_protein["res_ids"].dtype,
+            padded_length,
+            store_frames=store_frames,
+            bucket_sizes=bucket_sizes,
         )
     except Exception as e:
         print(e, flush=True)
@@ -191,6 +324,164 @@ def get_padded_neighborhoods(
     )
 
 
+def get_padded_neighborhoods_batch(
+    np_proteins,
+    r_max,
+    padded_length,
+    unique_chains,
+    remove_central_residue: bool,
+    remove_central_sidechain: bool,
+    central_residue_only: bool,
+    keep_central_CA: bool,
+    coordinate_system: str = "spherical",
+    align_to_backbone_frame: bool = False,
+    backbone_only: bool = False,
+    get_residues=None,
+    residue_filter: Optional[ResidueFilter] = None,
+    duplicate_chains=None,
+    store_frames: bool = False,
+    bucket_sizes: Optional[List[int]] = None,
+):
+    """
+    Batch counterpart of `get_padded_neighborhoods`, called by the
+    preprocessor on batches of proteins. The neighborhoods of all the proteins
+    are padded at once.
+
+    Parameters are the same as `get_padded_neighborhoods`, with np_proteins
+    an array of proteins.
+
+    Returns
+    -------
+    Tuple of (pdbs, number of neighborhoods of each protein, or -1 if the
+    protein failed, padded neighborhoods of all the proteins in order, as
+    returned by `get_padded_neighborhoods`)
+    """
+    pdbs = np_proteins["pdb"]
+    counts = np.full(pdbs.shape[0], -1, dtype=int)
+    neighborhoods = []
+    for i, np_protein in enumerate(np_proteins):
+        try:
+            protein_neighborhoods = get_protein_neighborhoods(
+                np_protein,
+                r_max,
+                unique_chains,
+                remove_central_residue,
+                remove_central_sidechain,
+                central_residue_only,
+                keep_central_CA,
+                coordinate_system=coordinate_system,
+                align_to_backbone_frame=align_to_backbone_frame,
+                backbone_only=backbone_only,
+                get_residues=get_residues,
+                residue_filter=residue_filter,
+                duplicate_chains=duplicate_chains,
+                store_frames=store_frames,
+            )
+        except Exception as e:
+            logger.error(e)
+            logger.error(f"Error with {pdbs[i]}")
+            continue
+        counts[i] = len(protein_neighborhoods)
+        neighborhoods.extend(protein_neighborhoods)
+
+    try:
+        padded_neighborhoods = pad_protein_neighborhoods(
+            neighborhoods,
+            np_proteins["res_ids"].dtype,
+            padded_length,
+            store_frames=store_frames,
+            bucket_sizes=bucket_sizes,
+        )
+    except Exception as e:
+        logger.error(e)
+        logger.error(f"Error with {pdbs.tolist()}")
+        counts[:] = -1
+        padded_neighborhoods = pad_protein_neighborhoods(
+            [],
+            np_proteins["res_ids"].dtype,
+            padded_length,
+            store_frames=store_frames,
+            bucket_sizes=bucket_sizes,
+        )
+
+    return pdbs, counts, padded_neighborhoods
+
+
+def get_protein_neighborhoods(
+    np_protein,
+    r_max,
+    unique_chains,
+    remove_central_residue: bool,
+    remove_central_sidechain: bool,
+    central_residue_only: bool,
+    keep_central_CA: bool,
+    coordinate_system: str = "spherical",
+    align_to_backbone_frame: bool = False,
+    backbone_only: bool = False,
+    get_residues=None,
+    residue_filter: Optional[ResidueFilter] = None,
+    duplicate_chains=None,
+    store_frames: bool = False,
+):
+    """
+    Ragged neighborhoods of one protein, see `get_padded_neighborhoods`
+    """
+    if get_residues is None:
+        res_ids = None
+    else:
+        res_ids = get_residues(np_protein)
+
+    if duplicate_chains is None:
+        excluded_chains = None
+    else:
+        excluded_chains = duplicate_chains.get(np_protein[0])
+
+    return get_neighborhoods_from_protein(
+        np_protein,
+        r_max=r_max,
+        res_ids_selection=res_ids,
+        uc=unique_chains,
+        excluded_chains=excluded_chains,
+        residue_filter=residue_filter,
+        remove_central_residue=remove_central_residue,
+        remove_central_sidechain=remove_central_sidechain,
+        central_residue_only=central_residue_only,
+        keep_central_CA=keep_central_CA,
+        backbone_only=backbone_only,
+        align_to_backbone_frame=align_to_backbone_frame,
+        coordinate_system=coordinate_system,
+        store_frames=store_frames,
+    )
+
+
+def pad_protein_neighborhoods(
+    neighborhoods,
+    res_id_dt: np.dtype,
+    padded_length: int,
+    store_frames: bool = False,
+    bucket_sizes: Optional[List[int]] = None,
+):
+    """
+    Pads ragged neighborhoods to padded_length, or to the size of their
+    bucket if bucket_sizes is set, see `get_padded_neighborhoods`
+    """
+    if bucket_sizes is not None:
+        if len(neighborhoods) == 0:
+            return (
+                np.zeros(shape=(0, 6), dtype=res_id_dt),
+                np.zeros(shape=(0,), dtype=int),
+                [None] * (len(bucket_sizes) + 1),
+            )
+        return bucket_neighborhoods(neighborhoods, bucket_sizes, padded_length)
+
+    if len(neighborhoods) == 0:
+        return np.zeros(
+            shape=(0,),
+            dtype=get_neighborhood_dtype(res_id_dt, padded_length, frame=store_frames),
+        )
+    return pad_neighborhoods(neighborhoods, padded_length=padded_length)
+
+
 def get_neighborhoods_from_dataset(
     hdf5_in,
     input_dataset_name,
@@ -209,7 +500,15 @@ def get_neighborhoods_from_dataset(
     max_atoms=1000,
     get_residues_file=None,
     filter_out_chains_not_in_proteinnet=False,
-    pdb_chain_pairs_to_consider_filepath=None
+    pdb_chain_pairs_to_consider_filepath=None,
+    dedup_chains_across_pdbs: bool = False,
+    residue_selection_file: Optional[str] = None,
+    store_frames: bool = False,
+    bucket_sizes: Optional[List[int]] = None,
+    shared_memory_mb: Optional[int] = None,
+    worker_limits: WorkerLimits = WorkerLimits(),
+    resume: bool = False,
+    update: bool = False,
 ):
     """
     Parallel retrieval of neighborhoods from structural info file and writing
@@ -230,53 +529,77 @@ def get_neighborhoods_from_dataset(
         contribute neighborhoods
     parallelism : int
         Number of workers to use
+    dedup_chains_across_pdbs : bool
+        Whether chains identical to a chain of another entry should not contribute
+        neighborhoods. The duplicates are recorded in the "chain_aliases" dataset.
+    residue_selection_file : str, optional
+        Path to a residue selection file, see `zernikegrams.utils.residue_selection`.
+        Proteins with no selected residue are not loaded.
+    store_frames : bool
+        Whether to store the backbone frame of the central residue of every
+        neighborhood, so that the zernikegrams stage does not recompute it.
+    bucket_sizes : list of int, optional
+        Group the neighborhoods by number of atoms, padding each one only to
+        the size of its bucket. Neighborhoods larger than all buckets go to an
+        overflow bucket padded to max_atoms. See `zernikegrams.neighborhoods.buckets`
+        for the layout of the output.
+    shared_memory_mb : int, optional
+        Size in MB of the shared memory buffers the workers send their
+        neighborhoods through, see `zernikegrams.preprocessors.shared_memory_ring`.
+    worker_limits : WorkerLimits
+        Limits of the workers, see `zernikegrams.preprocessors.supervised_pool`.
+        Proteins whose worker fails them are added to pdbs_fail.
+    resume : bool
+        Whether to record progress, and to resume an interrupted run with the
+        same parameters, see `zernikegrams.utils.checkpoints`.
+    update : bool
+        Whether to keep a manifest of the proteins, and to only process the
+        proteins that were added or changed in hdf5_in since the last run,
+        see `zernikegrams.utils.incremental`. hdf5_in must have been written
+        with update too.
     """
     # metadata = get_metadata()
 
-    if filter_out_chains_not_in_proteinnet and pdb_chain_pairs_to_consider_filepath is not None:
-        raise ValueError("Cannot use both filter_out_chains_not_in_proteinnet and pdb_chain_pairs_to_consider_filepath, as they conflict with each other.")
+    if resume and update:
+        raise ValueError("Cannot resume and update at the same time")
+    if dedup_chains_across_pdbs and update:
+        # the duplicates depend on all the proteins, not only the updated ones
+        raise ValueError("Cannot update with dedup_chains_across_pdbs")
 
-    ds = HDF5Preprocessor(hdf5_in, input_dataset_name)
+    if bucket_sizes is not None:
+        bucket_sizes = check_bucket_sizes(bucket_sizes, max_atoms)
 
-    L = np.max([ds.pdb_name_length, 5])
+    ds = HDF5Preprocessor(hdf5_in, input_dataset_name)
+    if update and ds.hashes is None:
+        raise ValueError(f"Cannot update from {hdf5_in}, it has no manifest")
+
+    params = {
+        "hdf5_in": hdf5_in,
+        "input_dataset_name": input_dataset_name,
+        "output_dataset_name": output_dataset_name,
+        "r_max": r_max,
+        "unique_chains": unique_chains,
+        "coordinate_system": coordinate_system,
+        "align_to_backbone_frame": align_to_backbone_frame,
+        "remove_central_residue": remove_central_residue,
+        "remove_central_sidechain": remove_central_sidechain,
+        "central_residue_only": central_residue_only,
+        "keep_central_CA": keep_central_CA,
+        "backbone_only": backbone_only,
+        "max_atoms": max_atoms,
+        "get_residues_file": get_residues_file,
+        "filter_out_chains_not_in_proteinnet": filter_out_chains_not_in_proteinnet,
+        "pdb_chain_pairs_to_consider_filepath": pdb_chain_pairs_to_consider_filepath,
+        "dedup_chains_across_pdbs": dedup_chains_across_pdbs,
+        "residue_selection_file": residue_selection_file,
+        "store_frames": store_frames,
+        "bucket_sizes": bucket_sizes,
+    }
+    incremental = IncrementalUpdate(hdf5_out, params, "nh_list", update=update)
+    L = incremental.get_name_length(np.max([ds.pdb_name_length, 5]))
     n = 0
-    curr_size = 10000
-
-    dt = np.dtype(
-        [
-            ("res_id", f"S{L}", (6)),
-            ("atom_names", "S4", (max_atoms)),
-            ("elements", "S2", (max_atoms)),
-            ("res_ids", f"S{L}", (max_atoms, 6)),
-            ("coords", "f4", (max_atoms, 3)),
-            ("SASAs", "f4", (max_atoms)),
-            ("charges", "f4", (max_atoms)),
-        ]
-    )
-
-    logger.info("Writing hdf5 file")
-    with h5py.File(hdf5_out, "w") as f:
-        f.create_dataset(
-            output_dataset_name,
-            shape=(curr_size,),
-            maxshape=(None,),
-            dtype=dt,
-            compression=LZ4(),
-        )
-        # record_metadata(metadata, f[protein_list])
 
-    if filter_out_chains_not_in_proteinnet:
-        print("Filtering out chains not in ProteinNet.")
-        try:
-            pdb_chain_pairs_to_consider = get_proteinnet__pdb_chain_pairs(
-                testing=True if "testing" in hdf5_in else False
-            )  # not an ideal if-confition... but it saves extra parameters
-        except FileNotFoundError:
-            print("Could not find ProteinNet file. Ignoring.")
-    elif pdb_chain_pairs_to_consider_filepath is not None:
-        print(f"Filtering out chains not in {pdb_chain_pairs_to_consider_filepath}.")
-        with open(pdb_chain_pairs_to_consider_filepath, "r") as f:
-            pdb_chain_pairs_to_consider = set(f.read().splitlines())
+    dt = get_neighborhood_dtype(np.dtype(f"S{L}"), max_atoms, frame=store_frames)
 
     # import user method
     if not get_residues_file is None:
@@ -293,97 +616,137 @@ def get_neighborhoods_from_dataset(
     else:
         get_residues = None
 
+    residue_filter = get_residue_filter(
+        hdf5_in,
+        filter_out_chains_not_in_proteinnet=filter_out_chains_not_in_proteinnet,
+        pdb_chain_pairs_to_consider_filepath=pdb_chain_pairs_to_consider_filepath,
+        residue_selection_file=residue_selection_file,
+    )
+    if residue_filter.pdbs is not None:
+        ds.filter_pdbs(residue_filter.pdbs)
+
+    if dedup_chains_across_pdbs:
+        duplicate_chains, chain_aliases = get_chain_dedup_index(ds, parallelism)
+    else:
+        duplicate_chains, chain_aliases = None, None
+
+    checkpoint = StageCheckpoint(hdf5_out, params, resume=resume)
+    if checkpoint.resuming:
+        ds.skip_pdbs(checkpoint.is_skipped)
+    if update:
+        incremental.plan(ds.hashes)
+        ds.skip_pdbs(incremental.is_skipped)
+
     logger.debug(f"Gathering unique chains {unique_chains}")
-    nhs = np.empty(shape=(curr_size,), dtype=(f"S{L}", (6)))
 
-    pdbs_pass = []
-    pdbs_fail = []
+    # the proteins done by an earlier run
+    pdbs_pass = [pdb.encode("utf-8") for pdb in sorted(checkpoint.done)]
+    pdbs_fail = [pdb.encode("utf-8") for pdb in checkpoint.failed]
+    pdbs_pass.extend(incremental.read_kept("pdbs_pass"))
+    pdbs_fail.extend(incremental.read_kept("pdbs_fail"))
 
+    logger.info("Writing hdf5 file")
     with Progress() as bar:
         task = bar.add_task("Neighborhoods", total=ds.count())
-        with h5py.File(hdf5_out, "r+") as f:
-            for i, (pdb, neighborhoods) in enumerate(
-                ds.execute(
-                    get_padded_neighborhoods,
-                    limit=None,
-                    params={
-                        "r_max": r_max,
-                        "padded_length": max_atoms,
-                        "unique_chains": unique_chains,
-                        "coordinate_system": coordinate_system,
-                        "align_to_backbone_frame": align_to_backbone_frame,
-                        "remove_central_residue": remove_central_residue,
-                        "remove_central_sidechain": remove_central_sidechain,
-                        "central_residue_only": central_residue_only,
-                        "keep_central_CA": keep_central_CA,
-                        "backbone_only": backbone_only,
-                        "get_residues": get_residues
-                    },
-                    parallelism=parallelism,
+        output = incremental if update else checkpoint
+        with output.open() as f, output.writer(f) as writer:
+            if bucket_sizes is not None:
+                bucket_writer = BucketedNeighborhoodsWriter(
+                    writer,
+                    output_dataset_name,
+                    np.dtype(f"S{L}"),
+                    bucket_sizes,
+                    max_atoms,
+                    frame=store_frames,
                 )
+            else:
+                writer.create_dataset(output_dataset_name, dt)
+            writer.create_dataset("nh_list", f"S{L}", shape=(6,))
+            n = writer.size("nh_list")
+
+            i = 0
+            for pdbs, counts, neighborhoods in ds.execute(
+                get_padded_neighborhoods_batch,
+                limit=None,
+                params={
+                    "r_max": r_max,
+                    "padded_length": max_atoms,
+                    "unique_chains": unique_chains,
+                    "coordinate_system": coordinate_system,
+                    "align_to_backbone_frame": align_to_backbone_frame,
+                    "remove_central_residue": remove_central_residue,
+                    "remove_central_sidechain": remove_central_sidechain,
+                    "central_residue_only": central_residue_only,
+                    "keep_central_CA": keep_central_CA,
+                    "backbone_only": backbone_only,
+                    "get_residues": get_residues,
+                    "residue_filter": residue_filter,
+                    "duplicate_chains": duplicate_chains,
+                    "store_frames": store_frames,
+                    "bucket_sizes": bucket_sizes,
+                },
+                parallelism=parallelism,
+                shared_memory_bytes=(
+                    None if shared_memory_mb is None else shared_memory_mb << 20
+                ),
+                batched=True,
+                worker_limits=worker_limits,
             ):
+                failed = []
                 try:
-
-                    if neighborhoods is None:
-                        pdbs_fail.append(pdb)
+                    for pdb, count in zip(pdbs, counts):
+                        if count == 0:
+                            logger.warning(f"No neighborhoods for {pdb}, possibly because no pdb_chain pair with this pdb is present in the file. Skipping.")
+                            failed.append((pdb, "no neighborhoods"))
+                        elif count < 0:
+                            failed.append((pdb, "failed to get the neighborhoods"))
+                        if count <= 0:
+                            pdbs_fail.append(pdb)
+
+                    if np.sum(np.maximum(counts, 0)) == 0:
                         continue
 
-                    if filter_out_chains_not_in_proteinnet or pdb_chain_pairs_to_consider_filepath is not None:
-                        filtered_neighborhoods = []
-                        for neighborhood in neighborhoods:
-                            if (
-                                "_".join(
-                                    [
-                                        neighborhood["res_id"][1].decode("utf-8"),
-                                        neighborhood["res_id"][2].decode("utf-8"),
-                                    ]
-                                )
-                                in pdb_chain_pairs_to_consider
-                            ):
-                                filtered_neighborhoods.append(neighborhood)
-                        neighborhoods = np.array(filtered_neighborhoods)
-
-                    neighborhoods_per_protein = neighborhoods.shape[0]
-
-                    if neighborhoods_per_protein == 0:
-                        logger.warning(f"No neighborhoods for {pdb}, possibly because no pdb_chain pair with this pdb is present in the file. Skipping.")
-                        pdbs_fail.append(pdb)
-                        continue
-
-                    while n + neighborhoods_per_protein > curr_size:
-                        curr_size += 10000
-                        nhs.resize((curr_size, 6))
-                        f[output_dataset_name].resize((curr_size,))
-
+                    if bucket_sizes is not None:
+                        res_id = bucket_writer.write(*neighborhoods)
+                    else:
+                        writer.append(output_dataset_name, neighborhoods)
+                        res_id = neighborhoods["res_id"]
+                    writer.append("nh_list", res_id)
+                    incremental.append(res_id[:, 1])
 
-                    f[output_dataset_name][n : n + neighborhoods_per_protein] = neighborhoods
-                    nhs[n : n + neighborhoods_per_protein] = neighborhoods["res_id"]
-
-                    n += neighborhoods_per_protein
+                    n += res_id.shape[0]
                 except Exception as e:
                     logger.warning(
                         "Failed to process neighborhood with the following error:"
                     )
                     logger.exception(e)
                 finally:
-                    # attempt to address memory issues. currently unsuccessfully
-                    pdbs_pass.append(pdb)
+                    pdbs_pass.extend(pdbs)
+                    checkpoint.update(writer, done=pdbs, failed=failed)
+                    i += pdbs.shape[0]
                     bar.update(
                         task,
-                        advance=1,
-                        description=f"Neighborhoods: {i + 1}/{ds.count()}",
+                        advance=pdbs.shape[0],
+                        description=f"Neighborhoods: {i}/{ds.count()}",
                     )
 
+            for pdb, reason in ds.failures:
+                logger.warning(f"Failed to process {pdb}: {reason}")
+                pdbs_fail.append(pdb)
+            checkpoint.update(writer, failed=ds.failures)
+            checkpoint.save(writer)
+
             logger.info(f"Number of processed neighborhoods: {n}")
-            f[output_dataset_name].resize((n,))
-            nhs.resize((n, 6))
+            if bucket_sizes is not None:
+                bucket_writer.close()
+            incremental.write(f)
 
     with h5py.File(hdf5_out, "r+") as f:
-        f.create_dataset("nh_list", data=nhs)
-        # record_metadata(metadata, f["nh_list"])
+        replace_dataset(f, "pdbs_pass", data=pdbs_pass)
+        replace_dataset(f, "pdbs_fail", data=pdbs_fail)
 
-        f.create_dataset("pdbs_pass", data=pdbs_pass)
-        f.create_dataset("pdbs_fail", data=pdbs_fail)
+        if chain_aliases is not None:
+            replace_dataset(f, "chain_aliases", data=chain_aliases)
 
     logger.info("Done with parallel computing")
 
@@ -426,6 +789,25 @@ def main():
         action="store_true",
         default=False
     )
+    parser.add_argument(
+        "--store_frames",
+        help="Whether to store the central residue's backbone frame with every neighborhood, for use by the zernikegrams stage with --request_frame.",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--max_atoms",
+        type=int,
+        help="Number of atoms every neighborhood is padded to.",
+        default=1000,
+    )
+    parser.add_argument(
+        "--bucket_sizes",
+        type=int,
+        nargs="+",
+        help="Group the neighborhoods by number of atoms into buckets of these sizes, e.g. '--bucket_sizes 256 512', each padded to its own size instead of --max_atoms. Neighborhoods larger than all buckets go to an overflow bucket padded to --max_atoms.",
+        default=None,
+    )
     parser.add_argument(
         "--remove_central_residue",
         help="Whether to remove the central residue from the neighborhood. Cannot be done in conjunction with --central_residue_only nor --remove_central_sidechain.",
@@ -482,6 +864,37 @@ def main():
         help="Path to file containing pdb_chain pairs to consider. Only relevant when filter_out_chains_not_in_proteinnet is True.",
         default=None
     )
+    parser.add_argument(
+        "--residue_selection_file",
+        type=str,
+        help="Path to a file selecting the residues to use as neighborhood centers, with one 'pdb [chain [resnums]]' entry per line, e.g. '1abc A 10-20,35'. Proteins not in the file are skipped without being loaded.",
+        default=None,
+    )
+    parser.add_argument(
+        "--dedup_chains_across_pdbs",
+        help="Only take neighborhoods from one chain per unique sequence across the whole dataset. Duplicate chains are recorded in the chain_aliases dataset.",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--shared_memory_mb",
+        type=int,
+        help="Send the neighborhoods of each protein from the workers through shared memory buffers of this size in MB instead of pickling them through a pipe. Results that do not fit go through the pipe as usual.",
+        default=None,
+    )
+    add_worker_arguments(parser)
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        default=False,
+        help="Record progress next to --hdf5_out, and resume an interrupted run with the same arguments from it, only processing the proteins that are not done yet.",
+    )
+    parser.add_argument(
+        "--update",
+        action="store_true",
+        default=False,
+        help="Keep a manifest of the proteins in --hdf5_out, and if it exists, update it with the same arguments: only process the proteins that were added or changed in --hdf5_in since, and tombstone the rows of the proteins that were removed or changed. Their rows stay in --hdf5_out, and readers other than the next stages must only read the rows from zernikegrams.utils.incremental.get_live_rows. --hdf5_in must have been written with --update. Cannot be combined with --resume.",
+    )
 
     args = parser.parse_args()
     s = time()
@@ -501,9 +914,18 @@ def main():
         args.keep_central_CA,
         args.backbone_only,
         args.parallelism,
+        max_atoms=args.max_atoms,
         get_residues_file=args.get_residues_file,
         filter_out_chains_not_in_proteinnet=args.filter_out_chains_not_in_proteinnet,
-        pdb_chain_pairs_to_consider_filepath=args.pdb_chain_pairs_to_consider_filepath
+        pdb_chain_pairs_to_consider_filepath=args.pdb_chain_pairs_to_consider_filepath,
+        dedup_chains_across_pdbs=args.dedup_chains_across_pdbs,
+        residue_selection_file=args.residue_selection_file,
+        store_frames=args.store_frames,
+        bucket_sizes=args.bucket_sizes,
+        shared_memory_mb=args.shared_memory_mb,
+        worker_limits=get_worker_limits(args),
+        resume=args.resume,
+        update=args.update,
     )
 
     logger.info(f"Total time = {time() - s:.2f} seconds")
@@ -1,5 +1,6 @@
 from functools import partial
-from typing import List
+import hashlib
+from typing import Dict, List, Optional, Set, Tuple
 
 import h5py
 import numpy as np
@@ -7,6 +8,8 @@ from sklearn.neighbors import KDTree
 
 from zernikegrams.utils.constants import BACKBONE_ATOMS, N, CA, C, O, EMPTY_ATOM_NAME
 from zernikegrams.utils.conversions import cartesian_to_spherical__numpy
+from zernikegrams.utils.filters import ResidueFilter
+from zernikegrams.utils.residue_selection import select_res_ids
 
 
 # given a set of neighbor coords, slice all info in the npProtein along neighbor inds
@@ -31,20 +34,8 @@ def get_neighborhoods(
     # list(map(partial(slice_array,inds=neighbor_inds),npProtein))
 
 
-def get_unique_chains(protein: np.ndarray) -> List[bytes]:
-    """
-    Obtain unique chains from a protein.
-
-    Parameters
-    ----------
-    protein : numpy.ndarray
-
-    Returns
-    -------
-    unique_chains : list of bytes
-        The ensuing unique chains.
-    """
-    valid_res_types = [
+VALID_RES_TYPES = np.array(
+    [
         b"A",
         b"C",
         b"D",
@@ -66,33 +57,148 @@ def get_unique_chains(protein: np.ndarray) -> List[bytes]:
         b"W",
         b"Y",
     ]
+)
+
+
+def get_chain_sequences(res_ids: np.ndarray) -> Dict[bytes, bytes]:
+    """
+    Obtain the per-residue sequence of every chain of a protein.
+
+    Parameters
+    ----------
+    res_ids : numpy.ndarray
+        Residue ids of the (real) atoms of a protein, shape [num_atoms, 6].
+        Atoms of the same residue are expected to be contiguous.
+
+    Returns
+    -------
+    chain_seqs : dict of bytes to bytes
+        Maps each chain with at least one canonical residue to its sequence,
+        with one letter per residue. Chains are in sorted order.
+    """
+    res_ids = res_ids[np.isin(res_ids[:, 0], VALID_RES_TYPES)]
+    if res_ids.shape[0] == 0:
+        return {}
+
+    # keep the first atom of every residue
+    residue_starts = np.ones(res_ids.shape[0], dtype=bool)
+    residue_starts[1:] = np.any(res_ids[1:, 1:5] != res_ids[:-1, 1:5], axis=-1)
+    res_ids = res_ids[residue_starts]
+
+    chains, chain_inv = np.unique(res_ids[:, 2], return_inverse=True)
+    order = np.argsort(chain_inv, kind="stable")
+    bounds = np.cumsum(np.bincount(chain_inv, minlength=chains.shape[0]))[:-1]
+    return {
+        chain: b"".join(seq)
+        for chain, seq in zip(chains, np.split(res_ids[order, 0], bounds))
+    }
+
+
+def hash_sequence(seq: bytes) -> str:
+    """Hash of a chain sequence, used to identify identical chains."""
+    return hashlib.sha1(seq).hexdigest()
+
+
+def get_chain_hashes(np_protein: np.ndarray, **kwargs) -> Tuple[bytes, Dict[bytes, str]]:
+    """
+    Obtain the sequence hash of every chain of a protein.
+
+    Parameters
+    ----------
+    np_protein : numpy.ndarray
+        Array representation of a protein
+
+    Returns
+    -------
+    Tuple of (pdb, dict mapping each chain to the hash of its sequence)
+    """
+    real_locs = np_protein["atom_names"] != EMPTY_ATOM_NAME
+    chain_seqs = get_chain_sequences(np_protein["res_ids"][real_locs])
+    return np_protein["pdb"], {
+        chain: hash_sequence(seq) for chain, seq in chain_seqs.items()
+    }
+
+
+def get_unique_chains(res_ids: np.ndarray) -> List[bytes]:
+    """
+    Obtain unique chains from a protein.
+
+    Parameters
+    ----------
+    res_ids : numpy.ndarray
+        Residue ids of the real atoms of a protein.
+
+    Returns
+    -------
+    unique_chains : list of bytes
+        The ensuing unique chains. When several chains have the same sequence,
+        only the first one in sorted order is kept.
+    """
+    unique_chains = {}
+    for chain, seq in get_chain_sequences(res_ids).items():
+        unique_chains.setdefault(hash_sequence(seq), chain)
+    return list(unique_chains.values())
+
+
+def get_backbone_frames(
+    N_coords: np.ndarray, CA_coords: np.ndarray, C_coords: np.ndarray
+) -> np.ndarray:
+    """
+    Compute the backbone frames of many residues at once.
+
+    x is the unit vector from CA to N, z is the unit vector perpendicular to
+    the plane of CA-N and CA-C, and y is the unit vector perpendicular to both.
+
+    Parameters
+    ----------
+    N_coords, CA_coords, C_coords : numpy.ndarray
+        Cartesian coordinates of the backbone atoms, shape [R, 3]
+
+    Returns
+    -------
+    frames : numpy.ndarray
+        Shape [R, 3, 3], where frames[r] has rows (x, y, z). Residues with
+        missing atoms (NaN coordinates) have NaN frames.
+    """
+    x = N_coords - CA_coords
+    x = x / np.linalg.norm(x, axis=-1, keepdims=True)
+    z = np.cross(x, C_coords - CA_coords)
+    z = z / np.linalg.norm(z, axis=-1, keepdims=True)
+    y = np.cross(z, x)
+    y = y / np.linalg.norm(y, axis=-1, keepdims=True)
+    return np.stack([x, y, z], axis=1)
 
-    # get sequences and chain sequences
-    seq = protein[:, 0][
-        np.logical_or.reduce([protein[:, 0] == x for x in valid_res_types])
-    ]
-    chain_seq = protein[:, 2][
-        np.logical_or.reduce([protein[:, 0] == x for x in valid_res_types])
-    ]
 
-    # get chains and associated residue sequences
-    chain_seqs = {}
-    for c in np.unique(chain_seq):
-        chain_seqs[c] = b"".join(seq[chain_seq == c])
-
-    # cluster chains by matching residue sequences
-    #    chain_matches = {}
-    #    for c1 in chain_seqs.keys():
-    #        for c2 in chain_seqs.keys():
-    #            chain_matches[(c1,c2)] = chain_seqs[c1] == chain_seqs[c2]
-    #
-    unique_chains = []
-    unique_chain_seqs = []
-    for chain in chain_seqs.keys():
-        if chain_seqs[chain] not in unique_chain_seqs:
-            unique_chains.append(chain)
-            unique_chain_seqs.append(chain_seqs[chain])
-    return unique_chains
+def get_residue_atom_inds(
+    res_ids: np.ndarray, atom_names: np.ndarray, atom_name: bytes
+) -> np.ndarray:
+    """
+    Index of the first atom with atom_name within the residue of every atom.
+
+    Parameters
+    ----------
+    res_ids : numpy.ndarray
+        Residue ids of the (real) atoms of a protein, shape [num_atoms, 6].
+        Atoms of the same residue are expected to be contiguous.
+    atom_names : numpy.ndarray
+        Atom names, shape [num_atoms]
+
+    Returns
+    -------
+    numpy.ndarray of int, shape [num_atoms], with -1 for the atoms whose
+    residue has no atom with atom_name
+    """
+    residue_starts = np.zeros(res_ids.shape[0], dtype=bool)
+    residue_starts[1:] = np.any(res_ids[1:] != res_ids[:-1], axis=-1)
+    residue_inds = np.cumsum(residue_starts)
+
+    atom_inds = np.nonzero(atom_names == atom_name)[0]
+    residues_with_atom, first = np.unique(
+        residue_inds[atom_inds], return_index=True
+    )
+    lookup = np.full(residue_inds[-1] + 1 if res_ids.shape[0] else 0, -1)
+    lookup[residues_with_atom] = atom_inds[first]
+    return lookup[residue_inds]
 
 
 def get_neighborhoods_from_protein(
@@ -107,6 +213,9 @@ def get_neighborhoods_from_protein(
     keep_central_CA: bool = False,
     backbone_only: bool = False,
     res_ids_selection=None,
+    excluded_chains: Optional[Set[bytes]] = None,
+    residue_filter: Optional[ResidueFilter] = None,
+    store_frames: bool = False,
 ) -> np.ndarray:
     """
     Obtain all neighborhoods from a protein given a certain radius.
@@ -119,11 +228,22 @@ def get_neighborhoods_from_protein(
         Radius of the neighborhoods.
     uc : bool, default True
         Use only unique chains.
+    excluded_chains : set of bytes, optional
+        Chains whose residues should not be the center of any neighborhood,
+        e.g. because an identical chain is featurized elsewhere.
+    residue_filter : ResidueFilter, optional
+        Only residues that pass the filter are the center of a neighborhood.
+    store_frames : bool, default False
+        Append the backbone frame of the central residue, in the original
+        (not aligned) coordinates, to every neighborhood. See
+        `get_backbone_frames`.
 
     Returns
     -------
-    neighborhoods : numpy.ndarray
-        Array of all the neighborhoods.
+    neighborhoods : list
+        Neighborhoods as lists of
+        [res_id, atom_names, elements, res_ids, coords, SASAs, charges],
+        followed by the frame if store_frames is True.
     """
     # print(f"Value of backbone_only: {backbone_only}")
 
@@ -140,146 +260,110 @@ def get_neighborhoods_from_protein(
     atom_names = atom_names[real_locs]
     coords = np_protein["coords"][real_locs]
     ca_locs = atom_names == CA
+    res_ids = np_protein[3][real_locs]
     if uc:
-        chains = np_protein["res_ids"][real_locs][:, 2]
-        unique_chains = get_unique_chains(np_protein["res_ids"])
-        nonduplicate_chain_locs = np.logical_or.reduce(
-            [chains == x for x in unique_chains]
+        unique_chains = get_unique_chains(res_ids)
+        ca_locs = np.logical_and(ca_locs, np.isin(res_ids[:, 2], unique_chains))
+    if excluded_chains:
+        ca_locs = np.logical_and(
+            ca_locs, ~np.isin(res_ids[:, 2], list(excluded_chains))
         )
-        ca_locs = np.logical_and(ca_locs, nonduplicate_chain_locs)
+    # exclude non-canonical amino-acids, as they're probably just gonna confuse the model
+    ca_locs = np.logical_and(ca_locs, ~np.isin(res_ids[:, 0], [b"Z", b"X"]))
 
-    res_ids = np_protein[3][real_locs]
-    nh_ids = res_ids[ca_locs]
-    ca_coords = coords[ca_locs]
+    ca_inds = np.nonzero(ca_locs)[0]
 
     if not (res_ids_selection is None):
-        equals = np.all(
-            res_ids_selection.reshape(-1, 6, 1) == nh_ids.transpose().reshape(1, 6, -1),
-            axis=1,
+        ca_inds = ca_inds[select_res_ids(res_ids[ca_inds], res_ids_selection)]
+
+    if residue_filter:
+        ca_inds = ca_inds[residue_filter.select(res_ids[ca_inds])]
+
+    if ca_inds.shape[0] == 0:
+        return []
+
+    nh_ids = res_ids[ca_inds]
+    ca_coords = coords[ca_inds]
+    num_nhs = ca_inds.shape[0]
+
+    if align_to_backbone_frame or store_frames:
+        backbone_coords = []
+        for atom_name in (N, C):
+            inds = get_residue_atom_inds(res_ids, atom_names, atom_name)[ca_inds]
+            if align_to_backbone_frame and np.any(inds < 0):
+                missing = nh_ids[inds < 0][0]
+                raise ValueError(
+                    f"No {atom_name.decode('utf-8').strip()} atom in residue "
+                    f"{missing} to compute its backbone frame."
+                )
+            atom_coords = coords[inds].astype(np.float64)
+            atom_coords[inds < 0] = np.nan
+            backbone_coords.append(atom_coords)
+        frames = get_backbone_frames(
+            backbone_coords[0], ca_coords.astype(np.float64), backbone_coords[1]
         )
-        pocket_locs = np.any(equals, axis=0)
-        nh_ids = nh_ids[pocket_locs]
-        ca_coords = ca_coords[pocket_locs]
 
     tree = KDTree(coords, leaf_size=2)
 
     neighbors_list = tree.query_radius(ca_coords, r=r_max, count_only=False)
 
-    get_neighbors_custom = partial(
-        get_neighborhoods,
-        structural_info=[np_protein[x] for x in range(1, len(np_protein))],
-    )
+    # CSR layout of the neighbor lists: the atoms of all the neighborhoods,
+    # concatenated, and the neighborhood of every atom
+    lengths = np.array([neighbor_list.shape[0] for neighbor_list in neighbors_list])
+    flat = np.concatenate(neighbors_list)
+    segments = np.repeat(np.arange(num_nhs), lengths)
 
-    if align_to_backbone_frame:
-        # first, get C, N and O coordinates per neighborhood
-        N_locs = atom_names == N
-        C_locs = atom_names == C
-        O_locs = atom_names == O
-        N_coords, C_coords, O_coords = [], [], []
-        for i, (nh_id, neighbor_list) in enumerate(zip(nh_ids, neighbors_list)):
-            central_locs = np.logical_and.reduce(
-                res_ids[neighbor_list] == nh_id[None, :], axis=-1
-            )
-            N_coords.append(coords[neighbor_list][central_locs][N_locs[neighbor_list][central_locs]][0])
-            C_coords.append(coords[neighbor_list][central_locs][C_locs[neighbor_list][central_locs]][0])
-            O_coords.append(coords[neighbor_list][central_locs][O_locs[neighbor_list][central_locs]][0])
+    central_locs = np.logical_and.reduce(res_ids[flat] == nh_ids[segments], axis=-1)
+    central_CA_locs = np.logical_and(central_locs, atom_names[flat] == CA)
+    backbone_locs = np.isin(atom_names[flat], BACKBONE_ATOMS)
 
     if remove_central_residue:
-        for i, (nh_id, neighbor_list) in enumerate(zip(nh_ids, neighbors_list)):
-            central_locs = np.logical_and.reduce(
-                res_ids[neighbor_list] == nh_id[None, :], axis=-1
-            )
-            neighbors_list[i] = neighbor_list[~central_locs]
-    
+        mask = ~central_locs
     elif remove_central_sidechain:
-        for i, (nh_id, neighbor_list) in enumerate(zip(nh_ids, neighbors_list)):
-            central_locs = np.logical_and.reduce(
-                res_ids[neighbor_list] == nh_id[None, :], axis=-1
-            )
-            backbone_locs = np.logical_or.reduce(
-                atom_names[neighbor_list][:, None] == BACKBONE_ATOMS[None, :], axis=-1
-            )
-            mask = np.logical_or(~central_locs, backbone_locs)
-            if not keep_central_CA:
-                CA_locs = atom_names[neighbor_list] == CA
-                central_CA_loc = np.logical_and(central_locs, CA_locs)
-                mask = np.logical_and(mask, ~central_CA_loc)
-            neighbors_list[i] = neighbor_list[mask]
-
+        mask = np.logical_or(~central_locs, backbone_locs)
+        if not keep_central_CA:
+            mask = np.logical_and(mask, ~central_CA_locs)
     elif central_residue_only:
         # remove central CA - if requested - but keep the rest of the central residue only
-        for i, (nh_id, neighbor_list) in enumerate(zip(nh_ids, neighbors_list)):
-            central_locs = np.logical_and.reduce(
-                res_ids[neighbor_list] == nh_id[None, :], axis=-1
-            )
-            if not keep_central_CA:
-                CA_locs = atom_names[neighbor_list] == CA
-                central_CA_loc = np.logical_and(central_locs, CA_locs)
-                neighbors_list[i] = neighbor_list[
-                    np.logical_and(central_locs, ~central_CA_loc)
-                ]
-
+        if not keep_central_CA:
+            mask = np.logical_and(central_locs, ~central_CA_locs)
+        else:
+            mask = np.ones(flat.shape[0], dtype=bool)
     else:
         # keep central residue and all other atoms but still remove central CA - if requested
-        for i, (nh_id, neighbor_list) in enumerate(zip(nh_ids, neighbors_list)):
-            central_locs = np.logical_and.reduce(
-                res_ids[neighbor_list] == nh_id[None, :], axis=-1
-            )
-            if not keep_central_CA:
-                CA_locs = atom_names[neighbor_list] == CA
-                neighbors_list[i] = neighbor_list[
-                    ~np.logical_and.reduce(np.stack([central_locs, CA_locs]), axis=0)
-                ]
+        if not keep_central_CA:
+            mask = ~central_CA_locs
+        else:
+            mask = np.ones(flat.shape[0], dtype=bool)
 
     if backbone_only:
-        for i, (nh_id, neighbor_list) in enumerate(zip(nh_ids, neighbors_list)):
-            backbone_locs = np.logical_or.reduce(
-                atom_names[neighbor_list][:, None] == BACKBONE_ATOMS[None, :], axis=-1
-            )
-            neighbors_list[i] = neighbor_list[backbone_locs]
-    
+        mask = np.logical_and(mask, backbone_locs)
+
+    flat = flat[mask]
+    segments = segments[mask]
+    lengths = np.bincount(segments, minlength=num_nhs)
 
-    neighborhoods = list(map(get_neighbors_custom, neighbors_list))
-
-    filtered_neighborhoods = []
-    for i, (nh, nh_id, ca_coord) in enumerate(zip(neighborhoods, nh_ids, ca_coords)):
-        
-        # center coordinates to CA
-        nh[3] = nh[3] - ca_coord
-
-        # align to backbone frame, if requested
-        if align_to_backbone_frame:
-            # center coordinates of C, N and O to CA
-            centered_N_coord, centered_C_coord, centered_O_coord = N_coords[i] - ca_coord, C_coords[i] - ca_coord, O_coords[i] - ca_coord
-            centered_CA_coord = np.zeros(3)
-
-            # compute frame
-            x = centered_N_coord - centered_CA_coord
-            x = x / np.linalg.norm(x)
-            CA_C_vec = centered_C_coord - centered_CA_coord
-            z = np.cross(x, CA_C_vec)
-            z = z / np.linalg.norm(z)
-            y = np.cross(z, x)
-            y = y / np.linalg.norm(y)
-            frame_rot_matrix = np.stack([x, y, z], axis=1)
-            # assert np.allclose(frame_rot_matrix.T, np.linalg.inv(frame_rot_matrix)) # this is always true, omitting it because it might return false for numerical errors that don't matter much
-
-            # align to frame
-            nh[3] = np.matmul(nh[3], frame_rot_matrix)
-        
-        if coordinate_system == "spherical":
-            nh[3] = np.array(cartesian_to_spherical__numpy(nh[3]))
-        if coordinate_system == "cartesian":
-            nh[3] = nh[3]
-        nh.insert(0, nh_id)
-
-        if nh_id[0].decode("utf-8") not in {
-            "Z",
-            "X",
-        }:  # exclude non-canonical amino-acids, as they're probably just gonna confuse the model
-            filtered_neighborhoods.append(nh)
-
-    neighborhoods = filtered_neighborhoods
+    fields = [np_protein[x][flat] for x in range(1, len(np_protein))]
+
+    # center coordinates to CA
+    nh_coords = fields[3] - ca_coords[segments]
+
+    # align to backbone frame, if requested, with one rotation per atom
+    if align_to_backbone_frame:
+        nh_coords = np.einsum("ni,nji->nj", nh_coords, frames[segments])
+
+    if coordinate_system == "spherical":
+        nh_coords = cartesian_to_spherical__numpy(nh_coords)
+    fields[3] = nh_coords
+
+    bounds = np.cumsum(lengths)[:-1]
+    fields = [np.split(field, bounds) for field in fields]
+    neighborhoods = [
+        [nh_ids[i]] + [field[i] for field in fields] for i in range(num_nhs)
+    ]
+    if store_frames:
+        for neighborhood, frame in zip(neighborhoods, frames):
+            neighborhood.append(frame)
 
     return neighborhoods
 
@@ -329,6 +413,27 @@ def pad(arr: np.ndarray, padded_length: int = 100) -> np.ndarray:
     return mat_arr
 
 
+def get_neighborhood_dtype(
+    res_id_dt: np.dtype, max_atoms: int, frame: bool = False
+) -> np.dtype:
+    """
+    Dtype of padded neighborhoods with max_atoms atoms, and optionally the
+    backbone frame of the central residue.
+    """
+    dt = [
+        ("res_id", res_id_dt, (6)),
+        ("atom_names", "S4", (max_atoms)),
+        ("elements", "S2", (max_atoms)),
+        ("res_ids", res_id_dt, (max_atoms, 6)),
+        ("coords", "f4", (max_atoms, 3)),
+        ("SASAs", "f4", (max_atoms)),
+        ("charges", "f4", (max_atoms)),
+    ]
+    if frame:
+        dt.append(("frame", "f4", (3, 3)))
+    return np.dtype(dt)
+
+
 def pad_neighborhood(
     res_id: bytes, ragged_structure, padded_length: int = 100
 ) -> np.ndarray:
@@ -351,19 +456,7 @@ def pad_neighborhood(
     """
     pad_custom = partial(pad, padded_length=padded_length)
 
-    res_id_dt = res_id.dtype
-    max_atoms = padded_length
-    dt = np.dtype(
-        [
-            ("res_id", res_id_dt, (6)),
-            ("atom_names", "S4", (max_atoms)),
-            ("elements", "S2", (max_atoms)),
-            ("res_ids", res_id_dt, (max_atoms, 6)),
-            ("coords", "f4", (max_atoms, 3)),
-            ("SASAs", "f4", (max_atoms)),
-            ("charges", "f4", (max_atoms)),
-        ]
-    )
+    dt = get_neighborhood_dtype(res_id.dtype, padded_length)
 
     mat_structure = np.empty(dtype=dt, shape=())
     padded_list = list(map(pad_custom, ragged_structure))
@@ -380,20 +473,46 @@ def pad_neighborhood(
 
 
 def pad_neighborhoods(neighborhoods, padded_length=600):
-    padded_neighborhoods = []
-    for i, neighborhood in enumerate(neighborhoods):
-        # print('Zeroeth entry',i,neighborhood[0])
-        padded_neighborhoods.append(
-            pad_neighborhood(
-                neighborhood[0],
-                [neighborhood[i] for i in range(1, len(neighborhood))],
-                padded_length=padded_length,
-            )
-        )
+    """
+    Pad all the neighborhoods of a protein at once.
+
+    Parameters
+    ----------
+    neighborhoods : list
+        Neighborhoods as returned by `get_neighborhoods_from_protein`, i.e.
+        [res_id, atom_names, elements, res_ids, coords, SASAs, charges],
+        optionally followed by the frame
+    padded_length : int, default 600
+        The resulting number of atoms of every neighborhood.
 
-    # [padded_neighborhood.insert(0,nh[0]) for nh,padded_neighborhood in zip(neighborhoods,padded_neighborhoods)]
-    # [padded_neighborhood['res_id'] = nh[0] for nh,padded_neighborhood in zip(neighborhoods,padded_neighborhoods)]
-    padded_neighborhoods = np.array(
-        padded_neighborhoods, dtype=padded_neighborhoods[0].dtype
+    Returns
+    -------
+    padded_neighborhoods : numpy.ndarray
+        Structured array with one row per neighborhood.
+    """
+    has_frame = len(neighborhoods[0]) > 7
+    dt = get_neighborhood_dtype(
+        neighborhoods[0][0].dtype, padded_length, frame=has_frame
     )
+
+    lengths = np.array([neighborhood[1].shape[0] for neighborhood in neighborhoods])
+    if np.any(lengths > padded_length):
+        raise ValueError(
+            f"Padded length of {padded_length} is smaller than the number of atoms "
+            f"of the largest neighborhood, {np.max(lengths)}."
+        )
+
+    padded_neighborhoods = np.zeros(shape=(len(neighborhoods),), dtype=dt)
+    padded_neighborhoods["res_id"] = [neighborhood[0] for neighborhood in neighborhoods]
+
+    # flat (neighborhood, atom) index of every atom of every neighborhood
+    rows = np.repeat(np.arange(len(neighborhoods)), lengths)
+    cols = np.arange(rows.shape[0]) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    for i, name in enumerate(dt.names[1:7]):
+        padded_neighborhoods[name][rows, cols] = np.concatenate(
+            [neighborhood[i + 1] for neighborhood in neighborhoods]
+        )
+    if has_frame:
+        padded_neighborhoods["frame"] = [neighborhood[7] for neighborhood in neighborhoods]
+
     return padded_neighborhoods
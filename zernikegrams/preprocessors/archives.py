@@ -0,0 +1,309 @@
+"""
+Structure files read in memory from gzipped files and tar or zip shards.
+
+Besides plain .pdb and .cif files, a pdb_dir can hold gzipped files,
+.pdb.gz and .cif.gz, and uncompressed .tar or .zip shards of such files. They
+are read without extracting anything onto the filesystem:
+
+    - gzipped files are read and decompressed in memory
+    - the members of a shard are located once per shard, by an index of the
+      offset and size of their data, see `load_index`, so that a worker reads
+      a contiguous run of members with one read, and decompresses them in
+      memory, see `read_structures`. Members are only read together if they
+      are at most READ_BYTES apart, since the data between them is read too.
+
+The structures are then parsed from their contents, see
+`zernikegrams.structural_info.native_parser`. The index is saved next to the
+shard, as <shard>.index.npy, when its directory is writable, and rebuilt when
+the shard is newer.
+
+Compressed tars (.tar.gz) cannot be read at an offset; shard them as tars of
+gzipped files instead.
+"""
+
+import functools
+import gzip
+import itertools
+import os
+import struct
+import tarfile
+import zipfile
+import zlib
+from typing import *
+
+import numpy as np
+
+from zernikegrams.preprocessors.batching import get_size_batches
+from zernikegrams.preprocessors.hdf5_ranges import READ_BYTES
+from zernikegrams.utils import log_config as logging
+
+logger = logging.getLogger(__name__)
+
+STRUCTURE_SUFFIXES = (".pdb", ".cif")
+GZIP_SUFFIX = ".gz"
+ARCHIVE_SUFFIXES = (".tar", ".zip")
+INDEX_SUFFIX = ".index.npy"
+
+# local file header of a zip member, before its name and extra field
+ZIP_LOCAL_HEADER = struct.Struct("<4s2B4HL2L2H")
+ZIP_LOCAL_SIGNATURE = b"PK\x03\x04"
+
+
+class ArchiveMember(NamedTuple):
+    """A structure file of a shard, see `load_index`"""
+
+    archive: str
+    filename: str  # e.g. 1abc.pdb, without the .gz suffix
+    offset: int  # of the data of the member in the archive
+    size: int  # of the data, compressed if any
+    compression: int  # zipfile.ZIP_STORED or zipfile.ZIP_DEFLATED
+    gzipped: bool
+
+
+# a path to a structure file, or a member of a shard
+Source = Union[str, ArchiveMember]
+
+
+def split_structure_name(filename: str) -> Optional[Tuple[str, str, bool]]:
+    """
+    (name, suffix, gzipped) of a structure file, e.g. ("1abc", ".pdb", True)
+    for 1abc.pdb.gz, or None if filename is not a structure file
+    """
+    filename = os.path.basename(filename)
+    gzipped = filename.endswith(GZIP_SUFFIX)
+    if gzipped:
+        filename = filename[: -len(GZIP_SUFFIX)]
+    for suffix in STRUCTURE_SUFFIXES:
+        if filename.endswith(suffix) and len(filename) > len(suffix):
+            return filename[: -len(suffix)], suffix, gzipped
+    return None
+
+
+def is_archive(path: str) -> bool:
+    return path.endswith(ARCHIVE_SUFFIXES)
+
+
+def get_index_dtype(filename_length: int) -> np.dtype:
+    return np.dtype(
+        [
+            ("filename", f"S{filename_length}"),
+            ("offset", "<i8"),
+            ("size", "<i8"),
+            ("compression", "<i2"),
+            ("gzipped", "?"),
+        ]
+    )
+
+
+def _index_tar(archive: str) -> List[Tuple[str, int, int, int]]:
+    try:
+        tar = tarfile.open(archive, "r:")
+    except tarfile.ReadError as e:
+        raise ValueError(
+            f"Cannot index {archive}: only uncompressed tars can be read at an "
+            f"offset, use a tar of gzipped files instead"
+        ) from e
+    with tar:
+        return [
+            (member.name, member.offset_data, member.size, zipfile.ZIP_STORED)
+            for member in tar
+            if member.isfile()
+        ]
+
+
+def _index_zip(archive: str) -> List[Tuple[str, int, int, int]]:
+    members = []
+    with zipfile.ZipFile(archive) as zf, open(archive, "rb") as f:
+        for info in zf.infolist():
+            if info.is_dir():
+                continue
+            if info.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+                logger.warning(
+                    f"Skipping {info.filename} of {archive}, compressed with "
+                    f"unsupported method {info.compress_type}"
+                )
+                continue
+            # the data follows the local header, whose extra field can differ
+            # from the one of the central directory
+            f.seek(info.header_offset)
+            header = ZIP_LOCAL_HEADER.unpack(f.read(ZIP_LOCAL_HEADER.size))
+            if header[0] != ZIP_LOCAL_SIGNATURE:
+                raise ValueError(f"Bad local header of {info.filename} in {archive}")
+            name_length, extra_length = header[-2:]
+            offset = info.header_offset + ZIP_LOCAL_HEADER.size + name_length + extra_length
+            members.append((info.filename, offset, info.compress_size, info.compress_type))
+    return members
+
+
+def build_index(archive: str) -> np.ndarray:
+    """
+    Offset and size of the data of the structure files of archive, in order
+    of offset, see `get_index_dtype`
+    """
+    members = _index_zip(archive) if archive.endswith(".zip") else _index_tar(archive)
+    rows = []
+    for name, offset, size, compression in members:
+        split = split_structure_name(name)
+        if split is None:
+            continue
+        pdb, suffix, gzipped = split
+        rows.append(((pdb + suffix).encode("utf-8"), offset, size, compression, gzipped))
+    length = max([1] + [len(row[0]) for row in rows])
+    index = np.array(rows, dtype=get_index_dtype(length))
+    return index[np.argsort(index["offset"], kind="stable")]
+
+
+@functools.lru_cache(maxsize=None)
+def load_index(archive: str) -> np.ndarray:
+    """
+    Index of archive, see `build_index`, read from <archive>.index.npy if it
+    is newer than archive, otherwise built and saved there if possible
+    """
+    path = archive + INDEX_SUFFIX
+    if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(archive):
+        return np.load(path)
+
+    logger.info(f"Indexing {archive}")
+    index = build_index(archive)
+    try:
+        with open(path, "wb") as f:
+            np.save(f, index)
+    except OSError as e:
+        logger.debug(f"Could not save the index of {archive}: {e}")
+    return index
+
+
+def get_archive_members(archive: str) -> List[ArchiveMember]:
+    return [
+        ArchiveMember(
+            archive,
+            filename.decode("utf-8"),
+            int(offset),
+            int(size),
+            int(compression),
+            bool(gzipped),
+        )
+        for filename, offset, size, compression, gzipped in load_index(archive)
+    ]
+
+
+def get_structure_sources(pdb_dir: str) -> Dict[str, Source]:
+    """
+    Sources of the structures of pdb_dir by name: its structure files, plain
+    or gzipped, and the members of its shards. Plain files take precedence
+    over gzipped files, and files over members of shards.
+    """
+    sources = {}
+    files = sorted(os.listdir(pdb_dir))
+    for file in files:
+        if is_archive(file):
+            for member in get_archive_members(os.path.join(pdb_dir, file)):
+                sources.setdefault(split_structure_name(member.filename)[0], member)
+    # plain files last, to take precedence
+    for file in sorted(files, key=lambda file: file.endswith(GZIP_SUFFIX), reverse=True):
+        split = split_structure_name(file)
+        if split is not None:
+            sources[split[0]] = os.path.join(pdb_dir, file)
+    return sources
+
+
+def get_source_file(source: Source) -> str:
+    """
+    Path of the structure of source, as an uncompressed file: the name
+    the structure is parsed under, which may not exist
+    """
+    if isinstance(source, ArchiveMember):
+        return os.path.join(source.archive, source.filename)
+    if source.endswith(GZIP_SUFFIX):
+        return source[: -len(GZIP_SUFFIX)]
+    return source
+
+
+def get_source_size(source: Source) -> int:
+    """Size of source to read, 0 for missing files"""
+    if isinstance(source, ArchiveMember):
+        return source.size
+    return os.path.getsize(source) if os.path.exists(source) else 0
+
+
+def _decompress(member: ArchiveMember, data: bytes) -> bytes:
+    if member.compression == zipfile.ZIP_DEFLATED:
+        data = zlib.decompress(data, -zlib.MAX_WBITS)
+    if member.gzipped:
+        data = gzip.decompress(data)
+    return data
+
+
+def _gap(previous: ArchiveMember, member: ArchiveMember) -> int:
+    # bytes between the data of consecutive members, read with them
+    return member.offset - (previous.offset + previous.size)
+
+
+def read_structures(sources: Sequence[Source]) -> List[Tuple[str, Optional[bytes]]]:
+    """
+    (pdb_file, contents) of the structures of sources, see `get_source_file`.
+    The contents of plain files are None, as they are read by their parser.
+    Consecutive members of the same shard, at most READ_BYTES apart, are read
+    with one read.
+    """
+    structures = []
+    i = 0
+    while i < len(sources):
+        source = sources[i]
+        if not isinstance(source, ArchiveMember):
+            if source.endswith(GZIP_SUFFIX):
+                with gzip.open(source, "rb") as f:
+                    structures.append((get_source_file(source), f.read()))
+            else:
+                structures.append((source, None))
+            i += 1
+            continue
+
+        # the run of members of the archive, in order of offset
+        j = i + 1
+        while (
+            j < len(sources)
+            and isinstance(sources[j], ArchiveMember)
+            and sources[j].archive == source.archive
+            and 0 <= _gap(sources[j - 1], sources[j]) <= READ_BYTES
+        ):
+            j += 1
+        start = source.offset
+        stop = max(member.offset + member.size for member in sources[i:j])
+        with open(source.archive, "rb") as f:
+            f.seek(start)
+            data = f.read(stop - start)
+        for member in sources[i:j]:
+            chunk = data[member.offset - start : member.offset - start + member.size]
+            structures.append((get_source_file(member), _decompress(member, chunk)))
+        i = j
+    return structures
+
+
+def get_member_groups(
+    items: Sequence[Tuple[str, ArchiveMember]], target_cost: float
+) -> List[List[Tuple[str, ArchiveMember]]]:
+    """
+    Groups (pdb, member) items into runs of members of the same shard,
+    contiguous in offset and at most READ_BYTES apart, costing up to
+    target_cost. Members cost the bytes read with them, their size and the
+    gap after the previous member of the run, see `read_structures`.
+    """
+    order = sorted(items, key=lambda item: (item[1].archive, item[1].offset))
+    groups = []
+    for _, archive_items in itertools.groupby(order, key=lambda item: item[1].archive):
+        runs, previous = [], None
+        for item in archive_items:
+            gap = None if previous is None else _gap(previous, item[1])
+            if gap is None or not 0 <= gap <= READ_BYTES:
+                runs.append([])
+                gap = 0
+            runs[-1].append((item, item[1].size + gap))
+            previous = item[1]
+        for run in runs:
+            groups.extend(
+                [item for item, _ in group]
+                for group in get_size_batches(run, lambda cost: cost[1], target_cost)
+            )
+    return groups
+
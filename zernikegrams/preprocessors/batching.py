@@ -0,0 +1,63 @@
+"""
+Batch callbacks of the preprocessors.
+
+With batched=True, the execute method of a preprocessor calls its callback on
+a batch of contiguous items, read in one go, instead of on single items:
+
+    - proteins_hdf5: callback(proteins, **params), with proteins an array of rows
+    - neighborhoods_hdf5: callback(neighborhoods, proportion_sidechain_removed, **params),
+      with proportion_sidechain_removed an array, or None
+    - pdbs: callback(pdb_files, **params), with pdb_files a list of paths
+
+and yields the result of the callback, one per batch. Batch sizes are chosen so
+that the input of a batch takes about batch_bytes of memory, while keeping
+enough batches per worker to balance the load.
+"""
+
+from typing import *
+
+from zernikegrams.preprocessors.hdf5_ranges import RANGES_PER_WORKER
+
+# target memory of the input of one batch
+BATCH_BYTES = 1 << 25
+
+
+def get_max_batch_items(num_items: int, parallelism: int) -> int:
+    """Number of items per batch above which some workers would be left idle"""
+    return max(1, -(-num_items // (RANGES_PER_WORKER * max(1, parallelism))))
+
+
+def get_size_batches(
+    items: Iterable[Any],
+    get_size: Callable[[Any], int],
+    batch_bytes: int = BATCH_BYTES,
+    max_items: Optional[int] = None,
+) -> Iterator[List[Any]]:
+    """
+    Groups consecutive items into batches whose sizes add up to about
+    batch_bytes. An item larger than batch_bytes is a batch of its own.
+
+    Parameters
+    ----------
+    items : iterable
+        Items to group, consumed lazily
+    get_size : callable
+        Estimated memory of an item
+    batch_bytes : int
+        Target memory of a batch
+    max_items : int, optional
+        Maximum number of items per batch
+    """
+    batch, batch_size = [], 0
+    for item in items:
+        size = get_size(item)
+        if batch and (
+            batch_size + size > batch_bytes
+            or (max_items is not None and len(batch) >= max_items)
+        ):
+            yield batch
+            batch, batch_size = [], 0
+        batch.append(item)
+        batch_size += size
+    if batch:
+        yield batch
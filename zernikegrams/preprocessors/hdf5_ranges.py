@@ -0,0 +1,71 @@
+"""
+Contiguous, chunk-aligned index ranges of HDF5 datasets.
+
+Workers read a whole range in one call and iterate over its rows in memory,
+so that every chunk is read and decompressed once rather than once per row.
+"""
+
+from typing import *
+
+import h5py
+import numpy as np
+
+# upper bound of the size of one read
+READ_BYTES = 1 << 22
+# lower bound of the number of ranges per worker, for load balancing
+RANGES_PER_WORKER = 4
+
+
+def get_rows_per_range(
+    dataset: h5py.Dataset,
+    num_rows: int,
+    parallelism: int,
+    read_bytes: int = READ_BYTES,
+) -> int:
+    """
+    Number of rows of the ranges of dataset, as a multiple of its chunk size.
+
+    Parameters
+    ----------
+    dataset : h5py.Dataset
+        Dataset to read
+    num_rows : int
+        Number of rows that will be read
+    parallelism : int
+        Number of workers reading the ranges
+    read_bytes : int
+        Upper bound of the size of one range, up to the chunk size
+    """
+    chunk_rows = dataset.chunks[0] if dataset.chunks is not None else 1
+    rows = min(
+        read_bytes // max(1, dataset.dtype.itemsize),
+        -(-num_rows // (RANGES_PER_WORKER * max(1, parallelism))),
+    )
+    return max(1, -(-rows // chunk_rows)) * chunk_rows
+
+
+def get_index_ranges(
+    inds: np.ndarray, rows_per_range: int
+) -> List[Tuple[int, int, np.ndarray]]:
+    """
+    Groups indices into ranges of rows aligned to multiples of rows_per_range.
+
+    Parameters
+    ----------
+    inds : np.ndarray
+        Sorted indices of the rows to read
+    rows_per_range : int
+        See `get_rows_per_range`
+
+    Returns
+    -------
+    List of (start, stop, indices of the rows to read in [start, stop))
+    """
+    if len(inds) == 0:
+        return []
+    blocks = inds // rows_per_range
+    bounds = np.nonzero(blocks[1:] != blocks[:-1])[0] + 1
+    return [
+        (int(group[0]), int(group[-1]) + 1, group)
+        for group in np.split(inds, bounds)
+    ]
@@ -1,26 +1,26 @@
 import signal
 import numpy as np
-import os
-import logging
-import functools
-from multiprocessing import Pool
 import h5py
-import sys
 
+from zernikegrams.neighborhoods.buckets import is_bucketed
+from zernikegrams.preprocessors.batching import BATCH_BYTES
+from zernikegrams.preprocessors.hdf5_ranges import (
+    READ_BYTES,
+    get_index_ranges,
+    get_rows_per_range,
+)
+from zernikegrams.preprocessors.supervised_pool import (
+    SupervisedPool,
+    WorkerLimits,
+)
 from zernikegrams.utils import log_config as logging
+from zernikegrams.utils.incremental import get_live_hashes, get_live_rows
 
 logger = logging.getLogger(__name__)
 
 
-def process_data(ind, hdf5_file, neighborhood_list):
+def process_data(neighborhood, proportion_sidechain_removed=None):
     assert process_data.callback
-    with h5py.File(hdf5_file, "r") as f:
-        neighborhood = f[neighborhood_list][ind]
-        if "proportion_sidechain_removed" in f:
-            proportion_sidechain_removed = f["proportion_sidechain_removed"][ind]
-        else:
-            proportion_sidechain_removed = None
-
     return process_data.callback(
         neighborhood,
         proportion_sidechain_removed=proportion_sidechain_removed,
@@ -28,11 +28,59 @@ def process_data(ind, hdf5_file, neighborhood_list):
     )
 
 
-def initializer(init, callback, params, init_params):
+def process_range(index_range):
+    """
+    Processes the neighborhoods of a contiguous range of rows of the dataset
+    at path, read in one call, one by one or as a batch
+    """
+    path, start, stop, inds = index_range
+    neighborhoods = process_range.f[path][start:stop]
+    if process_range.proportions is not None and path == process_range.neighborhood_list:
+        proportions = process_range.proportions[start:stop]
+    else:
+        proportions = None
+
+    if process_range.batched:
+        return [
+            process_data(
+                neighborhoods[inds - start],
+                None if proportions is None else proportions[inds - start],
+            )
+        ]
+
+    return [
+        process_data(
+            neighborhoods[ind - start],
+            None if proportions is None else proportions[ind - start],
+        )
+        for ind in inds
+    ]
+
+
+def split_range(index_range):
+    """
+    Splits a failed range into ranges of one row, see
+    `SupervisedPool.imap_with_retries`
+    """
+    path, _, _, inds = index_range
+    return [(path, ind, ind + 1, inds[i : i + 1]) for i, ind in enumerate(inds)]
+
+
+def initializer(
+    init, callback, params, init_params, hdf5_file, neighborhood_list, batched=False
+):
     if init is not None:
         init(**init_params)
     process_data.callback = callback
     process_data.params = params
+    process_range.batched = batched
+    # opened once per worker, for all the ranges it processes
+    process_range.f = h5py.File(hdf5_file, "r")
+    process_range.neighborhood_list = neighborhood_list
+    if "proportion_sidechain_removed" in process_range.f:
+        process_range.proportions = process_range.f["proportion_sidechain_removed"]
+    else:
+        process_range.proportions = None
     signal.signal(signal.SIGINT, signal.SIG_IGN)
 
 
@@ -40,23 +88,76 @@ class HDF5Preprocessor:
     def __init__(self, hdf5_file, neighborhood_list):
 
         with h5py.File(hdf5_file, "r") as f:
-            num_neighborhoods = np.array(f[neighborhood_list].shape[0])
-            self.pdb_name_length = np.max(
-                list(map(len, f[neighborhood_list]["res_id"][:, 1]))
-            )
-            self.__max_atoms = f[neighborhood_list][0]["atom_names"].shape[0]
-            self.__dtype = f[neighborhood_list].dtype
+            if is_bucketed(f, neighborhood_list):
+                self.__init_bucketed(f[neighborhood_list])
+            else:
+                num_neighborhoods = np.array(f[neighborhood_list].shape[0])
+                self.res_ids = f[neighborhood_list]["res_id"]
+                self.__max_atoms = f[neighborhood_list][0]["atom_names"].shape[0]
+                self.__dtype = f[neighborhood_list].dtype
+                self.__data = np.arange(num_neighborhoods)
+                self.__index = None
+            self.pdb_name_length = np.max(list(map(len, self.res_ids[:, 1])))
+            # rows of tombstones are skipped, see `zernikegrams.utils.incremental`
+            live_rows = get_live_rows(f)
+            if live_rows is not None:
+                self.__data = self.__data[np.isin(self.__data, live_rows)]
+            self.hashes = get_live_hashes(f)
 
         self.neighborhood_list = neighborhood_list
         self.hdf5_file = hdf5_file
-        self.size = num_neighborhoods
-        self.__data = np.arange(num_neighborhoods)
+        self.size = self.res_ids.shape[0]
+        # (res_id, reason) of the neighborhoods whose worker failed, see `supervised_pool`
+        self.failures = []
 
         logger.info(f"Preprocessed {self.size} neighborhoods from {self.hdf5_file}")
 
+    def __init_bucketed(self, group):
+        """
+        Reads the residue ids of bucketed neighborhoods in index order, and
+        orders the neighborhoods bucket by bucket, so that consecutive tasks
+        read consecutive rows of the same bucket.
+        """
+        index = group["index"][:]
+        self.__index = index
+        self.__bucket_names = list(group.attrs["buckets"])
+        self.res_ids = None
+        for bucket, bucket_name in enumerate(group.attrs["buckets"]):
+            rows = index["bucket"] == bucket
+            if not np.any(rows):
+                continue
+            res_ids = group[bucket_name]["res_id"]
+            if self.res_ids is None:
+                self.res_ids = np.empty((index.shape[0], 6), dtype=res_ids.dtype)
+            self.res_ids[rows] = res_ids[index["offset"][rows]]
+            # the widest bucket that is not empty
+            self.__max_atoms = group[bucket_name].dtype["atom_names"].shape[0]
+            self.__dtype = group[bucket_name].dtype
+        self.__data = np.lexsort((index["offset"], index["bucket"]))
+
     def count(self):
         return len(self.__data)
 
+    def filter_neighborhoods(self, residue_filter):
+        """
+        Only process the neighborhoods whose central residue passes residue_filter
+        """
+        keep = residue_filter.select(self.res_ids[self.__data])
+        logger.info(f"Skipping {np.sum(~keep)} neighborhoods that do not pass the filter")
+        self.__data = self.__data[keep]
+
+    def skip_neighborhoods(self, is_skipped):
+        """
+        Does not process the neighborhoods whose residue id is_skipped, e.g.
+        the neighborhoods done by an earlier run, see `zernikegrams.utils.checkpoints`
+        """
+        keep = np.array(
+            [not is_skipped(res_id) for res_id in self.res_ids[self.__data]],
+            dtype=bool,
+        )
+        logger.info(f"Skipping {np.sum(~keep)} neighborhoods")
+        self.__data = self.__data[keep]
+
     def max_atoms(self):
         return self.__max_atoms
 
@@ -71,48 +172,99 @@ class HDF5Preprocessor:
         params=None,
         init=None,
         init_params=None,
+        batched=False,
+        batch_bytes=BATCH_BYTES,
+        worker_limits=WorkerLimits(),
     ):
+        """
+        Runs callback on the neighborhoods in parallel, yielding the results
+        in order. If batched, callback is called on batches of neighborhoods of
+        about batch_bytes, see `batching`. Neighborhoods whose worker fails the
+        worker_limits are recorded in self.failures, see `supervised_pool`,
+        and the neighborhoods of failed batches are retried one by one after
+        all the others.
+        """
         if limit is None:
             data = self.__data
         else:
             data = self.__data[:limit]
-        with Pool(
+        with SupervisedPool(
+            parallelism,
             initializer=initializer,
-            processes=parallelism,
-            initargs=(init, callback, params, init_params),
+            initargs=(
+                init,
+                callback,
+                params,
+                init_params,
+                self.hdf5_file,
+                self.neighborhood_list,
+                batched,
+            ),
+            limits=worker_limits,
         ) as pool:
 
-            all_loaded = True
-            if all_loaded:
-                # logging.info('All PDB files are loaded.')
-                pass
-            else:
-                raise Exception("Some PDB files could not be loaded.")
-            process_data_hdf5 = functools.partial(
-                process_data,
-                hdf5_file=self.hdf5_file,
-                neighborhood_list=self.neighborhood_list,
+            index_ranges = self.__get_index_ranges(
+                data, parallelism, batch_bytes if batched else READ_BYTES
             )
-            ntasks = self.size
-            num_cpus = os.cpu_count()
-            chunksize = ntasks // num_cpus + 1
-
             logger.info(f"Parallelism: {parallelism}")
-            logger.info(f"Number of tasks: {ntasks}")
-            logger.info(f"Number of cpus: {num_cpus}")
-            logger.info(f"Chunksize: {chunksize}")
-
+            logger.info(f"Number of tasks: {len(data)}")
             logger.debug(
-                f"Data size = {ntasks}, "
-                f"cpus = {num_cpus}, "
-                f"chunksize = {chunksize}"
+                f"Data size = {len(data)}, " f"ranges = {len(index_ranges)}"
             )
 
-            if chunksize > 100:
-                chunksize = 16
+            # ordered, so that results follow the order of the neighborhoods
+            for results in pool.imap_with_retries(
+                process_range,
+                index_ranges,
+                split_range,
+                num_items=lambda index_range: len(index_range[3]),
+                ordered=True,
+            ):
+                for res in results:
+                    if res:
+                        yield res
+            self.failures = self.__get_failures(pool.failures)
+
+    def __get_failures(self, failures):
+        """(res_id, reason) of the neighborhoods of failed tasks"""
+        if not failures:
+            return []
+        res_id_failures = []
+        with h5py.File(self.hdf5_file, "r") as f:
+            for failure in failures:
+                path, _, _, inds = failure.task
+                for ind in inds:
+                    res_id_failures.append((f[path][ind]["res_id"], failure.reason))
+        return res_id_failures
 
-            logger.info(f"Chunksize: {chunksize}")
+    def __get_index_ranges(self, data, parallelism, read_bytes):
+        """
+        Ranges of rows of the dataset (or of each bucket) holding the
+        neighborhoods in data, in the order of data
+        """
+        with h5py.File(self.hdf5_file, "r") as f:
+            if self.__index is None:
+                rows_per_range = get_rows_per_range(
+                    f[self.neighborhood_list], len(data), parallelism, read_bytes
+                )
+                return [
+                    (self.neighborhood_list, *index_range)
+                    for index_range in get_index_ranges(data, rows_per_range)
+                ]
 
-            for res in pool.imap(process_data_hdf5, data, chunksize=chunksize):
-                if res:
-                    yield res
+            # data is sorted by bucket, then by offset within the bucket
+            index = self.__index[data]
+            bounds = np.nonzero(index["bucket"][1:] != index["bucket"][:-1])[0] + 1
+            index_ranges = []
+            for group in np.split(index, bounds):
+                if len(group) == 0:
+                    continue
+                path = f"{self.neighborhood_list}/{self.__bucket_names[group['bucket'][0]]}"
+                rows_per_range = get_rows_per_range(
+                    f[path], len(group), parallelism, read_bytes
+                )
+                index_ranges.extend(
+                    (path, *index_range)
+                    for index_range in get_index_ranges(group["offset"], rows_per_range)
+                )
+            return index_ranges
@@ -1,7 +1,7 @@
 import functools
+import itertools
 import os
 import signal
-import tempfile
 import stopit
 
 import numpy as np
@@ -9,62 +9,185 @@ import numpy as np
 from typing import (
     Any,
     Callable,
+    Dict,
     Iterator,
     List,
+    Optional,
     Tuple,
 )
-from multiprocessing import Pool
 
+from zernikegrams.preprocessors.archives import (
+    ArchiveMember,
+    Source,
+    get_member_groups,
+    get_source_size,
+    get_structure_sources,
+    read_structures,
+)
+from zernikegrams.preprocessors.batching import (
+    BATCH_BYTES,
+    get_max_batch_items,
+)
+from zernikegrams.preprocessors.hdf5_ranges import READ_BYTES, get_index_ranges
+from zernikegrams.preprocessors.proteins_hdf5 import split_range
+from zernikegrams.preprocessors.scheduling import (
+    get_cost_groups,
+    get_target_cost,
+)
+from zernikegrams.preprocessors.shared_memory_ring import (
+    SharedMemoryRing,
+    attach,
+    pack_result,
+    pack_results,
+)
+from zernikegrams.preprocessors.supervised_pool import (
+    SupervisedPool,
+    WorkerLimits,
+)
 from zernikegrams.utils import log_config as logging
+from zernikegrams.utils.pdb_lists import pdb_list_from_foldcomp
 
 logger = logging.getLogger(__name__)
 
 
 TIMEOUT = 300  # Max seconds per protein
+# estimated size of a decoded FoldComp entry, to size the ranges of indices
+# the workers decode
+FOLDCOMP_ENTRY_BYTES = 1 << 18
 
 
 @stopit.threading_timeoutable()
-def process_data_dir(pdb: str, pdb_dir: str) -> Tuple[str, Tuple]:
+def process_data_dir(pdb_file: str, pdb_data: Optional[bytes] = None) -> Tuple[str, Tuple]:
     """
-    Given a single instance of a pdb file and its parent directory,
-    processes the pdb and returns a tuple of (pdb name, (*structural info))
+    Given a single pdb file, or its name and contents if it was read in
+    memory (see `archives`), processes the pdb and returns a tuple of
+    (pdb name, (*structural info))
 
     This function should be called in a multiprocessing routine; see
     PDBPreprocessor.execute
     """
     assert process_data_dir.callback
 
-    pdb = pdb if isinstance(pdb, str) else pdb.decode("utf-8")
-    pdb_file = os.path.join(pdb_dir, pdb + ".pdb")
-
-    return process_data_dir.callback(pdb_file, **process_data_dir.params)
+    if pdb_data is None:
+        return process_data_dir.callback(pdb_file, **process_data_dir.params)
+    return process_data_dir.callback(
+        pdb_file, pdb_data=pdb_data, **process_data_dir.params
+    )
 
 
 @stopit.threading_timeoutable()
-def process_data_foldcomp(data: Tuple[str, str]) -> Tuple[str, Tuple]:
+def process_data_foldcomp(pdb_file: str, pdb_data: bytes) -> Tuple[str, Tuple]:
     """
-    Given a single instance of a pdb id and pdb file contents as a string
-    processes the pdb and returns a tuple of (pdb name, (*structural info))
-
-    Param: data -- tuple of (name, pdb) where pdb is the string contents of
-    a pdb file.
+    Given the name and the contents of a pdb decoded from a FoldComp
+    database, processes the pdb in memory and returns a tuple of
+    (pdb name, (*structural info))
 
     This function should be called in a multiprocessing routine; see
     FoldCompPreprocessor.execute
     """
     assert process_data_foldcomp.callback
 
-    name, pdb = data
+    return process_data_foldcomp.callback(
+        pdb_file, pdb_data=pdb_data, **process_data_foldcomp.params
+    )
+
 
-    with tempfile.TemporaryDirectory() as temp_dir:
-        with open(f"{temp_dir}/{name}.pdb", "w") as w:
-            w.write(pdb)
+def get_foldcomp_file(name: str, foldcomp_file: str) -> str:
+    """
+    Name of the pdb file of entry name of foldcomp_file, which does not
+    exist, as `archives.get_source_file`
+    """
+    return os.path.join(foldcomp_file, name + ".pdb")
+
+
+def process_range_foldcomp(index_range: Tuple[int, int, np.ndarray]) -> List[Any]:
+    """
+    Decodes the entries of a range of indices of the FoldComp database opened
+    by the worker, and processes them one by one or as a batch
+    """
+    _, _, inds = index_range
+    db = process_range_foldcomp.db
+    structures = []
+    for ind in inds:
+        name, pdb = db[int(ind)]
+        structures.append(
+            (
+                get_foldcomp_file(name, process_range_foldcomp.foldcomp_file),
+                pdb.encode("utf-8"),
+            )
+        )
+    if process_range_foldcomp.batched:
+        return [pack_result(process_batch_foldcomp, structures)]
+    return pack_results(
+        process_data_foldcomp(pdb_file, pdb_data, timeout=TIMEOUT)
+        for pdb_file, pdb_data in structures
+    )
+
+
+def get_pdb_file(pdb: str, pdb_dir: str) -> str:
+    pdb = pdb if isinstance(pdb, str) else pdb.decode("utf-8")
+    return os.path.join(pdb_dir, pdb + ".pdb")
+
+
+def process_group_dir(group: List[Tuple[str, Source]]) -> List[Tuple[str, Tuple]]:
+    """
+    Processes a group of (pdb, source) one by one, see `scheduling`. The
+    members of shards of the group are read together, see `archives`.
+    """
+    return pack_results(
+        process_data_dir(pdb_file, pdb_data, timeout=TIMEOUT)
+        for pdb_file, pdb_data in read_structures([source for _, source in group])
+    )
+
+
+def process_batch_dir(group: List[Tuple[str, Source]]) -> Any:
+    """
+    Batch counterpart of process_data_dir: calls the callback on the files
+    of a batch of (pdb, source), see `batching`, with the list of their
+    contents as pdb_data if some were read in memory
+    """
+    assert process_data_dir.callback
+
+    structures = read_structures([source for _, source in group])
+    pdb_files = [pdb_file for pdb_file, _ in structures]
+    pdb_data = [data for _, data in structures]
+    params = process_data_dir.params
+    if any(data is not None for data in pdb_data):
+        params = {**params, "pdb_data": pdb_data}
+    with stopit.ThreadingTimeout(TIMEOUT * len(pdb_files)):
+        return process_data_dir.callback(pdb_files, **params)
+
+
+def process_batch_foldcomp(data: List[Tuple[str, bytes]]) -> Any:
+    """
+    Batch counterpart of process_data_foldcomp: calls the callback on a
+    batch of (pdb_file, pdb_data), see `batching`
+    """
+    assert process_data_foldcomp.callback
+
+    pdb_files = [pdb_file for pdb_file, _ in data]
+    with stopit.ThreadingTimeout(TIMEOUT * len(pdb_files)):
         return process_data_foldcomp.callback(
-            f"{temp_dir}/{name}.pdb", **process_data_foldcomp.params
+            pdb_files,
+            pdb_data=[pdb_data for _, pdb_data in data],
+            **process_data_foldcomp.params,
         )
 
 
-def initializer(init: Callable, init_params: Any, callback: Callable, params: Any):
+def split_group(group: List[Any]) -> List[List[Any]]:
+    """Splits a failed group into groups of one, see `SupervisedPool.imap_with_retries`"""
+    return [[item] for item in group]
+
+
+def initializer(
+    init: Callable,
+    init_params: Any,
+    callback: Callable,
+    params: Any,
+    ring: Optional[SharedMemoryRing] = None,
+    foldcomp_file: Optional[str] = None,
+    batched: bool = False,
+):
     """
     Initializer function for the multiprocessing pool.
 
@@ -73,6 +196,9 @@ def initializer(init: Callable, init_params: Any, callback: Callable, params: An
         - init_params: params to init
         - callback: function to be called by process_data_*
         - params: parameters to callback
+        - ring: shared memory ring to send the results through, if not None
+        - foldcomp_file: FoldComp database to decode ranges of, if not None
+        - batched: whether the ranges of foldcomp_file are processed as batches
     """
     if init is not None:
         init(**init_params)
@@ -80,15 +206,62 @@ def initializer(init: Callable, init_params: Any, callback: Callable, params: An
     process_data_dir.params = params
     process_data_foldcomp.callback = callback
     process_data_foldcomp.params = params
+    if foldcomp_file is not None:
+        import foldcomp
+
+        # opened once per worker, for all the ranges it decodes
+        process_range_foldcomp.db = foldcomp.open(foldcomp_file)
+        process_range_foldcomp.foldcomp_file = foldcomp_file
+        process_range_foldcomp.batched = batched
+    attach(ring)
     signal.signal(signal.SIGINT, signal.SIG_IGN)
 
 
+def get_source_groups(
+    items: List[Tuple[str, Source]], costs: np.ndarray, target_cost: float
+) -> List[List[Tuple[str, Source]]]:
+    """
+    Groups of (pdb, source) items: largest files first, alone, and smaller
+    files in groups, see `scheduling`, and runs of contiguous members of
+    shards, see `archives`, largest groups first
+    """
+    is_member = np.array(
+        [isinstance(source, ArchiveMember) for _, source in items], dtype=bool
+    )
+    files = [item for item, member in zip(items, is_member) if not member]
+    groups = get_cost_groups(files, costs[~is_member], target_cost)
+    if np.any(is_member):
+        members = [item for item, member in zip(items, is_member) if member]
+        groups.extend(get_member_groups(members, target_cost))
+        groups.sort(
+            key=lambda group: -sum(get_source_size(source) for _, source in group)
+        )
+    return groups
+
+
 class PDBPreprocessor:
-    def __init__(self, pdb_list: List[str], pdb_dir: str):
+    def __init__(
+        self,
+        pdb_list: List[str],
+        pdb_dir: str,
+        sources: Optional[Dict[str, Source]] = None,
+    ):
+        """
+        Takes the pdbs to process in pdb_dir, whose files can be plain,
+        gzipped, or members of shards, see `archives`. sources are the ones
+        of `archives.get_structure_sources`, if already listed.
+        """
         self.pdb_dir = pdb_dir
+        self.sources = get_structure_sources(pdb_dir) if sources is None else sources
         self.__data = pdb_list
         self.size = len(pdb_list)
         self.pdb_name_length = np.max(list(map(len, self.__data)))
+        # (pdb, reason) of the pdbs whose worker failed, see `supervised_pool`
+        self.failures: List[Tuple[str, str]] = []
+
+    def get_source(self, pdb: str) -> Source:
+        """Source of pdb, or the path of its .pdb file if it is not in pdb_dir"""
+        return self.sources.get(pdb, get_pdb_file(pdb, self.pdb_dir))
 
     def count(self) -> int:
         """
@@ -105,6 +278,15 @@ class PDBPreprocessor:
         """
         return len(self.__data)
 
+    def skip_pdbs(self, is_skipped: Callable[[str], bool]):
+        """
+        Does not process the pdbs for which is_skipped is True, e.g. the pdbs
+        done by an earlier run, see `zernikegrams.utils.checkpoints`
+        """
+        data = [pdb for pdb in self.__data if not is_skipped(pdb)]
+        logger.info(f"Skipping {len(self.__data) - len(data)} pdbs")
+        self.__data = data
+
     def execute(
         self,
         callback: Callable,
@@ -113,6 +295,10 @@ class PDBPreprocessor:
         params=None,
         init=None,
         init_params=None,
+        shared_memory_bytes: Optional[int] = None,
+        batched: bool = False,
+        batch_bytes: int = BATCH_BYTES,
+        worker_limits: WorkerLimits = WorkerLimits(),
     ) -> Iterator[Tuple[str, Tuple]]:
         """
         Kicks off the multiprocessing routine for PDB files
@@ -124,29 +310,70 @@ class PDBPreprocessor:
             - Params: parameters to callback
             - init: function to be called during multiprocessor pool initialization
             - init_params: parameters to init
+            - shared_memory_bytes: if not None, results are sent through
+              shared memory slots of this size, see `shared_memory_ring`
+            - batched: whether to call callback on batches of pdb files of
+              about batch_bytes, see `batching`
+            - worker_limits: limits of the workers, whose failed pdbs are
+              recorded in self.failures, see `supervised_pool`
         """
         if limit is None:
             data = self.__data
         else:
             data = self.__data[:limit]
-        with Pool(
-            initializer=initializer,
-            processes=parallelism,
-            initargs=(init, init_params, callback, params),
-        ) as pool:
-            all_loaded = True
-            if all_loaded:
-                logger.info("All PDB files are loaded.")
-            else:
-                msg = "Some PDB files could not be loaded."
-                logger.error(msg)
-                raise Exception(msg)
-            process_data_pdbs = functools.partial(
-                process_data_dir, pdb_dir=self.pdb_dir, timeout=TIMEOUT
-            )
-            for res in pool.imap(process_data_pdbs, data, chunksize=parallelism):
-                if res:
-                    yield res
+        ring = None
+        if shared_memory_bytes is not None:
+            ring = SharedMemoryRing.for_pool(parallelism, shared_memory_bytes)
+        try:
+            with SupervisedPool(
+                parallelism,
+                initializer=initializer,
+                initargs=(init, init_params, callback, params, ring),
+                limits=worker_limits,
+            ) as pool:
+                all_loaded = True
+                if all_loaded:
+                    logger.info("All PDB files are loaded.")
+                else:
+                    msg = "Some PDB files could not be loaded."
+                    logger.error(msg)
+                    raise Exception(msg)
+                items = [(pdb, self.get_source(pdb)) for pdb in data]
+                costs = np.array(
+                    [get_source_size(source) for _, source in items], dtype=np.float64
+                )
+                target_cost = get_target_cost(costs, parallelism)
+                groups = get_source_groups(
+                    items,
+                    costs,
+                    min(target_cost, batch_bytes) if batched else target_cost,
+                )
+                if batched:
+                    results = pool.imap_with_retries(
+                        functools.partial(pack_result, process_batch_dir),
+                        groups,
+                        split_group,
+                        num_items=len,
+                    )
+                else:
+                    results = itertools.chain.from_iterable(
+                        pool.imap_with_retries(
+                            process_group_dir, groups, split_group, num_items=len
+                        )
+                    )
+                if ring is not None:
+                    results = ring.results(results)
+                for res in results:
+                    if res:
+                        yield res
+                self.failures = [
+                    (pdb, failure.reason)
+                    for failure in pool.failures
+                    for pdb, _ in failure.task
+                ]
+        finally:
+            if ring is not None:
+                ring.close()
 
 
 class FoldCompPreprocessor:
@@ -154,6 +381,9 @@ class FoldCompPreprocessor:
         """
         Takes the path to a foldcomp_file
         For example, data/afdb_rep_v4/afdb_rep_v4
+
+        The entries are decoded by the workers, that open foldcomp_file and
+        decode ranges of its indices, see `process_range_foldcomp`
         """
         try:
             import foldcomp
@@ -161,29 +391,32 @@ class FoldCompPreprocessor:
             logger.error("Foldcomp is not installed. Install with pip or bioconda")
             raise e
 
-        self.__data = foldcomp_file
-        with foldcomp.open(self.__data) as db:
+        self.foldcomp_file = foldcomp_file
+        with foldcomp.open(self.foldcomp_file) as db:
             self.size = len(db)
+        # names of the entries, in the order of the database
+        self.names = pdb_list_from_foldcomp(foldcomp_file)
         self.pdb_name_length = np.max(list(map(len, pdb_list)))
+        self.__data = np.arange(self.size)
+        # (name, reason) of the proteins whose worker failed, see `supervised_pool`
+        self.failures: List[Tuple[str, str]] = []
 
     def count(self) -> int:
         """
         Returns number of PDBs
         """
-        return self.size
+        return len(self.__data)
 
-    def data(self, limit: int) -> Iterator[Tuple[str, str]]:
+    def skip_pdbs(self, is_skipped: Callable[[str], bool]):
         """
-        Generator for name, pdb tuples in FoldComp database
-
-        Limit: integer or None
+        Does not process the proteins for which is_skipped is True, e.g. the
+        proteins done by an earlier run, see `zernikegrams.utils.checkpoints`
         """
-        with foldcomp.open(self.__data) as db:
-            for idx, (name, pdb) in enumerate(db):
-                if idx >= self.count() or (limit is not None and idx >= limit):
-                    break
-                else:
-                    yield name, pdb
+        keep = np.array(
+            [not is_skipped(self.names[ind]) for ind in self.__data], dtype=bool
+        )
+        logger.info(f"Skipping {np.sum(~keep)} proteins")
+        self.__data = self.__data[keep]
 
     def execute(
         self,
@@ -193,6 +426,10 @@ class FoldCompPreprocessor:
         params=None,
         init=None,
         init_params=None,
+        shared_memory_bytes: Optional[int] = None,
+        batched: bool = False,
+        batch_bytes: int = BATCH_BYTES,
+        worker_limits: WorkerLimits = WorkerLimits(),
     ) -> Iterator[Tuple[str, Tuple]]:
         """
         Kicks off the multiprocessing routine for PDB files
@@ -204,17 +441,69 @@ class FoldCompPreprocessor:
             - Params: parameters to callback
             - init: function to be called during multiprocessor pool initialization
             - init_params: parameters to init
+            - shared_memory_bytes: if not None, results are sent through
+              shared memory slots of this size, see `shared_memory_ring`
+            - batched: whether to call callback on batches of pdb files of
+              about batch_bytes, see `batching`
+            - worker_limits: limits of the workers, whose failed pdbs are
+              recorded in self.failures, see `supervised_pool`
         """
-        data = self.data(limit)
+        if limit is None:
+            data = self.__data
+        else:
+            data = self.__data[:limit]
 
-        with Pool(
-            initializer=initializer,
-            processes=parallelism,
-            initargs=(init, init_params, callback, params),
-        ) as pool:
-            process_data_pdbs = functools.partial(
-                process_data_foldcomp, timeout=TIMEOUT
-            )
-            for res in pool.imap(process_data_pdbs, data, chunksize=parallelism):
-                if res:
-                    yield res
+        ring = None
+        if shared_memory_bytes is not None:
+            ring = SharedMemoryRing.for_pool(parallelism, shared_memory_bytes)
+        try:
+            with SupervisedPool(
+                parallelism,
+                initializer=initializer,
+                initargs=(
+                    init,
+                    init_params,
+                    callback,
+                    params,
+                    ring,
+                    self.foldcomp_file,
+                    batched,
+                ),
+                limits=worker_limits,
+            ) as pool:
+                rows_per_range = min(
+                    get_max_batch_items(len(data), parallelism),
+                    max(
+                        1,
+                        (batch_bytes if batched else READ_BYTES)
+                        // FOLDCOMP_ENTRY_BYTES,
+                    ),
+                )
+                index_ranges = get_index_ranges(data, rows_per_range)
+                logger.debug(
+                    f"Data size = {len(data)}, "
+                    f"ranges = {len(index_ranges)}, "
+                    f"rows per range = {rows_per_range}"
+                )
+                results = itertools.chain.from_iterable(
+                    pool.imap_with_retries(
+                        process_range_foldcomp,
+                        index_ranges,
+                        split_range,
+                        num_items=lambda index_range: len(index_range[2]),
+                        ordered=True,
+                    )
+                )
+                if ring is not None:
+                    results = ring.results(results)
+                for res in results:
+                    if res:
+                        yield res
+                self.failures = [
+                    (self.names[ind], failure.reason)
+                    for failure in pool.failures
+                    for ind in failure.task[2]
+                ]
+        finally:
+            if ring is not None:
+                ring.close()
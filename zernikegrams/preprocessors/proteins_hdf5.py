@@ -1,32 +1,82 @@
-import functools
-from multiprocessing import Pool
-import os
+import itertools
 import h5py
 import numpy as np
 import signal
 import stopit
 
 
+from zernikegrams.preprocessors.batching import BATCH_BYTES
+from zernikegrams.preprocessors.hdf5_ranges import (
+    READ_BYTES,
+    get_index_ranges,
+    get_rows_per_range,
+)
+from zernikegrams.preprocessors.scheduling import (
+    get_row_costs,
+    get_target_cost,
+    schedule_index_ranges,
+)
+from zernikegrams.preprocessors.shared_memory_ring import (
+    SharedMemoryRing,
+    attach,
+    pack_result,
+    pack_results,
+)
+from zernikegrams.preprocessors.supervised_pool import (
+    SupervisedPool,
+    WorkerLimits,
+)
 from zernikegrams.utils import log_config as logging
+from zernikegrams.utils.incremental import get_live_hashes, get_live_rows
 
 logger = logging.getLogger(__name__)
 
 
 @stopit.threading_timeoutable()
-def process_data(ind, hdf5_file, protein_list):
+def process_data(protein):
     assert process_data.callback
-
-    with h5py.File(hdf5_file, "r") as f:
-        protein = f[protein_list][ind]
-        # print('loaded protein',protein[0])
     return process_data.callback(protein, **process_data.params)
 
 
-def initializer(init, callback, params, init_params):
+def process_range(index_range):
+    """
+    Processes the proteins of a contiguous range of rows, read in one call,
+    one by one or as a batch
+    """
+    start, stop, inds = index_range
+    proteins = process_range.dataset[start:stop]
+    if process_range.batched:
+        return [pack_result(process_data, proteins[inds - start])]
+    return pack_results(process_data(proteins[ind - start]) for ind in inds)
+
+
+def split_range(index_range):
+    """
+    Splits a failed range into ranges of one row, see
+    `SupervisedPool.imap_with_retries`
+    """
+    _, _, inds = index_range
+    return [(ind, ind + 1, inds[i : i + 1]) for i, ind in enumerate(inds)]
+
+
+def initializer(
+    init,
+    callback,
+    params,
+    init_params,
+    hdf5_file,
+    protein_list,
+    ring=None,
+    batched=False,
+):
     if init is not None:
         init(**init_params)
     process_data.callback = callback
     process_data.params = params
+    process_range.batched = batched
+    # opened once per worker, for all the ranges it processes
+    process_range.dataset = h5py.File(hdf5_file, "r")[protein_list]
+    attach(ring)
     signal.signal(signal.SIGINT, signal.SIG_IGN)
 
 
@@ -35,18 +85,43 @@ class HDF5Preprocessor:
 
         with h5py.File(hdf5_file, "r") as f:
             num_proteins = np.array(f[protein_list].shape[0])
-            self.pdb_name_length = np.max(list(map(len, f[protein_list]["pdb"])))
+            self.pdbs = f[protein_list]["pdb"]
+            self.pdb_name_length = np.max(list(map(len, self.pdbs)))
+            # rows of tombstones are skipped, see `zernikegrams.utils.incremental`
+            live_rows = get_live_rows(f)
+            self.hashes = get_live_hashes(f)
 
         self.protein_list = protein_list
         self.hdf5_file = hdf5_file
         self.size = num_proteins
-        self.__data = np.arange(num_proteins)
+        self.__data = np.arange(num_proteins) if live_rows is None else live_rows
+        # (pdb, reason) of the proteins whose worker failed, see `supervised_pool`
+        self.failures = []
 
         logger.info(f"Preprocessed {self.size} proteins from {self.hdf5_file}")
 
     def count(self):
         return len(self.__data)
 
+    def filter_pdbs(self, pdbs):
+        """
+        Only process the proteins whose pdb is in pdbs, without loading the others
+        """
+        keep = np.array([pdb in pdbs for pdb in self.pdbs[self.__data]], dtype=bool)
+        logger.info(f"Skipping {np.sum(~keep)} proteins not in the selection")
+        self.__data = self.__data[keep]
+
+    def skip_pdbs(self, is_skipped):
+        """
+        Does not process the proteins whose pdb is_skipped, e.g. the proteins
+        done by an earlier run, see `zernikegrams.utils.checkpoints`
+        """
+        keep = np.array(
+            [not is_skipped(pdb) for pdb in self.pdbs[self.__data]], dtype=bool
+        )
+        logger.info(f"Skipping {np.sum(~keep)} proteins")
+        self.__data = self.__data[keep]
+
     def execute(
         self,
         callback,
@@ -55,40 +130,86 @@ class HDF5Preprocessor:
         params=None,
         init=None,
         init_params=None,
+        shared_memory_bytes=None,
+        batched=False,
+        batch_bytes=BATCH_BYTES,
+        worker_limits=WorkerLimits(),
     ):
+        """
+        Runs callback on the proteins in parallel, yielding the results as
+        they complete. If shared_memory_bytes is not None, results are sent
+        through shared memory slots of this size, see `shared_memory_ring`.
+        If batched, callback is called on batches of proteins of about
+        batch_bytes, see `batching`. Proteins whose worker fails the
+        worker_limits are recorded in self.failures, see `supervised_pool`.
+        """
         if limit is None:
             data = self.__data
         else:
             data = self.__data[:limit]
-        with Pool(
-            initializer=initializer,
-            processes=parallelism,
-            initargs=(init, callback, params, init_params),
-        ) as pool:
-
-            all_loaded = True
-            if all_loaded:
-                # logger.info('All PDB files are loaded.')
-                pass
-            else:
-                raise Exception("Some PDB files could not be loaded.")
-
-            process_data_hdf5 = functools.partial(
-                process_data, hdf5_file=self.hdf5_file, protein_list=self.protein_list
-            )
-            ntasks = self.size
-            num_cpus = os.cpu_count()
-            chunksize = ntasks // num_cpus + 1
-            logger.debug(
-                f"Data size = {ntasks}, "
-                f"cpus = {num_cpus}, "
-                f"chunksize = {chunksize}"
-            )
-
-            if chunksize > 4:
-                chunksize = 4
-            logger.info(f"chunksize = {chunksize}")
-            for res in pool.imap_unordered(
-                process_data_hdf5, data, chunksize=chunksize
-            ):
-                yield res
+        ring = None
+        if shared_memory_bytes is not None:
+            ring = SharedMemoryRing.for_pool(parallelism, shared_memory_bytes)
+        try:
+            with SupervisedPool(
+                parallelism,
+                initializer=initializer,
+                initargs=(
+                    init,
+                    callback,
+                    params,
+                    init_params,
+                    self.hdf5_file,
+                    self.protein_list,
+                    ring,
+                    batched,
+                ),
+                limits=worker_limits,
+            ) as pool:
+
+                all_loaded = True
+                if all_loaded:
+                    # logger.info('All PDB files are loaded.')
+                    pass
+                else:
+                    raise Exception("Some PDB files could not be loaded.")
+
+                with h5py.File(self.hdf5_file, "r") as f:
+                    rows_per_range = get_rows_per_range(
+                        f[self.protein_list],
+                        len(data),
+                        parallelism,
+                        read_bytes=batch_bytes if batched else READ_BYTES,
+                    )
+                    costs = get_row_costs(f[self.protein_list])
+                # largest proteins first, see `scheduling`
+                index_ranges = schedule_index_ranges(
+                    get_index_ranges(data, rows_per_range),
+                    costs,
+                    get_target_cost(costs[data], parallelism),
+                )
+                logger.debug(
+                    f"Data size = {len(data)}, "
+                    f"ranges = {len(index_ranges)}, "
+                    f"rows per range = {rows_per_range}"
+                )
+
+                results = itertools.chain.from_iterable(
+                    pool.imap_with_retries(
+                        process_range,
+                        index_ranges,
+                        split_range,
+                        num_items=lambda index_range: len(index_range[2]),
+                    )
+                )
+                if ring is not None:
+                    results = ring.results(results)
+                yield from results
+                self.failures = [
+                    (self.pdbs[ind], failure.reason)
+                    for failure in pool.failures
+                    for ind in failure.task[2]
+                ]
+        finally:
+            if ring is not None:
+                ring.close()
@@ -0,0 +1,101 @@
+"""
+Cost-model scheduling of the tasks of the preprocessors.
+
+The cost of every item is estimated cheaply up front, from the size of its
+file or of the compressed HDF5 chunk holding it, both roughly proportional to
+its number of atoms. Tasks are then dispatched most expensive first, expensive
+items alone and cheap items grouped, so that a large protein does not keep one
+worker busy at the end of a stage while the others are idle.
+"""
+
+import os
+from typing import *
+
+import h5py
+import numpy as np
+
+from zernikegrams.preprocessors.batching import get_size_batches
+from zernikegrams.preprocessors.hdf5_ranges import RANGES_PER_WORKER
+from zernikegrams.utils import log_config as logging
+
+logger = logging.getLogger(__name__)
+
+
+def get_target_cost(costs: np.ndarray, parallelism: int) -> float:
+    """Cost of one task, so that every worker gets several tasks"""
+    return max(1.0, float(np.sum(costs)) / (RANGES_PER_WORKER * max(1, parallelism)))
+
+
+def get_file_costs(files: Sequence[str]) -> np.ndarray:
+    """Sizes of files, 0 for missing files"""
+    return np.array(
+        [os.path.getsize(file) if os.path.exists(file) else 0 for file in files],
+        dtype=np.float64,
+    )
+
+
+def get_row_costs(dataset: h5py.Dataset) -> np.ndarray:
+    """
+    Compressed size of the rows of dataset, read from the chunk index without
+    reading the data. Rows of a chunk share its size. Uniform if dataset is not
+    chunked or the chunks cannot be iterated over.
+    """
+    costs = np.ones(dataset.shape[0], dtype=np.float64)
+    if dataset.chunks is None or not hasattr(dataset.id, "chunk_iter"):
+        return costs
+
+    chunk_rows = dataset.chunks[0]
+
+    def set_cost(info):
+        start = info.chunk_offset[0]
+        costs[start : start + chunk_rows] = info.size / chunk_rows
+
+    try:
+        dataset.id.chunk_iter(set_cost)
+    except Exception as e:
+        logger.debug(f"Could not read the chunk sizes of {dataset.name}: {e}")
+        costs[:] = 1.0
+    return costs
+
+
+def get_cost_groups(
+    items: Sequence[Any], costs: np.ndarray, target_cost: float
+) -> List[List[Any]]:
+    """
+    Groups items most expensive first. Items costing more than target_cost
+    are alone in their group, cheaper items are grouped up to target_cost.
+    """
+    order = np.argsort(-costs, kind="stable")
+    return [
+        [items[i] for i in group]
+        for group in get_size_batches(order, costs.__getitem__, target_cost)
+    ]
+
+
+def schedule_index_ranges(
+    index_ranges: List[Tuple[int, int, np.ndarray]],
+    costs: np.ndarray,
+    target_cost: float,
+) -> List[Tuple[int, int, np.ndarray]]:
+    """
+    Splits the ranges of `hdf5_ranges.get_index_ranges` whose rows cost more
+    than target_cost, and orders the ranges most expensive first.
+
+    Parameters
+    ----------
+    index_ranges : list of (start, stop, indices)
+        Ranges of rows
+    costs : np.ndarray
+        Cost of every row of the dataset, see `get_row_costs`
+    target_cost : float
+        Cost above which a range is split, see `get_target_cost`
+    """
+    scheduled = []
+    for _, _, inds in index_ranges:
+        for group in get_size_batches(inds, costs.__getitem__, target_cost):
+            group = np.asarray(group)
+            scheduled.append(
+                (float(np.sum(costs[group])), (int(group[0]), int(group[-1]) + 1, group))
+            )
+    scheduled.sort(key=lambda cost_range: -cost_range[0])
+    return [index_range for _, index_range in scheduled]
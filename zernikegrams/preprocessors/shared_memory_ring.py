@@ -0,0 +1,203 @@
+"""
+Transport of worker results through a ring of shared memory buffers.
+
+By default, results of the pool workers are pickled and copied through the
+pipe of the pool, which limits scaling for results made of large padded
+arrays. With a ring, a worker copies the numpy arrays of its result into a
+free slot of shared memory and sends only a small descriptor through the pipe.
+The parent turns the descriptor back into a result whose arrays are views of
+the slot, without copies.
+
+A slot is released when the parent requests the next result, so the arrays
+of a result must be copied (e.g. written out) before that. Results that do not
+fit in a slot, or for which no slot frees up in time, go through the pipe.
+The results of a task are only sent once it is done, so a task with several
+results does not wait for slots, which its own results may hold, see
+`pack_results`.
+"""
+
+import multiprocessing
+import os
+import queue
+from multiprocessing.shared_memory import SharedMemory
+from typing import *
+
+import numpy as np
+
+from zernikegrams.utils import log_config as logging
+
+logger = logging.getLogger(__name__)
+
+# seconds a worker waits for a free slot before sending through the pipe
+SLOT_TIMEOUT = 1.0
+# alignment of the arrays in a slot
+ALIGNMENT = 64
+# slots per worker
+SLOTS_PER_WORKER = 2
+
+
+class SharedArray(NamedTuple):
+    offset: int
+    shape: Tuple[int, ...]
+    dtype: np.dtype
+
+
+class SharedMemoryResult(NamedTuple):
+    slot: int
+    result: Any
+
+
+def _aligned(nbytes: int) -> int:
+    return -(-nbytes // ALIGNMENT) * ALIGNMENT
+
+
+def _is_shareable(obj: Any) -> bool:
+    return isinstance(obj, np.ndarray) and not obj.dtype.hasobject
+
+
+def _is_sequence(obj: Any) -> bool:
+    # named tuples cannot be rebuilt from an iterable
+    return isinstance(obj, list) or (
+        isinstance(obj, tuple) and not hasattr(obj, "_fields")
+    )
+
+
+def _shared_bytes(obj: Any) -> int:
+    if _is_shareable(obj):
+        return _aligned(obj.nbytes)
+    if _is_sequence(obj):
+        return sum(map(_shared_bytes, obj))
+    return 0
+
+
+class SharedMemoryRing:
+    """
+    Ring of shared memory slots of a fixed size, created by the parent before
+    the pool and passed to the workers through the pool initializer.
+
+    Parameters
+    ----------
+    num_slots : int
+        Number of results that can be in flight at once
+    slot_bytes : int
+        Size of each slot
+    """
+
+    def __init__(self, num_slots: int, slot_bytes: int):
+        self.slot_bytes = slot_bytes
+        self.slots = [SharedMemory(create=True, size=slot_bytes) for _ in range(num_slots)]
+        self.free_slots = multiprocessing.Queue()
+        for slot in range(num_slots):
+            self.free_slots.put(slot)
+        self.pid = os.getpid()
+
+    @classmethod
+    def for_pool(cls, parallelism: int, slot_bytes: int) -> "SharedMemoryRing":
+        logger.info(
+            f"Sending results through {SLOTS_PER_WORKER * parallelism} shared "
+            f"memory slots of {slot_bytes / 2**20:.1f} MB"
+        )
+        return cls(SLOTS_PER_WORKER * parallelism, slot_bytes)
+
+    def pack(self, result: Any, timeout: float = SLOT_TIMEOUT) -> Any:
+        """
+        Called in the workers. Copies the arrays of result, possibly nested in
+        lists and tuples, into a free slot and returns the descriptor to send
+        instead of result. Waits up to timeout seconds for a free slot, not at
+        all if 0.
+        """
+        nbytes = _shared_bytes(result)
+        if nbytes == 0 or nbytes > self.slot_bytes:
+            return result
+        try:
+            if timeout > 0:
+                slot = self.free_slots.get(timeout=timeout)
+            else:
+                slot = self.free_slots.get_nowait()
+        except queue.Empty:
+            return result
+
+        buf = self.slots[slot].buf
+        offset = 0
+
+        def share(obj):
+            nonlocal offset
+            if _is_shareable(obj):
+                view = np.ndarray(obj.shape, dtype=obj.dtype, buffer=buf, offset=offset)
+                view[...] = obj
+                shared = SharedArray(offset, obj.shape, obj.dtype)
+                offset += _aligned(obj.nbytes)
+                return shared
+            if _is_sequence(obj):
+                return type(obj)(map(share, obj))
+            return obj
+
+        return SharedMemoryResult(slot, share(result))
+
+    def unpack(self, result: SharedMemoryResult) -> Any:
+        """Called in the parent. Result with views of the slot of the descriptor"""
+        buf = self.slots[result.slot].buf
+
+        def view(obj):
+            if isinstance(obj, SharedArray):
+                return np.ndarray(obj.shape, dtype=obj.dtype, buffer=buf, offset=obj.offset)
+            if _is_sequence(obj):
+                return type(obj)(map(view, obj))
+            return obj
+
+        return view(result.result)
+
+    def results(self, results: Iterable) -> Iterator:
+        """
+        Called in the parent on the results of the pool. Unpacks descriptors,
+        and releases their slot when the next result is requested.
+        """
+        for res in results:
+            if not isinstance(res, SharedMemoryResult):
+                yield res
+                continue
+            try:
+                yield self.unpack(res)
+            finally:
+                self.free_slots.put(res.slot)
+
+    def close(self):
+        """Called in the parent once the pool is done. Frees the slots"""
+        if os.getpid() != self.pid:
+            return
+        for shm in self.slots:
+            try:
+                shm.close()
+            except BufferError:
+                # views of the slot are still referenced, the mapping is
+                # released with them
+                pass
+            shm.unlink()
+        self.free_slots.close()
+
+
+# ring of the current worker, set by the pool initializers
+_ring: Optional[SharedMemoryRing] = None
+
+
+def attach(ring: Optional[SharedMemoryRing]):
+    """Called in the pool initializers with the ring of the pool, if any"""
+    global _ring
+    _ring = ring
+
+
+def pack_result(fn: Callable, *args, **kwargs) -> Any:
+    """Calls fn in a worker and packs its result into the ring of the pool, if any"""
+    res = fn(*args, **kwargs)
+    return res if _ring is None else _ring.pack(res)
+
+
+def pack_results(results: Iterable) -> List[Any]:
+    """
+    Packs the results of a task into the ring of the pool, if any, as they
+    are computed. The slots are released after the whole task, so results
+    that find no free slot go through the pipe without waiting.
+    """
+    if _ring is None:
+        return list(results)
+    return [_ring.pack(res, timeout=0) for res in results]
@@ -0,0 +1,402 @@
+"""
+Process pool that supervises its workers.
+
+Unlike `multiprocessing.Pool`, every worker runs one task at a time, sent
+through its own pipe, so that the parent always knows which task a worker is
+running. The parent kills and replaces a worker that exceeds the wall-clock
+timeout of its task or the RSS cap, which also interrupts C code that a
+timeout in the worker itself cannot, and records the task as failed with the
+reason. Workers are also recycled after a number of tasks or a growth of their
+RSS, to bound slow memory leaks.
+
+RSS is read from /proc, and is not capped on systems without it. Shared
+memory slots held by a killed worker, see `shared_memory_ring`, are not
+reclaimed, and later results fall back to the pipe if none is left.
+"""
+
+import argparse
+import multiprocessing
+import os
+import time
+import traceback
+from multiprocessing.connection import wait
+from typing import *
+
+from zernikegrams.utils import log_config as logging
+
+logger = logging.getLogger(__name__)
+
+# seconds between checks of the limits of the workers
+POLL_INTERVAL = 0.5
+# seconds given to a retired worker to exit before it is killed
+EXIT_TIMEOUT = 5.0
+
+GB = 1 << 30
+
+try:
+    PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+except (AttributeError, ValueError, OSError):
+    PAGE_SIZE = 4096
+
+
+def get_rss(pid: int) -> Optional[int]:
+    """Resident set size of process pid in bytes, or None if unknown"""
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class WorkerLimits(NamedTuple):
+    """
+    Limits of the workers of a `SupervisedPool`. None disables a limit.
+
+    Parameters
+    ----------
+    timeout : float, optional
+        Seconds a task may run per item, see `SupervisedPool.imap_unordered`
+    max_rss : int, optional
+        Bytes of RSS above which a worker is killed, failing its task
+    max_tasks : int, optional
+        Number of tasks after which a worker is replaced
+    max_rss_growth : int, optional
+        Bytes of RSS growth since the worker started after which it is
+        replaced, once its task is done
+    """
+
+    timeout: Optional[float] = None
+    max_rss: Optional[int] = None
+    max_tasks: Optional[int] = None
+    max_rss_growth: Optional[int] = None
+
+
+class TaskFailure(NamedTuple):
+    task: Any
+    reason: str
+
+
+def _worker_main(conn, initializer, initargs):
+    if initializer is not None:
+        initializer(*initargs)
+    conn.send(("ready", None, None))
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        index, fn, task = message
+        try:
+            conn.send(("done", index, fn(task)))
+        except Exception as e:
+            logger.debug(traceback.format_exc())
+            conn.send(("error", index, f"{type(e).__name__}: {e}"))
+    conn.close()
+
+
+class _Worker:
+    def __init__(self, ctx, initializer, initargs):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(
+            target=_worker_main,
+            args=(child_conn, initializer, initargs),
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+        self.ready = False
+        self.base_rss = None
+        self.num_tasks = 0
+        # (index, task, deadline) of the running task
+        self.running = None
+
+    def send(self, fn, index, task, timeout):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        self.running = (index, task, deadline)
+        self.conn.send((index, fn, task))
+
+    def retire(self):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(EXIT_TIMEOUT)
+        if self.process.is_alive():
+            self.kill()
+        self.conn.close()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+
+
+class SupervisedPool:
+    """
+    Pool of worker processes with hard limits, see the module docstring.
+    Failed tasks are recorded in `failures` instead of raising.
+
+    Parameters
+    ----------
+    processes : int
+        Number of workers
+    initializer : callable, optional
+        Called with initargs in every worker, including replacements
+    initargs : tuple
+    limits : WorkerLimits
+    """
+
+    def __init__(
+        self,
+        processes: int,
+        initializer: Optional[Callable] = None,
+        initargs: Tuple = (),
+        limits: WorkerLimits = WorkerLimits(),
+    ):
+        self.ctx = multiprocessing.get_context()
+        self.initializer = initializer
+        self.initargs = initargs
+        self.limits = limits
+        self.failures: List[TaskFailure] = []
+        if (
+            limits.max_rss is not None or limits.max_rss_growth is not None
+        ) and get_rss(os.getpid()) is None:
+            logger.warning("Cannot read the RSS of the workers, RSS limits are disabled")
+        self.workers = [self.__start_worker() for _ in range(max(1, processes))]
+
+    def __start_worker(self) -> _Worker:
+        return _Worker(self.ctx, self.initializer, self.initargs)
+
+    def __replace(self, worker: _Worker, kill: bool = False):
+        if kill:
+            worker.kill()
+            worker.conn.close()
+        else:
+            worker.retire()
+        self.workers[self.workers.index(worker)] = self.__start_worker()
+
+    def __fail(self, worker: _Worker, reason: str) -> int:
+        index, task, _ = worker.running
+        worker.running = None
+        logger.error(f"Task failed ({reason}): {task!r:.200}")
+        self.failures.append(TaskFailure(task, reason))
+        return index
+
+    def __run(
+        self,
+        fn: Callable,
+        tasks: Iterable,
+        num_items: Optional[Callable[[Any], int]],
+    ) -> Iterator[Tuple[int, bool, Any]]:
+        """Yields (index, succeeded, result) of the tasks as they complete"""
+        tasks = enumerate(tasks)
+        exhausted = False
+        while True:
+            for worker in self.workers:
+                if exhausted or not worker.ready or worker.running is not None:
+                    continue
+                try:
+                    index, task = next(tasks)
+                except StopIteration:
+                    exhausted = True
+                    break
+                timeout = self.limits.timeout
+                if timeout is not None and num_items is not None:
+                    timeout *= max(1, num_items(task))
+                worker.send(fn, index, task, timeout)
+
+            if exhausted and all(worker.running is None for worker in self.workers):
+                return
+
+            wait(
+                [worker.conn for worker in self.workers]
+                + [worker.process.sentinel for worker in self.workers],
+                timeout=POLL_INTERVAL,
+            )
+            for worker in list(self.workers):
+                yield from self.__check(worker)
+
+    def __check(self, worker: _Worker) -> Iterator[Tuple[int, bool, Any]]:
+        try:
+            message = worker.conn.recv() if worker.conn.poll() else None
+        except (EOFError, OSError):
+            message = None
+
+        if message is not None:
+            status, index, payload = message
+            if status == "ready":
+                worker.ready = True
+                worker.base_rss = get_rss(worker.process.pid)
+                return
+            if status == "done":
+                worker.running = None
+                yield index, True, payload
+            else:
+                yield self.__fail(worker, payload), False, None
+            worker.num_tasks += 1
+            self.__recycle(worker)
+            return
+
+        if not worker.process.is_alive():
+            if not worker.ready:
+                raise RuntimeError(
+                    f"Worker initialization failed with exit code {worker.process.exitcode}"
+                )
+            if worker.running is not None:
+                reason = f"worker died with exit code {worker.process.exitcode}"
+                yield self.__fail(worker, reason), False, None
+            self.__replace(worker, kill=True)
+            return
+
+        if worker.running is None:
+            return
+        _, _, deadline = worker.running
+        if deadline is not None and time.monotonic() > deadline:
+            yield self.__fail(worker, "timed out"), False, None
+            self.__replace(worker, kill=True)
+            return
+        if self.limits.max_rss is not None:
+            rss = get_rss(worker.process.pid)
+            if rss is not None and rss > self.limits.max_rss:
+                reason = f"exceeded the RSS cap with {rss / GB:.2f} GB"
+                yield self.__fail(worker, reason), False, None
+                self.__replace(worker, kill=True)
+
+    def __recycle(self, worker: _Worker):
+        limits = self.limits
+        if limits.max_tasks is not None and worker.num_tasks >= limits.max_tasks:
+            logger.debug(f"Recycling worker {worker.process.pid} after {worker.num_tasks} tasks")
+            self.__replace(worker)
+            return
+        if limits.max_rss_growth is not None and worker.base_rss is not None:
+            rss = get_rss(worker.process.pid)
+            if rss is not None and rss - worker.base_rss > limits.max_rss_growth:
+                logger.debug(
+                    f"Recycling worker {worker.process.pid} after "
+                    f"{(rss - worker.base_rss) / GB:.2f} GB of growth"
+                )
+                self.__replace(worker)
+
+    def imap_unordered(
+        self,
+        fn: Callable,
+        tasks: Iterable,
+        num_items: Optional[Callable[[Any], int]] = None,
+    ) -> Iterator:
+        """
+        Results of fn on tasks, in completion order. Failed tasks are recorded
+        in `failures` and have no result.
+
+        Parameters
+        ----------
+        num_items : callable, optional
+            Number of items of a task, by which the timeout is multiplied
+        """
+        for _, succeeded, result in self.__run(fn, tasks, num_items):
+            if succeeded:
+                yield result
+
+    def imap(
+        self,
+        fn: Callable,
+        tasks: Iterable,
+        num_items: Optional[Callable[[Any], int]] = None,
+    ) -> Iterator:
+        """Same as `imap_unordered`, with results in the order of tasks"""
+        pending = {}
+        next_index = 0
+        for index, succeeded, result in self.__run(fn, tasks, num_items):
+            pending[index] = (succeeded, result)
+            while next_index in pending:
+                succeeded, result = pending.pop(next_index)
+                next_index += 1
+                if succeeded:
+                    yield result
+
+    def imap_with_retries(
+        self,
+        fn: Callable,
+        tasks: Iterable,
+        split: Callable[[Any], List[Any]],
+        num_items: Optional[Callable[[Any], int]] = None,
+        ordered: bool = False,
+    ) -> Iterator:
+        """
+        Same as `imap_unordered` (or `imap`), retrying the tasks that fail as
+        the smaller tasks returned by split, once all the tasks are done, so
+        that only the items that cause the failure are recorded as failed.
+        """
+        num_failures = len(self.failures)
+        run = self.imap if ordered else self.imap_unordered
+        yield from run(fn, tasks, num_items)
+
+        retries = []
+        failures = self.failures[num_failures:]
+        del self.failures[num_failures:]
+        for failure in failures:
+            parts = split(failure.task)
+            if len(parts) > 1:
+                retries.extend(parts)
+            else:
+                self.failures.append(failure)
+        if retries:
+            logger.info(f"Retrying {len(retries)} items of failed tasks one by one")
+            yield from run(fn, retries, num_items)
+
+    def close(self):
+        for worker in self.workers:
+            if worker.process.is_alive():
+                worker.retire()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            for worker in self.workers:
+                if worker.process.is_alive():
+                    worker.kill()
+
+
+def add_worker_arguments(
+    parser: argparse.ArgumentParser, timeout: Optional[float] = None
+) -> None:
+    """Adds the arguments of `get_worker_limits` to parser"""
+    parser.add_argument(
+        "--worker_timeout",
+        type=float,
+        default=timeout,
+        help="Seconds a worker may spend per item before it is killed and replaced, and the item recorded as failed. Unlike a timeout within the worker, also interrupts C code.",
+    )
+    parser.add_argument(
+        "--max_worker_rss_gb",
+        type=float,
+        default=None,
+        help="[Optional] Memory (RSS) in GB above which a worker is killed and replaced, and its item recorded as failed",
+    )
+    parser.add_argument(
+        "--max_tasks_per_worker",
+        type=int,
+        default=None,
+        help="[Optional] Replace workers after this many tasks",
+    )
+    parser.add_argument(
+        "--max_worker_growth_gb",
+        type=float,
+        default=None,
+        help="[Optional] Replace workers whose memory (RSS) grew by more than this many GB since they started",
+    )
+
+
+def get_worker_limits(args: argparse.Namespace) -> WorkerLimits:
+    """Limits of the workers from the arguments of `add_worker_arguments`"""
+
+    def gb_to_bytes(gb):
+        return None if gb is None else int(gb * GB)
+
+    return WorkerLimits(
+        timeout=args.worker_timeout,
+        max_rss=gb_to_bytes(args.max_worker_rss_gb),
+        max_tasks=args.max_tasks_per_worker,
+        max_rss_growth=gb_to_bytes(args.max_worker_growth_gb),
+    )
@@ -2,10 +2,13 @@
 # https://github.com/KULL-Centre/_2022_ML-ddG-Blaabjerg/blob/main/src/pdb_parser_scripts/clean_pdb.py
 # under the apache 2 license https://www.apache.org/licenses/LICENSE-2.0
 
+import io
 import os
 import subprocess
-import tempfile
+from functools import lru_cache
+from typing import Dict, List, NamedTuple, Optional, Tuple
 
+import numpy as np
 import Bio.PDB
 import Bio.PDB.Polypeptide
 import Bio.SeqIO
@@ -14,9 +17,39 @@ import simtk
 import openmm
 import openmm.app
 
+from zernikegrams.structural_info.hydrogens import add_hydrogens
+
 PDBIO = Bio.PDB.PDBIO()
 PDB_PARSER = Bio.PDB.PDBParser(PERMISSIVE=0, QUIET=True)
 
+# pdbfixer names the chains A to Z, see `_step_4_fix_numbering`
+MAX_CHAINS = 26
+
+# Dipeptide of 1bkx with the side chain of its glutamate missing, see `warm_up`
+WARM_UP_PDB = """\
+ATOM      1  N   GLN A  12      17.825  60.742  45.395  1.00 71.02           N
+ATOM      2  CA  GLN A  12      17.542  61.927  44.627  1.00 69.89           C
+ATOM      3  C   GLN A  12      18.708  62.884  44.567  1.00 70.22           C
+ATOM      4  O   GLN A  12      18.539  64.086  44.298  1.00 75.59           O
+ATOM      5  CB  GLN A  12      16.241  62.624  45.030  1.00 79.62           C
+ATOM      6  CG  GLN A  12      14.984  61.791  44.687  1.00100.00           C
+ATOM      7  CD  GLN A  12      13.825  62.029  45.656  1.00100.00           C
+ATOM      8  OE1 GLN A  12      13.783  61.447  46.759  1.00100.00           O
+ATOM      9  NE2 GLN A  12      12.889  62.900  45.257  1.00 90.57           N
+ATOM     10  N   GLU A  13      19.893  62.356  44.857  1.00 38.43           N
+ATOM     11  CA  GLU A  13      21.092  63.090  44.635  1.00 44.13           C
+ATOM     12  C   GLU A  13      21.682  62.662  43.281  1.00 55.94           C
+ATOM     13  O   GLU A  13      21.442  63.269  42.263  1.00 50.65           O
+END
+"""
+
+
+class CleanedStructure(NamedTuple):
+    """First model of a structure cleaned by `clean_structure`"""
+
+    model: Bio.PDB.Model.Model
+    bypassed: bool  # complete, so pdbfixer was not run, see `is_complete`
+
 
 class NonHetSelector(Bio.PDB.Select):
     """Remove HET atoms and choose first conformation of disordered atoms"""
@@ -55,43 +88,73 @@ class PDBFixerResIdentifiabilityIssue(Exception):
     pass
 
 
-def _step_0_remove_hydrogens(pdb_input_filename, temp0):
-    with open(pdb_input_filename, "r") as f:
-        lines = f.readlines()
+class _WrittenSelector(Bio.PDB.Select):
+    """
+    Selects what selector selects, blanking the altlocs of the atoms it
+    accepts, and records the chains, residues and atoms written, in order,
+    as they would be parsed back
+    """
+
+    def __init__(self, selector):
+        self.selector = selector
+        self.chains = []  # [(chain id, [residues])]
+        self.atoms = []
+
+    def accept_model(self, model):
+        return self.selector.accept_model(model)
+
+    def accept_chain(self, chain):
+        return self.selector.accept_chain(chain)
+
+    def accept_residue(self, residue):
+        return self.selector.accept_residue(residue)
 
+    def accept_atom(self, atom):
+        if not self.selector.accept_atom(atom):
+            return False
+        atom.set_altloc(" ")
+        residue = atom.get_parent()
+        chain_id = residue.get_parent().id
+        if not self.chains or self.chains[-1][0] != chain_id:
+            self.chains.append((chain_id, []))
+        residues = self.chains[-1][1]
+        if not residues or residues[-1] is not residue:
+            residues.append(residue)
+        self.atoms.append(atom)
+        return True
+
+
+def _step_0_remove_hydrogens(pdb_text):
+    buffer = io.StringIO()
     atom_number_counter = 0
-    with open(temp0.name, "w") as f:
+    for line in pdb_text.splitlines(keepends=True):
 
-        for line in lines:
+        if line[0:6] in ["ANISOU"]:
+            # change atom number in line with atom_number_counter
+            line = line[:6] + str(atom_number_counter).rjust(5) + line[11:]
+            buffer.write(line)
 
-            if line[0:6] in ["ANISOU"]:
+        elif line[0:6] in ["ATOM  ", "HETATM"]:
+
+            if line[77] != "H": # 77 is the element column; used to be 13 for the middle of the atom name, but that's not reliable
+                atom_number_counter += 1
                 # change atom number in line with atom_number_counter
                 line = line[:6] + str(atom_number_counter).rjust(5) + line[11:]
-                f.write(line)
-
-            elif line[0:6] in ["ATOM  ", "HETATM"]:
+                buffer.write(line)
 
-                if line[77] != "H": # 77 is the element column; used to be 13 for the middle of the atom name, but that's not reliable
-                    atom_number_counter += 1
-                    # change atom number in line with atom_number_counter
-                    line = line[:6] + str(atom_number_counter).rjust(5) + line[11:]
-                    f.write(line)
-                
-            else:
-                f.write(line)
+        else:
+            buffer.write(line)
 
-    temp0.flush()
-    return temp0
+    return buffer.getvalue()
 
 
 def _step_1_reduce(
     reduce_executable,
-    pdb_input_filename,
+    pdb_text,
     pdbid,
-    temp1,
 ):
 
-    # Add hydrogens using reduce program
+    # Add hydrogens using reduce program, reading the structure from stdin
     command = [
         reduce_executable,
         "-BUILD",
@@ -101,28 +164,105 @@ def _step_1_reduce(
             "reduce_wwPDB_het_dict.txt",
         ),
         "-Quiet",
-        pdb_input_filename,
+        "-",
     ]
-    with open(os.devnull, "w") as devnull:
-        error_code = subprocess.Popen(command, stdout=temp1, stderr=devnull).wait()
-    temp1.flush()
+    result = subprocess.run(
+        command, input=pdb_text, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True
+    )
 
-    first_model = PDB_PARSER.get_structure(pdbid, temp1.name)[0]
+    first_model = PDB_PARSER.get_structure(pdbid, io.StringIO(result.stdout))[0]
 
     return first_model
 
 
-def _step_3_pdbfixer(first_model, temp3, hydrogens):
-    for chain in first_model:
-        for res in chain:
-            for atom in res:
-                atom.set_altloc(" ")
+@lru_cache(maxsize=None)
+def get_template_atoms() -> Tuple[np.ndarray, Dict[str, int]]:
+    """
+    Heavy atoms of the pdbfixer templates of the standard amino acids
+
+    Returns
+    -------
+    np.ndarray
+        Sorted "RES ATOM ELEMENT" keys of the atoms a residue may have,
+        its template atoms and a terminal oxygen
+    dict
+        Number of template atoms of each residue name
+    """
+    templates = os.path.join(os.path.dirname(pdbfixer.pdbfixer.__file__), "templates")
+    keys = []
+    num_atoms = {}
+    for resname in pdbfixer.pdbfixer.proteinResidues:
+        template = openmm.app.PDBFile(os.path.join(templates, f"{resname}.pdb"))
+        atoms = [
+            (atom.name, atom.element.symbol.upper())
+            for atom in template.topology.atoms()
+            if atom.element is not None and atom.element.symbol != "H"
+        ]
+        keys += [f"{resname} {name} {element}" for name, element in atoms]
+        keys.append(f"{resname} OXT O")
+        num_atoms[resname] = len(atoms)
+    return np.sort(np.array(keys)), num_atoms
+
+
+def is_complete(chains: List[Tuple[str, List]], atoms: List) -> bool:
+    """
+    Whether pdbfixer leaves the selected atoms of a structure as they are:
+    all residues are standard amino acids with every heavy atom of their
+    template, no other atoms, and a terminal oxygen at the end of each chain.
+    No residue can be found missing, as no SEQRES records are passed on.
+
+    Parameters
+    ----------
+    chains: list of (chain id, list of residues)
+        Selected residues, as recorded by `_WrittenSelector`
+    atoms: list
+        Selected atoms of the residues, in order
+
+    Returns
+    -------
+    bool
+    """
+    if len(chains) > MAX_CHAINS or not atoms:
+        return False
+    keys, num_atoms = get_template_atoms()
+
+    residues = [residue for _, chain_residues in chains for residue in chain_residues]
+    resnames = np.array([residue.get_resname() for residue in residues])
+    if not np.isin(resnames, list(num_atoms)).all():
+        return False
+
+    indices = {id(residue): i for i, residue in enumerate(residues)}
+    atom_residues = np.array([indices[id(atom.get_parent())] for atom in atoms])
+    names = np.array([atom.get_id() for atom in atoms])
+    atom_keys = np.char.add(
+        np.char.add(resnames[atom_residues], " "),
+        np.char.add(np.char.add(names, " "), [atom.element for atom in atoms]),
+    )
+    found = np.searchsorted(keys, atom_keys).clip(max=keys.shape[0] - 1)
+    if not (keys[found] == atom_keys).all():
+        return False
+
+    terminal = names == "OXT"
+    counts = np.bincount(atom_residues[~terminal], minlength=len(residues))
+    if not (counts == [num_atoms[resname] for resname in resnames]).all():
+        return False
+    ends = np.cumsum([len(chain_residues) for _, chain_residues in chains]) - 1
+    return np.isin(ends, atom_residues[terminal]).all()
+
+
+def _step_3_select(first_model, selector):
+    # Select and replace altloc chars to " ", in memory
+    selector = _WrittenSelector(selector)
+    buffer = io.StringIO()
     PDBIO.set_structure(first_model)
-    PDBIO.save(temp3)
-    temp3.flush()
+    PDBIO.save(buffer, select=selector)
+    buffer.seek(0)
+    return selector, buffer
+
 
+def _step_3_pdbfixer(buffer, hydrogens):
     # Use PDBFixer to fix common PDB errors
-    fixer = pdbfixer.PDBFixer(temp3.name)
+    fixer = pdbfixer.PDBFixer(pdbfile=buffer)
     fixer.findMissingResidues()
     fixer.findNonstandardResidues()
     fixer.replaceNonstandardResidues()
@@ -130,24 +270,28 @@ def _step_3_pdbfixer(first_model, temp3, hydrogens):
     fixer.addMissingAtoms()
     if hydrogens:
         fixer.addMissingHydrogens(7.0)
-    return temp3, fixer
+    return fixer
 
 
-def _step_4_fix_numbering(fixer, temp3, temp4):
-    simtk.openmm.app.PDBFile.writeFile(
-        fixer.topology, fixer.positions, temp4, keepIds=False
+def _step_3_complete(buffer, pdbid):
+    # The selected atoms as pdbfixer would write them, with an occupancy of 1
+    structure = PDB_PARSER.get_structure(pdbid, buffer)
+    for atom in structure.get_atoms():
+        atom.set_occupancy(1.0)
+    return structure
+
+
+def _step_4_fix_numbering(fixer, selector, pdbid):
+    buffer = io.StringIO()
+    openmm.app.PDBFile.writeFile(
+        fixer.topology, fixer.positions, buffer, keepIds=False
     )
-    temp4.flush()
+    buffer.seek(0)
     # Fix IDs manually since pdbfixer does not preserve insertion codes
-    structure_before = PDB_PARSER.get_structure(temp3.name, temp3.name)
-    structure_after = PDB_PARSER.get_structure(temp4.name, temp4.name)
-    residues_before = []
-    atoms_before = [  ]
-    for chain in structure_before[0]:
-        residues_before.append(chain.get_list())
-        for res in chain:
-            for atom in res:
-                atoms_before.append(atom)
+    structure_after = PDB_PARSER.get_structure(pdbid, buffer)
+    chains_before = [chain_id for chain_id, _ in selector.chains]
+    residues_before = [residues for _, residues in selector.chains]
+    atoms_before = selector.atoms
     residues_after = []
     atoms_after = []
     for chain in structure_after[0]:
@@ -156,27 +300,20 @@ def _step_4_fix_numbering(fixer, temp3, temp4):
             for atom in res:
                 atoms_after.append(atom)
     chain_counter = ""
-    for i, chain in enumerate(structure_before[0]):
+    for i, chain_id in enumerate(chains_before):
         try:
-            if (
-                structure_after[0].get_list()[i].id
-                != structure_before[0].get_list()[i].id
-            ):
+            if structure_after[0].get_list()[i].id != chain_id:
                 try:
                     # HACK BECAUSE OF https://github.com/biopython/biopython/issues/1551
                     # Essentially, a new change in biopython prevents you from changing the
                     # id to an already existing id which broke this initial script.
                     # Therefore, we now change the ids to "change_counter" which will never look
                     # like a canonical chainid.
-                    structure_after[0][
-                        structure_before[0].get_list()[i].id
-                    ].id = chain_counter
+                    structure_after[0][chain_id].id = chain_counter
                     chain_counter += "KK"
                 except KeyError:
                     pass
-                structure_after[0].get_list()[i].id = (
-                    structure_before[0].get_list()[i].id
-                )
+                structure_after[0].get_list()[i].id = chain_id
             if len(residues_before[i]) != len(residues_after[i]):
                 raise PDBFixerResIdentifiabilityIssue()
 
@@ -198,7 +335,7 @@ def _step_4_fix_numbering(fixer, temp3, temp4):
             if res2.id != res1.id:
                 try:
                     # Similar issue as previous hack https://github.com/biopython/biopython/issues/1551
-                    structure_after[0][chain.get_id()][res1.id].id = (
+                    structure_after[0][chain_id][res1.id].id = (
                         " ",
                         counter,
                         " ",
@@ -213,61 +350,144 @@ def _step_4_fix_numbering(fixer, temp3, temp4):
     return structure_after
 
 
-def clean_pdb(pdb_input_filename: str, out_path: str, reduce_executable: str, hydrogens: bool, extra_molecules: bool):
+def clean_structure(
+    pdb_input_filename: str,
+    reduce_executable: str,
+    hydrogens: bool,
+    extra_molecules: bool,
+    pdb_data: Optional[bytes] = None,
+    bypass_complete: bool = True,
+    hydrogen_engine: str = "reduce",
+) -> CleanedStructure:
     """
-    Function to clean pdbs using reduce and pdbfixer.
+    Function to clean pdbs using reduce and pdbfixer, passing the structure
+    between the steps in memory. Unless reduce adds hydrogens, complete
+    structures bypass pdbfixer, see `is_complete`.
 
     Parameters
     ----------
     pdb_input_filename: str
         PDB filename
-    out_dir: str
-        Output directory.
     reduce_executable: str
         Path to the reduce executable
     Hydrogens: bool
         include hydrogens
     extra_molecules: bool
         include extra_molecules (whatever is flagged as hetero)
+    pdb_data: bytes, optional
+        Contents of pdb_input_filename, if read in memory
+    bypass_complete: bool
+        whether complete structures bypass pdbfixer, which leaves them unchanged
+    hydrogen_engine: str
+        "reduce" to add hydrogens with reduce and pdbfixer, or "builtin" to
+        place them on the standard residues of the cleaned structure, see
+        `zernikegrams.structural_info.hydrogens`
+
+    Returns
+    -------
+    CleanedStructure
+        The first model of the cleaned structure, and whether it bypassed
+        pdbfixer
     """
 
     pdbid = pdb_input_filename.split("/")[-1].split(".pdb")[0]
 
+    if pdb_data is None:
+        with open(pdb_input_filename, "r") as f:
+            pdb_text = f.read()
+    else:
+        pdb_text = pdb_data.decode("utf-8")
+
     # Step 0: remove hydrogen atoms if they already exist, since reduce will add duplicates and that can cause issues
-    with tempfile.NamedTemporaryFile(mode="wt", delete=True) as temp0:
-        temp0 = _step_0_remove_hydrogens(pdb_input_filename, temp0)
-
-        # Step 1: Add hydrogens using reduce program
-        with tempfile.NamedTemporaryFile(mode="wt", delete=True) as temp1:
-
-            if hydrogens:
-                first_model = _step_1_reduce(
-                    reduce_executable, temp0.name, pdbid, temp1
-                )
-            else:
-                first_model = PDB_PARSER.get_structure(pdbid, temp0.name)[0]
-
-            # Step 2: NonHetSelector filter
-            with tempfile.NamedTemporaryFile(mode="wt", delete=True) as temp2:
-
-                if not extra_molecules:
-                    PDBIO.set_structure(first_model)
-                    PDBIO.save(temp2, select=NonHetSelector())
-                    temp2.flush()
-                    first_model = PDB_PARSER.get_structure(temp2.name, temp2.name)[0]
-                else:
-                    PDBIO.set_structure(first_model)
-                    PDBIO.save(temp2, select=FirstDisorderedSelector())
-                    temp2.flush()
-                    first_model = PDB_PARSER.get_structure(temp2.name, temp2.name)[0]
-
-                # Step 3: Replace altloc chars to " " and use pdbfixer
-                with tempfile.NamedTemporaryFile(mode="wt", delete=True) as temp3:
-                    temp_3, fixer = _step_3_pdbfixer(first_model, temp3, hydrogens)
-
-                    # Step 4: Correct for pdbfixer not preserving insertion codes
-                    with tempfile.NamedTemporaryFile(mode="wt", delete=True) as temp4:
-                        structure_after = _step_4_fix_numbering(fixer, temp3, temp4)
-                        with open(out_path, "w") as outpdb:
-                            PDBIO.set_structure(structure_after[0])
-                            PDBIO.save(outpdb)
+    pdb_text = _step_0_remove_hydrogens(pdb_text)
+
+    # Step 1: Add hydrogens using reduce program
+    reduce_hydrogens = hydrogens and hydrogen_engine == "reduce"
+    if reduce_hydrogens:
+        first_model = _step_1_reduce(reduce_executable, pdb_text, pdbid)
+    else:
+        first_model = PDB_PARSER.get_structure(pdbid, io.StringIO(pdb_text))[0]
+
+    # Step 2: NonHetSelector filter, applied as the structure is passed to pdbfixer
+    selector = NonHetSelector() if not extra_molecules else FirstDisorderedSelector()
+
+    # Step 3: Replace altloc chars to " " and use pdbfixer, unless there is nothing to fix
+    selector, buffer = _step_3_select(first_model, selector)
+    bypassed = (
+        bypass_complete
+        and not reduce_hydrogens
+        and is_complete(selector.chains, selector.atoms)
+    )
+    if bypassed:
+        first_model = _step_3_complete(buffer, pdbid)[0]
+    else:
+        fixer = _step_3_pdbfixer(buffer, reduce_hydrogens)
+
+        # Step 4: Correct for pdbfixer not preserving insertion codes
+        first_model = _step_4_fix_numbering(fixer, selector, pdbid)[0]
+
+    # Step 5: Place hydrogens on the standard residues, if not added by reduce
+    if hydrogens and hydrogen_engine == "builtin":
+        add_hydrogens(first_model)
+    return CleanedStructure(first_model, bypassed)
+
+
+def warm_up(hydrogens: bool = False) -> Bio.PDB.Model.Model:
+    """
+    Runs steps 3 and 4 of `clean_structure` on a dipeptide, so that the
+    OpenMM force fields, the pdbfixer templates (also those of `is_complete`)
+    and the OpenMM platform are loaded before the first structure of a process.
+
+    Parameters
+    ----------
+    hydrogens: bool
+        whether hydrogens are added too, which loads the amber14 force field
+
+    Returns
+    -------
+    Bio.PDB.Model.Model
+        The cleaned dipeptide
+    """
+    first_model = PDB_PARSER.get_structure("warm-up", io.StringIO(WARM_UP_PDB))[0]
+    selector, buffer = _step_3_select(first_model, FirstDisorderedSelector())
+    get_template_atoms()
+    fixer = _step_3_pdbfixer(buffer, hydrogens)
+    return _step_4_fix_numbering(fixer, selector, "warm-up")[0]
+
+
+def clean_pdb(
+    pdb_input_filename: str,
+    out_path: str,
+    reduce_executable: str,
+    hydrogens: bool,
+    extra_molecules: bool,
+    hydrogen_engine: str = "reduce",
+):
+    """
+    Function to clean pdbs using reduce and pdbfixer, see `clean_structure`.
+
+    Parameters
+    ----------
+    pdb_input_filename: str
+        PDB filename
+    out_path: str
+        Output PDB filename.
+    reduce_executable: str
+        Path to the reduce executable
+    Hydrogens: bool
+        include hydrogens
+    extra_molecules: bool
+        include extra_molecules (whatever is flagged as hetero)
+    hydrogen_engine: str
+        "reduce" or "builtin", see `clean_structure`
+    """
+    first_model = clean_structure(
+        pdb_input_filename,
+        reduce_executable,
+        hydrogens,
+        extra_molecules,
+        hydrogen_engine=hydrogen_engine,
+    ).model
+    with open(out_path, "w") as outpdb:
+        PDBIO.set_structure(first_model)
+        PDBIO.save(outpdb)
@@ -0,0 +1,406 @@
+"""
+In-process secondary structure assignment, compatible with mkdssp.
+
+The DSSP algorithm of Kabsch and Sander, with the conventions of mkdssp 4, on
+the backbone coordinates of the atoms already in memory:
+
+    - residues are the ones with a complete backbone, N, CA, C and O, and the
+      chain breaks where the peptide bond is longer than MAX_PEPTIDE_BOND
+    - the hydrogen of the N of a residue is placed 1 A from the N, opposite to
+      the C=O of the previous residue. Prolines have no hydrogen.
+    - the electrostatic energy of the hydrogen bonds NH(i) -> O(j) is computed
+      for the pairs of residues whose CA are closer than MIN_CA_DISTANCE,
+      found with a cell list, and every NH keeps its two best acceptors
+    - bridges, ladders and bulges make the strands E and bridges B, n-turns
+      the helices H, G and I and the turns T, and the CA angles the bends S,
+      see `assign_secondary_structure`
+    - stretches of polyproline II angles are P, as in mkdssp 4
+
+The codes are the ones of `Bio.PDB.DSSP`, with "-" for the residues of no
+secondary structure, see `get_dssp_dict`.
+"""
+
+from typing import *
+
+import numpy as np
+from Bio.Data.PDBData import protein_letters_3to1_extended
+
+from zernikegrams.structural_info.sasa import get_neighbor_pairs
+from zernikegrams.utils import log_config as logging
+
+logger = logging.getLogger(__name__)
+
+LOOP = "-"
+
+# as in mkdssp
+COUPLING_CONSTANT = -27.888  # = -332 * 0.42 * 0.2
+MIN_HBOND_ENERGY = -9.9
+MAX_HBOND_ENERGY = -0.5
+MIN_DISTANCE = 0.5
+MIN_CA_DISTANCE = 9.0
+MAX_PEPTIDE_BOND = 2.5
+MIN_BEND_ANGLE = 70.0
+PP_STRETCH = 3
+PP_PHI, PP_PSI, PP_EPSILON = -75.0, 145.0, 29.0
+
+BACKBONE = ("N", "CA", "C", "O")
+WATERS = ("HOH", "WAT", "DOD")
+
+
+class Backbone(NamedTuple):
+    """Residues with a complete backbone, in order, see `get_backbone`"""
+
+    residues: np.ndarray  # index of the first atom of the residue
+    n: np.ndarray  # [num_residues, 3] coordinates of the N
+    ca: np.ndarray
+    c: np.ndarray
+    o: np.ndarray
+    chains: np.ndarray
+    prolines: np.ndarray  # [num_residues] bool
+
+
+def get_backbone(
+    chains: np.ndarray,
+    resnums: np.ndarray,
+    icodes: np.ndarray,
+    resnames: np.ndarray,
+    atom_names: np.ndarray,
+    coords: np.ndarray,
+) -> Backbone:
+    """
+    Backbones of the residues of atoms, residues being runs of atoms of the
+    same chain, resnum and icode. The first atom of each name is used.
+    """
+    num_atoms = coords.shape[0]
+    starts = np.ones(num_atoms, dtype=bool)
+    starts[1:] = (
+        (chains[1:] != chains[:-1])
+        | (resnums[1:] != resnums[:-1])
+        | (icodes[1:] != icodes[:-1])
+    )
+    residues = np.flatnonzero(starts)
+    atom_residues = np.cumsum(starts) - 1
+
+    backbone = []
+    for name in BACKBONE:
+        atoms = np.flatnonzero(atom_names == name)
+        first = np.full(residues.shape[0], -1)
+        # in reverse, so that the first atom of the name is written last
+        first[atom_residues[atoms[::-1]]] = atoms[::-1]
+        backbone.append(first)
+    backbone = np.stack(backbone, axis=1)
+
+    complete = np.all(backbone >= 0, axis=1) & ~np.isin(resnames[residues], WATERS)
+    backbone = backbone[complete]
+    residues = residues[complete]
+    coords = np.asarray(coords, dtype=np.float64)
+    return Backbone(
+        residues,
+        *(coords[backbone[:, k]] for k in range(len(BACKBONE))),
+        chains[residues],
+        resnames[residues] == "PRO",
+    )
+
+
+def _unit(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.linalg.norm(vectors, axis=-1, keepdims=True)
+
+
+def _dihedral(p0, p1, p2, p3) -> np.ndarray:
+    b0, b1, b2 = p0 - p1, p2 - p1, p3 - p2
+    b1 = _unit(b1)
+    v = b0 - np.sum(b0 * b1, axis=1, keepdims=True) * b1
+    w = b2 - np.sum(b2 * b1, axis=1, keepdims=True) * b1
+    x = np.sum(v * w, axis=1)
+    y = np.sum(np.cross(b1, v) * w, axis=1)
+    return np.degrees(np.arctan2(y, x))
+
+
+def get_hbonds(backbone: Backbone) -> np.ndarray:
+    """
+    Sorted keys donor * num_residues + acceptor of the hydrogen bonds
+    NH(donor) -> O(acceptor): the two best acceptors of every donor, of
+    energy below MAX_HBOND_ENERGY
+    """
+    n, ca, c, o = backbone.n, backbone.ca, backbone.c, backbone.o
+    num_residues = n.shape[0]
+
+    # the hydrogen, opposite to the C=O of the previous residue of the chain
+    h = n.copy()
+    has_previous = np.zeros(num_residues, dtype=bool)
+    has_previous[1:] = backbone.chains[1:] == backbone.chains[:-1]
+    placed = has_previous & ~backbone.prolines
+    previous = np.flatnonzero(placed) - 1
+    h[placed] += _unit(c[previous] - o[previous])
+
+    donors, acceptors = get_neighbor_pairs(
+        ca, np.full(num_residues, MIN_CA_DISTANCE / 2), np.arange(num_residues)
+    )
+    # mkdssp skips NH(i + 1) -> O(i), and prolines are no donors
+    keep = (donors != acceptors + 1) & ~backbone.prolines[donors]
+    donors, acceptors = donors[keep], acceptors[keep]
+
+    d_ho = np.linalg.norm(h[donors] - o[acceptors], axis=1)
+    d_hc = np.linalg.norm(h[donors] - c[acceptors], axis=1)
+    d_nc = np.linalg.norm(n[donors] - c[acceptors], axis=1)
+    d_no = np.linalg.norm(n[donors] - o[acceptors], axis=1)
+    too_close = np.min(np.stack([d_ho, d_hc, d_nc, d_no]), axis=0) < MIN_DISTANCE
+    with np.errstate(divide="ignore"):
+        energies = COUPLING_CONSTANT * (1 / d_ho - 1 / d_hc + 1 / d_nc - 1 / d_no)
+    energies = np.where(too_close, MIN_HBOND_ENERGY, energies)
+    # rounded like the energies of mkdssp, half away from zero
+    energies = np.sign(energies) * np.floor(np.abs(energies) * 1000 + 0.5) / 1000
+    energies = np.maximum(energies, MIN_HBOND_ENERGY)
+
+    # the two best acceptors of every donor, the first acceptors on ties
+    order = np.lexsort((acceptors, energies, donors))
+    donors, acceptors, energies = donors[order], acceptors[order], energies[order]
+    run_starts = np.flatnonzero(np.diff(donors, prepend=-1))
+    ranks = np.arange(donors.shape[0]) - np.repeat(
+        run_starts, np.diff(np.append(run_starts, donors.shape[0]))
+    )
+    bonded = (ranks < 2) & (energies < MAX_HBOND_ENERGY)
+    return np.sort(donors[bonded] * num_residues + acceptors[bonded])
+
+
+def _get_bridges(
+    hbonds: np.ndarray, segments: np.ndarray
+) -> List[Tuple[str, List[int], List[int]]]:
+    """
+    Bridges (type, i, j) of mkdssp, "p" parallel or "a" antiparallel, in order
+    of i then j, ladders of consecutive bridges being extended
+    """
+    num_residues = segments.shape[0]
+    if hbonds.shape[0] == 0:
+        return []
+
+    def test_bond(donors, acceptors):
+        keys = donors * num_residues + acceptors
+        pos = np.minimum(np.searchsorted(hbonds, keys), hbonds.shape[0] - 1)
+        return hbonds[pos] == keys
+
+    # bridges are within one residue of hydrogen bonds
+    donors, acceptors = np.divmod(hbonds, num_residues)
+    shifts = np.array([(s, t) for s in (-1, 0, 1) for t in (-1, 0, 1)])
+    first = (donors[:, None] + shifts[:, 0]).reshape(-1)
+    second = (acceptors[:, None] + shifts[:, 1]).reshape(-1)
+    pairs = np.unique(
+        np.stack([np.minimum(first, second), np.maximum(first, second)], axis=1), axis=0
+    )
+    i, j = pairs[:, 0], pairs[:, 1]
+    keep = (i >= 1) & (i + 4 < num_residues) & (j >= i + 3) & (j + 1 < num_residues)
+    i, j = i[keep], j[keep]
+    keep = (segments[i - 1] == segments[i + 1]) & (segments[j - 1] == segments[j + 1])
+    i, j = i[keep], j[keep]
+
+    parallel = (test_bond(i + 1, j) & test_bond(j, i - 1)) | (
+        test_bond(j + 1, i) & test_bond(i, j - 1)
+    )
+    antiparallel = ~parallel & (
+        (test_bond(i + 1, j - 1) & test_bond(j + 1, i - 1))
+        | (test_bond(j, i) & test_bond(i, j))
+    )
+
+    bridges = []
+    for bi, bj, is_parallel, is_antiparallel in zip(
+        i.tolist(), j.tolist(), parallel.tolist(), antiparallel.tolist()
+    ):
+        if not (is_parallel or is_antiparallel):
+            continue
+        kind = "p" if is_parallel else "a"
+        for bridge in bridges:
+            if kind != bridge[0] or bi != bridge[1][-1] + 1:
+                continue
+            if kind == "p" and bridge[2][-1] + 1 == bj:
+                bridge[1].append(bi)
+                bridge[2].append(bj)
+                break
+            if kind == "a" and bridge[2][0] - 1 == bj:
+                bridge[1].append(bi)
+                bridge[2].insert(0, bj)
+                break
+        else:
+            bridges.append((kind, [bi], [bj]))
+    return bridges
+
+
+def _merge_bulges(
+    bridges: List[Tuple[str, List[int], List[int]]], segments: np.ndarray
+) -> List[Tuple[str, List[int], List[int]]]:
+    """Ladders joined by bulges, as in mkdssp"""
+
+    def gap(a, b):
+        # mkdssp compares unsigned differences
+        return a - b if a >= b else np.inf
+
+    def no_break(a, b):
+        return segments[a] == segments[b]
+
+    bridges = sorted(bridges, key=lambda bridge: bridge[1][0])
+    for a in range(len(bridges)):
+        b = a + 1
+        while b < len(bridges):
+            kind, i_a, j_a = bridges[a]
+            _, i_b, j_b = bridges[b]
+            ibi, iei, jbi, jei = i_a[0], i_a[-1], j_a[0], j_a[-1]
+            ibj, iej, jbj, jej = i_b[0], i_b[-1], j_b[0], j_b[-1]
+            if (
+                kind != bridges[b][0]
+                or not no_break(min(ibi, ibj), max(iei, iej))
+                or not no_break(min(jbi, jbj), max(jei, jej))
+                or gap(ibj, iei) >= 6
+                or (iei >= ibj and ibi <= iej)
+            ):
+                b += 1
+                continue
+            if kind == "p":
+                bulge = (gap(jbj, jei) < 6 and gap(ibj, iei) < 3) or gap(jbj, jei) < 3
+            else:
+                bulge = (gap(jbi, jej) < 6 and gap(ibj, iei) < 3) or gap(jbi, jej) < 3
+            if bulge:
+                i_a.extend(i_b)
+                if kind == "p":
+                    j_a.extend(j_b)
+                else:
+                    j_a[:0] = j_b
+                del bridges[b]
+            else:
+                b += 1
+    return bridges
+
+
+def assign_secondary_structure(
+    backbone: Backbone, pp_stretch: int = PP_STRETCH
+) -> np.ndarray:
+    """
+    DSSP code of every residue of backbone, see the module docstring
+
+    Parameters
+    ----------
+    backbone : Backbone
+        Residues with a complete backbone, see `get_backbone`
+    pp_stretch : int
+        Minimal number of residues of a polyproline II helix, 0 for none, as
+        --min-pp-stretch of mkdssp
+
+    Returns
+    -------
+    np.ndarray
+        [num_residues] codes H, B, E, G, I, T, S, P, or LOOP
+    """
+    n, ca, c = backbone.n, backbone.ca, backbone.c
+    num_residues = n.shape[0]
+    ss = np.full(num_residues, LOOP, dtype="U1")
+    if num_residues == 0:
+        return ss
+
+    # residues a and b are in the same unbroken segment if segments[a] == segments[b]
+    breaks = np.zeros(num_residues, dtype=bool)
+    breaks[1:] = (backbone.chains[1:] != backbone.chains[:-1]) | (
+        np.linalg.norm(c[:-1] - n[1:], axis=1) > MAX_PEPTIDE_BOND
+    )
+    segments = np.cumsum(breaks)
+
+    hbonds = get_hbonds(backbone)
+
+    # strands and bridges
+    for kind, i, j in _merge_bulges(_get_bridges(hbonds, segments), segments):
+        code = "E" if len(i) > 1 else "B"
+        for start, stop in ((i[0], i[-1]), (j[0], j[-1])):
+            stretch = ss[start : stop + 1]
+            stretch[stretch != "E"] = code
+
+    # n-turns: NH(i + n) -> O(i), within a segment
+    starts = {}
+    residues = np.arange(num_residues)
+    for stride in (3, 4, 5):
+        turn = np.zeros(num_residues, dtype=bool)
+        i = residues[: max(num_residues - stride, 0)]
+        if i.shape[0] and hbonds.shape[0]:
+            keys = (i + stride) * num_residues + i
+            pos = np.minimum(np.searchsorted(hbonds, keys), hbonds.shape[0] - 1)
+            turn[i] = (hbonds[pos] == keys) & (segments[i] == segments[i + stride])
+        starts[stride] = turn
+
+    # helices, of two consecutive n-turns: H, then G and I where still free
+    helix = np.flatnonzero(starts[4][1:] & starts[4][:-1]) + 1
+    ss[(helix[:, None] + np.arange(4)).reshape(-1)] = "H"
+    for stride, code, free in ((3, "G", (LOOP, "G")), (5, "I", (LOOP, "I", "H"))):
+        for i in np.flatnonzero(starts[stride][1:] & starts[stride][:-1]) + 1:
+            if np.all(np.isin(ss[i : i + stride], free)):
+                ss[i : i + stride] = code
+
+    # turns, then bends, of the residues still free
+    turn = np.zeros(num_residues, dtype=bool)
+    for stride in (3, 4, 5):
+        for k in range(1, stride):
+            turn[k:] |= starts[stride][:-k]
+    bend = np.zeros(num_residues, dtype=bool)
+    i = residues[2 : max(num_residues - 2, 2)]
+    i = i[segments[i - 2] == segments[i + 2]]
+    cosines = np.sum(_unit(ca[i] - ca[i - 2]) * _unit(ca[i + 2] - ca[i]), axis=1)
+    bend[i] = np.degrees(np.arccos(np.clip(cosines, -1, 1))) > MIN_BEND_ANGLE
+    free = (ss == LOOP) & (residues >= 1) & (residues + 1 < num_residues)
+    ss[free & turn] = "T"
+    ss[free & ~turn & bend] = "S"
+
+    # polyproline II helices, of the residues still free
+    if pp_stretch > 0:
+        phi = np.full(num_residues, 360.0)
+        psi = np.full(num_residues, 360.0)
+        i = np.flatnonzero(segments[1:] == segments[:-1]) + 1
+        phi[i] = _dihedral(c[i - 1], n[i], ca[i], c[i])
+        psi[i - 1] = _dihedral(n[i - 1], ca[i - 1], c[i - 1], n[i])
+        pp = (np.abs(phi - PP_PHI) <= PP_EPSILON) & (np.abs(psi - PP_PSI) <= PP_EPSILON)
+        stretch = np.zeros(num_residues, dtype=bool)
+        for start in range(1, num_residues - pp_stretch):
+            if np.all(pp[start : start + pp_stretch]):
+                stretch[start : start + pp_stretch] = True
+        ss[stretch & (ss == LOOP)] = "P"
+
+    return ss
+
+
+def get_dssp_dict(
+    chains: np.ndarray,
+    resnums: np.ndarray,
+    icodes: np.ndarray,
+    resnames: np.ndarray,
+    atom_names: np.ndarray,
+    coords: np.ndarray,
+    pp_stretch: int = PP_STRETCH,
+) -> Dict[Tuple[str, Tuple[str, int, str]], Tuple[str, str]]:
+    """
+    DSSP dictionary of the atoms, keyed like the one of
+    `Bio.PDB.DSSP.dssp_dict_from_pdb_file` by (chain, (" ", resnum, icode)),
+    of values (aa, ss)
+
+    Parameters
+    ----------
+    chains, resnums, icodes, resnames, atom_names : np.ndarray
+        [num_atoms] chain, residue number, insertion code, residue name and
+        atom name of every atom
+    coords : np.ndarray
+        [num_atoms, 3] coordinates
+    """
+    chains, resnums, icodes, resnames, atom_names = (
+        np.asarray(array) for array in (chains, resnums, icodes, resnames, atom_names)
+    )
+    if coords.shape[0] == 0:
+        return {}
+    backbone = get_backbone(chains, resnums, icodes, resnames, atom_names, coords)
+    ss = assign_secondary_structure(backbone, pp_stretch=pp_stretch)
+    residues = backbone.residues
+    return {
+        (chain, (" ", resnum, icode)): (
+            protein_letters_3to1_extended.get(resname.capitalize(), "X"),
+            code,
+        )
+        for chain, resnum, icode, resname, code in zip(
+            chains[residues].tolist(),
+            resnums[residues].tolist(),
+            icodes[residues].tolist(),
+            resnames[residues].tolist(),
+            ss.tolist(),
+        )
+    }
@@ -6,23 +6,44 @@ import sys
 import sqlitedict
 import time
 
+from concurrent.futures import ThreadPoolExecutor
+
 from typing import *
 from rich.progress import Progress
 
 import numpy as np
 
 from zernikegrams.utils import log_config as logging
+from zernikegrams.utils.checkpoints import StageCheckpoint
+from zernikegrams.utils.incremental import IncrementalUpdate, hash_bytes, hash_file
 from zernikegrams.utils.pdb_lists import (
     pdb_list_from_dir,
     pdb_list_from_foldcomp,
 )
+from zernikegrams.preprocessors.archives import (
+    Source,
+    get_structure_sources,
+    read_structures,
+)
 from zernikegrams.preprocessors.pdbs import (
     PDBPreprocessor,
     FoldCompPreprocessor,
+    TIMEOUT,
+    get_pdb_file,
+)
+from zernikegrams.preprocessors.supervised_pool import (
+    WorkerLimits,
+    add_worker_arguments,
+    get_worker_limits,
 )
+from zernikegrams.structural_info.sasa import N_POINTS
 from zernikegrams.structural_info.structural_info_core import (
+    DSSP_ENGINES,
+    HYDROGEN_ENGINES,
     get_structural_info_from_protein,
     pad_structural_info,
+    relocate_pdbfixer,
+    warm_up_pdbfixer,
 )
 
 logger = logging.getLogger(__name__)
@@ -62,7 +83,7 @@ def get_parser():
     parser.add_argument(
         "--pdb_dir",
         type=str,
-        help="directory of pdb files. Required if --foldcomp is not set",
+        help="directory of pdb files. Required if --foldcomp is not set. The .pdb and .cif files can be gzipped, or members of uncompressed .tar or .zip shards, which are read without extracting them.",
     )
     parser.add_argument(
         "--foldcomp",
@@ -95,6 +116,12 @@ def get_parser():
         default=False,
         help="If present, SASAs are calculated for each atom.",
     )
+    parser.add_argument(
+        "--sasa_points",
+        type=int,
+        default=N_POINTS,
+        help="Number of points on the sphere of each atom for the SASAs. Fewer points are faster and less precise.",
+    )
     parser.add_argument(
         "--charge",
         "-c",
@@ -108,6 +135,13 @@ def get_parser():
         default=False,
         help="If present, secondary structure annotations are calculated for each residue",
     )
+    parser.add_argument(
+        "--DSSP_engine",
+        type=str,
+        choices=DSSP_ENGINES,
+        default="mkdssp",
+        help="How the secondary structure is assigned with the biopython parser: by running mkdssp, or in process.",
+    )
     parser.add_argument(
         "--fix_pdbs",
         "-F",
@@ -120,7 +154,14 @@ def get_parser():
         "-H",
         action="store_true",
         default=False,
-        help="Use Reduce to add hydrogen atoms to the incoming PDBs. This implies --fix_pdbs",
+        help="Add hydrogen atoms to the incoming PDBs, with the engine of --hydrogen_engine. This implies --fix_pdbs",
+    )
+    parser.add_argument(
+        "--hydrogen_engine",
+        type=str,
+        choices=HYDROGEN_ENGINES,
+        default="reduce",
+        help="How hydrogens are added with --add_hydrogens and the biopython parser: by running reduce, or placed in process from ideal geometries.",
     )
     parser.add_argument(
         "--remove_extra_molecules",
@@ -135,6 +176,26 @@ def get_parser():
         choices=["crash", "warn", "allow"],
         help="Behavior for handling PDBs with multiple structures",
     )
+    parser.add_argument(
+        "--shared_memory_mb",
+        type=int,
+        default=None,
+        help="[Optional] Send the results of the workers through shared memory buffers of this size in MB instead of pickling them through a pipe. Should be larger than one padded protein, about 60 bytes per atom of --max_atoms. Results that do not fit go through the pipe as usual.",
+    )
+    # past the timeout within the workers, for the C code it cannot interrupt
+    add_worker_arguments(parser, timeout=2 * TIMEOUT)
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        default=False,
+        help="Record progress next to --hdf5_out, and resume an interrupted run with the same arguments from it, only processing the PDBs that are not done yet.",
+    )
+    parser.add_argument(
+        "--update",
+        action="store_true",
+        default=False,
+        help="Keep a manifest of the content hashes of the PDBs in --hdf5_out, and if it exists, update it with the same arguments: only process the PDBs that were added or changed since, and tombstone the rows of the PDBs that were removed or changed. Their rows stay in --hdf5_out, and readers other than the next stages must only read the rows from zernikegrams.utils.incremental.get_live_rows. Cannot be combined with --resume.",
+    )
     parser.add_argument("--logging", type=str, help="logging level", default="INFO")
     parser.add_argument(
         "--fixed_pdb_dir",
@@ -152,6 +213,11 @@ def parse_args():
 
     args.input_path = args.foldcomp if args.foldcomp is not None else args.pdb_dir
 
+    if args.resume and args.update:
+        msg = "--resume and --update cannot be combined"
+        logger.exception(msg)
+        raise ValueError(msg)
+
     if args.parser == "pyrosetta":
         print("Warning: Using pyrosetta for parsing. The 'pyrosetta' option automatically adds hydrogens to the structures, it keeps all extra molecules except for water, and it does not substitute non-canonical residues.")
 
@@ -168,11 +234,17 @@ def get_structural_info_fn(pdb_file: str,
                             fix: bool = False,
                             hydrogens: bool = False,
                             extra_molecules: bool = True,
-                            multi_struct: str = "warn"):
+                            multi_struct: str = "warn",
+                            pdb_data: Optional[Union[bytes, List[Optional[bytes]]]] = None,
+                            sasa_points: int = N_POINTS,
+                            dssp_engine: str = "mkdssp",
+                            hydrogen_engine: str = "reduce"):
 
     """
     Get structural info from a single pdb file.
     If padded_length is None, does not pad the protein.
+    pdb_data are the contents of the pdb files read in memory, if any,
+    see `zernikegrams.preprocessors.archives`.
     """
 
     if isinstance(pdb_file, str):
@@ -184,13 +256,16 @@ def get_structural_info_fn(pdb_file: str,
 
     if isinstance(pdb_file, str):
         pdb_file = [pdb_file]
+        pdb_data = [pdb_data]
+    elif pdb_data is None:
+        pdb_data = [None] * len(pdb_file)
     
 
     n = 0
-    for i, pdb_file in enumerate(pdb_file):
+    for i, (pdb_file, data) in enumerate(zip(pdb_file, pdb_data)):
 
         if padded_length is None:
-            si = get_structural_info_from_protein(
+            pdb, structural_info = get_structural_info_from_protein(
                     pdb_file,
                     parser=parser,
                     calculate_SASA=SASA,
@@ -200,9 +275,13 @@ def get_structural_info_fn(pdb_file: str,
                     fix=fix,
                     hydrogens=hydrogens,
                     extra_molecules=extra_molecules,
-                    multi_struct=multi_struct)
+                    multi_struct=multi_struct,
+                    pdb_data=data,
+                    sasa_points=sasa_points,
+                    dssp_engine=dssp_engine,
+                    hydrogen_engine=hydrogen_engine)
         else:
-            si = get_padded_structural_info(
+            pdb, *structural_info = get_padded_structural_info(
                     pdb_file,
                     parser=parser,
                     padded_length=padded_length,
@@ -213,16 +292,17 @@ def get_structural_info_fn(pdb_file: str,
                     fix=fix,
                     hydrogens=hydrogens,
                     extra_molecules=extra_molecules,
-                    multi_struct=multi_struct)
+                    multi_struct=multi_struct,
+                    pdb_data=data,
+                    sasa_points=sasa_points,
+                    dssp_engine=dssp_engine,
+                    hydrogen_engine=hydrogen_engine)
 
-        if si[0] is None:
+        if pdb is None:
             print(f"Failed to process {pdb_file}", file=sys.stderr)
             continue
 
-        try:
-            pdb,atom_names,elements,res_ids,coords,sasas,charges,res_ids_per_residue,angles,vecs,multi_struc = si
-        except ValueError:
-            pdb,(atom_names,elements,res_ids,coords,sasas,charges,res_ids_per_residue,angles,vecs,multi_struc) = si
+        atom_names,elements,res_ids,coords,sasas,charges,res_ids_per_residue,angles,vecs,multi_struc,bypassed = structural_info
 
         if n == 0:
             if padded_length is None:
@@ -276,6 +356,13 @@ def get_structural_info_from_dataset(
     extra_molecules: bool = True,
     handle_multi_structures: str = "warn",
     fixed_pdb_dir: str = None,
+    shared_memory_mb: Optional[int] = None,
+    worker_limits: WorkerLimits = WorkerLimits(),
+    resume: bool = False,
+    update: bool = False,
+    sasa_points: int = N_POINTS,
+    dssp_engine: str = "mkdssp",
+    hydrogen_engine: str = "reduce",
 ) -> None:
     """
     Parallel processing of PDBs into structural info
@@ -320,26 +407,87 @@ def get_structural_info_from_dataset(
         Behavior for handling PDBs with multiple structures
     Fixed_pdb_dir
         Directory to save fixed pdbs
+    shared_memory_mb
+        If set, size in MB of the shared memory buffers the workers send their
+        results through, see `zernikegrams.preprocessors.shared_memory_ring`
+    worker_limits
+        Limits of the workers, see `zernikegrams.preprocessors.supervised_pool`
+    resume
+        Whether to record progress, and to resume an interrupted run with the
+        same parameters, see `zernikegrams.utils.checkpoints`
+    update
+        Whether to keep a manifest of the content hashes of the PDBs, and to
+        only process the PDBs that were added or changed since the last run,
+        see `zernikegrams.utils.incremental`
+    sasa_points
+        Number of points per atom of the SASA, see
+        `zernikegrams.structural_info.sasa`
+    dssp_engine
+        "mkdssp" to run DSSP, or "builtin" to assign the secondary structure
+        in process, see `zernikegrams.structural_info.dssp`
+    hydrogen_engine
+        "reduce" to add hydrogens with reduce and pdbfixer, or "builtin" to
+        place them in process, see `zernikegrams.structural_info.hydrogens`
     """
+    if resume and update:
+        raise ValueError("Cannot resume and update at the same time")
+
+    # copied once for all the workers, in read-only apptainer
+    pdbfixer_dir = (
+        relocate_pdbfixer() if parser == "biopython" and (fix or hydrogens) else None
+    )
+
     if os.path.isdir(input_path):
         pdb_dir = input_path
 
-        pdb_list_from_dir = []
-        for file in os.listdir(pdb_dir):
-            if file.endswith(".pdb"):
-                pdb = file.removesuffix(".pdb")
-                pdb_list_from_dir.append(pdb)
+        # plain and gzipped files, and members of shards
+        sources = get_structure_sources(pdb_dir)
 
         # filter out pdbs that are not in the directory
-        pdb_list = list(set(pdb_list) & set(pdb_list_from_dir))
+        pdb_list = list(set(pdb_list) & set(sources))
 
-        processor = PDBPreprocessor(pdb_list, pdb_dir)
+        processor = PDBPreprocessor(pdb_list, pdb_dir, sources)
 
     else:
         processor = FoldCompPreprocessor(pdb_list, input_path)
 
-    L = np.max([processor.pdb_name_length, 5])
+    params = {
+        "input_path": input_path,
+        "max_atoms": max_atoms,
+        "output_dataset_name": output_dataset_name,
+        "parser": parser,
+        "angle_db": angle_db,
+        "vec_db": vec_db,
+        "SASA": SASA,
+        "sasa_points": sasa_points,
+        "charge": charge,
+        "DSSP": DSSP,
+        "dssp_engine": dssp_engine,
+        "fix": fix,
+        "hydrogens": hydrogens,
+        "hydrogen_engine": hydrogen_engine,
+        "extra_molecules": extra_molecules,
+        "handle_multi_structures": handle_multi_structures,
+    }
+    incremental = IncrementalUpdate(hdf5_out, params, output_dataset_name, update=update)
+    L = incremental.get_name_length(np.max([processor.pdb_name_length, 5]))
     logger.info(f"Maximum pdb name L = {L}")
+    if update:
+        incremental.plan(
+            get_input_hashes(input_path, pdb_list, parser, parallelism)
+        )
+        processor.skip_pdbs(
+            lambda pdb: incremental.is_skipped(get_output_name(pdb, parser))
+        )
+
+    checkpoint = StageCheckpoint(
+        hdf5_out, {**params, "pdb_name_length": L}, resume=resume
+    )
+    if checkpoint.resuming:
+        # recorded by the names of the rows, like the update
+        processor.skip_pdbs(
+            lambda pdb: checkpoint.is_skipped(get_output_name(pdb, parser))
+        )
 
     # dt_arr = [
     #     ("pdb", f"S{L}", ()),
@@ -365,41 +513,55 @@ def get_structural_info_from_dataset(
         ]
     )
 
-    with h5py.File(hdf5_out, "w") as f:
-        f.create_dataset(
-            output_dataset_name,
-            shape=(processor.size,),
-            maxshape=(None,),
-            dtype=dt,
-            chunks=True,
-            compression=hdf5plugin.LZ4(),
-        )
-
     angle_dict = {}
     vec_dict = {}
 
+    def save_progress(writer):
+        # angles and vectors of the pdbs recorded as done must be saved too
+        save_to_db(angle_db, angle_dict)
+        save_to_db(vec_db, vec_dict)
+        checkpoint.save(writer)
+
     with Progress() as bar:
         task = bar.add_task("Structural Info", total=processor.count())
-        with h5py.File(hdf5_out, "r+") as f:
-            n = 0
+        output = incremental if update else checkpoint
+        with output.open() as f, output.writer(f) as writer:
+            writer.create_dataset(output_dataset_name, dt)
+            n = writer.size(output_dataset_name)
             n_multimodel = 0
+            n_bypassed = 0
             for structural_info in processor.execute(
                 callback=get_padded_structural_info,
                 limit=None,
+                init=init_worker,
+                init_params={
+                    "parser": parser,
+                    "fix": fix,
+                    "hydrogens": hydrogens,
+                    "hydrogen_engine": hydrogen_engine,
+                    "pdbfixer_dir": pdbfixer_dir,
+                },
                 params={
                     "parser": parser,
                     "padded_length": max_atoms,
                     "SASA": SASA,
+                    "sasa_points": sasa_points,
                     "charge": charge,
                     "angles": vec_db is not None or angle_db is not None,
                     "DSSP": DSSP,
+                    "dssp_engine": dssp_engine,
                     "fix": fix,
                     "hydrogens": hydrogens,
+                    "hydrogen_engine": hydrogen_engine,
                     "extra_molecules": extra_molecules,
                     "multi_struct": handle_multi_structures,
                     "fixed_pdb_dir": fixed_pdb_dir,
                 },
                 parallelism=parallelism,
+                shared_memory_bytes=(
+                    None if shared_memory_mb is None else shared_memory_mb << 20
+                ),
+                worker_limits=worker_limits,
             ):
                 try:
                     if structural_info[0] is None:
@@ -417,9 +579,11 @@ def get_structural_info_from_dataset(
                         angles,
                         norm_vecs,
                         multi_model,
+                        fix_bypassed,
                     ) = (*structural_info,)
 
                     n_multimodel += multi_model[0]
+                    n_bypassed += fix_bypassed[0]
 
                     if angle_db is not None or vec_db is not None:
                         for res_id, curr_angles, curr_norm_vecs in zip(
@@ -429,7 +593,7 @@ def get_structural_info_from_dataset(
                             angle_dict[res_id] = curr_angles.tolist()
                             vec_dict[res_id] = curr_norm_vecs.tolist()
 
-                    f[output_dataset_name][n] = (
+                    writer.append(output_dataset_name, (
                         pdb,
                         atom_names,
                         elements,
@@ -437,9 +601,11 @@ def get_structural_info_from_dataset(
                         coords,
                         sasas,
                         charges,
-                    )  # [0:len(dt_arr)]
+                    ))  # [0:len(dt_arr)]
 
                     n += 1
+                    incremental.append([pdb])
+                    checkpoint.update(writer, done=[pdb], save=save_progress)
                 except Exception as e:
                     logger.warning("Failed to write PDB with the following error:")
                     logger.exception(e)
@@ -450,29 +616,129 @@ def get_structural_info_from_dataset(
                         description=f"Structural Info: {n}/{processor.count()}",
                     )
 
+            for pdb, reason in processor.failures:
+                logger.warning(f"Failed to process {pdb}: {reason}")
+            if processor.failures:
+                logger.info(f"PDBs failed in the workers: {len(processor.failures)}")
+            checkpoint.update(
+                writer,
+                failed=[
+                    (get_output_name(pdb, parser), reason)
+                    for pdb, reason in processor.failures
+                ],
+            )
+            save_progress(writer)
+            incremental.write(f)
+
             if handle_multi_structures in ("warn", "allow"):
                 logger.info(f"PDBs with multiple models: {n_multimodel}")
+            # pdbfixer is only bypassed when it does not add hydrogens
+            if parser == "biopython" and (fix or hydrogens) and not (
+                hydrogens and hydrogen_engine == "reduce"
+            ):
+                logger.info(f"PDBs complete without pdbfixer: {n_bypassed}")
 
             logger.info(f"PDBs successfully processed: {n}")
-            f[output_dataset_name].resize((n,))
 
     if angle_db is not None:
-        angle_db = sqlitedict.SqliteDict(angle_db, autocommit=False)
-        for k, v in angle_dict.items():
-            angle_db[k] = v
-        angle_db.commit()
-        angle_db.close()
         logger.info(f"Saved chi angles to {angle_db}")
-
     if vec_db is not None:
-        vec_db = sqlitedict.SqliteDict(vec_db, autocommit=False)
-        for k, v in vec_dict.items():
-            vec_db[k] = v
-        vec_db.commit()
-        vec_db.close()
         logger.info(f"Saved normal vectors to {vec_db}")
 
 
+def get_output_name(pdb: str, parser: str = "biopython") -> str:
+    """
+    Name of pdb in the rows of the output, see `get_structural_info_from_protein`
+    """
+    return pdb if parser == "pyrosetta" else pdb.replace("_", "-")
+
+
+def get_input_hashes(
+    input_path: str, pdb_list: List[str], parser: str, parallelism: int
+) -> Dict[str, str]:
+    """
+    Content hashes of the PDBs in pdb_list, by name in the output, see
+    `zernikegrams.utils.incremental`
+    """
+    if os.path.isdir(input_path):
+        sources = get_structure_sources(input_path)
+        hashes = hash_sources(
+            [sources.get(pdb, get_pdb_file(pdb, input_path)) for pdb in pdb_list],
+            parallelism,
+        )
+        return {
+            get_output_name(pdb, parser): h for pdb, h in zip(pdb_list, hashes)
+        }
+
+    import foldcomp
+
+    pdbs = set(pdb_list)
+    with foldcomp.open(input_path) as db:
+        return {
+            get_output_name(name, parser): hash_bytes(pdb.encode("utf-8"))
+            for name, pdb in db
+            if name in pdbs
+        }
+
+
+def hash_sources(sources: List[Source], parallelism: int = 4) -> List[str]:
+    """
+    Content hashes of the structures of sources, see
+    `zernikegrams.utils.incremental.hash_files`. Gzipped
+    files and members of shards are hashed decompressed.
+    """
+
+    def hash_source(source):
+        ((pdb_file, data),) = read_structures([source])
+        return hash_file(pdb_file) if data is None else hash_bytes(data)
+
+    with ThreadPoolExecutor(max(1, parallelism)) as executor:
+        return list(executor.map(hash_source, sources))
+
+
+def save_to_db(db_path: Optional[str], values: Dict[str, Any]) -> None:
+    """
+    Adds values to the sqlite db at db_path, if not None, and clears them
+    """
+    if db_path is None:
+        return
+    db = sqlitedict.SqliteDict(db_path, autocommit=False)
+    for k, v in values.items():
+        db[k] = v
+    db.commit()
+    db.close()
+    values.clear()
+
+
+def init_worker(
+    parser: str = "biopython",
+    fix: bool = False,
+    hydrogens: bool = False,
+    hydrogen_engine: str = "reduce",
+    pdbfixer_dir: Optional[str] = None,
+) -> None:
+    """
+    Warm-up of each worker of `get_structural_info_from_dataset`, before its
+    first protein. PyRosetta is initialized for the pyrosetta parser, and
+    pdbfixer is relocated and OpenMM loaded when the proteins are fixed.
+
+    Parameters
+    ----------
+    parser: parser to use for reading PDBs
+    Fix: Whether or not to fix missing atoms
+    Hydrogens: Whether or not to add hydrogen atoms
+    hydrogen_engine: "reduce" or "builtin", see `get_structural_info_from_protein`
+    pdbfixer_dir: directory of pdbfixer, see `relocate_pdbfixer`
+    """
+    if parser == "pyrosetta":
+        from zernikegrams.structural_info.pyrosetta_core import init_pyrosetta
+
+        init_pyrosetta()
+    elif fix or hydrogens:
+        # pdbfixer only adds the hydrogens of reduce
+        warm_up_pdbfixer(hydrogens and hydrogen_engine == "reduce", pdbfixer_dir)
+
+
 def get_padded_structural_info(
     pdb_file: str,
     parser: str = "biopython",
@@ -486,6 +752,10 @@ def get_padded_structural_info(
     extra_molecules: bool = True,
     multi_struct: str = "warn",
     fixed_pdb_dir: str = None,
+    pdb_data: Optional[bytes] = None,
+    sasa_points: int = N_POINTS,
+    dssp_engine: str = "mkdssp",
+    hydrogen_engine: str = "reduce",
 ) -> Tuple[
     bytes, np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray
 ]:
@@ -506,6 +776,10 @@ def get_padded_structural_info(
     extra_molecules: Whether or not to keep extra_molecules
     multi_struct: Behavior for handling PDBs with multiple structures
     fixed_pdb_dir: Directory to save fixed pdbs
+    pdb_data: contents of pdb_file, if read in memory
+    sasa_points: number of points per atom of the SASA
+    dssp_engine: "builtin" or "mkdssp", see `get_structural_info_from_protein`
+    hydrogen_engine: "reduce" or "builtin", see `get_structural_info_from_protein`
 
     Returns
     -------
@@ -520,6 +794,9 @@ def get_padded_structural_info(
               coordinates of each atom
             float array of shape [max_atoms] storing the SASA of each atom
             float array of shape [max_atoms] storing the partial charge of each atom
+        followed by the rest of the structural info, see
+        `get_structural_info_from_protein`, ending with is_multi_model and
+        is_bypassed
     """
 
     try:
@@ -535,6 +812,10 @@ def get_padded_structural_info(
             extra_molecules=extra_molecules,
             multi_struct=multi_struct,
             fixed_pdb_dir=fixed_pdb_dir,
+            pdb_data=pdb_data,
+            sasa_points=sasa_points,
+            dssp_engine=dssp_engine,
+            hydrogen_engine=hydrogen_engine,
         )
 
         mat_structural_info = pad_structural_info(
@@ -584,6 +865,13 @@ def main():
         not args.remove_extra_molecules,
         args.handle_multi_structures,
         args.fixed_pdb_dir,
+        args.shared_memory_mb,
+        get_worker_limits(args),
+        args.resume,
+        args.update,
+        args.sasa_points,
+        args.DSSP_engine,
+        args.hydrogen_engine,
     )
 
     logger.info(f"Total time = {time.time() - start_time:.2f} seconds")
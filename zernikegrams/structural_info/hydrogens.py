@@ -0,0 +1,558 @@
+"""
+In-process hydrogen placement on the standard amino acids, a fast
+alternative to reduce and pdbfixer for approximate hydrogen positions.
+
+The hydrogens of each heavy atom are built from the positions of its bonded
+heavy atoms with ideal geometries, for all the residues of a type at once:
+
+    - METHINE: a single hydrogen of an sp3 atom with three heavy neighbors,
+      opposite to the sum of the bonds, e.g. HA
+    - METHYLENE: the two hydrogens of an sp3 atom with two heavy neighbors,
+      in the plane bisecting them, with a tetrahedral H-X-H angle, e.g. HB2
+      and HB3. The sign picks the prochiral position.
+    - PLANAR: the hydrogen of an sp2 atom with two heavy neighbors, in their
+      plane, opposite to the sum of the bonds, e.g. aromatic hydrogens and
+      the H of the backbone
+    - ROTOR: hydrogens of atoms with a single heavy neighbor, from internal
+      coordinates (angle, dihedral) relative to the neighbor and one of its
+      neighbors. Methyls and ammoniums are staggered, hydroxyls and thiols
+      anti, and amides and guanidiniums planar.
+
+Protonation is fixed, as at pH 7: Lys, Arg and the N-termini are charged,
+Asp, Glu and the C-termini deprotonated, His protonated on NE2 only and
+cysteines in disulfide bonds have no HG. Rotatable hydrogens are not
+optimized, unlike with reduce, and residues missing the heavy atoms a
+hydrogen is built from do not get it.
+
+The distances to the hydrogens are the ones of reduce, to the centers of
+the electron clouds, by default, see `ECLOUD` and `NUCLEAR`. Hydrogens are
+named as by pdbfixer, see `HYDROGENS`, and `compare_hydrogens` compares them
+to the ones of another engine, e.g. reduce, see `main`.
+"""
+
+import argparse
+import itertools
+import os
+import time
+from typing import *
+
+import numpy as np
+from Bio.PDB.Atom import Atom
+
+from zernikegrams.utils import log_config as logging
+
+logger = logging.getLogger(__name__)
+
+METHINE = "methine"
+METHYLENE = "methylene"
+PLANAR = "planar"
+ROTOR = "rotor"
+
+TETRAHEDRAL = 109.5
+TRIGONAL = 120.0
+# C-S-H and C-O-H angles
+THIOL = 96.0
+HYDROXYL = 109.5
+
+# X-H distances of reduce, by element of X, "CAR" for aromatic carbons
+ECLOUD = {"C": 0.97, "CAR": 0.93, "N": 0.86, "O": 0.84, "S": 1.2}
+NUCLEAR = {"C": 1.09, "CAR": 1.08, "N": 1.01, "O": 0.96, "S": 1.34}
+
+MAX_PEPTIDE_BOND = 2.0
+MAX_DISULFIDE_BOND = 2.5
+# dihedral C-CA-N-H of the H of a residue after a chain break, as in a helix
+BREAK_DIHEDRAL = 120.0
+
+
+class Hydrogen(NamedTuple):
+    """
+    Hydrogen of a residue template, bonded to parent and placed relative to
+    its neighbors as kind, see the module docstring
+    """
+
+    name: str
+    kind: str
+    parent: str
+    neighbors: Tuple[str, ...]  # bonded, and its neighbor for ROTOR, "-" for the previous residue
+    length: str  # key of the X-H distances
+    angle: float = 0.0  # ROTOR: neighbor-parent-H angle, METHYLENE: sign
+    dihedral: float = 0.0
+
+
+def _methylene(parent, neighbors, names, length="C"):
+    return [
+        Hydrogen(names[0], METHYLENE, parent, neighbors, length, -1.0),
+        Hydrogen(names[1], METHYLENE, parent, neighbors, length, 1.0),
+    ]
+
+
+def _rotor(parent, neighbors, names, length, angle=TETRAHEDRAL, dihedrals=(180.0, -60.0, 60.0)):
+    return [
+        Hydrogen(name, ROTOR, parent, neighbors, length, angle, dihedral)
+        for name, dihedral in zip(names, dihedrals)
+    ]
+
+
+def _ring(*atoms):
+    # (hydrogen, parent, neighbors) of aromatic CH
+    return [Hydrogen(name, PLANAR, parent, neighbors, "CAR") for name, parent, neighbors in atoms]
+
+
+_HA = [Hydrogen("HA", METHINE, "CA", ("N", "C", "CB"), "C")]
+_HB = _methylene("CB", ("CA", "CG"), ("HB2", "HB3"))
+_HG = _methylene("CG", ("CB", "CD"), ("HG2", "HG3"))
+_PHENYL = _ring(
+    ("HD1", "CD1", ("CG", "CE1")),
+    ("HD2", "CD2", ("CG", "CE2")),
+    ("HE1", "CE1", ("CD1", "CZ")),
+    ("HE2", "CE2", ("CD2", "CZ")),
+)
+
+# hydrogens of the side chains and the CA of the standard amino acids
+HYDROGENS = {
+    "ALA": _HA + _rotor("CB", ("CA", "N"), ("HB1", "HB2", "HB3"), "C"),
+    "ARG": _HA
+    + _HB
+    + _HG
+    + _methylene("CD", ("CG", "NE"), ("HD2", "HD3"))
+    + [Hydrogen("HE", PLANAR, "NE", ("CD", "CZ"), "N")]
+    + _rotor("NH1", ("CZ", "NE"), ("HH11", "HH12"), "N", TRIGONAL, (0.0, 180.0))
+    + _rotor("NH2", ("CZ", "NE"), ("HH21", "HH22"), "N", TRIGONAL, (0.0, 180.0)),
+    "ASN": _HA
+    + _HB
+    + _rotor("ND2", ("CG", "OD1"), ("HD21", "HD22"), "N", TRIGONAL, (180.0, 0.0)),
+    "ASP": _HA + _HB,
+    "CYS": _HA
+    + _methylene("CB", ("CA", "SG"), ("HB2", "HB3"))
+    + _rotor("SG", ("CB", "CA"), ("HG",), "S", THIOL),
+    "GLN": _HA
+    + _HB
+    + _HG
+    + _rotor("NE2", ("CD", "OE1"), ("HE21", "HE22"), "N", TRIGONAL, (180.0, 0.0)),
+    "GLU": _HA + _HB + _HG,
+    "GLY": _methylene("CA", ("N", "C"), ("HA2", "HA3")),
+    "HIS": _HA
+    + _HB
+    + _ring(("HD2", "CD2", ("CG", "NE2")), ("HE1", "CE1", ("ND1", "NE2")))
+    + [Hydrogen("HE2", PLANAR, "NE2", ("CD2", "CE1"), "N")],
+    "ILE": _HA
+    + [Hydrogen("HB", METHINE, "CB", ("CA", "CG1", "CG2"), "C")]
+    + _methylene("CG1", ("CB", "CD1"), ("HG12", "HG13"))
+    + _rotor("CG2", ("CB", "CA"), ("HG21", "HG22", "HG23"), "C")
+    + _rotor("CD1", ("CG1", "CB"), ("HD11", "HD12", "HD13"), "C"),
+    "LEU": _HA
+    + _HB
+    + [Hydrogen("HG", METHINE, "CG", ("CB", "CD1", "CD2"), "C")]
+    + _rotor("CD1", ("CG", "CB"), ("HD11", "HD12", "HD13"), "C")
+    + _rotor("CD2", ("CG", "CB"), ("HD21", "HD22", "HD23"), "C"),
+    "LYS": _HA
+    + _HB
+    + _HG
+    + _methylene("CD", ("CG", "CE"), ("HD2", "HD3"))
+    + _methylene("CE", ("CD", "NZ"), ("HE2", "HE3"))
+    + _rotor("NZ", ("CE", "CD"), ("HZ1", "HZ2", "HZ3"), "N"),
+    "MET": _HA
+    + _HB
+    + _methylene("CG", ("CB", "SD"), ("HG2", "HG3"))
+    + _rotor("CE", ("SD", "CG"), ("HE1", "HE2", "HE3"), "C"),
+    "PHE": _HA + _HB + _PHENYL + _ring(("HZ", "CZ", ("CE1", "CE2"))),
+    "PRO": _HA + _HB + _HG + _methylene("CD", ("CG", "N"), ("HD2", "HD3")),
+    "SER": _HA
+    + _methylene("CB", ("CA", "OG"), ("HB2", "HB3"))
+    + _rotor("OG", ("CB", "CA"), ("HG",), "O", HYDROXYL),
+    "THR": _HA
+    + [Hydrogen("HB", METHINE, "CB", ("CA", "OG1", "CG2"), "C")]
+    + _rotor("OG1", ("CB", "CA"), ("HG1",), "O", HYDROXYL)
+    + _rotor("CG2", ("CB", "CA"), ("HG21", "HG22", "HG23"), "C"),
+    "TRP": _HA
+    + _HB
+    + _ring(
+        ("HD1", "CD1", ("CG", "NE1")),
+        ("HE3", "CE3", ("CD2", "CZ3")),
+        ("HZ2", "CZ2", ("CE2", "CH2")),
+        ("HZ3", "CZ3", ("CE3", "CH2")),
+        ("HH2", "CH2", ("CZ2", "CZ3")),
+    )
+    + [Hydrogen("HE1", PLANAR, "NE1", ("CD1", "CE2"), "N")],
+    "TYR": _HA
+    + _HB
+    + _PHENYL
+    + _rotor("OH", ("CZ", "CE1"), ("HH",), "O", HYDROXYL),
+    "VAL": _HA
+    + [Hydrogen("HB", METHINE, "CB", ("CA", "CG1", "CG2"), "C")]
+    + _rotor("CG1", ("CB", "CA"), ("HG11", "HG12", "HG13"), "C")
+    + _rotor("CG2", ("CB", "CA"), ("HG21", "HG22", "HG23"), "C"),
+}
+
+# hydrogens of the N, by position of the residue in its chain
+AMIDE = [Hydrogen("H", PLANAR, "N", ("-C", "CA"), "N")]
+BREAK = _rotor("N", ("CA", "C"), ("H",), "N", TRIGONAL, (BREAK_DIHEDRAL,))
+N_TERMINUS = _rotor("N", ("CA", "C"), ("H", "H2", "H3"), "N")
+N_TERMINUS_PRO = _methylene("N", ("CA", "CD"), ("H2", "H3"), "N")
+
+
+class Hydrogens(NamedTuple):
+    """Hydrogens placed on residues, in order of residue, see `get_hydrogens`"""
+
+    names: np.ndarray
+    residues: np.ndarray  # index of the residue
+    coords: np.ndarray  # [num_hydrogens, 3]
+
+
+def _unit(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.linalg.norm(vectors, axis=-1, keepdims=True)
+
+
+def _place(kind, parents, neighbors, lengths, angles, dihedrals):
+    """Positions of hydrogens of one kind, with arrays of [num_hydrogens, ...]"""
+    bonds = _unit(neighbors - parents[:, None])
+    if kind == METHINE or kind == PLANAR:
+        return parents + lengths[:, None] * _unit(-bonds.sum(axis=1))
+    if kind == METHYLENE:
+        bisector = _unit(-bonds.sum(axis=1))
+        normal = _unit(np.cross(bonds[:, 0], bonds[:, 1]))
+        half = np.radians(TETRAHEDRAL / 2)
+        return parents + lengths[:, None] * (
+            np.cos(half) * bisector + (angles * np.sin(half))[:, None] * normal
+        )
+    # ROTOR, from the internal coordinates neighbor[1]-neighbor[0]-parent-H
+    axis = -bonds[:, 0]
+    normal = _unit(np.cross(neighbors[:, 0] - neighbors[:, 1], axis))
+    theta = np.radians(angles)
+    phi = np.radians(dihedrals)
+    return parents + lengths[:, None] * (
+        -np.cos(theta)[:, None] * axis
+        + (np.sin(theta) * np.cos(phi))[:, None] * np.cross(normal, axis)
+        + (np.sin(theta) * np.sin(phi))[:, None] * normal
+    )
+
+
+def get_hydrogens(
+    residue_chains: np.ndarray,
+    resnames: np.ndarray,
+    atom_residues: np.ndarray,
+    atom_names: np.ndarray,
+    coords: np.ndarray,
+    lengths: Dict[str, float] = ECLOUD,
+) -> Hydrogens:
+    """
+    Hydrogens of the standard residues, see the module docstring. Consecutive
+    residues of a chain are bonded if the C-N distance is less than
+    MAX_PEPTIDE_BOND, and the first residue of each chain is an N-terminus.
+
+    Params:
+        - residue_chains: [num_residues] chain of each residue, in order
+        - resnames: [num_residues] name of each residue
+        - atom_residues: [num_atoms] index of the residue of each atom
+        - atom_names: [num_atoms] names of the heavy atoms
+        - coords: [num_atoms, 3] coordinates of the heavy atoms
+        - lengths: X-H distances, ECLOUD or NUCLEAR
+
+    Returns:
+        the hydrogens, sorted by residue
+    """
+    num_residues = resnames.shape[0]
+    coords = np.asarray(coords, dtype=np.float64)
+
+    # index of the atom of each (residue, name), -1 if missing
+    names, name_codes = np.unique(atom_names, return_inverse=True)
+    keys = atom_residues * names.shape[0] + name_codes.reshape(-1)
+    order = np.argsort(keys, kind="stable")
+    keys = keys[order]
+
+    def lookup(residues, name):
+        if name.startswith("-"):
+            return lookup(residues - 1, name[1:])
+        code = np.searchsorted(names, name)
+        if code == names.shape[0] or names[code] != name:
+            return np.full(residues.shape[0], -1)
+        key = residues * names.shape[0] + code
+        found = np.searchsorted(keys, key).clip(max=keys.shape[0] - 1)
+        return np.where(keys[found] == key, order[found], -1)
+
+    # templates of the N, by residue
+    all_residues = np.arange(num_residues)
+    n = lookup(all_residues, "N")
+    previous_c = np.full(num_residues, -1)
+    previous_c[1:] = lookup(all_residues[1:], "-C")
+    same_chain = np.zeros(num_residues, dtype=bool)
+    same_chain[1:] = residue_chains[1:] == residue_chains[:-1]
+    bonded = (previous_c >= 0) & (n >= 0) & same_chain
+    bonded[bonded] = (
+        np.linalg.norm(coords[previous_c[bonded]] - coords[n[bonded]], axis=1)
+        < MAX_PEPTIDE_BOND
+    )
+    prolines = resnames == "PRO"
+    n_templates = [
+        (bonded & ~prolines, AMIDE),
+        (same_chain & ~bonded & ~prolines, BREAK),
+        (~same_chain & ~prolines, N_TERMINUS),
+        (~same_chain & prolines, N_TERMINUS_PRO),
+    ]
+
+    # cysteines in disulfide bonds
+    cysteines = np.flatnonzero(resnames == "CYS")
+    sg = lookup(cysteines, "SG")
+    cysteines, sg = cysteines[sg >= 0], sg[sg >= 0]
+    distances = np.linalg.norm(coords[sg][:, None] - coords[sg][None], axis=-1)
+    np.fill_diagonal(distances, np.inf)
+    disulfides = set(cysteines[(distances < MAX_DISULFIDE_BOND).any(axis=1)])
+
+    # (hydrogen, residues) to place, grouped by kind
+    groups = {kind: [] for kind in (METHINE, METHYLENE, PLANAR, ROTOR)}
+    for mask, hydrogens in n_templates:
+        for hydrogen in hydrogens:
+            groups[hydrogen.kind].append((hydrogen, np.flatnonzero(mask)))
+    for resname, hydrogens in HYDROGENS.items():
+        residues = np.flatnonzero(resnames == resname)
+        if residues.shape[0] == 0:
+            continue
+        for hydrogen in hydrogens:
+            if hydrogen.name == "HG" and resname == "CYS":
+                groups[hydrogen.kind].append(
+                    (hydrogen, np.array([r for r in residues if r not in disulfides], dtype=int))
+                )
+            else:
+                groups[hydrogen.kind].append((hydrogen, residues))
+
+    all_names, all_residues, all_coords = [], [], []
+    for kind, rows in groups.items():
+        parents, neighbors, residues, params, row_names = [], [], [], [], []
+        for hydrogen, hydrogen_residues in rows:
+            parent = lookup(hydrogen_residues, hydrogen.parent)
+            neighbor = np.stack(
+                [lookup(hydrogen_residues, name) for name in hydrogen.neighbors], axis=1
+            )
+            found = (parent >= 0) & (neighbor >= 0).all(axis=1)
+            parents.append(parent[found])
+            neighbors.append(neighbor[found])
+            residues.append(hydrogen_residues[found])
+            params.append(
+                np.tile(
+                    [lengths[hydrogen.length], hydrogen.angle, hydrogen.dihedral],
+                    (found.sum(), 1),
+                )
+            )
+            row_names.append(np.full(found.sum(), hydrogen.name, dtype="U4"))
+        if not rows:
+            continue
+        parents = np.concatenate(parents)
+        if parents.shape[0] == 0:
+            continue
+        params = np.concatenate(params)
+        all_coords.append(
+            _place(
+                kind,
+                coords[parents],
+                coords[np.concatenate(neighbors)],
+                params[:, 0],
+                params[:, 1],
+                params[:, 2],
+            )
+        )
+        all_names.append(np.concatenate(row_names))
+        all_residues.append(np.concatenate(residues))
+
+    if not all_coords:
+        return Hydrogens(np.array([], dtype="U4"), np.array([], dtype=int), np.zeros((0, 3)))
+    residues = np.concatenate(all_residues)
+    order = np.argsort(residues, kind="stable")
+    return Hydrogens(
+        np.concatenate(all_names)[order],
+        residues[order],
+        np.concatenate(all_coords)[order],
+    )
+
+
+def add_hydrogens(model, lengths: Dict[str, float] = ECLOUD) -> int:
+    """
+    Adds the hydrogens of `get_hydrogens` to the standard residues of a
+    Biopython model without hydrogens, after the heavy atoms of each residue
+
+    Returns the number of hydrogens added
+    """
+    residues = [
+        residue
+        for chain in model
+        for residue in chain
+        if residue.get_resname() in HYDROGENS
+    ]
+    atoms = [
+        (i, atom.get_id(), atom.get_coord())
+        for i, residue in enumerate(residues)
+        for atom in residue
+        if atom.element != "H"
+    ]
+    if not atoms:
+        return 0
+    atom_residues, atom_names, coords = zip(*atoms)
+    hydrogens = get_hydrogens(
+        np.array([residue.get_parent().id for residue in residues]),
+        np.array([residue.get_resname() for residue in residues]),
+        np.array(atom_residues),
+        np.array(atom_names),
+        np.array(coords),
+        lengths,
+    )
+    for name, i, coord in zip(*hydrogens):
+        residues[i].add(
+            Atom(
+                name,
+                coord.astype(np.float32),
+                0.0,
+                1.0,
+                " ",
+                name if len(name) == 4 else f" {name:<3}",
+                None,
+                element="H",
+            )
+        )
+    return hydrogens.names.shape[0]
+
+
+class HydrogenComparison(NamedTuple):
+    """Agreement of the hydrogens of two structures, see `compare_hydrogens`"""
+
+    num_hydrogens: int
+    num_reference: int
+    num_matched: int
+    rmsd: float  # over the matched hydrogens, nan if there are none
+
+
+def _hydrogens_by_parent(model) -> Dict[Tuple, np.ndarray]:
+    # coordinates of the hydrogens of each (chain, residue, nearest heavy atom)
+    groups = {}
+    for chain in model:
+        for residue in chain:
+            heavy = [atom for atom in residue if atom.element != "H"]
+            hydrogens = [atom for atom in residue if atom.element == "H"]
+            if not heavy or not hydrogens:
+                continue
+            heavy_coords = np.array([atom.get_coord() for atom in heavy])
+            for atom in hydrogens:
+                distances = np.linalg.norm(heavy_coords - atom.get_coord(), axis=1)
+                key = (chain.id, residue.id, heavy[np.argmin(distances)].get_id())
+                groups.setdefault(key, []).append(atom.get_coord())
+    return {key: np.array(coords) for key, coords in groups.items()}
+
+
+def compare_hydrogens(model, reference) -> HydrogenComparison:
+    """
+    Compares the hydrogens of two Biopython models of the same structure,
+    e.g. of the builtin engine and of reduce. Hydrogens are matched by the
+    heavy atom they are bonded to, regardless of their names, which differ
+    between engines, and within each heavy atom in the order that minimizes
+    their distances, so that the names of prochiral hydrogens and methyl
+    rotations do not count as errors if positions agree.
+
+    Returns:
+        the numbers of hydrogens of each model and of the matched ones, and
+        the RMSD of the matched ones
+    """
+    groups = _hydrogens_by_parent(model)
+    reference_groups = _hydrogens_by_parent(reference)
+    num_matched, squared = 0, 0.0
+    for key in groups.keys() & reference_groups.keys():
+        coords, reference_coords = groups[key], reference_groups[key]
+        if coords.shape[0] > reference_coords.shape[0]:
+            coords, reference_coords = reference_coords, coords
+        # squared distances of each hydrogen to each reference one
+        distances = ((coords[:, None] - reference_coords[None]) ** 2).sum(axis=-1)
+        squared += min(
+            distances[np.arange(coords.shape[0]), list(order)].sum()
+            for order in itertools.permutations(
+                range(reference_coords.shape[0]), coords.shape[0]
+            )
+        )
+        num_matched += coords.shape[0]
+    return HydrogenComparison(
+        sum(coords.shape[0] for coords in groups.values()),
+        sum(coords.shape[0] for coords in reference_groups.values()),
+        num_matched,
+        float(np.sqrt(squared / num_matched)) if num_matched else float("nan"),
+    )
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="Compares the hydrogens of the builtin engine to the ones of reduce"
+    )
+    parser.add_argument(
+        "--pdb_dir", type=str, required=True, help="Directory containing PDB files"
+    )
+    parser.add_argument(
+        "--pdb_list_file",
+        type=str,
+        help="Path to file containing list of PDB files of interest, one per row. By default, all the files of --pdb_dir",
+    )
+    parser.add_argument(
+        "--reduce", type=str, default="reduce", help="Path to the reduce executable"
+    )
+    parser.add_argument(
+        "--remove_extra_molecules",
+        action="store_true",
+        default=False,
+        help="If present, removes extra molecules (whatever is flagged as hetero)",
+    )
+    parser.add_argument("--logging", type=str, help="logging level", default="INFO")
+    return parser
+
+
+def main():
+    # imported here, since RaSP places hydrogens with this module
+    from zernikegrams.structural_info.RaSP import clean_structure
+    from zernikegrams.utils.pdb_lists import pdb_list_from_dir
+
+    args = get_parser().parse_args()
+    logger.setLevel(args.logging)
+
+    if args.pdb_list_file is not None:
+        with open(args.pdb_list_file, "r") as f:
+            pdb_list = [pdb.strip() for pdb in f.readlines()]
+    else:
+        pdb_list = pdb_list_from_dir(args.pdb_dir)
+
+    totals = np.zeros(4)
+    squared = 0.0
+    times = {"reduce": 0.0, "builtin": 0.0}
+    for pdb in pdb_list:
+        pdb_file = os.path.join(args.pdb_dir, f"{pdb}.pdb")
+        models = {}
+        try:
+            for engine in times:
+                start = time.time()
+                models[engine] = clean_structure(
+                    pdb_file,
+                    args.reduce,
+                    True,
+                    not args.remove_extra_molecules,
+                    hydrogen_engine=engine,
+                ).model
+                times[engine] += time.time() - start
+        except Exception as e:
+            logger.warning(f"Failed to clean {pdb}: {e}")
+            continue
+        comparison = compare_hydrogens(models["builtin"], models["reduce"])
+        logger.info(
+            f"{pdb}: {comparison.num_hydrogens} builtin, "
+            f"{comparison.num_reference} reduce, {comparison.num_matched} matched, "
+            f"RMSD {comparison.rmsd:.3f} A"
+        )
+        totals += [1, *comparison[:3]]
+        if comparison.num_matched:
+            squared += comparison.num_matched * comparison.rmsd**2
+
+    num_pdbs, num_hydrogens, num_reference, num_matched = totals.astype(int)
+    logger.info(
+        f"{num_pdbs} PDBs: {num_hydrogens} builtin, {num_reference} reduce, "
+        f"{num_matched} matched hydrogens, RMSD "
+        f"{np.sqrt(squared / max(num_matched, 1)):.3f} A"
+    )
+    logger.info(
+        f"Time with reduce = {times['reduce']:.2f} seconds, "
+        f"with builtin = {times['builtin']:.2f} seconds"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,397 @@
+"""
+Native reader of the atoms of PDB and mmCIF files into column arrays.
+
+`Bio.PDB` builds a Structure/Model/Chain/Residue/Atom object graph that the
+structural info then walks atom by atom. This module instead slices the fixed
+columns of the ATOM/HETATM records of PDB files, or splits the _atom_site loop
+of mmCIF files, straight into numpy arrays, and reproduces what Biopython
+yields from `Structure.get_atoms()`:
+
+    - only the first model
+    - atoms grouped by chain, then by residue, in order of first appearance,
+      the atoms of a residue that reappears later being merged into it
+    - of the alternate locations of an atom, the one with the highest
+      occupancy, the first one on ties
+
+Files that Biopython builds in some other way, e.g. point mutations
+(residues with the same id and different names), atoms with both blank and
+non-blank altlocs, or duplicate atoms, raise `UnsupportedStructureError`, and
+the caller falls back to Biopython.
+"""
+
+import re
+from typing import *
+
+import numpy as np
+from Bio.Data import IUPACData
+
+from zernikegrams.utils import log_config as logging
+
+logger = logging.getLogger(__name__)
+
+ATOM_RECORDS = (b"ATOM  ", b"HETATM")
+# Biopython's PDBParser stops at these records
+END_RECORDS = (b"END   ", b"CONECT")
+MODEL_RECORDS = (b"MODEL ", b"ENDMDL")
+
+# fixed columns of the ATOM/HETATM records, see the PDB format
+PDB_COLUMNS = {
+    "fullname": (12, 16),
+    "altloc": (16, 17),
+    "resname": (17, 20),
+    "chain": (21, 22),
+    "resseq": (22, 26),
+    "icode": (26, 27),
+    "x": (30, 38),
+    "y": (38, 46),
+    "z": (46, 54),
+    "occupancy": (54, 60),
+    "element": (76, 78),
+}
+LINE_LENGTH = 80
+
+CIF_TOKEN = re.compile(r"""'(.*?)'(?=\s|$)|"(.*?)"(?=\s|$)|(\S+)""", re.M)
+CIF_UNASSIGNED = (".", "?")
+
+
+class UnsupportedStructureError(ValueError):
+    """The file has records that the native reader does not build like Biopython"""
+
+
+class AtomColumns(NamedTuple):
+    """
+    The atoms of the first model of a structure, one entry per atom in the
+    order of Biopython's `Structure.get_atoms()`
+    """
+
+    atom_names: np.ndarray  # as `Atom.get_name()`, without padding
+    elements: np.ndarray  # as `Atom.element`
+    chains: np.ndarray
+    resnums: np.ndarray
+    icodes: np.ndarray
+    resnames: np.ndarray
+    coords: np.ndarray  # float32, [num_atoms, 3]
+    altlocs: np.ndarray
+    occupancies: np.ndarray
+    num_models: int
+
+
+class _AtomRecords(NamedTuple):
+    """The atom records of a file, in file order"""
+
+    hetero: np.ndarray
+    names: np.ndarray
+    fullnames: np.ndarray
+    altlocs: np.ndarray
+    resnames: np.ndarray
+    chains: np.ndarray
+    resseqs: np.ndarray
+    icodes: np.ndarray
+    coords: np.ndarray
+    occupancies: np.ndarray
+    elements: np.ndarray
+    models: np.ndarray
+
+
+def is_mmcif(path: str) -> bool:
+    return path.endswith(".cif") or path.endswith(".cif.gz")
+
+
+def read_atom_columns(path: str, data: Optional[bytes] = None) -> AtomColumns:
+    """
+    Atoms of the first model of the PDB or mmCIF file at path, or of its
+    contents data if given, see the module docstring
+    """
+    if data is None:
+        with open(path, "rb") as f:
+            data = f.read()
+    # as read by Biopython, in text mode
+    data = data.replace(b"\r\n", b"\n")
+    try:
+        records = _read_mmcif(data) if is_mmcif(path) else _read_pdb(data)
+    except (ValueError, IndexError, UnicodeError) as e:
+        raise UnsupportedStructureError(f"Cannot read {path}: {e}") from e
+    num_models = int(records.models.max()) + 1 if records.models.shape[0] else 0
+    records = _AtomRecords(*(column[records.models == 0] for column in records))
+    selected = _select_atoms(records)
+    if selected.shape[0] == 0:
+        raise UnsupportedStructureError(f"No atoms in {path}")
+    return AtomColumns(
+        atom_names=records.names[selected],
+        elements=_assign_elements(
+            records.elements[selected], records.names[selected], records.fullnames[selected]
+        ),
+        chains=records.chains[selected],
+        resnums=records.resseqs[selected],
+        icodes=records.icodes[selected],
+        resnames=records.resnames[selected],
+        coords=records.coords[selected],
+        altlocs=records.altlocs[selected],
+        occupancies=records.occupancies[selected],
+        num_models=num_models,
+    )
+
+
+def get_structure_columns(entity, num_models: int = 1) -> AtomColumns:
+    """
+    Columns of the atoms of a Biopython entity, e.g. the first model of a
+    structure fixed by pdbfixer, in the order of `get_atoms()`. The fields of
+    the residues are read once per residue.
+    """
+    residues = list(entity.get_residues())
+    residue_atoms = [list(residue.get_atoms()) for residue in residues]
+    counts = [len(atoms) for atoms in residue_atoms]
+    atoms = [atom for atoms in residue_atoms for atom in atoms]
+
+    def per_residue(values, dtype=None):
+        return np.repeat(np.array(values, dtype=dtype), counts)
+
+    return AtomColumns(
+        atom_names=np.array([atom.get_name() for atom in atoms], dtype="U4"),
+        elements=np.array([atom.element for atom in atoms], dtype="U2"),
+        chains=per_residue([residue.get_parent().id for residue in residues], "U"),
+        resnums=per_residue([residue.id[1] for residue in residues], np.int64),
+        icodes=per_residue([residue.id[2] for residue in residues], "U1"),
+        resnames=per_residue([residue.resname for residue in residues], "U"),
+        coords=np.array(
+            [atom.get_coord() for atom in atoms], dtype=np.float32
+        ).reshape(-1, 3),
+        altlocs=np.array([atom.get_altloc() for atom in atoms], dtype="U1"),
+        occupancies=np.array(
+            [atom.get_occupancy() or 0.0 for atom in atoms], dtype=np.float64
+        ),
+        num_models=num_models,
+    )
+
+
+def _decode(column: np.ndarray) -> np.ndarray:
+    return column.astype("U")
+
+
+def _read_pdb(data: bytes) -> _AtomRecords:
+    lines = np.array(data.split(b"\n"))
+    records = lines.astype("S6")
+
+    # coordinates start at the first atom or model, and end at END or CONECT
+    starts = np.flatnonzero(np.isin(records, ATOM_RECORDS + (b"MODEL ",)))
+    if starts.shape[0] == 0:
+        raise ValueError("no atoms")
+    ends = np.flatnonzero(np.isin(records[starts[0] :], END_RECORDS))
+    stop = starts[0] + ends[0] if ends.shape[0] else lines.shape[0]
+    lines, records = lines[starts[0] : stop], records[starts[0] : stop]
+
+    is_atom = np.isin(records, ATOM_RECORDS)
+    models = _get_models(records, is_atom)
+
+    # fixed columns, padded with spaces as Biopython reads short lines
+    atom_lines = lines[is_atom].astype(f"S{LINE_LENGTH}")
+    chars = atom_lines.view("u1").reshape(-1, LINE_LENGTH).copy()
+    chars[chars == 0] = ord(" ")
+
+    def column(name):
+        start, stop = PDB_COLUMNS[name]
+        return chars[:, start:stop].copy().view(f"S{stop - start}").ravel()
+
+    fullnames = _decode(column("fullname"))
+    names = np.char.strip(fullnames)
+    # atom names with internal spaces keep all their spaces
+    spaced = np.char.find(names, " ") >= 0
+    names[spaced] = fullnames[spaced]
+
+    return _AtomRecords(
+        hetero=records[is_atom] == b"HETATM",
+        names=names,
+        fullnames=fullnames,
+        altlocs=_decode(column("altloc")),
+        resnames=np.char.strip(_decode(column("resname"))),
+        chains=_decode(column("chain")),
+        resseqs=column("resseq").astype(np.int64),
+        icodes=_decode(column("icode")),
+        coords=np.stack(
+            [column(axis).astype(np.float64) for axis in ("x", "y", "z")], axis=1
+        ).astype(np.float32),
+        occupancies=column("occupancy").astype(np.float64),
+        elements=np.char.upper(np.char.strip(_decode(column("element")))),
+        models=models,
+    )
+
+
+def _get_models(records: np.ndarray, is_atom: np.ndarray) -> np.ndarray:
+    """
+    Model index of every atom record: a model starts at a MODEL record, or at
+    an atom record when no model is open
+    """
+    models = np.zeros(is_atom.shape[0], dtype=np.int64)
+    controls = np.flatnonzero(np.isin(records, MODEL_RECORDS))
+    bounds = np.concatenate([[0], controls, [is_atom.shape[0]]])
+    model, model_open = -1, False
+    for i, (start, stop) in enumerate(zip(bounds[:-1], bounds[1:])):
+        if i > 0:
+            if records[start] == b"MODEL ":
+                model, model_open = model + 1, True
+            else:
+                model_open = False
+        if np.any(is_atom[start:stop]) and not model_open:
+            model, model_open = model + 1, True
+        models[start:stop] = model
+    return models[is_atom]
+
+
+def _read_mmcif(data: bytes) -> _AtomRecords:
+    text = data.decode("utf-8")
+    header = re.search(r"^loop_\s*\n((?:_atom_site\.\S+\s*\n)+)", text, re.M)
+    if header is None:
+        raise ValueError("no _atom_site loop")
+    fields = [line.strip()[len("_atom_site.") :] for line in header.group(1).split()]
+    # the loop ends at the next loop, category or data block
+    end = re.compile(r"^(?:loop_|_|data_|#)", re.M).search(text, header.end())
+    body = text[header.end() : end.start() if end else len(text)]
+
+    if "'" in body or '"' in body:
+        tokens = [a or b or c for a, b, c in CIF_TOKEN.findall(body)]
+    else:
+        tokens = body.split()
+    if len(tokens) % len(fields):
+        raise ValueError("truncated _atom_site loop")
+    table = np.array(tokens, dtype="U").reshape(-1, len(fields))
+
+    def column(name, default=None):
+        if name not in fields:
+            if default is None:
+                raise ValueError(f"no _atom_site.{name}")
+            return np.full(table.shape[0], default)
+        return table[:, fields.index(name)]
+
+    def assigned(values, default=" "):
+        return np.where(np.isin(values, CIF_UNASSIGNED), default, values)
+
+    seq_ids = column("auth_seq_id") if "auth_seq_id" in fields else column("label_seq_id")
+    if np.any(seq_ids == "."):
+        raise ValueError("atoms without residue ids")
+    names = column("label_atom_id")
+    model_nums = column("pdbx_PDB_model_num", "1")
+    # a model starts where the model number changes
+    models = np.cumsum(np.concatenate([[False], model_nums[1:] != model_nums[:-1]]))
+
+    return _AtomRecords(
+        hetero=column("group_PDB") == "HETATM",
+        names=names,
+        fullnames=names,
+        altlocs=assigned(column("label_alt_id", ".")),
+        resnames=column("label_comp_id"),
+        chains=column("auth_asym_id"),
+        resseqs=seq_ids.astype(np.int64),
+        icodes=assigned(column("pdbx_PDB_ins_code", "?")),
+        coords=np.stack(
+            [column(f"Cartn_{axis}").astype(np.float64) for axis in "xyz"], axis=1
+        ).astype(np.float32),
+        occupancies=column("occupancy").astype(np.float64),
+        elements=np.char.upper(column("type_symbol", "")),
+        models=models,
+    )
+
+
+def _first_indices(*keys: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Index of the first row with the same keys as each row, and the id of the
+    keys of each row
+    """
+    table = np.rec.fromarrays(keys)
+    _, first, inverse = np.unique(table, return_index=True, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    return first[inverse], inverse
+
+
+def _select_atoms(records: _AtomRecords) -> np.ndarray:
+    """
+    Indices of the records of the atoms Biopython yields, in its order, see
+    the module docstring
+    """
+    n = records.names.shape[0]
+    if n == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    # hetero residues are keyed by their name too
+    fields = np.where(
+        records.hetero,
+        np.where(np.isin(records.resnames, ("HOH", "WAT")), "W", np.char.add("H_", records.resnames)),
+        " ",
+    )
+    chain_first, _ = _first_indices(records.chains)
+    residue_first, residue_ids = _first_indices(
+        records.chains, fields, records.resseqs, records.icodes
+    )
+
+    # Biopython starts a residue where the chain, hetero flag, number,
+    # insertion code or name changes
+    starts = np.ones(n, dtype=bool)
+    starts[1:] = (
+        (records.chains[1:] != records.chains[:-1])
+        | (records.hetero[1:] != records.hetero[:-1])
+        | (fields[1:] != fields[:-1])
+        | (records.resseqs[1:] != records.resseqs[:-1])
+        | (records.icodes[1:] != records.icodes[:-1])
+        | (records.resnames[1:] != records.resnames[:-1])
+    )
+    runs_per_residue = np.bincount(residue_ids[starts])
+    reopened = runs_per_residue[residue_ids] > 1
+    if np.any(reopened):
+        # only standard residues reopened with the same name are merged
+        if np.any(fields[reopened] != " "):
+            raise UnsupportedStructureError("hetero residues defined twice")
+        _, name_ids = _first_indices(residue_ids[reopened], records.resnames[reopened])
+        if np.unique(name_ids).shape[0] != np.unique(residue_ids[reopened]).shape[0]:
+            raise UnsupportedStructureError("point mutations")
+
+    atom_first, atom_ids = _first_indices(residue_ids, records.names)
+    counts = np.bincount(atom_ids)
+    selected = np.flatnonzero(atom_first == np.arange(n))
+    duplicated = counts[atom_ids[selected]] > 1
+    if np.any(duplicated):
+        selected = selected.copy()
+        for i in np.flatnonzero(duplicated):
+            selected[i] = _select_altloc(records, np.flatnonzero(atom_ids == atom_ids[selected[i]]))
+
+    order = np.lexsort(
+        (atom_first[selected], residue_first[selected], chain_first[selected])
+    )
+    return selected[order]
+
+
+def _select_altloc(records: _AtomRecords, rows: np.ndarray) -> int:
+    """
+    The record of the alternate location of an atom Biopython selects: the
+    highest occupancy, the first one on ties
+    """
+    altlocs = records.altlocs[rows]
+    if np.any(altlocs == " "):
+        raise UnsupportedStructureError("atoms defined twice, or with a blank altloc")
+    if np.unique(altlocs).shape[0] != altlocs.shape[0]:
+        raise UnsupportedStructureError("alternate locations defined twice")
+    if np.unique(records.fullnames[rows]).shape[0] != 1:
+        raise UnsupportedStructureError("atom names that differ only in spaces")
+    occupancies = records.occupancies[rows]
+    if np.any(np.isnan(occupancies)):
+        raise UnsupportedStructureError("missing occupancies")
+    return rows[np.argmax(occupancies)]
+
+
+def _assign_elements(
+    elements: np.ndarray, names: np.ndarray, fullnames: np.ndarray
+) -> np.ndarray:
+    """
+    Elements of the atoms, guessed from their names when missing or unknown,
+    as `Bio.PDB.Atom.Atom._assign_element`
+    """
+    elements = elements.copy()
+    known = np.isin(np.char.capitalize(elements), list(IUPACData.atom_weights))
+    for i in np.flatnonzero(~known):
+        name, fullname = names[i], fullnames[i]
+        if fullname[0].isalpha() and not fullname[2:].isdigit():
+            putative = name.strip()
+        elif name[0].isdigit():
+            putative = name[1]
+        else:
+            putative = name[0]
+        elements[i] = putative if putative.capitalize() in IUPACData.atom_weights else "X"
+    return elements
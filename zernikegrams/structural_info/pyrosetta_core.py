@@ -4,9 +4,10 @@ import numpy as np
 import numpy.typing as npt
 from typing import *
 
+from functools import lru_cache
+
 import pyrosetta
 init_flags = '-ignore_unrecognized_res 1 -include_current -ex1 -ex2 -mute all -include_sugars -ignore_zero_occupancy false -obey_ENDMDL 1'
-pyrosetta.init(init_flags, silent=True)
 
 from pyrosetta.rosetta.core.pose import Pose
 from pyrosetta.rosetta.core.id import AtomID_Map_double_t, AtomID_Map_bool_t
@@ -19,6 +20,12 @@ logger = logging.getLogger(__name__)
 from zernikegrams.structural_info.structural_info_core import get_chi_angles_and_norm_vecs, CHARGES_AMBER99SB
 
 
+@lru_cache(maxsize=None)
+def init_pyrosetta() -> None:
+    """Initializes pyrosetta once per process, on the first call"""
+    pyrosetta.init(init_flags, silent=True)
+
+
 def calculate_sasa(
     pose : Pose,
     probe_radius : float=1.4
@@ -50,18 +57,24 @@ def get_structural_info_from_protein__pyrosetta(
     # hydrogens: bool = False,
     # extra_molecules: bool = True,
     # multi_struct: str = "warn",
+    pdb_data: Optional[bytes] = None,
     **kwargs
  ) -> Tuple[str, Tuple[npt.NDArray, npt.NDArray, npt.NDArray, npt.NDArray]]:
-    ## comment out these three lines for faster, bulk processing with pyrosetta, and uncomment the lines at the top of the script
-    # import pyrosetta
-    # init_flags = '-ignore_unrecognized_res 1 -include_current -ex1 -ex2 -mute all -include_sugars -ignore_zero_occupancy false -obey_ENDMDL 1'
-    # pyrosetta.init(init_flags, silent=True)
+    # no-op after the first call, e.g. in the workers of get_structural_info
+    init_pyrosetta()
 
     from pyrosetta.toolbox.extract_coords_pose import pose_coords_as_rows
     from pyrosetta.rosetta.core.id import AtomID
     from pyrosetta.rosetta.protocols.moves import DsspMover
 
-    pose = pyrosetta.pose_from_pdb(pdb_file)
+    if pdb_data is None:
+        pose = pyrosetta.pose_from_pdb(pdb_file)
+    else:
+        # read in memory, named after pdb_file
+        pose = Pose()
+        pyrosetta.rosetta.core.import_pose.pose_from_pdbstring(
+            pose, pdb_data.decode("utf-8"), pdb_file
+        )
 
     # lists for each type of information to obtain
     atom_names = []
@@ -182,4 +195,5 @@ def get_structural_info_from_protein__pyrosetta(
         np.array(
             [0] # just there for compatibility, assuming only one model in the file
         ), 
+        np.array([0]),  # is_bypassed, not cleaned by pdbfixer
     )
\ No newline at end of file
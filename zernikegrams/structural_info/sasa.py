@@ -0,0 +1,248 @@
+"""
+Vectorized Shrake-Rupley solvent accessible surface areas.
+
+Same algorithm and parameters as `Bio.PDB.SASA.ShrakeRupley`, on arrays of
+coordinates and elements instead of a Structure:
+
+    - every atom is a sphere of its radius plus the probe radius, with
+      n_points points of the golden spiral on its surface
+    - a point is buried if it is within the sphere of a neighbor, an atom
+      closer than the sum of the two radii, see `get_neighbor_pairs`
+    - the area of an atom is its sphere area times its share of points that
+      are not buried
+
+The neighbors are found with a cell list instead of a KD tree, and the points
+of a block of atoms are tested against all their neighbors at once, see
+`shrake_rupley`. Blocks run in threads for large complexes.
+"""
+
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import *
+
+import numpy as np
+from Bio.PDB.SASA import ATOMIC_RADII
+
+from zernikegrams.utils import log_config as logging
+
+logger = logging.getLogger(__name__)
+
+PROBE_RADIUS = 1.40
+N_POINTS = 100
+# atoms whose points are tested at once
+BLOCK_ATOMS = 256
+# number of atoms above which blocks run in threads
+THREADED_ATOMS = 50000
+MAX_THREADS = 4
+
+
+def get_sphere_points(n_points: int = N_POINTS) -> np.ndarray:
+    """
+    n_points points on the unit sphere, placed with the golden spiral as in
+    `Bio.PDB.SASA.ShrakeRupley`
+    """
+    k = np.arange(n_points)
+    dz = 2.0 / n_points
+    z = 1 - dz / 2 - k * dz
+    longitude = k * (math.pi * (3 - 5**0.5))
+    r = np.sqrt(1 - z * z)
+    return np.stack(
+        [np.cos(longitude) * r, np.sin(longitude) * r, z], axis=1
+    ).astype(np.float32)
+
+
+def get_radii(
+    elements: np.ndarray,
+    probe_radius: float = PROBE_RADIUS,
+    radii_dict: Optional[Dict[str, float]] = None,
+) -> np.ndarray:
+    """Radii of the atoms of elements plus the probe radius"""
+    radii = ATOMIC_RADII.copy()
+    if radii_dict is not None:
+        radii.update(radii_dict)
+    elements = np.asarray(elements)
+    if elements.dtype.kind == "S":
+        elements = np.char.decode(elements, "utf-8")
+    unique, inverse = np.unique(elements, return_inverse=True)
+    return (
+        np.array([radii[element] for element in unique], dtype=np.float64)[
+            inverse.reshape(-1)
+        ]
+        + probe_radius
+    )
+
+
+def get_neighbor_pairs(
+    coords: np.ndarray,
+    radii: np.ndarray,
+    atoms: np.ndarray,
+    cells: Optional[Tuple] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Pairs (i, j) of atoms i of atoms and all atoms j != i closer than
+    radii[i] + radii[j], sorted by i, found in a cell list of cells of the
+    largest such distance
+
+    Parameters
+    ----------
+    coords : np.ndarray
+        [num_atoms, 3] coordinates
+    radii : np.ndarray
+        [num_atoms] radii, see `get_radii`
+    atoms : np.ndarray
+        Sorted indices of the atoms to find the neighbors of
+    cells : tuple, optional
+        Cell list of the atoms, see `get_cells`, built if not given
+    """
+    if cells is None:
+        cells = get_cells(coords, radii)
+    cells, cell_starts, cell_order, cell_keys = cells
+    offsets = np.array(
+        [(x, y, z) for x in (-1, 0, 1) for y in (-1, 0, 1) for z in (-1, 0, 1)]
+    )
+
+    firsts, seconds = [], []
+    for offset in offsets:
+        keys = _cell_key(cells[atoms] + offset, cell_keys[1])
+        pos = np.searchsorted(cell_keys[0], keys)
+        pos = np.minimum(pos, cell_keys[0].shape[0] - 1)
+        found = cell_keys[0][pos] == keys
+        starts = np.where(found, cell_starts[pos], 0)
+        counts = np.where(found, cell_starts[pos + 1] - cell_starts[pos], 0)
+        # the atoms of the neighbor cell of every atom
+        first = np.repeat(atoms, counts)
+        run_starts = np.repeat(np.cumsum(counts) - counts, counts)
+        second = cell_order[
+            np.repeat(starts, counts) + np.arange(first.shape[0]) - run_starts
+        ]
+        firsts.append(first)
+        seconds.append(second)
+
+    first = np.concatenate(firsts)
+    second = np.concatenate(seconds)
+    dist2 = np.sum((coords[first] - coords[second]) ** 2, axis=1)
+    close = (first != second) & (dist2 < (radii[first] + radii[second]) ** 2)
+    first, second = first[close], second[close]
+    order = np.argsort(first, kind="stable")
+    return first[order], second[order]
+
+
+def _cell_key(cells: np.ndarray, shape: np.ndarray) -> np.ndarray:
+    # cells outside of the grid get keys no cell has
+    outside = np.any((cells < 0) | (cells >= shape), axis=1)
+    keys = (cells[:, 0] * shape[1] + cells[:, 1]) * shape[2] + cells[:, 2]
+    return np.where(outside, -1, keys)
+
+
+def get_cells(coords: np.ndarray, radii: np.ndarray) -> Tuple:
+    """
+    Cell list of the atoms, reused by all the blocks: the cell of every atom,
+    and the atoms of every cell, see `get_neighbor_pairs`
+    """
+    size = 2 * float(np.max(radii))
+    cells = np.floor((coords - coords.min(axis=0)) / size).astype(np.int64)
+    shape = cells.max(axis=0) + 1
+    keys = _cell_key(cells, shape)
+    cell_order = np.argsort(keys, kind="stable")
+    unique, starts = np.unique(keys[cell_order], return_index=True)
+    cell_starts = np.append(starts, keys.shape[0])
+    return cells, cell_starts, cell_order, (unique, shape)
+
+
+def _count_accessible(
+    coords: np.ndarray,
+    radii: np.ndarray,
+    sphere: np.ndarray,
+    cells: Tuple,
+    atoms: np.ndarray,
+) -> np.ndarray:
+    """Number of points of the spheres of atoms that are not buried"""
+    first, second = get_neighbor_pairs(coords, radii, atoms, cells)
+    buried = np.zeros((atoms.shape[0], sphere.shape[0]), dtype=bool)
+    if first.shape[0]:
+        # point s of the sphere of i is within the sphere of j if
+        # |r_i s + c_i - c_j|^2 <= r_j^2, expanded so that the products of the
+        # points and the offsets c_i - c_j are one matrix product
+        offsets = coords[first] - coords[second]
+        sphere = sphere.astype(np.float64)
+        r_i = radii[first, None]
+        buried_by = 2 * r_i * (offsets @ sphere.T) + r_i**2 * np.sum(
+            sphere**2, axis=1
+        ) <= (radii[second] ** 2 - np.sum(offsets**2, axis=1))[:, None]
+        runs = np.flatnonzero(np.diff(first, prepend=-1))
+        buried[np.searchsorted(atoms, first[runs])] = np.logical_or.reduceat(
+            buried_by, runs, axis=0
+        )
+    return sphere.shape[0] - np.sum(buried, axis=1)
+
+
+def shrake_rupley(
+    coords: np.ndarray,
+    elements: np.ndarray,
+    probe_radius: float = PROBE_RADIUS,
+    n_points: int = N_POINTS,
+    radii_dict: Optional[Dict[str, float]] = None,
+    residues: Optional[np.ndarray] = None,
+    block_atoms: int = BLOCK_ATOMS,
+    threads: Optional[int] = None,
+) -> np.ndarray:
+    """
+    Solvent accessible surface area of every atom, see the module docstring
+
+    Parameters
+    ----------
+    coords : np.ndarray
+        [num_atoms, 3] coordinates
+    elements : np.ndarray
+        [num_atoms] elements, as `Bio.PDB.Atom.element`
+    probe_radius : float
+        Radius of the probe, about the one of a water molecule
+    n_points : int
+        Number of points per sphere: fewer points are faster, and less precise
+    radii_dict : dict, optional
+        Radii of elements, replacing the ones of `Bio.PDB.SASA.ATOMIC_RADII`
+    residues : np.ndarray, optional
+        [num_atoms] index of the residue of every atom. If given, returns the
+        area of every residue, the sum of the areas of its atoms.
+    block_atoms : int
+        Number of atoms whose points are tested at once
+    threads : int, optional
+        Number of threads running the blocks, by default more than one only
+        for complexes of more than THREADED_ATOMS atoms
+
+    Returns
+    -------
+    np.ndarray
+        [num_atoms] areas, or [num_residues] areas if residues is given
+    """
+    if probe_radius <= 0.0:
+        raise ValueError(f"Probe radius must be a positive number: {probe_radius} <= 0")
+    if n_points < 1:
+        raise ValueError(f"Number of sphere points must be larger than 1: {n_points}")
+    coords = np.asarray(coords, dtype=np.float64)
+    num_atoms = coords.shape[0]
+    if num_atoms == 0:
+        raise ValueError("Entity has no child atoms.")
+
+    radii = get_radii(elements, probe_radius, radii_dict)
+    sphere = get_sphere_points(n_points)
+    if threads is None:
+        threads = 1 if num_atoms < THREADED_ATOMS else min(MAX_THREADS, os.cpu_count() or 1)
+
+    blocks = [
+        np.arange(start, min(start + block_atoms, num_atoms))
+        for start in range(0, num_atoms, block_atoms)
+    ]
+    cells = get_cells(coords, radii)
+    count = lambda atoms: _count_accessible(coords, radii, sphere, cells, atoms)
+    if threads > 1:
+        with ThreadPoolExecutor(threads) as executor:
+            counts = list(executor.map(count, blocks))
+    else:
+        counts = list(map(count, blocks))
+
+    sasas = np.concatenate(counts) * (radii * radii * (4 * np.pi / n_points))
+    if residues is not None:
+        return np.bincount(residues, weights=sasas)
+    return sasas
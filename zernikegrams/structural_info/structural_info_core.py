@@ -5,20 +5,22 @@ import io
 import subprocess
 import shutil
 
-from contextlib import contextmanager
+from multiprocessing.util import Finalize
 
 from Bio.PDB import (
+    MMCIFParser,
     PDBParser,
-    SASA,
     PDBIO
 )
-from Bio.PDB.DSSP import dssp_dict_from_pdb_file
+from Bio.PDB.DSSP import _make_dssp_dict, dssp_dict_from_pdb_file
+from Bio.PDB.Model import Model
 from collections import defaultdict
-from functools import partial
+from functools import lru_cache, partial
 from typing import (
     Dict,
     Tuple,
     List,
+    Optional,
 )
 import pdbfixer
 
@@ -26,20 +28,31 @@ import numpy as np
 import numpy.typing as npt
 
 from zernikegrams.utils import log_config as logging
-from zernikegrams.structural_info.RaSP import clean_pdb
+from zernikegrams.structural_info.RaSP import clean_structure, warm_up
+from zernikegrams.structural_info.native_parser import (
+    AtomColumns,
+    UnsupportedStructureError,
+    get_structure_columns,
+    is_mmcif,
+    read_atom_columns,
+)
+from zernikegrams.structural_info.sasa import N_POINTS, shrake_rupley
+from zernikegrams.structural_info import dssp
 
 logger = logging.getLogger(__name__)
 
 REDUCER = "reduce"
+# "reduce" adds hydrogens with reduce and pdbfixer, "builtin" places them in
+# process, see `zernikegrams.structural_info.hydrogens`
+HYDROGEN_ENGINES = ("reduce", "builtin")
+# added by read-only apptainer to directories, see `get_pdbfixer_dir`
+WHITEOUT = ".wh..wh..opq"
 
 DSSP = "mkdssp"
-DSSP_VERSION = (
-    subprocess.run(
-        f"{DSSP} --version".split(), capture_output=True
-    )
-    .stdout.decode()
-    .strip(f"mkdssp version ")
-)
+# "mkdssp" runs DSSP, "builtin" assigns the secondary structure in process,
+# see `zernikegrams.structural_info.dssp`, until it is checked against the
+# stored outputs of mkdssp, see tests/struct_info/test_dssp.py
+DSSP_ENGINES = ("mkdssp", "builtin")
 
 ##################### Copied from https://github.com/nekitmm/DLPacker/blob/main/utils.py
 # read in the charges from special file
@@ -55,6 +68,16 @@ with open(
             else:
                 l = re.split(r" +", line[:-1])
                 CHARGES_AMBER99SB[key][l[1]] = float(l[3])
+
+# the same charges as a table of sorted "RESNAME ATOMNAME" keys, see `get_charges`
+_charges = sorted(
+    (f"{resname} {atom_name}", charge)
+    for resname, res_charges in CHARGES_AMBER99SB.items()
+    for atom_name, charge in res_charges.items()
+)
+CHARGE_KEYS = np.array([key for key, _ in _charges])
+CHARGE_VALUES = np.array([charge for _, charge in _charges], dtype=float)
+del _charges
 ################################################################################
 
 
@@ -192,28 +215,197 @@ def get_chi_angles_and_norm_vecs(
     return chis, vecs
 
 
-def remove_waters_pdb(original: str, waterless: str, header: bool = False) -> None:
+def _get_chi_angles(
+    plane_norms_1: npt.NDArray,
+    plane_norms_2: npt.NDArray,
+    a2: npt.NDArray,
+    a3: npt.NDArray,
+) -> npt.NDArray:
+    """`get_chi_angle` of rows of plane norms and atom places"""
+    eps = 1e-6
+
+    sign_with_magnitude = np.sum((a3 - a2) * np.cross(plane_norms_1, plane_norms_2), axis=-1)
+    sign = sign_with_magnitude / (np.abs(sign_with_magnitude) + eps)
+
+    dot = np.sum(plane_norms_1 * plane_norms_2, axis=-1) / (
+        np.linalg.norm(plane_norms_1, axis=-1) * np.linalg.norm(plane_norms_2, axis=-1)
+    )
+    return np.degrees(sign * np.arccos(dot * (1 - eps)))
+
+
+def get_chi_angles_and_norm_vecs_of_residues(
+    resnames: npt.NDArray,
+    atom_residues: npt.NDArray,
+    atom_names: npt.NDArray,
+    coords: npt.NDArray,
+    pdb: str,
+) -> Tuple[npt.NDArray, npt.NDArray]:
     """
-    Removes water atoms from a pdb file
+    `get_chi_angles_and_norm_vecs` of many residues at once, with the
+    products of all the residues of the same name batched
+
+    Parameters
+    ----------
+    resnames : np.ndarray
+        [num_residues] names of the residues
+    atom_residues : np.ndarray
+        [num_atoms] index of the residue of every atom
+    atom_names : np.ndarray
+        [num_atoms] names of the atoms, without padding. Of the atoms of the
+        same name in a residue, the last one is used.
+    coords : np.ndarray
+        [num_atoms, 3] coordinates
+    pdb: str
+        Name of protein (logging use only)
+
+    Returns
+    -------
+    np.ndarray
+        [num_residues, 4] chi angles
+    np.ndarray
+        [num_residues, 5, 3] normal vectors
+    """
+    num_residues = resnames.shape[0]
+    vecs = np.full((num_residues, 5, 3), np.nan, dtype=float)
+    chis = np.full((num_residues, 4), np.nan, dtype=float)
+
+    # the last atom of every name of every residue
+    keys = np.char.add(np.char.add(atom_residues.astype(str), ":"), atom_names.astype(str))
+    keys, last = np.unique(keys[::-1], return_index=True)
+    last = atom_residues.shape[0] - 1 - last
+
+    def get_places(residues, atom_name):
+        wanted = np.char.add(residues.astype(str), ":" + atom_name)
+        pos = np.minimum(np.searchsorted(keys, wanted), keys.shape[0] - 1)
+        found = keys[pos] == wanted
+        return coords[last[pos]], found
+
+    for resname, triples in VEC_AA_ATOM_DICT.items():
+        residues = np.flatnonzero(resnames == resname)
+        if residues.shape[0] == 0:
+            continue
+        places, found = {}, {}
+        for atom_name in sorted(set(name for triple in triples for name in triple)):
+            places[atom_name], found[atom_name] = get_places(residues, atom_name)
+        complete = np.all(list(found.values()), axis=0)
+        for i in np.flatnonzero(~complete):
+            missing = [atom_name for atom_name in found if not found[atom_name][i]]
+            logger.warning(
+                f"Failed to calculate chi angles/normal vectors for a {resname} in {pdb}: missing atoms {missing}. "
+                "The remaining structural info for this protein, including other chi angles, is likely still valid."
+            )
+        residues = residues[complete]
+        places = {name: place[complete] for name, place in places.items()}
+
+        for i, (name_1, name_2, name_3) in enumerate(triples):
+            x = np.cross(places[name_1] - places[name_2], places[name_3] - places[name_2])
+            vecs[residues, i] = x / np.linalg.norm(x, axis=-1, keepdims=True)
+
+        for i in range(len(triples) - 1):
+            chis[residues, i] = _get_chi_angles(
+                vecs[residues, i],
+                vecs[residues, i + 1],
+                places[triples[i][1]],
+                places[triples[i][2]],
+            )
+
+    return chis, vecs
+
+
+def get_charges(resnames: npt.NDArray, atom_names: npt.NDArray) -> npt.NDArray:
+    """
+    AMBER99SB charges of atoms, gathered from the table CHARGE_KEYS by the
+    names of their residues and their own, 0 for unknown ones as in
+    CHARGES_AMBER99SB
+    """
+    keys = np.char.add(
+        np.char.add(resnames.astype(str), " "), np.char.upper(atom_names.astype(str))
+    )
+    pos = np.minimum(np.searchsorted(CHARGE_KEYS, keys), CHARGE_KEYS.shape[0] - 1)
+    return np.where(CHARGE_KEYS[pos] == keys, CHARGE_VALUES[pos], 0.0)
+
+
+@lru_cache(maxsize=None)
+def get_dssp_version() -> str:
+    """Version of mkdssp, only queried when it is used"""
+    return (
+        subprocess.run([DSSP, "--version"], capture_output=True)
+        .stdout.decode()
+        .strip("mkdssp version ")
+    )
+
+
+def get_mkdssp_dict(pdb_file: str, pdb_data: Optional[bytes] = None) -> Dict:
+    """
+    DSSP dictionary of pdb_file, see `Bio.PDB.DSSP.dssp_dict_from_pdb_file`,
+    or of its contents pdb_data if given, piped to DSSP
+    """
+    if pdb_data is None:
+        return dssp_dict_from_pdb_file(pdb_file, DSSP=DSSP, dssp_version=get_dssp_version())[0]
+
+    if get_dssp_version() < "4":
+        cmd = [DSSP, "/dev/stdin"]
+    else:
+        cmd = [DSSP, "--output-format=dssp", "/dev/stdin"]
+    p = subprocess.run(cmd, input=pdb_data, capture_output=True)
+    out, err = p.stdout.decode(), p.stderr.decode()
+    if err.strip():
+        logger.warning(err)
+        if not out.strip():
+            raise Exception("DSSP failed to produce an output")
+    return _make_dssp_dict(io.StringIO(out))[0]
+
+
+def get_dssp_dict(
+    pdb_file: str,
+    pdb_data: Optional[bytes] = None,
+    atoms: Optional[Tuple[npt.NDArray, ...]] = None,
+    engine: str = "mkdssp",
+) -> Dict:
+    """
+    DSSP dictionary of pdb_file, keyed by (chain, (" ", resnum, icode))
+
+    Params:
+        - pdb_file: path to pdb file
+        - pdb_data: if set, contents of pdb_file
+        - atoms: (chains, resnums, icodes, resnames, atom_names, coords) of the
+          atoms of pdb_file, used by the builtin engine
+        - engine: one of DSSP_ENGINES
+    """
+    if engine == "builtin":
+        return dssp.get_dssp_dict(*atoms)
+    elif engine == "mkdssp":
+        return get_mkdssp_dict(pdb_file, pdb_data)
+    else:
+        raise ValueError(f"Unknown DSSP engine {engine}")
+
+
+def remove_waters(model: Model) -> None:
+    """Removes the water residues of a model"""
+    for chain in list(model):
+        for residue in [residue for residue in chain if residue.resname == "HOH"]:
+            chain.detach_child(residue.id)
+        if len(chain) == 0:
+            model.detach_child(chain.id)
+
+
+def get_pdb_data(entity, header: bool = False) -> bytes:
+    """
+    Contents of a PDB file of entity, e.g. to pipe to DSSP
 
-    Original: path to pdb file with original data
-    waterless: path where new PDB file will be written
     header: add a dummy header
     """
     with io.StringIO() as buffer:
         if header:
             buffer.write("HEADER dummy header for DSSP\n")
-        with open(original, "r") as f_in:
-            for line in f_in.readlines():
-                if "HOH" not in line:
-                    buffer.write(line)
-
-        with open(waterless, "w") as f_out:
-            print(buffer.getvalue(), file=f_out)
+        pdbio = PDBIO()
+        pdbio.set_structure(entity)
+        pdbio.save(buffer)
+        return buffer.getvalue().encode("utf-8")
 
 
-@contextmanager
-def remove_whiteout(tmp_dir):
+@lru_cache(maxsize=None)
+def get_pdbfixer_dir() -> str:
     """
     In read-only apptainer, a "whiteout" file '.wh..wh..opq'
     is added to some directories. pdbfixer relies on enumerating and
@@ -221,32 +413,59 @@ def remove_whiteout(tmp_dir):
     So we should remove this file manually and hope its not important.
     Or make a PR request to pdbfixer.
 
-    By definition, cannot edit read-only FS. So we're doing this
+    By definition, cannot edit read-only FS. So the package is copied, once
+    per process, to a temporary directory removed when the process exits.
+
+    Returns the directory of pdbfixer without whiteout files
     """
+    root = os.path.dirname(pdbfixer.pdbfixer.__file__)
+    if not os.path.exists(os.path.join(root, "templates", WHITEOUT)):
+        return root
+
+    tmp_dir = tempfile.mkdtemp(prefix="pdbfixer-")
+    Finalize(None, shutil.rmtree, args=(tmp_dir, True), exitpriority=0)
+    shutil.copytree(root, tmp_dir, dirs_exist_ok=True)
+    for root, dirs, files in os.walk(tmp_dir):
+        for filename in files:
+            if WHITEOUT in filename:
+                os.remove(os.path.join(root, filename))
+    return tmp_dir
 
-    def copy_to_tmp():
-        pdbfixer_true_path = pdbfixer.pdbfixer.__file__
-        root = os.path.dirname(pdbfixer_true_path)
 
-        if os.path.exists(os.path.join(root, "templates/.wh..wh..opq")):
-            shutil.copytree(root, tmp_dir, dirs_exist_ok=True)
+def relocate_pdbfixer(pdbfixer_dir: Optional[str] = None) -> str:
+    """
+    Points pdbfixer to a directory without whiteout files, for the rest of the process
 
-            for root, dirs, files in os.walk(tmp_dir):
-                for filename in files:
-                    if ".wh..wh..opq" in filename:
-                        file_path = os.path.join(root, filename)
-                        os.remove(file_path)
+    Params:
+        - pdbfixer_dir: directory returned by `get_pdbfixer_dir` in another
+            process of the run (e.g. the parent of a pool), or None to get it here
 
-            open(f"{tmp_dir}/fake_file", "a").close()
-            pdbfixer.pdbfixer.__file__ = f"{tmp_dir}/fake_file"
+    Returns the directory pdbfixer now loads its templates from
+    """
+    if pdbfixer_dir is None:
+        pdbfixer_dir = get_pdbfixer_dir()
+    pdbfixer.pdbfixer.__file__ = os.path.join(pdbfixer_dir, "pdbfixer.py")
+    return pdbfixer_dir
 
-        return pdbfixer_true_path
 
+def warm_up_pdbfixer(
+    hydrogens: bool = False, pdbfixer_dir: Optional[str] = None
+) -> None:
+    """
+    Relocates pdbfixer and loads the OpenMM force fields and templates
+    that cleaning structures uses, see `RaSP.warm_up`.
+    Failures are logged, and left to the first structure to raise again.
+
+    Params:
+        - hydrogens: whether the structures get hydrogens added
+        - pdbfixer_dir: see `relocate_pdbfixer`
+    """
     try:
-        true_path = copy_to_tmp()
-        yield
-    finally:
-        pdbfixer.pdbfixer.__file__ = true_path
+        relocate_pdbfixer(pdbfixer_dir)
+        warm_up(hydrogens)
+    except Exception as e:
+        logger.warning(f"Could not warm up pdbfixer: {e}")
+
 
 def get_structural_info_from_protein(*args, parser='biopython', **kwargs):
     if parser == 'biopython':
@@ -268,6 +487,10 @@ def get_structural_info_from_protein__biopython(
     extra_molecules: bool = True,
     multi_struct: str = "warn",
     fixed_pdb_dir: str = None,
+    pdb_data: Optional[bytes] = None,
+    sasa_points: int = N_POINTS,
+    dssp_engine: str = "mkdssp",
+    hydrogen_engine: str = "reduce",
 ) -> Tuple[str, Tuple[npt.NDArray, npt.NDArray, npt.NDArray, npt.NDArray]]:
     """
     Params:
@@ -278,36 +501,72 @@ def get_structural_info_from_protein__biopython(
         - extra_molecules: if set, extra_molecules are left in
         - multi_struct: Behavior for handling PDBs with multiple structures
         - fixed_pdb_dir: directory to save fixed pdbs
+        - pdb_data: if set, contents of pdb_file, which is only used as its name,
+          e.g. when read from an archive, see `zernikegrams.preprocessors.archives`
+        - sasa_points: number of points per atom of the SASA, see
+          `zernikegrams.structural_info.sasa`
+        - dssp_engine: "mkdssp" to run DSSP, or "builtin" to assign the
+          secondary structure in process, see `zernikegrams.structural_info.dssp`
+        - hydrogen_engine: one of HYDROGEN_ENGINES, used if hydrogens is set
 
     Returns:
-        Tuple of (pdb, (atom_names, elements, res_ids, coords, sasas, charges, res_ids_per_residue, angles, norm_vecs, is_multi_model [1 or 0] ))
+        Tuple of (pdb, (atom_names, elements, res_ids, coords, sasas, charges, res_ids_per_residue, angles, norm_vecs, is_multi_model [1 or 0], is_bypassed [1 or 0] ))
 
     By default, biopyton selects only atoms with the highest occupancy, thus behaving like pyrosetta does with the flag "-ignore_zero_occupancy false"
+
+    Files that are used as is are read into columns by `native_parser`,
+    falling back to Biopython for the files it does not support. The atoms of
+    the structures Biopython reads, fixed or not, are then put into columns
+    too, see `get_structural_info_from_columns`.
     """
-    parser = PDBParser(QUIET=True)
+    parser = MMCIFParser(QUIET=True) if is_mmcif(pdb_file) else PDBParser(QUIET=True)
 
     pdb_name = pdb_file[:-4]
-    L = len(pdb_name)
 
+    if not (fix or hydrogens) and fixed_pdb_dir is None:
+        try:
+            columns = read_atom_columns(pdb_file, pdb_data)
+        except UnsupportedStructureError as e:
+            logger.debug(f"{e}. Parsing it with Biopython.")
+        else:
+            return get_structural_info_from_columns(
+                pdb_file,
+                columns,
+                calculate_SASA=calculate_SASA,
+                calculate_charge=calculate_charge,
+                calculate_DSSP=calculate_DSSP,
+                calculate_angles=calculate_angles,
+                multi_struct=multi_struct,
+                pdb_data=pdb_data,
+                sasa_points=sasa_points,
+                dssp_engine=dssp_engine,
+            )
+
+    bypassed = False
     if fix or hydrogens:
-        tmp = tempfile.NamedTemporaryFile()
-
-        with tempfile.TemporaryDirectory() as tmp_dir:
-            with remove_whiteout(tmp_dir):
-                clean_pdb(pdb_file, tmp.name, REDUCER, hydrogens, extra_molecules)
-
-        remove_waters_pdb(original=tmp.name, waterless=tmp.name, header=True)
-
-        pdb_file = tmp.name
-
-    structure = parser.get_structure(pdb_name, pdb_file)
-
+        # passed between the steps in memory, without waters
+        relocate_pdbfixer()
+        model, bypassed = clean_structure(
+            pdb_file,
+            REDUCER,
+            hydrogens,
+            extra_molecules,
+            pdb_data=pdb_data,
+            hydrogen_engine=hydrogen_engine,
+        )
+        remove_waters(model)
+        structure, models = model, [model]
+        if calculate_DSSP and dssp_engine == "mkdssp":
+            pdb_data = get_pdb_data(model, header=True)
+    elif pdb_data is None:
+        structure = parser.get_structure(pdb_name, pdb_file)
+        models = list(structure.get_models())
+    else:
+        structure = parser.get_structure(pdb_name, io.StringIO(pdb_data.decode("utf-8")))
+        models = list(structure.get_models())
 
-    # assume the pdb name was provided as id to create the structure
-    pdb = structure.get_id()
-    pdb = os.path.basename(pdb).replace(
-        "_", "-"
-    )  # "_" is reserved for the res_id delimiter later in pipeline
+    # "_" is reserved for the res_id delimiter later in pipeline
+    pdb = os.path.basename(pdb_name).replace("_", "-")
 
     if fixed_pdb_dir is not None:
         if not os.path.exists(fixed_pdb_dir):
@@ -317,121 +576,178 @@ def get_structural_info_from_protein__biopython(
         save_path = os.path.join(fixed_pdb_dir, f"{pdb}.pdb")
         pdbio.save(save_path)
 
-    models = list(structure.get_models())
-    if len(models) != 1:
-        if multi_struct == "crash":
-            raise ValueError(f"More than 1 model found for {pdb_file}")
-        else:
-            if multi_struct == "warn":
-                logger.warn(
-                    f"{len(models)} models found for {pdb_file}. Setting structure to the first model."
-                )
-            structure = models[0]
-
-    if calculate_SASA:
-        # Calculates SASAs with biopython; each atom will have a .sasa attribute
-        SASA.ShrakeRupley().compute(structure, level="A")
+    # the first model, warned about by get_structural_info_from_columns
+    columns = get_structure_columns(models[0], num_models=len(models))
 
     if calculate_DSSP:
-        dssp_dict, _dssp_keys = dssp_dict_from_pdb_file(pdb_file, DSSP=DSSP, dssp_version=DSSP_VERSION)
+        dssp_dict = get_dssp_dict(
+            pdb_file,
+            pdb_data,
+            atoms=(
+                columns.chains,
+                columns.resnums,
+                columns.icodes,
+                columns.resnames,
+                columns.atom_names,
+                columns.coords,
+            ),
+            engine=dssp_engine,
+        )
     else:
         dssp_dict = {}
 
-    if fix or hydrogens:
-        tmp.close()
+    return get_structural_info_from_columns(
+        pdb_file,
+        columns,
+        calculate_SASA=calculate_SASA,
+        calculate_charge=calculate_charge,
+        calculate_DSSP=calculate_DSSP,
+        calculate_angles=calculate_angles,
+        multi_struct=multi_struct,
+        pdb_data=pdb_data,
+        sasa_points=sasa_points,
+        dssp_engine=dssp_engine,
+        dssp_dict=dssp_dict,
+        is_bypassed=bypassed,
+    )
 
-    # lists for each type of information to obtain
-    atom_names = []
-    elements = []
-    sasas = []
-    coords = []
-    charges = []
-    res_ids = []
 
-    angles = []
-    vecs = []
-    res_ids_per_residue = []
+def get_structural_info_from_columns(
+    pdb_file: str,
+    columns: AtomColumns,
+    calculate_SASA: bool = True,
+    calculate_charge: bool = True,
+    calculate_DSSP: bool = True,
+    calculate_angles: bool = True,
+    multi_struct: str = "warn",
+    pdb_data: Optional[bytes] = None,
+    sasa_points: int = N_POINTS,
+    dssp_engine: str = "mkdssp",
+    dssp_dict: Optional[Dict] = None,
+    is_bypassed: bool = False,
+) -> Tuple[str, Tuple[npt.NDArray, npt.NDArray, npt.NDArray, npt.NDArray]]:
+    """
+    Structural info of the atoms of pdb_file read into columns, see
+    `native_parser`. The res_ids are built once per residue and broadcast to
+    its atoms, and the charges and chi angles are computed for all the atoms
+    at once.
+
+    Params:
+        - pdb_file: path to pdb file
+        - columns: atoms of the first model of pdb_file
+        - calculate_X: if set to false, go faster
+        - multi_struct: Behavior for handling PDBs with multiple structures
+        - pdb_data: if set, contents of pdb_file
+        - sasa_points: number of points per atom of the SASA
+        - dssp_engine: one of DSSP_ENGINES
+        - dssp_dict: if set, DSSP dictionary of the atoms, e.g. computed on
+          the fixed structure, see `get_dssp_dict`
+        - is_bypassed: whether the structure was fixed without pdbfixer,
+          see `RaSP.clean_structure`
 
-    chi_atoms = {}
+    Returns:
+        Tuple of (pdb, (atom_names, elements, res_ids, coords, sasas, charges, res_ids_per_residue, angles, norm_vecs, is_multi_model [1 or 0], is_bypassed [1 or 0] ))
+    """
+    pdb_name = pdb_file[:-4]
+    L = len(pdb_name)
+    # "_" is reserved for the res_id delimiter later in pipeline
+    pdb = os.path.basename(pdb_name).replace("_", "-")
+
+    if columns.num_models != 1:
+        if multi_struct == "crash":
+            raise ValueError(f"More than 1 model found for {pdb_file}")
+        elif multi_struct == "warn":
+            logger.warn(
+                f"{columns.num_models} models found for {pdb_file}. Setting structure to the first model."
+            )
+
+    if dssp_dict is None and calculate_DSSP:
+        dssp_dict = get_dssp_dict(
+            pdb_file,
+            pdb_data,
+            atoms=(
+                columns.chains,
+                columns.resnums,
+                columns.icodes,
+                columns.resnames,
+                columns.atom_names,
+                columns.coords,
+            ),
+            engine=dssp_engine,
+        )
+    elif dssp_dict is None:
+        dssp_dict = {}
 
-    def pad_for_consistency(string):
-        return string.ljust(4, " ")
+    num_atoms = columns.atom_names.shape[0]
 
-    # get structural info from each residue in the protein
-    for atom in structure.get_atoms():
-        atom_full_id = atom.get_full_id()
+    if calculate_SASA:
+        sasas = shrake_rupley(columns.coords, columns.elements, n_points=sasa_points)
+    else:
+        sasas = np.array([])
 
-        chain = atom_full_id[2]
-        resnum = atom_full_id[3][1]
-        icode = atom_full_id[3][2]
-        atom_name_unpadded = atom.get_name()
-        atom_name = pad_for_consistency(atom_name_unpadded)
-        element = atom.element
-        coord = atom.get_coord()
-        ss = dssp_dict.get((chain, (" ", resnum, " ")), ("_", "null"))[1]
+    # per residue, then broadcast to its atoms
+    residues, residue_inds, atom_residues = np.unique(
+        np.rec.fromarrays([columns.chains, columns.resnums, columns.icodes, columns.resnames]),
+        return_index=True,
+        return_inverse=True,
+    )
+    aas = np.array(
+        [aa_to_one_letter.get(resname, "Z") for resname in residues.f3], dtype="U1"
+    )
+    sss = np.array(
+        [
+            dssp_dict.get((chain, (" ", int(resnum), " ")), ("_", "null"))[1]
+            for chain, resnum in zip(residues.f0, residues.f1)
+        ],
+        dtype="U",
+    )
 
-        residue = atom.get_parent().resname
-        if residue in aa_to_one_letter:
-            aa = aa_to_one_letter[residue]
-        else:
-            aa = "Z"
-
-        res_id = np.array([aa, pdb, chain, resnum, icode, ss], dtype=f"S{L}")
-
-        res_key = tuple(res_id)
-        if res_key not in chi_atoms:
-            chi_atoms[res_key] = residue, {}
-        chi_atoms[res_key][1][atom_name_unpadded] = coord
-
-        atom_names.append(atom_name)
-        elements.append(element)
-        res_ids.append(res_id)
-        coords.append(coord)
-        if calculate_SASA:
-            sasas.append(atom.sasa)
-
-        if calculate_charge:
-            res_charges = CHARGES_AMBER99SB[residue]
-            if isinstance(res_charges, dict):
-                charge = res_charges[atom_name_unpadded.upper()]
-            elif isinstance(res_charges, float) or isinstance(res_charges, int):
-                charge = res_charges
-            else:
-                raise ValueError(
-                    f"Unknown charge type: {type(res_charges)}. Something must be wrong."
-                )
-            charges.append(charge)
+    res_ids = np.empty((num_atoms, 6), dtype=f"U{L}")
+    res_ids[:, 0] = aas[atom_residues]
+    res_ids[:, 1] = pdb
+    res_ids[:, 2] = columns.chains
+    res_ids[:, 3] = columns.resnums.astype(str)
+    res_ids[:, 4] = columns.icodes
+    res_ids[:, 5] = sss[atom_residues]
+    res_ids = res_ids.astype(f"S{L}")
+
+    if calculate_charge:
+        charges = get_charges(columns.resnames, columns.atom_names)
+    else:
+        charges = np.array([])
 
+    angles = []
+    vecs = []
+    res_ids_per_residue = []
     if calculate_angles:
-        for res_key, (resname, atoms) in chi_atoms.items():
-            res_ids_per_residue.append(np.array([*res_key], dtype=f"S{L}"))
-            chis, norms = get_chi_angles_and_norm_vecs(resname, atoms, pdb)
-            angles.append(chis)
-            vecs.append(norms)
-
-    atom_names = np.array(atom_names, dtype="|S4")
-    elements = np.array(elements, dtype="S1")
-    coords = np.array(coords)
-    res_ids = np.array(res_ids)
-    sasas = np.array(sasas)
-    charges = np.array(charges)
-    res_ids_per_residue = np.array(res_ids_per_residue)
-    angles = np.array(angles)
-    vecs = np.array(vecs)
+        # residues of the same res_id, in order of first appearance
+        unique_res_ids, first_atoms, atom_res_ids = np.unique(
+            res_ids, axis=0, return_index=True, return_inverse=True
+        )
+        order = np.argsort(first_atoms)
+        ranks = np.empty_like(order)
+        ranks[order] = np.arange(order.shape[0])
+        res_ids_per_residue = unique_res_ids[order]
+        angles, vecs = get_chi_angles_and_norm_vecs_of_residues(
+            columns.resnames[first_atoms[order]],
+            ranks[atom_res_ids.reshape(-1)],
+            columns.atom_names,
+            columns.coords,
+            pdb,
+        )
 
     return pdb, (
-        atom_names,
-        elements,
+        np.char.ljust(columns.atom_names, 4).astype("|S4"),
+        columns.elements.astype("S1"),
         res_ids,
-        coords,
+        columns.coords,
         sasas,
         charges,
-        res_ids_per_residue,
-        angles,
-        vecs,
-        np.array(
-            [0 if len(models) == 1 else 1]
-        ),  # necessary to compute number of pdbs with multiple structures
+        np.array(res_ids_per_residue),
+        np.array(angles),
+        np.array(vecs),
+        np.array([0 if columns.num_models == 1 else 1]),
+        np.array([1 if is_bypassed else 0]),
     )
 
 
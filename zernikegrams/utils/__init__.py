@@ -1 +1 @@
-from . import argparse, constants, conversions, log_config, pdb_lists, protein_naming, spherical_bases
\ No newline at end of file
+from . import argparse, constants, conversions, filters, hdf5_writer, log_config, pdb_lists, protein_naming, residue_selection, spherical_bases
\ No newline at end of file
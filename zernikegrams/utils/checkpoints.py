@@ -0,0 +1,184 @@
+"""
+Resumable stage runs.
+
+With resume, a stage records its progress in a manifest next to its output,
+<hdf5_out>.progress.json, at most every CHECKPOINT_SECONDS: the inputs that
+are done, the inputs that failed with the reason, and the number of rows of
+every dataset of the output. The rows buffered by the `BufferedHDF5Writer`
+are written and the file flushed before the manifest is replaced, so that
+the rows it counts are on disk.
+
+A restarted run with resume truncates the datasets to the rows of the
+manifest, dropping the rows of the inputs that were not recorded as done,
+skips the inputs that are done or failed, and appends the rest. The manifest
+records the parameters of the stage, and a run with other parameters does not
+resume.
+
+HDF5 files are not crash safe: an output killed in the middle of a write of
+its metadata may not open, and then the run must start over.
+"""
+
+import json
+import os
+import time
+from typing import *
+
+import h5py
+
+from zernikegrams.utils import log_config as logging
+from zernikegrams.utils.hdf5_writer import BufferedHDF5Writer
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_SECONDS = 300
+
+
+def get_manifest_path(hdf5_out: str) -> str:
+    return hdf5_out + ".progress.json"
+
+
+def _name(name: Union[str, bytes]) -> str:
+    return name.decode("utf-8") if isinstance(name, bytes) else str(name)
+
+
+class StageCheckpoint:
+    """
+    Progress of a stage writing hdf5_out, see the module docstring. Without
+    resume, nothing is recorded and the output is written from scratch.
+
+    Parameters
+    ----------
+    hdf5_out : str
+        Output of the stage
+    params : dict
+        Parameters of the stage that the output depends on
+    resume : bool
+        Whether to resume from the manifest, if any, and to record progress
+    persist_done : bool
+        Whether to record the inputs that are done in the manifest. Stages
+        with many inputs can instead read them from the rows of the output.
+    interval : float
+        Minimum seconds between two checkpoints
+    """
+
+    def __init__(
+        self,
+        hdf5_out: str,
+        params: Dict[str, Any],
+        resume: bool = False,
+        persist_done: bool = True,
+        interval: float = CHECKPOINT_SECONDS,
+    ):
+        self.hdf5_out = hdf5_out
+        self.path = get_manifest_path(hdf5_out)
+        # as read back from the manifest
+        self.params = json.loads(json.dumps(params, default=str))
+        self.enabled = resume
+        self.persist_done = persist_done
+        self.interval = interval
+        self.done: Set[str] = set()
+        self.failed: Dict[str, str] = {}
+        self.rows: Optional[Dict[str, int]] = None
+        self.last_save = time.monotonic()
+
+        if not resume:
+            # stale once the output is rewritten
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            return
+        if not (os.path.exists(self.path) and os.path.exists(hdf5_out)):
+            logger.info(f"No progress recorded for {hdf5_out}, starting from scratch")
+            return
+
+        with open(self.path) as f:
+            manifest = json.load(f)
+        if manifest["params"] != self.params:
+            raise ValueError(
+                f"{hdf5_out} was written with other parameters, "
+                f"{manifest['params']}, and cannot be resumed"
+            )
+        self.done = set(manifest["done"])
+        self.failed = manifest["failed"]
+        self.rows = manifest["rows"]
+        if persist_done:
+            logger.info(
+                f"Resuming {hdf5_out}: {len(self.done)} inputs done, "
+                f"{len(self.failed)} failed"
+            )
+        else:
+            logger.info(
+                f"Resuming {hdf5_out}: {max(self.rows.values(), default=0)} rows "
+                f"done, {len(self.failed)} inputs failed"
+            )
+
+    @property
+    def resuming(self) -> bool:
+        return self.rows is not None
+
+    def open(self) -> h5py.File:
+        """Output file, to append to when resuming"""
+        if not self.resuming:
+            return h5py.File(self.hdf5_out, "w")
+        try:
+            return h5py.File(self.hdf5_out, "r+")
+        except OSError as e:
+            raise OSError(
+                f"Cannot open {self.hdf5_out} to resume, it was probably "
+                f"interrupted during a write. Run again without resuming."
+            ) from e
+
+    def writer(self, f: h5py.File) -> BufferedHDF5Writer:
+        """Writer of the output, appending to the recorded rows when resuming"""
+        return BufferedHDF5Writer(f, resume_rows=self.rows)
+
+    def is_skipped(self, name: Union[str, bytes]) -> bool:
+        """Whether input name is done or failed"""
+        name = _name(name)
+        return name in self.done or name in self.failed
+
+    def update(
+        self,
+        writer: BufferedHDF5Writer,
+        done: Iterable[Union[str, bytes]] = (),
+        failed: Iterable[Tuple[Union[str, bytes], str]] = (),
+        save: Optional[Callable[[BufferedHDF5Writer], None]] = None,
+    ):
+        """
+        Records inputs whose rows were appended to writer as done, and failed
+        inputs with the reason, saving the progress if it is time to, with
+        save if given, which must call `save` after saving the other outputs
+        of the inputs done
+        """
+        if not self.enabled:
+            return
+        self.done.update(map(_name, done))
+        for name, reason in failed:
+            self.failed[_name(name)] = reason
+        if time.monotonic() - self.last_save >= self.interval:
+            (self.save if save is None else save)(writer)
+
+    def save(self, writer: BufferedHDF5Writer):
+        """Writes the rows appended to writer and saves the progress"""
+        if not self.enabled:
+            return
+        writer.flush()
+        manifest = {
+            "params": self.params,
+            "done": sorted(self.done) if self.persist_done else [],
+            "failed": self.failed,
+            "rows": {name: writer.size(name) for name in writer.buffers},
+        }
+        # replaced at once, so that an interrupted save keeps the previous one
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, self.path)
+        self.last_save = time.monotonic()
+        logger.debug(f"Saved the progress of {self.hdf5_out}")
+
+
+def replace_dataset(f: h5py.File, name: str, **kwargs) -> h5py.Dataset:
+    """Creates dataset name, replacing the one written by an earlier run"""
+    if name in f:
+        del f[name]
+    return f.create_dataset(name, **kwargs)
@@ -0,0 +1,92 @@
+"""
+Chain and residue predicates that are evaluated inside the workers, before
+neighbor search and projection, rather than on their outputs.
+"""
+
+from typing import *
+
+import numpy as np
+
+from zernikegrams.utils.residue_selection import ResidueSelection
+
+# residues whose sidechain is at most a CB
+RESIDUES_WITH_NO_SIDECHAIN = (b"G", b"A")
+
+
+class ResidueFilter:
+    """
+    Conjunction of the predicates on the central residue of a neighborhood.
+
+    Parameters
+    ----------
+    pdb_chain_pairs : set of str, optional
+        Only keep residues of these "pdb_chain" pairs.
+    excluded_residue_types : iterable of bytes, optional
+        One-letter codes of the residues to exclude.
+    residue_selection : ResidueSelection, optional
+        Only keep residues in the selection.
+    """
+
+    def __init__(
+        self,
+        pdb_chain_pairs: Optional[Set[str]] = None,
+        excluded_residue_types: Optional[Iterable[bytes]] = None,
+        residue_selection: Optional[ResidueSelection] = None,
+    ):
+        if pdb_chain_pairs is None:
+            self.pdb_chain_pairs = None
+        else:
+            self.pdb_chain_pairs = {pair.encode("utf-8") for pair in pdb_chain_pairs}
+        if excluded_residue_types is None:
+            self.excluded_residue_types = None
+        else:
+            self.excluded_residue_types = np.array(list(excluded_residue_types))
+        self.residue_selection = residue_selection
+
+    def __bool__(self) -> bool:
+        return (
+            self.pdb_chain_pairs is not None
+            or self.excluded_residue_types is not None
+            or self.residue_selection is not None
+        )
+
+    @property
+    def pdbs(self) -> Optional[Set[bytes]]:
+        """
+        The pdbs that can have passing residues, or None if any pdb can
+        """
+        pdbs = None
+        if self.pdb_chain_pairs is not None:
+            pdbs = {pair.rsplit(b"_", 1)[0] for pair in self.pdb_chain_pairs}
+        if self.residue_selection is not None:
+            if pdbs is None:
+                pdbs = self.residue_selection.pdbs
+            else:
+                pdbs &= self.residue_selection.pdbs
+        return pdbs
+
+    def select(self, res_ids: np.ndarray) -> np.ndarray:
+        """
+        Mask of the residue ids that pass all the predicates.
+
+        Parameters
+        ----------
+        res_ids : np.ndarray
+            Residue ids, shape [N, 6]
+
+        Returns
+        -------
+        np.ndarray of bool, shape [N]
+        """
+        mask = np.ones(res_ids.shape[0], dtype=bool)
+        if self.excluded_residue_types is not None:
+            mask &= ~np.isin(res_ids[:, 0], self.excluded_residue_types)
+        if self.pdb_chain_pairs is not None:
+            pdb_chains = np.char.add(np.char.add(res_ids[:, 1], b"_"), res_ids[:, 2])
+            mask &= np.array(
+                [pdb_chain in self.pdb_chain_pairs for pdb_chain in pdb_chains],
+                dtype=bool,
+            )
+        if self.residue_selection is not None:
+            mask &= self.residue_selection.select(res_ids)
+        return mask
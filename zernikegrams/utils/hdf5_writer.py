@@ -0,0 +1,236 @@
+"""
+Buffered, chunk-aligned writes of stage outputs to HDF5.
+
+Rows are appended to in-memory buffers that span a whole number of HDF5
+chunks. Full buffers are written by a background thread, so that every write
+covers whole chunks (each chunk is compressed exactly once) and compression
+overlaps with the collection of results from the workers.
+"""
+
+import queue
+import threading
+from typing import *
+
+import h5py
+from hdf5plugin import LZ4
+import numpy as np
+
+from zernikegrams.utils import log_config as logging
+
+logger = logging.getLogger(__name__)
+
+# in the range of the chunk sizes chosen by h5py, so that reading single rows
+# does not decompress much more than the row
+CHUNK_BYTES = 1 << 16
+FLUSH_BYTES = 1 << 22
+
+
+def get_chunk_rows(dtype: np.dtype, shape: Tuple = (), chunk_bytes: int = CHUNK_BYTES) -> int:
+    """Number of rows of the given dtype and shape in a chunk of about chunk_bytes"""
+    row_bytes = np.dtype(dtype).itemsize * int(np.prod(shape))
+    return max(1, chunk_bytes // max(1, row_bytes))
+
+
+class DatasetBuffer:
+    def __init__(self, dataset: h5py.Dataset, chunk_rows: int, buffer_rows: int):
+        self.dataset = dataset
+        self.chunk_rows = chunk_rows
+        self.buffer_rows = buffer_rows
+        self.dtype = dataset.dtype
+        self.shape = dataset.shape[1:]
+        self.buffer = np.zeros((buffer_rows, *self.shape), dtype=self.dtype)
+        # differs from shape for subarray dtypes, e.g. residue ids
+        self.row_shape = self.buffer.shape[1:]
+        self.filled = 0
+        # rows handed to the writer thread
+        self.flushed = 0
+
+    @property
+    def size(self) -> int:
+        return self.flushed + self.filled
+
+
+class BufferedHDF5Writer:
+    """
+    Appends rows to resizable datasets of an open HDF5 file.
+
+    The datasets created by the writer must not be accessed by other means
+    until the writer is closed. Used as a context manager, the writer is closed
+    on exit.
+
+    Parameters
+    ----------
+    f : h5py.File
+        File opened for writing
+    max_queued : int, default 4
+        Number of full buffers waiting to be written before `append` blocks
+    resume_rows : dict, optional
+        Rows to keep of datasets that already exist in f, by name, to append
+        to them instead of creating them, see `zernikegrams.utils.checkpoints`
+    """
+
+    def __init__(
+        self,
+        f: h5py.File,
+        max_queued: int = 4,
+        resume_rows: Optional[Dict[str, int]] = None,
+    ):
+        self.f = f
+        self.resume_rows = resume_rows
+        self.buffers: Dict[str, DatasetBuffer] = {}
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.error = None
+        self.thread = threading.Thread(target=self.__write_loop, daemon=True)
+        self.thread.start()
+
+    def create_dataset(
+        self,
+        name: str,
+        dtype: np.dtype,
+        shape: Tuple = (),
+        chunk_rows: Optional[int] = None,
+        **kwargs,
+    ) -> h5py.Dataset:
+        """
+        Creates an empty, resizable dataset of rows with the given dtype and
+        shape, chunked along the rows. Remaining keyword arguments are passed
+        to `h5py.File.create_dataset`.
+
+        When resuming, an existing dataset is truncated to its rows in
+        resume_rows (none if it has no entry) and appended to instead.
+        """
+        if self.resume_rows is not None and name in self.f:
+            return self.__open_dataset(name, dtype, shape)
+        if chunk_rows is None:
+            chunk_rows = get_chunk_rows(dtype, shape)
+        chunk_bytes = chunk_rows * np.dtype(dtype).itemsize * int(np.prod(shape))
+        chunks_per_buffer = max(1, FLUSH_BYTES // max(1, chunk_bytes))
+        kwargs.setdefault("compression", LZ4())
+        dataset = self.f.create_dataset(
+            name,
+            shape=(0, *shape),
+            maxshape=(None, *shape),
+            dtype=dtype,
+            chunks=(chunk_rows, *shape),
+            **kwargs,
+        )
+        self.buffers[name] = DatasetBuffer(
+            dataset, chunk_rows, chunk_rows * chunks_per_buffer
+        )
+        return dataset
+
+    def __open_dataset(self, name: str, dtype: np.dtype, shape: Tuple) -> h5py.Dataset:
+        dataset = self.f[name]
+        if dataset.dtype != np.dtype(dtype) or dataset.shape[1:] != tuple(shape):
+            raise ValueError(
+                f"Cannot resume {name}: it has dtype {dataset.dtype} and shape "
+                f"{dataset.shape[1:]} instead of {np.dtype(dtype)} and {tuple(shape)}"
+            )
+        rows = self.resume_rows.get(name, 0)
+        if dataset.shape[0] < rows:
+            raise ValueError(
+                f"Cannot resume {name}: it has {dataset.shape[0]} rows, fewer than "
+                f"the {rows} rows recorded"
+            )
+        # rows past the record are from inputs that were not recorded as done
+        dataset.resize((rows, *dataset.shape[1:]))
+        chunk_rows = dataset.chunks[0]
+        chunk_bytes = chunk_rows * dataset.dtype.itemsize * int(np.prod(shape))
+        chunks_per_buffer = max(1, FLUSH_BYTES // max(1, chunk_bytes))
+        buf = DatasetBuffer(dataset, chunk_rows, chunk_rows * chunks_per_buffer)
+        buf.flushed = rows
+        self.buffers[name] = buf
+        return dataset
+
+    def size(self, name: str) -> int:
+        """Number of rows appended to dataset name"""
+        return self.buffers[name].size
+
+    def append(self, name: str, rows: Union[np.ndarray, Sequence]):
+        """
+        Appends rows to dataset name. rows can also be a single row of a
+        compound dtype, given as a tuple.
+        """
+        self.__check_error()
+        buf = self.buffers[name]
+        if isinstance(rows, tuple):
+            rows = np.array([rows], dtype=buf.dtype)
+        else:
+            rows = np.asarray(rows)
+            if rows.shape == buf.row_shape:
+                rows = rows[None]
+
+        start = 0
+        while start < rows.shape[0]:
+            num = min(rows.shape[0] - start, buf.buffer_rows - buf.filled)
+            buf.buffer[buf.filled : buf.filled + num] = rows[start : start + num]
+            buf.filled += num
+            start += num
+            if buf.filled == buf.buffer_rows:
+                self.__flush(buf)
+
+    def __flush(self, buf: DatasetBuffer):
+        if buf.filled == 0:
+            return
+        self.queue.put((buf.dataset, buf.flushed, buf.buffer[: buf.filled]))
+        buf.flushed += buf.filled
+        buf.filled = 0
+        buf.buffer = np.zeros_like(buf.buffer)
+
+    def __write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is not None:
+                self.queue.task_done()
+                continue  # drain the queue after an error
+            dataset, start, rows = item
+            try:
+                end = start + rows.shape[0]
+                if end > dataset.shape[0]:
+                    dataset.resize((end, *dataset.shape[1:]))
+                dataset[start:end] = rows
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def __check_error(self):
+        if self.error is not None:
+            raise RuntimeError("Failed to write to HDF5 file") from self.error
+
+    def flush(self):
+        """
+        Writes all the rows appended so far, including partial buffers, and
+        flushes the file, so that they are on disk. Used for checkpoints.
+        """
+        for buf in self.buffers.values():
+            self.__flush(buf)
+        self.queue.join()
+        self.__check_error()
+        self.f.flush()
+
+    def close(self):
+        """
+        Writes the remaining rows and waits for all the writes to finish.
+        """
+        if not self.thread.is_alive():
+            return
+        try:
+            for buf in self.buffers.values():
+                self.__flush(buf)
+        finally:
+            self.queue.put(None)
+            self.thread.join()
+        for buf in self.buffers.values():
+            # datasets with no rows
+            if buf.dataset.shape[0] != buf.flushed:
+                buf.dataset.resize((buf.flushed, *buf.shape))
+        self.__check_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,355 @@
+"""
+Incremental updates of stage outputs, driven by a content-hash manifest.
+
+With update, a stage keeps a manifest of its inputs in its output, in the
+"manifest" group:
+
+    index       one entry per version of an input: its key (a pdb name), the
+                hash of its content, the range [start, stop) of the rows of
+                the output it produced, and whether it is a tombstone
+    params      attribute, the parameters of the stage, as JSON
+
+A run against an output that has a manifest only processes the inputs that
+were added or whose hash changed, and appends their rows. The entries of
+removed and changed inputs become tombstones: their rows stay in the output,
+but are not live anymore. The preprocessors only read the live rows of an
+input that has a manifest, see `get_live_rows`, so downstream stages ignore
+the rows of tombstones. Other readers of the outputs of structural info and
+neighborhoods must do the same. The zernikegram stages are the last ones, and
+remove the rows of tombstones after each update, see
+`IncrementalUpdate.compact`, so that all the rows of their outputs are live.
+
+Structural info hashes the contents of the pdb files. The other stages use
+the hashes of the manifest of their input, so that they only process the
+proteins that changed upstream.
+"""
+
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import *
+
+import h5py
+import numpy as np
+
+from zernikegrams.utils import log_config as logging
+from zernikegrams.utils.checkpoints import replace_dataset
+from zernikegrams.utils.hdf5_writer import BufferedHDF5Writer
+
+logger = logging.getLogger(__name__)
+
+MANIFEST = "manifest"
+HASH_DT = np.dtype("S32")
+# rows copied at once when compacting
+COMPACT_ROWS = 1 << 14
+
+
+def get_entry_dtype(key_length: int) -> np.dtype:
+    return np.dtype(
+        [
+            ("key", f"S{key_length}"),
+            ("hash", HASH_DT),
+            ("start", "<i8"),
+            ("stop", "<i8"),
+            ("tombstone", "?"),
+        ]
+    )
+
+
+def hash_bytes(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def hash_file(path: str) -> str:
+    with open(path, "rb") as f:
+        return hash_bytes(f.read())
+
+
+def hash_files(paths: Sequence[str], parallelism: int = 4) -> List[str]:
+    """Content hashes of files, read in parallel threads"""
+    with ThreadPoolExecutor(max(1, parallelism)) as executor:
+        return list(executor.map(hash_file, paths))
+
+
+def _key(key: Union[str, bytes]) -> str:
+    return key.decode("utf-8") if isinstance(key, bytes) else str(key)
+
+
+def get_live_rows(f: h5py.File) -> Optional[np.ndarray]:
+    """
+    Sorted rows of the output in f that belong to inputs that are not
+    tombstones, or None if f has no manifest
+    """
+    if MANIFEST not in f:
+        return None
+    entries = f[MANIFEST]["index"][:]
+    entries = entries[~entries["tombstone"]]
+    if entries.shape[0] == 0:
+        return np.zeros(0, dtype=np.int64)
+    return np.sort(
+        np.concatenate(
+            [np.arange(start, stop) for start, stop in zip(entries["start"], entries["stop"])]
+        )
+    )
+
+
+def get_live_hashes(f: h5py.File) -> Optional[Dict[str, str]]:
+    """Hashes of the inputs of the output in f that are not tombstones"""
+    if MANIFEST not in f:
+        return None
+    entries = f[MANIFEST]["index"][:]
+    entries = entries[~entries["tombstone"]]
+    return {_key(key): _key(h) for key, h in zip(entries["key"], entries["hash"])}
+
+
+class IncrementalUpdate:
+    """
+    Manifest of a stage writing hdf5_out, see the module docstring. Without
+    update, the output is written from scratch and has no manifest.
+
+    Parameters
+    ----------
+    hdf5_out : str
+        Output of the stage
+    params : dict
+        Parameters of the stage that the output depends on
+    key_dataset : str
+        Dataset of the output whose rows are tracked by the manifest, e.g.
+        "data" or "nh_list"
+    update : bool
+        Whether to keep a manifest, and to update hdf5_out if it exists
+    """
+
+    def __init__(
+        self,
+        hdf5_out: str,
+        params: Dict[str, Any],
+        key_dataset: str,
+        update: bool = False,
+    ):
+        self.hdf5_out = hdf5_out
+        self.params = json.loads(json.dumps(params, default=str))
+        self.key_dataset = key_dataset
+        self.enabled = update
+        self.entries = None
+        self.rows = None
+        self.hashes: Dict[str, str] = {}
+        self.to_process: Optional[Set[str]] = None
+        self.keys: List[np.ndarray] = []
+        self.name_length = 1
+
+        if not (update and os.path.exists(hdf5_out)):
+            return
+        with h5py.File(hdf5_out, "r") as f:
+            if MANIFEST not in f:
+                raise ValueError(
+                    f"{hdf5_out} has no manifest, as it was not written with "
+                    f"update, and cannot be updated"
+                )
+            params = json.loads(f[MANIFEST].attrs["params"])
+            if params != self.params:
+                raise ValueError(
+                    f"{hdf5_out} was written with other parameters, {params}, "
+                    f"and cannot be updated"
+                )
+            self.entries = f[MANIFEST]["index"][:]
+            # rows to append to
+            self.rows = {}
+            f.visititems(
+                lambda name, obj: self.rows.__setitem__(name, obj.shape[0])
+                if isinstance(obj, h5py.Dataset) and obj.ndim > 0
+                else None
+            )
+
+    @property
+    def updating(self) -> bool:
+        return self.entries is not None
+
+    @property
+    def key_length(self) -> int:
+        """Length of the keys of the existing manifest"""
+        return self.entries.dtype["key"].itemsize
+
+    def get_name_length(self, name_length: int) -> int:
+        """
+        Length of the pdb names in the rows of the output, which cannot change
+        when updating
+        """
+        if not self.updating:
+            self.name_length = name_length
+            return name_length
+        if name_length > self.key_length:
+            raise ValueError(
+                f"Cannot update {self.hdf5_out}: it has pdb names of up to "
+                f"{self.key_length} characters, and the new inputs have names of "
+                f"{name_length} characters"
+            )
+        self.name_length = self.key_length
+        return self.key_length
+
+    def plan(self, hashes: Dict[Union[str, bytes], str]):
+        """
+        Compares the hashes of the inputs with the manifest, to only process
+        the inputs that were added or changed. The entries of the inputs that
+        were removed or changed become tombstones.
+        """
+        if not self.enabled:
+            return
+        self.hashes = {_key(key): h for key, h in hashes.items()}
+        if not self.updating:
+            self.to_process = set(self.hashes)
+            return
+
+        live = ~self.entries["tombstone"]
+        live_hashes = {
+            _key(key): _key(h)
+            for key, h in zip(self.entries["key"][live], self.entries["hash"][live])
+        }
+        self.to_process = {
+            key for key, h in self.hashes.items() if live_hashes.get(key) != h
+        }
+        removed = set(live_hashes) - set(self.hashes)
+        added = self.to_process - set(live_hashes)
+        stale = removed | (self.to_process - added)
+        self.entries["tombstone"][
+            live & np.isin(self.entries["key"], [key.encode("utf-8") for key in stale])
+        ] = True
+        logger.info(
+            f"Updating {self.hdf5_out}: {len(added)} inputs added, "
+            f"{len(self.to_process) - len(added)} changed, {len(removed)} removed, "
+            f"{len(self.hashes) - len(self.to_process)} unchanged"
+        )
+
+    def is_skipped(self, key: Union[str, bytes]) -> bool:
+        """Whether input key is unchanged since the last run, or removed"""
+        return self.to_process is not None and _key(key) not in self.to_process
+
+    def is_kept(self, key: Union[str, bytes]) -> bool:
+        """Whether the rows of input key written by earlier runs are live"""
+        key = _key(key)
+        return self.updating and key in self.hashes and key not in self.to_process
+
+    def read_kept(self, name: str) -> List[bytes]:
+        """
+        Pdb names of dataset name of the output, e.g. "pdbs_pass", that are
+        kept by the update, see `is_kept`
+        """
+        if not self.updating:
+            return []
+        with h5py.File(self.hdf5_out, "r") as f:
+            if name not in f:
+                return []
+            return [pdb for pdb in f[name][:] if self.is_kept(pdb)]
+
+    def open(self) -> h5py.File:
+        """Output file, to append to when updating"""
+        return h5py.File(self.hdf5_out, "r+" if self.updating else "w")
+
+    def writer(self, f: h5py.File) -> BufferedHDF5Writer:
+        """Writer of the output, appending to the existing rows when updating"""
+        return BufferedHDF5Writer(f, resume_rows=self.rows)
+
+    def append(self, keys: Union[np.ndarray, Sequence]):
+        """
+        Records the keys of the rows appended to the key dataset, in the
+        order they were appended
+        """
+        if not self.enabled:
+            return
+        keys = np.asarray(keys).reshape(-1)
+        if keys.dtype.kind == "U":
+            keys = np.char.encode(keys, "utf-8")
+        self.keys.append(keys)
+
+    def write(self, f: h5py.File):
+        """
+        Writes the manifest, with entries for the rows appended, and empty
+        entries for the inputs processed that have no rows
+        """
+        if not self.enabled:
+            return
+        start = 0 if self.rows is None else self.rows.get(self.key_dataset, 0)
+        keys = np.concatenate(self.keys) if self.keys else np.zeros(0, dtype="S1")
+        key_length = max(
+            [keys.dtype.itemsize, self.name_length]
+            + ([self.key_length] if self.updating else [])
+            + [len(key.encode("utf-8")) for key in self.to_process]
+        )
+        dt = get_entry_dtype(key_length)
+
+        # runs of rows of the same key
+        bounds = np.flatnonzero(keys[1:] != keys[:-1]) + 1
+        starts = np.concatenate([[0], bounds]) if keys.shape[0] else np.zeros(0, dtype=int)
+        stops = np.concatenate([bounds, [keys.shape[0]]]) if keys.shape[0] else starts
+        new_entries = [
+            (keys[i], self.hashes[_key(keys[i])], start + i, start + j, False)
+            for i, j in zip(starts, stops)
+        ]
+        with_rows = {_key(key) for key in keys[starts]}
+        new_entries.extend(
+            (key.encode("utf-8"), self.hashes[key], 0, 0, False)
+            for key in sorted(self.to_process - with_rows)
+        )
+
+        entries = np.array(new_entries, dtype=dt)
+        if self.updating:
+            entries = np.concatenate([self.entries.astype(dt), entries])
+        group = f.require_group(MANIFEST)
+        group.attrs["params"] = json.dumps(self.params)
+        replace_dataset(group, "index", data=entries)
+
+    def compact(self, names: Sequence[str]):
+        """
+        Removes the rows of tombstones from datasets names of the output,
+        which must have one row per row of the key dataset, and the
+        tombstones from the manifest. Called after the output is written and
+        closed.
+        """
+        if not self.enabled:
+            return
+        with h5py.File(self.hdf5_out, "r+") as f:
+            entries = f[MANIFEST]["index"][:]
+            if not entries["tombstone"].any():
+                return
+            entries = entries[~entries["tombstone"]]
+
+            # entries of the same rows in the new output, in the order of the rows
+            order = np.argsort(entries["start"], kind="stable")
+            lengths = entries["stop"][order] - entries["start"][order]
+            starts = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+            compacted = entries.copy()
+            compacted["start"][order] = np.where(lengths > 0, starts, 0)
+            compacted["stop"][order] = np.where(lengths > 0, starts + lengths, 0)
+
+            # runs of consecutive live rows
+            runs = []
+            for start, stop in zip(entries["start"][order], entries["stop"][order]):
+                if stop == start:
+                    continue
+                if runs and runs[-1][1] == start:
+                    runs[-1][1] = stop
+                else:
+                    runs.append([start, stop])
+
+            with BufferedHDF5Writer(f) as writer:
+                for name in names:
+                    dataset = f[name]
+                    writer.create_dataset(
+                        f"{name}_compact",
+                        dataset.dtype,
+                        dataset.shape[1:],
+                        chunk_rows=dataset.chunks[0],
+                    )
+                    for start, stop in runs:
+                        for i in range(start, stop, COMPACT_ROWS):
+                            writer.append(
+                                f"{name}_compact", dataset[i : min(i + COMPACT_ROWS, stop)]
+                            )
+            for name in names:
+                del f[name]
+                f.move(f"{name}_compact", name)
+            replace_dataset(f[MANIFEST], "index", data=compacted)
+            logger.info(
+                f"Compacted {self.hdf5_out}: {int(lengths.sum())} live rows kept"
+            )
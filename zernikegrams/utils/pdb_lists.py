@@ -2,13 +2,16 @@ import os
 
 from typing import List
 
+from zernikegrams.preprocessors.archives import get_structure_sources
+
 
 def pdb_list_from_dir(pdb_dir: str) -> List[str]:
     """
-    Create a list of pdb files from a give directory
+    Create a list of pdb files from a give directory: its .pdb and .cif files,
+    plain or gzipped, and the members of its .tar and .zip shards, see
+    `zernikegrams.preprocessors.archives`
     """
-    x = [f.removesuffix(".pdb") for f in os.listdir(pdb_dir) if f.endswith(".pdb")]
-    return x
+    return list(get_structure_sources(pdb_dir))
 
 
 def pdb_list_from_foldcomp(foldcomp: str) -> List[str]:
@@ -0,0 +1,153 @@
+"""
+Selection of the residues that should be the center of a neighborhood.
+
+A selection file has one entry per line, with whitespace-separated columns:
+
+    pdb [chain [resnums]]
+
+where chain can be "*" to select all chains, and resnums is a comma-separated
+list of residue numbers and inclusive ranges, e.g. "10-20,35". Omitted columns
+select everything. Lines starting with "#" are ignored. Example:
+
+    1abc                # all residues of 1abc
+    2def A              # all residues of chain A of 2def
+    2def B 10-20,35     # residues 10 to 20 and 35 of chain B of 2def
+"""
+
+from typing import *
+
+import numpy as np
+
+
+def pack_res_ids(res_ids: np.ndarray, itemsize: int) -> List[bytes]:
+    """
+    Packs every [6] residue id into a single bytes key, so that residue ids can
+    be compared with hash lookups rather than field by field. Residue ids packed
+    with the same itemsize can be compared.
+    """
+    res_ids = np.ascontiguousarray(res_ids, dtype=f"S{itemsize}").reshape(-1, 6)
+    return res_ids.view(np.dtype((np.void, itemsize * 6))).reshape(-1).tolist()
+
+
+def select_res_ids(res_ids: np.ndarray, res_ids_selection: np.ndarray) -> np.ndarray:
+    """
+    Mask of the residue ids that are in res_ids_selection, as a hash join on
+    the packed residue ids.
+
+    Parameters
+    ----------
+    res_ids : np.ndarray
+        Residue ids, shape [N, 6]
+    res_ids_selection : np.ndarray
+        Residue ids to select, shape [S, 6]
+
+    Returns
+    -------
+    np.ndarray of bool, shape [N]
+    """
+    itemsize = max(res_ids.dtype.itemsize, res_ids_selection.dtype.itemsize)
+    selection = set(pack_res_ids(res_ids_selection, itemsize))
+    return np.array(
+        [key in selection for key in pack_res_ids(res_ids, itemsize)], dtype=bool
+    )
+
+
+def parse_resnums(astr: str) -> List[Tuple[int, int]]:
+    """Parses "10-20,35" into [(10, 20), (35, 35)]"""
+    ranges = []
+    for item in astr.split(","):
+        # the first character can be the sign of a negative residue number
+        start, sep, end = item[1:].partition("-")
+        start = item[0] + start
+        ranges.append((int(start), int(end) if sep else int(start)))
+    return ranges
+
+
+class ResidueSelection:
+    """
+    Declarative selection of residues, by pdb, chain and residue number ranges.
+
+    The pdbs of the selection are known without loading any protein, so that
+    whole proteins can be skipped upfront.
+    """
+
+    def __init__(self):
+        # pdb -> None to select all chains, or chain -> None to select all
+        # residues or list of inclusive residue number ranges
+        self.__selection = {}
+
+    @classmethod
+    def from_file(cls, path: str) -> "ResidueSelection":
+        selection = cls()
+        with open(path, "r") as f:
+            for line in f:
+                line = line.split("#")[0].split()
+                if len(line) == 0:
+                    continue
+                if len(line) > 3:
+                    raise ValueError(f"Cannot parse residue selection line: {line}")
+                selection.add(*line)
+        return selection
+
+    def add(self, pdb: str, chain: Optional[str] = None, resnums: Optional[str] = None):
+        pdb = pdb.encode("utf-8")
+        if chain is None or chain == "*":
+            if resnums is not None:
+                raise ValueError("Residue numbers require a chain")
+            self.__selection[pdb] = None
+            return
+
+        chains = self.__selection.setdefault(pdb, {})
+        if chains is None:
+            return  # all chains are already selected
+        chain = chain.encode("utf-8")
+        if resnums is None:
+            chains[chain] = None
+        elif chains.get(chain, []) is not None:
+            chains.setdefault(chain, []).extend(parse_resnums(resnums))
+
+    @property
+    def pdbs(self) -> Set[bytes]:
+        return set(self.__selection.keys())
+
+    def __contains__(self, pdb: Union[str, bytes]) -> bool:
+        if isinstance(pdb, str):
+            pdb = pdb.encode("utf-8")
+        return pdb in self.__selection
+
+    def select(self, res_ids: np.ndarray) -> np.ndarray:
+        """
+        Mask of the selected residue ids.
+
+        Parameters
+        ----------
+        res_ids : np.ndarray
+            Residue ids, shape [N, 6]
+
+        Returns
+        -------
+        np.ndarray of bool, shape [N]
+        """
+        mask = np.zeros(res_ids.shape[0], dtype=bool)
+        for pdb in np.unique(res_ids[:, 1]):
+            if pdb not in self.__selection:
+                continue
+            pdb_locs = res_ids[:, 1] == pdb
+            chains = self.__selection[pdb]
+            if chains is None:
+                mask |= pdb_locs
+                continue
+
+            for chain, ranges in chains.items():
+                locs = np.logical_and(pdb_locs, res_ids[:, 2] == chain)
+                if ranges is not None and np.any(locs):
+                    resnums = res_ids[locs, 3].astype(int)
+                    in_ranges = np.logical_or.reduce(
+                        [
+                            np.logical_and(resnums >= start, resnums <= end)
+                            for start, end in ranges
+                        ]
+                    )
+                    locs[locs] = in_ranges
+                mask |= locs
+        return mask